@@ -0,0 +1,117 @@
+"""Lock contention micro-benchmark: single-lock LRUCache vs ShardedLRUCache.
+
+Each thread does a fixed number of cache hits (plus an occasional set) on
+one shared cache. Prints total cache ops/sec per thread count.
+
+    python bench_cache_contention.py --threads 1 2 4 8 16 32 64
+"""
+
+from argparse import ArgumentParser
+import random
+import threading
+import time
+
+from threaded_proxy import LRUCache, ShardedLRUCache
+
+
+def run(cache, keys, num_threads, ops_per_thread, set_ratio):
+    """Hammers cache from num_threads threads
+        :returns: total ops/sec across all threads
+    """
+
+    start_gate = threading.Event()
+
+    def worker(seed):
+        rand = random.Random(seed)
+        picks = [rand.choice(keys) for _ in xrange(1024)]
+        start_gate.wait()
+        for i in xrange(ops_per_thread):
+            key = picks[i & 1023]
+            if rand.random() < set_ratio:
+                cache.set(key, key)
+            else:
+                cache.get(key)
+
+    threads = [threading.Thread(target=worker, args=(i,)) for i in xrange(num_threads)]
+    for thread in threads:
+        thread.start()
+    start = time.time()
+    start_gate.set()
+    for thread in threads:
+        thread.join()
+    return num_threads * ops_per_thread / (time.time() - start)
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--threads',
+        type=int,
+        nargs='+',
+        dest='threads',
+        default=[1, 2, 4, 8, 16, 32, 64],
+        action='store',
+        required=False,
+        help='Enter thread counts to benchmark',
+    )
+
+    parser.add_argument(
+        '--ops',
+        type=int,
+        dest='ops',
+        default=20000,
+        action='store',
+        required=False,
+        help='Enter # of cache ops per thread',
+    )
+
+    parser.add_argument(
+        '--keys',
+        type=int,
+        dest='keys',
+        default=10000,
+        action='store',
+        required=False,
+        help='Enter # of distinct keys (all of them fit in the cache)',
+    )
+
+    parser.add_argument(
+        '--shards',
+        type=int,
+        dest='shards',
+        default=16,
+        action='store',
+        required=False,
+        help='Enter # of shards for ShardedLRUCache',
+    )
+
+    parser.add_argument(
+        '--set-ratio',
+        type=float,
+        dest='set_ratio',
+        default=0.01,
+        action='store',
+        required=False,
+        help='Enter fraction of ops that are sets',
+    )
+
+    args = parser.parse_args()
+
+    keys = ["key:%s" % i for i in xrange(args.keys)]
+    print "%8s %18s %18s %8s" % ("threads", "LRUCache ops/s", "Sharded ops/s", "speedup")
+    for num_threads in args.threads:
+        results = []
+        for cache in (
+            LRUCache(capacity=args.keys, ttl=86400),
+            ShardedLRUCache(capacity=args.keys, ttl=86400, shards=args.shards),
+        ):
+            for key in keys:
+                cache.set(key, key)
+            results.append(run(cache, keys, num_threads, args.ops, args.set_ratio))
+        print "%8d %18.0f %18.0f %7.2fx" % (
+            num_threads,
+            results[0],
+            results[1],
+            results[1] / results[0],
+        )
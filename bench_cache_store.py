@@ -0,0 +1,140 @@
+"""Cache store micro-benchmark: LRUCache vs CompactLRUCache.
+
+For each store, fills a cache with --keys entries & reports the memory each
+entry takes besides its key & value (the growth of the process's resident
+set, measured in a forked child so stores don't reuse each other's freed
+memory), then times a hit, a miss & a set that evicts, in us per op.
+
+    python bench_cache_store.py --keys 100000
+"""
+
+from argparse import ArgumentParser
+import os
+import random
+
+from bench_metrics import per_op
+from compactcache import CompactLRUCache
+import proxy
+import threaded_proxy
+
+
+STORES = (
+    ("LRUCache (threaded)", threaded_proxy.LRUCache),
+    ("LRUCache (select)", proxy.LRUCache),
+    ("CompactLRUCache", CompactLRUCache),
+)
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def resident_bytes():
+    with open('/proc/self/statm') as f:
+        return int(f.read().split()[1]) * PAGE_SIZE
+
+
+def bytes_per_entry(cache_cls, keys, vals):
+    """Fills a cache_cls in a child process
+        :returns: growth of the child's resident set per entry
+    """
+
+    read_end, write_end = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read_end)
+        cache = cache_cls(capacity=len(keys), ttl=86400)
+        before = resident_bytes()
+        for key, val in zip(keys, vals):
+            cache.set(key, val)
+        os.write(write_end, str(resident_bytes() - before))
+        os._exit(0)
+    os.close(write_end)
+    grown = int(os.read(read_end, 64))
+    os.close(read_end)
+    os.waitpid(pid, 0)
+    return grown / float(len(keys))
+
+
+def hits(cache, picks, ops):
+    lookup = cache.lookup
+    for i in xrange(ops):
+        lookup(picks[i & 1023])
+
+
+def sets(cache, keys, ops):
+    # Keys the cache doesn't hold, so each set evicts the oldest entry
+    for i in xrange(ops):
+        cache.set(keys[i % len(keys)], "v")
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--keys',
+        type=int,
+        dest='keys',
+        default=100000,
+        action='store',
+        required=False,
+        help='Enter # of entries in each cache',
+    )
+
+    parser.add_argument(
+        '--value-size',
+        type=int,
+        dest='value_size',
+        default=100,
+        action='store',
+        required=False,
+        help='Enter size (in bytes) of each value',
+    )
+
+    parser.add_argument(
+        '--ops',
+        type=int,
+        dest='ops',
+        default=200000,
+        action='store',
+        required=False,
+        help='Enter # of cache ops per run',
+    )
+
+    parser.add_argument(
+        '--repeat',
+        type=int,
+        dest='repeat',
+        default=5,
+        action='store',
+        required=False,
+        help='Enter # of runs to take the best of',
+    )
+
+    args = parser.parse_args()
+
+    keys = ["key:%s" % i for i in xrange(args.keys)]
+    # Distinct values, so they're allocated like ones read off a socket
+    vals = ["%0*d" % (args.value_size, i) for i in xrange(args.keys)]
+    new_keys = ["new:%s" % i for i in xrange(args.keys)]
+    rand = random.Random(0)
+    picks = [rand.choice(keys) for _ in xrange(1024)]
+    missing = ["missing:%s" % i for i in xrange(1024)]
+
+    memory = [bytes_per_entry(cache_cls, keys, vals) for name, cache_cls in STORES]
+    caches = []
+    for name, cache_cls in STORES:
+        cache = cache_cls(capacity=args.keys, ttl=86400)
+        for key, val in zip(keys, vals):
+            cache.set(key, val)
+        caches.append(cache)
+    hit_times = per_op([lambda cache=cache: hits(cache, picks, args.ops) for cache in caches], args.ops, args.repeat)
+    miss_times = per_op([lambda cache=cache: hits(cache, missing, args.ops) for cache in caches], args.ops, args.repeat)
+    set_times = per_op([lambda cache=cache: sets(cache, new_keys, args.ops) for cache in caches], args.ops, args.repeat)
+
+    print "%-22s %12s %10s %10s %10s" % ("store", "bytes/entry", "hit", "miss", "set")
+    for i, (name, cache_cls) in enumerate(STORES):
+        print "%-22s %12.0f %7.3f us %7.3f us %7.3f us" % (
+            name,
+            memory[i],
+            hit_times[i],
+            miss_times[i],
+            set_times[i],
+        )
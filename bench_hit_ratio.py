@@ -0,0 +1,131 @@
+"""Hit ratio of each eviction policy on a synthetic or recorded key trace.
+
+Each key in the trace is read from the cache, and set on a miss, the way the
+proxy does with values from Redis. Prints the hit ratio per policy.
+
+    python bench_hit_ratio.py --capacity 500
+    python bench_hit_ratio.py --trace keys.log --capacity 10000
+
+A recorded trace is a file with one key per line, e.g. the keys of the GETs
+in a `redis-cli monitor` capture.
+"""
+
+from argparse import ArgumentParser
+import bisect
+import random
+
+from eviction import POLICIES
+from proxy import LRUCache
+
+
+def zipf_trace(num_keys, length, skew=0.9, seed=0):
+    """Keys drawn from a Zipfian distribution: key:1 is the most popular
+        :param num_keys (int): # of distinct keys
+        :param length (int): # of accesses
+        :param skew (float): Zipf exponent; higher is more skewed
+    """
+
+    rand = random.Random(seed)
+    cdf = []
+    total = 0.0
+    for rank in xrange(1, num_keys + 1):
+        total += 1.0 / rank ** skew
+        cdf.append(total)
+    return [
+        "key:%d" % (bisect.bisect(cdf, rand.random() * total) + 1)
+        for _ in xrange(length)
+    ]
+
+
+def scan_trace(hot_keys, scan_length, rounds, reads_per_round=500, seed=0):
+    """Random reads of a small hot set, each round followed by a scan of
+        scan_length keys that are never read again
+    """
+
+    rand = random.Random(seed)
+    trace = []
+    for round_num in xrange(rounds):
+        trace.extend("hot:%d" % rand.randrange(hot_keys) for _ in xrange(reads_per_round))
+        trace.extend("scan:%d:%d" % (round_num, i) for i in xrange(scan_length))
+    return trace
+
+
+def load_trace(path):
+    with open(path) as trace_file:
+        return [line.strip() for line in trace_file if line.strip()]
+
+
+def hit_ratio(policy, trace, capacity):
+    """Replays trace against an LRUCache with the given eviction policy
+        :returns: fraction of reads that were cache hits
+    """
+
+    cache = LRUCache(capacity, ttl=86400, policy=policy)
+    hits = 0
+    for key in trace:
+        if cache.get(key) is None:
+            cache.set(key, key)
+        else:
+            hits += 1
+    return hits / float(len(trace))
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--trace',
+        type=str,
+        dest='trace',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter path of a recorded trace, one key per line (Defaults to synthetic traces)',
+    )
+
+    parser.add_argument(
+        '--capacity',
+        type=int,
+        dest='capacity',
+        default=500,
+        action='store',
+        required=False,
+        help='Enter max. # of cache keys',
+    )
+
+    parser.add_argument(
+        '--keys',
+        type=int,
+        dest='keys',
+        default=10000,
+        action='store',
+        required=False,
+        help='Enter # of distinct keys in the synthetic Zipf trace',
+    )
+
+    parser.add_argument(
+        '--length',
+        type=int,
+        dest='length',
+        default=100000,
+        action='store',
+        required=False,
+        help='Enter # of accesses in the synthetic Zipf trace',
+    )
+
+    args = parser.parse_args()
+
+    if args.trace:
+        traces = [(args.trace, load_trace(args.trace))]
+    else:
+        zipf = zipf_trace(args.keys, args.length)
+        traces = [
+            ("zipf", zipf),
+            ("zipf + scan", zipf[:len(zipf) // 2] + ["scan:%d" % i for i in xrange(args.capacity * 10)] + zipf[len(zipf) // 2:]),
+            ("hot set + scans", scan_trace(args.capacity // 2, args.capacity * 2, 20)),
+        ]
+
+    policies = sorted(POLICIES)
+    print "%-20s" % "trace" + "".join("%10s" % name for name in policies)
+    for name, trace in traces:
+        print "%-20s" % name + "".join("%10.3f" % hit_ratio(policy, trace, args.capacity) for policy in policies)
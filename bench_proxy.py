@@ -0,0 +1,742 @@
+"""End-to-end load benchmark of the proxy engines against a stand-in Redis.
+
+Starts a fake Redis in this process (it speaks enough RESP for the proxies:
+GET, MGET, PTTL & PING, with optional added latency per round trip, plus
+SET, DEL & FLUSHALL, announced to CLIENT TRACKING & keyspace notification
+subscribers, for tests of invalidation), then for
+each engine: starts the proxy pointed at it, drives it from many client
+connections for a while, stops it, and reports as JSON:
+
+    throughput (requests/sec), latency percentiles (p50/p99/p999, in us),
+    hit ratio (the share of requested keys the fake Redis wasn't asked for)
+    and the proxy's CPU time per request (from /proc, so Linux only)
+
+Results carry the git commit they were run on, so runs can be compared
+across commits:
+
+    python bench_proxy.py --engine select eventloop threaded --output before.json
+    python bench_proxy.py --distribution scan --pipeline 16 --redis-latency 0.5
+    python bench_proxy.py --proxy-cmd "python my_proxy.py" --proxy-args "--capacity 5000"
+
+Any proxy can be benchmarked with --proxy-cmd, as long as it listens on
+--proxy-port & takes `--backend host:port`, which is appended to its command.
+"""
+
+from argparse import ArgumentParser
+from collections import OrderedDict
+import json
+import os
+import random
+import shlex
+import signal
+import socket
+import SocketServer
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from bench_hit_ratio import zipf_trace
+from metrics import clock, Histogram
+from invalidation import KEYSPACE_PREFIX, TRACKING_CHANNEL
+from resp import (
+    encode_command,
+    encode_error,
+    encode_reply,
+    encode_value,
+    encode_values,
+    IntegerReply,
+    parse_redis_reply,
+    ProtocolError,
+    RedisError,
+    RequestParser,
+)
+
+
+ENGINES = OrderedDict([
+    ('select', ['proxy.py', '--engine', 'select']),
+    ('eventloop', ['proxy.py', '--engine', 'eventloop']),
+    ('threaded', ['threaded_proxy.py']),
+])
+DISTRIBUTIONS = ('uniform', 'zipf', 'scan')
+# Keys each client connection cycles through
+TRACE_LENGTH = 100000
+RECV_SIZE = 65536
+# Key no benchmark run asks for: its nil reply marks the end of the greeting
+# the proxies send on connect
+HANDSHAKE_KEY = "bench:handshake"
+STARTUP_TIMEOUT = 10.0
+SHUTDOWN_TIMEOUT = 5.0
+
+
+class FakeRedisHandler(SocketServer.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        with server.lock:
+            server.last_client_id += 1
+            self.client_id = server.last_client_id
+        try:
+            self._serve()
+        finally:
+            with server.lock:
+                server.subscribers = [sub for sub in server.subscribers if sub[0] is not self.request]
+
+    def _serve(self):
+        server = self.server
+        parser = RequestParser()
+        while True:
+            data = self.request.recv(RECV_SIZE)
+            if not data:
+                return
+            try:
+                commands = parser.feed(data)
+            except ProtocolError, e:
+                self.request.sendall(encode_error("Protocol error: %s" % e))
+                return
+            if not commands:
+                continue
+            replies = []
+            fetched = 0
+            for args, inline in commands:
+                name = args[0].upper()
+                if name == "GET" and len(args) == 2:
+                    replies.append(encode_value(args[1], server.data.get(args[1])))
+                    fetched += 1
+                elif name == "MGET" and len(args) > 1:
+                    replies.append(encode_values(args[1:], [server.data.get(key) for key in args[1:]]))
+                    fetched += len(args) - 1
+                elif name == "PTTL" and len(args) == 2:
+                    if args[1] not in server.data:
+                        replies.append(":-2\r\n")
+                    else:
+                        replies.append(":%d\r\n" % server.ttls.get(args[1], -1))
+                elif name == "PING":
+                    replies.append("+PONG\r\n")
+                elif name == "SET" and len(args) == 3:
+                    server.data[args[1]] = args[2]
+                    server.ttls.pop(args[1], None)
+                    server.publish([args[1]], "set")
+                    replies.append("+OK\r\n")
+                elif name == "DEL" and len(args) > 1:
+                    deleted = [key for key in args[1:] if server.data.pop(key, None) is not None]
+                    for key in deleted:
+                        server.ttls.pop(key, None)
+                    server.publish(deleted, "del")
+                    replies.append(":%d\r\n" % len(deleted))
+                elif name == "FLUSHALL":
+                    server.data.clear()
+                    server.ttls.clear()
+                    server.publish(None, None)
+                    replies.append("+OK\r\n")
+                elif name == "CLIENT" and args[1:] == ["ID"]:
+                    replies.append(":%d\r\n" % self.client_id)
+                elif name == "CLIENT" and args[1:3] == ["TRACKING", "ON"]:
+                    redirect = int(args[args.index("REDIRECT") + 1])
+                    prefixes = [args[i + 1] for i, arg in enumerate(args) if arg == "PREFIX"]
+                    with server.lock:
+                        server.tracking[redirect] = prefixes
+                    replies.append("+OK\r\n")
+                elif name == "CONFIG" and args[1:] == ["GET", "notify-keyspace-events"]:
+                    replies.append(encode_reply(["notify-keyspace-events", server.keyspace_events]))
+                elif name in ("SUBSCRIBE", "PSUBSCRIBE") and len(args) == 2:
+                    # Confirmed before the subscriber can be sent anything
+                    with server.lock:
+                        self.request.sendall("".join(replies) + encode_reply([name.lower(), args[1], IntegerReply(1)]))
+                        replies = []
+                        if name == "SUBSCRIBE":
+                            server.subscribers.append((self.request, 'tracking', server.tracking.get(self.client_id)))
+                        else:
+                            server.subscribers.append((self.request, 'keyspace', args[1]))
+                else:
+                    replies.append(encode_error("unknown command '%s'" % args[0]))
+            with server.lock:
+                server.fetched += fetched
+            # One delay per read, like a network round trip: a pipelined
+            # batch pays it once
+            if server.latency:
+                time.sleep(server.latency)
+            if replies:
+                self.request.sendall("".join(replies))
+
+
+class FakeRedis(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """Stand-in Redis holding key:1 ... key:N, served from a background
+    thread. Counts the keys it's asked for, so the proxy's hit ratio can be
+    worked out from outside it.
+    """
+
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, data, latency=0.0, address=('127.0.0.1', 0)):
+        """
+            :param data (dict): key -> value
+            :param latency (float): seconds added to every round trip
+            :param address (tuple): (host, port) to listen on; port 0 picks
+                a free one
+        """
+
+        SocketServer.TCPServer.__init__(self, address, FakeRedisHandler)
+        self.data = data
+        # Key -> ms PTTL reports it has left, for keys that expire (they
+        # aren't actually expired)
+        self.ttls = {}
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.fetched = 0
+        self.last_client_id = 0
+        # Client id -> key prefixes tracked for it ([] for all keys)
+        self.tracking = {}
+        # (socket, 'tracking' or 'keyspace', prefixes or pattern)
+        self.subscribers = []
+        self.keyspace_events = "KA"
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+    def publish(self, keys, event):
+        """Announces changed keys to subscribers, as Redis would
+            :param keys (list): None for a flush of every key
+            :param event (str): keyspace event, e.g. "set"
+        """
+
+        with self.lock:
+            for sock, mode, arg in self.subscribers:
+                if mode == 'tracking':
+                    if keys is None:
+                        message = encode_reply(["message", TRACKING_CHANNEL, None])
+                    else:
+                        tracked = [key for key in keys if not arg or key.startswith(tuple(arg))]
+                        if not tracked:
+                            continue
+                        message = encode_reply(["message", TRACKING_CHANNEL, tracked])
+                elif keys is not None:
+                    message = "".join(
+                        encode_reply(["pmessage", arg, KEYSPACE_PREFIX + key, event]) for key in keys
+                    )
+                else:
+                    continue
+                try:
+                    sock.sendall(message)
+                except socket.error:
+                    pass
+
+    def disconnect_subscribers(self):
+        """Drops every subscriber's connection, as if Redis restarted"""
+
+        with self.lock:
+            for sock, mode, arg in self.subscribers:
+                sock.shutdown(socket.SHUT_RDWR)
+            self.subscribers = []
+
+
+def parse_sizes(spec):
+    """Parses --value-size: "N" bytes, or "MIN-MAX" for sizes picked at
+        random in that range
+        :returns: (min, max) tuple
+    """
+
+    low, sep, high = spec.partition('-')
+    if not sep:
+        return int(low), int(low)
+    return int(low), int(high)
+
+
+def make_data(num_keys, value_size, seed=0):
+    """key:1 ... key:num_keys, with values value_size = (min, max) bytes"""
+
+    rand = random.Random(seed)
+    low, high = value_size
+    return dict(
+        ("key:%d" % i, "v" * rand.randint(low, high))
+        for i in xrange(1, num_keys + 1)
+    )
+
+
+def key_trace(distribution, num_keys, conn_index, num_conns, skew=0.9, seed=0):
+    """Keys one client connection asks for, in order
+        :param distribution (str): uniform, zipf (key:1 is the most
+            popular) or scan (every key in turn, each connection starting
+            at its own offset)
+    """
+
+    seed = seed * 1000003 + conn_index
+    if distribution == 'zipf':
+        return zipf_trace(num_keys, TRACE_LENGTH, skew, seed)
+    if distribution == 'scan':
+        start = conn_index * num_keys // num_conns
+        return ["key:%d" % ((start + i) % num_keys + 1) for i in xrange(TRACE_LENGTH)]
+    rand = random.Random(seed)
+    return ["key:%d" % rand.randint(1, num_keys) for _ in xrange(TRACE_LENGTH)]
+
+
+class ClientConnection(object):
+    """One benchmark client: sends batches of pipelined GETs & times each
+    reply from when its batch was sent
+    """
+
+    def __init__(self, address, trace, pipeline):
+        self.sock = socket.create_connection(address)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.trace = trace
+        self.pipeline = pipeline
+        self.pos = 0
+        self.buf = bytearray()
+        self.latency = None
+        self.errors = 0
+        self._handshake()
+
+    def _handshake(self):
+        """Reads past the proxy's greeting, if it sends one"""
+
+        self.sock.sendall(encode_command("GET", HANDSHAKE_KEY))
+        marker = "$-1\r\n"
+        while True:
+            data = self.sock.recv(RECV_SIZE)
+            if not data:
+                raise socket.error("connection closed during handshake")
+            self.buf.extend(data)
+            end = self.buf.find(marker)
+            if end != -1:
+                del self.buf[:end + len(marker)]
+                return
+
+    def run(self, deadline):
+        """Sends batches until deadline (on the clock() clock), recording
+            into a fresh self.latency & self.errors
+            :returns: # of requests answered
+        """
+
+        self.latency = Histogram()
+        self.errors = 0
+        answered = 0
+        trace = self.trace
+        while clock() < deadline:
+            commands = []
+            for _ in xrange(self.pipeline):
+                commands.append(encode_command("GET", trace[self.pos]))
+                self.pos = (self.pos + 1) % len(trace)
+            start = clock()
+            self.sock.sendall("".join(commands))
+            pending = self.pipeline
+            parsed = 0
+            while pending:
+                reply, consumed = parse_redis_reply(self.buf, parsed)
+                if not consumed:
+                    del self.buf[:parsed]
+                    parsed = 0
+                    data = self.sock.recv(RECV_SIZE)
+                    if not data:
+                        raise socket.error("connection closed by proxy")
+                    self.buf.extend(data)
+                    continue
+                parsed += consumed
+                self.latency.record(clock() - start)
+                if reply is None or isinstance(reply, RedisError):
+                    self.errors += 1
+                pending -= 1
+            del self.buf[:parsed]
+            answered += self.pipeline
+        return answered
+
+    def close(self):
+        self.sock.close()
+
+
+def connect(address, traces, pipeline):
+    """Opens a ClientConnection per trace"""
+
+    return [ClientConnection(address, trace, pipeline) for trace in traces]
+
+
+def run_load(clients, duration):
+    """Drives the proxy from one thread per client for duration seconds
+        :returns: dict with requests, errors, elapsed & a merged latency
+            Histogram
+    """
+
+    counts = [0] * len(clients)
+    failures = []
+    deadline = clock() + duration
+
+    def drive(i):
+        try:
+            counts[i] = clients[i].run(deadline)
+        except socket.error, e:
+            failures.append(e)
+
+    threads = [threading.Thread(target=drive, args=(i,)) for i in xrange(len(clients))]
+    start = clock()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = clock() - start
+    latency = Histogram()
+    for client in clients:
+        latency.merge(client.latency)
+    if failures:
+        raise failures[0]
+    return {
+        'requests': sum(counts),
+        'errors': sum(client.errors for client in clients),
+        'elapsed': elapsed,
+        'latency': latency,
+    }
+
+
+def process_cpu(pid):
+    """CPU seconds used by pid & its child processes (e.g. --workers), or
+        None where there's no /proc
+    """
+
+    ticks = float(os.sysconf('SC_CLK_TCK'))
+    total = 0
+    try:
+        pids = [int(name) for name in os.listdir('/proc') if name.isdigit()]
+    except OSError:
+        return None
+    for other in pids:
+        try:
+            with open('/proc/%s/stat' % other) as stat_file:
+                # The command name may hold spaces; fields are counted from
+                # after its closing paren
+                fields = stat_file.read().rsplit(')', 1)[1].split()
+        except (IOError, IndexError):
+            continue
+        if other == pid or int(fields[1]) == pid:
+            total += int(fields[11]) + int(fields[12])
+    return total / ticks
+
+
+def git_commit():
+    try:
+        with open(os.devnull, 'w') as devnull:
+            return subprocess.check_output(
+                ['git', 'rev-parse', '--short', 'HEAD'],
+                stderr=devnull,
+                cwd=os.path.dirname(os.path.abspath(__file__)),
+            ).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class ProxyProcess(object):
+    """A proxy engine running as a child process"""
+
+    def __init__(self, command, address):
+        self.command = command
+        self.address = address
+        self.log = tempfile.TemporaryFile()
+        self.process = None
+
+    def start(self):
+        """Starts the proxy & waits until it accepts connections"""
+
+        self.process = subprocess.Popen(self.command, stdout=self.log, stderr=subprocess.STDOUT)
+        deadline = time.time() + STARTUP_TIMEOUT
+        while True:
+            if self.process.poll() is not None:
+                raise RuntimeError("Proxy exited with status %s:\n%s" % (self.process.returncode, self.output()))
+            try:
+                socket.create_connection(self.address, timeout=1).close()
+                return
+            except socket.error:
+                if time.time() > deadline:
+                    self.stop()
+                    raise RuntimeError("Proxy didn't start listening on %s:%s" % self.address)
+                time.sleep(0.1)
+
+    def stop(self):
+        if self.process.poll() is None:
+            self.process.send_signal(signal.SIGTERM)
+            deadline = time.time() + SHUTDOWN_TIMEOUT
+            while self.process.poll() is None and time.time() < deadline:
+                time.sleep(0.05)
+            if self.process.poll() is None:
+                self.process.kill()
+                self.process.wait()
+
+    def output(self):
+        self.log.seek(0)
+        return self.log.read()
+
+
+def benchmark(name, command, fake_redis, traces, args):
+    """Runs one engine through a warm-up & a measured run
+        :returns: dict of results
+    """
+
+    address = (args.proxy_host, args.proxy_port)
+    proxy = ProxyProcess(command, address)
+    proxy.start()
+    clients = []
+    try:
+        clients = connect(address, traces, args.pipeline)
+        if args.warmup:
+            run_load(clients, args.warmup)
+        fetched_before = fake_redis.fetched
+        cpu_before = process_cpu(proxy.process.pid)
+        result = run_load(clients, args.duration)
+        cpu_after = process_cpu(proxy.process.pid)
+        fetched = fake_redis.fetched - fetched_before
+    finally:
+        # Clients hang up first, so the proxy's port isn't left in TIME_WAIT
+        for client in clients:
+            client.close()
+        proxy.stop()
+
+    requests = result['requests']
+    latency = result['latency']
+    cpu = None
+    if cpu_before is not None and cpu_after is not None:
+        cpu = cpu_after - cpu_before
+    return OrderedDict([
+        ('engine', name),
+        ('command', command),
+        ('requests', requests),
+        ('errors', result['errors']),
+        ('elapsed', round(result['elapsed'], 3)),
+        ('throughput', round(requests / result['elapsed'], 1)),
+        ('latency_us', OrderedDict([
+            ('mean', round(latency.total / requests * 1e6, 1) if requests else 0),
+            ('p50', int(latency.percentile(50) * 1e6)),
+            ('p99', int(latency.percentile(99) * 1e6)),
+            ('p999', int(latency.percentile(99.9) * 1e6)),
+            ('max', latency.max),
+        ])),
+        ('redis_fetches', fetched),
+        ('hit_ratio', round(1 - float(fetched) / requests, 4) if requests else None),
+        ('cpu_seconds', round(cpu, 3) if cpu is not None else None),
+        ('cpu_us_per_request', round(cpu / requests * 1e6, 2) if cpu is not None and requests else None),
+    ])
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--engine',
+        type=str,
+        nargs='+',
+        dest='engines',
+        default=list(ENGINES),
+        choices=list(ENGINES),
+        action='store',
+        required=False,
+        help='Enter engines to benchmark (Defaults to all of them)',
+    )
+
+    parser.add_argument(
+        '--proxy-cmd',
+        type=str,
+        dest='proxy_cmd',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter command line of another proxy to benchmark instead; --backend host:port is appended',
+    )
+
+    parser.add_argument(
+        '--proxy-args',
+        type=str,
+        dest='proxy_args',
+        default='',
+        action='store',
+        required=False,
+        help='Enter extra arguments passed to every proxy, e.g. "--capacity 5000 --ttl 60"',
+    )
+
+    parser.add_argument(
+        '--proxy-host',
+        type=str,
+        dest='proxy_host',
+        default='127.0.0.1',
+        action='store',
+        required=False,
+        help='Enter address the proxy listens on',
+    )
+
+    parser.add_argument(
+        '--proxy-port',
+        type=int,
+        dest='proxy_port',
+        default=5555,
+        action='store',
+        required=False,
+        help='Enter port the proxy listens on',
+    )
+
+    parser.add_argument(
+        '--connections',
+        type=int,
+        dest='connections',
+        default=16,
+        action='store',
+        required=False,
+        help='Enter # of client connections, each driven by its own thread',
+    )
+
+    parser.add_argument(
+        '--pipeline',
+        type=int,
+        dest='pipeline',
+        default=1,
+        action='store',
+        required=False,
+        help='Enter # of GETs each connection sends before reading the replies',
+    )
+
+    parser.add_argument(
+        '--duration',
+        type=float,
+        dest='duration',
+        default=10.0,
+        action='store',
+        required=False,
+        help='Enter seconds of measured load per engine',
+    )
+
+    parser.add_argument(
+        '--warmup',
+        type=float,
+        dest='warmup',
+        default=2.0,
+        action='store',
+        required=False,
+        help='Enter seconds of load before measuring, to fill the cache',
+    )
+
+    parser.add_argument(
+        '--keys',
+        type=int,
+        dest='keys',
+        default=10000,
+        action='store',
+        required=False,
+        help='Enter # of distinct keys in the fake Redis',
+    )
+
+    parser.add_argument(
+        '--value-size',
+        type=parse_sizes,
+        dest='value_size',
+        default=(100, 100),
+        action='store',
+        required=False,
+        help='Enter bytes per value, or MIN-MAX for random sizes in that range',
+    )
+
+    parser.add_argument(
+        '--distribution',
+        type=str,
+        dest='distribution',
+        default='zipf',
+        choices=DISTRIBUTIONS,
+        action='store',
+        required=False,
+        help='Enter key distribution: uniform, zipf (default) or scan',
+    )
+
+    parser.add_argument(
+        '--skew',
+        type=float,
+        dest='skew',
+        default=0.9,
+        action='store',
+        required=False,
+        help='Enter Zipf exponent; higher is more skewed',
+    )
+
+    parser.add_argument(
+        '--redis-latency',
+        type=float,
+        dest='redis_latency',
+        default=0.0,
+        action='store',
+        required=False,
+        help='Enter ms the fake Redis waits before each reply',
+    )
+
+    parser.add_argument(
+        '--seed',
+        type=int,
+        dest='seed',
+        default=0,
+        action='store',
+        required=False,
+        help='Enter random seed for keys & value sizes',
+    )
+
+    parser.add_argument(
+        '--output',
+        type=str,
+        dest='output',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter file to write the JSON report to (Defaults to stdout)',
+    )
+
+    args = parser.parse_args()
+
+    here = os.path.dirname(os.path.abspath(__file__))
+    if args.proxy_cmd:
+        commands = OrderedDict([('custom', shlex.split(args.proxy_cmd))])
+    else:
+        commands = OrderedDict(
+            (name, [sys.executable] + [os.path.join(here, ENGINES[name][0])] + ENGINES[name][1:])
+            for name in args.engines
+        )
+
+    fake_redis = FakeRedis(
+        make_data(args.keys, args.value_size, args.seed),
+        args.redis_latency / 1000.0,
+    ).start()
+    backend = "%s:%s" % fake_redis.server_address
+    traces = [
+        key_trace(args.distribution, args.keys, i, args.connections, args.skew, args.seed)
+        for i in xrange(args.connections)
+    ]
+
+    results = []
+    try:
+        for name, command in commands.iteritems():
+            command = command + shlex.split(args.proxy_args) + ['--backend', backend]
+            print >> sys.stderr, "Benchmarking %s: %s" % (name, " ".join(command))
+            results.append(benchmark(name, command, fake_redis, traces, args))
+    finally:
+        fake_redis.stop()
+
+    report = OrderedDict([
+        ('commit', git_commit()),
+        ('config', OrderedDict([
+            ('connections', args.connections),
+            ('pipeline', args.pipeline),
+            ('duration', args.duration),
+            ('warmup', args.warmup),
+            ('keys', args.keys),
+            ('value_size', list(args.value_size)),
+            ('distribution', args.distribution),
+            ('skew', args.skew),
+            ('redis_latency_ms', args.redis_latency),
+            ('seed', args.seed),
+            ('proxy_args', args.proxy_args),
+        ])),
+        ('results', results),
+    ])
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + "\n")
+    else:
+        print text
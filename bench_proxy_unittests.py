@@ -0,0 +1,106 @@
+import socket
+import time
+import unittest
+
+from bench_proxy import (
+    connect,
+    FakeRedis,
+    key_trace,
+    make_data,
+    parse_sizes,
+    run_load,
+)
+from resp import encode_command, RedisConnection
+
+
+class TestFakeRedis(unittest.TestCase):
+
+    def setUp(self):
+        self.fake_redis = FakeRedis({'key:1': 'foo', 'key:2': 'bar'}).start()
+        self.conn = RedisConnection(socket.create_connection(self.fake_redis.server_address))
+
+    def tearDown(self):
+        self.conn.close()
+        self.fake_redis.stop()
+
+    def test_get_and_mget(self):
+        self.conn.sendall(encode_command("GET", "key:1") + encode_command("MGET", "key:2", "key:3"))
+
+        self.assertEqual(self.conn.read_reply(), 'foo')
+        self.assertEqual(self.conn.read_reply(), ['bar', None])
+        self.assertEqual(self.fake_redis.fetched, 3)
+
+    def test_pttl(self):
+        self.fake_redis.ttls['key:1'] = 5000
+        self.conn.sendall("".join(encode_command("PTTL", key) for key in ['key:1', 'key:2', 'key:3']))
+
+        self.assertEqual([self.conn.read_reply() for _ in xrange(3)], ['5000', '-1', '-2'])
+
+    def test_latency_added_per_round_trip(self):
+        """Test that a pipelined batch waits out the latency once, not per
+            command
+        """
+
+        self.fake_redis.latency = 0.05
+        start = time.time()
+        self.conn.sendall(encode_command("GET", "key:1") * 4)
+        for _ in xrange(4):
+            self.conn.read_reply()
+
+        self.assertGreaterEqual(time.time() - start, 0.05)
+        self.assertLess(time.time() - start, 0.15)
+
+
+class TestLoadGenerator(unittest.TestCase):
+
+    def test_parse_sizes(self):
+        self.assertEqual(parse_sizes('100'), (100, 100))
+        self.assertEqual(parse_sizes('64-4096'), (64, 4096))
+
+    def test_make_data(self):
+        data = make_data(100, (10, 20))
+
+        self.assertEqual(sorted(data), sorted("key:%d" % i for i in xrange(1, 101)))
+        self.assertTrue(all(10 <= len(val) <= 20 for val in data.itervalues()))
+
+    def test_scan_trace_covers_keyspace(self):
+        trace = key_trace('scan', 50, 1, 2)
+
+        self.assertEqual(trace[0], 'key:26')
+        self.assertEqual(set(trace[:50]), set("key:%d" % i for i in xrange(1, 51)))
+
+    def test_zipf_trace_skewed(self):
+        trace = key_trace('zipf', 1000, 0, 1)
+
+        self.assertGreater(trace.count('key:1'), trace.count('key:500') * 10)
+
+    def test_traces_reproducible(self):
+        for distribution in ('uniform', 'zipf', 'scan'):
+            self.assertEqual(
+                key_trace(distribution, 1000, 3, 4, seed=7)[:100],
+                key_trace(distribution, 1000, 3, 4, seed=7)[:100],
+            )
+        self.assertNotEqual(key_trace('uniform', 1000, 0, 4)[:100], key_trace('uniform', 1000, 1, 4)[:100])
+
+    def test_run_load(self):
+        """Test that pipelined load is answered & timed, straight against
+            the fake Redis
+        """
+
+        fake_redis = FakeRedis(make_data(100, (10, 10))).start()
+        try:
+            clients = connect(fake_redis.server_address, [key_trace('uniform', 100, i, 2) for i in xrange(2)], 4)
+            result = run_load(clients, 0.2)
+            for client in clients:
+                client.close()
+        finally:
+            fake_redis.stop()
+
+        self.assertGreater(result['requests'], 0)
+        self.assertEqual(result['requests'] % 4, 0)
+        self.assertEqual(result['errors'], 0)
+        self.assertEqual(result['latency'].count, result['requests'])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,57 @@
+"""Bloom filter used by the proxies to screen negative-cache lookups"""
+
+from hashlib import md5
+import math
+import struct
+
+
+class BloomFilter(object):
+    """Fixed-size Bloom filter over str keys.
+
+    A key that was never added is reported absent, except for a small
+    false-positive rate; a key that was added is always reported present,
+    until clear(). Entries can't be removed, so once more than capacity keys
+    have gone in (and the false-positive rate climbs past the target) the
+    filter starts over empty.
+    """
+
+    def __init__(self, capacity, error_rate=0.01):
+        """
+            :param capacity (int): # of keys to hold at error_rate
+            :param error_rate (float): target false-positive rate
+        """
+
+        if not capacity:
+            raise TypeError("Capacity cannot be None for BloomFilter")
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(self.num_bits / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+        self.resets = 0
+
+    def add(self, key):
+        if self.count >= self.capacity:
+            self.clear()
+            self.resets += 1
+        for bit in self._bits_for(key):
+            self.bits[bit >> 3] |= 1 << (bit & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for bit in self._bits_for(key):
+            if not bits[bit >> 3] & (1 << (bit & 7)):
+                return False
+        return True
+
+    def clear(self):
+        self.bits = bytearray(len(self.bits))
+        self.count = 0
+
+    def _bits_for(self, key):
+        """Derives num_hashes bit positions from one digest (double hashing)"""
+
+        h1, h2 = struct.unpack("<QQ", md5(key).digest())
+        return [(h1 + i * h2) % self.num_bits for i in xrange(self.num_hashes)]
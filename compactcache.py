@@ -0,0 +1,316 @@
+"""Compact LRU cache store: one dict of __slots__ entries, kept in recency
+order on an intrusive doubly linked list.
+
+LRUCache keeps every key twice, in its own OrderedDict (in set order) and
+in the eviction policy's (in read order), with the value & deadline in a
+tuple: a tuple, two linked-list nodes and two dict slots per entry, and a
+hit deletes the key from the policy's OrderedDict & inserts it again. Here
+a key maps straight to an Entry holding the value, the deadline (integer
+ms) and the entry's neighbours, so a hit relinks the entry in place without
+allocating anything. Eviction is always least recently used.
+
+Otherwise CompactLRUCache has LRUCache's interface & behaviour (TTL, grace,
+refresh-ahead, memory limits, sweeping & compression).
+`python bench_cache_store.py` compares the two.
+"""
+
+import heapq
+import sys
+from threading import Lock
+
+from monotonic import monotonic
+
+from compression import CompressedValue, Compressor, DEFAULT_LEVEL
+
+
+# Approx. bytes an entry takes besides its key & value: the Entry, its dict
+# slot, its deadline & its expiry heap record (see bench_cache_store.py)
+ENTRY_OVERHEAD = 280
+SWEEP_BATCH = 100
+
+
+def now_ms():
+    """Monotonic clock, in integer milliseconds"""
+
+    return int(monotonic() * 1000)
+
+
+class Entry(object):
+    """A cached value & its place in recency order"""
+
+    __slots__ = ('key', 'val', 'deadline', 'prev', 'next')
+
+    def __init__(self, key=None, val=None, deadline=0):
+        self.key = key
+        self.val = val
+        self.deadline = deadline
+        self.prev = self.next = self
+
+
+class CompactLRUCache(object):
+    """LRUCache (see threaded_proxy.py), least recently used eviction only,
+    with one Entry per key instead of two OrderedDict nodes & a tuple.
+    """
+
+    def __init__(self,
+        capacity=None,
+        ttl=None,
+        max_memory=None,
+        max_entry_fraction=0.5,
+        grace=0,
+        refresh_ahead=0,
+        compress_threshold=None,
+        compress_level=DEFAULT_LEVEL,
+    ):
+        """
+            :param capacity (int): max. # of keys
+            :param ttl (int): # of seconds that a key can live in cache
+            :param max_memory (int): max. approx. bytes of keys, values &
+                entry overhead
+            :param max_entry_fraction (float): values whose entry would take
+                more than this fraction of max_memory are not cached
+            :param grace (int): # of seconds an expired entry is still served,
+                while it's refreshed
+            :param refresh_ahead (int): # of seconds before expiry during
+                which a read flags the entry for refreshing
+            :param compress_threshold (int): min. # of bytes of a value to
+                compress it. None disables compression
+            :param compress_level (int): zlib level, 1-9
+        """
+
+        if not capacity and not max_memory:
+            raise TypeError("Capacity cannot be None for CompactLRUCache")
+        if not ttl:
+            raise TypeError("TTL cannot be None for CompactLRUCache")
+        self.capacity = capacity
+        self.ttl = ttl
+        self.ttl_ms = int(ttl * 1000)
+        self.grace_ms = int(grace * 1000)
+        self.refresh_ahead_ms = int(refresh_ahead * 1000)
+        self.max_memory = max_memory
+        self.max_entry_fraction = max_entry_fraction
+        # No method takes the lock while holding it, so it needn't be an RLock
+        self.lock = Lock()
+        self.data = {}
+        # Sentinel of the circular list: head.next is the entry used most
+        # recently, head.prev the one used least recently
+        self.head = Entry()
+        # (deadline, key) per entry set; records for keys since re-set or
+        # evicted are skipped when popped
+        self.expiry_heap = []
+        self.compressor = None
+        if compress_threshold:
+            self.compressor = Compressor(compress_threshold, compress_level)
+
+        # Stats
+        self.size = 0
+        self.compression_saved = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.rejections = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Checks if key is in data
+            :param key (str)
+            :returns: val (str) if exists or None
+        """
+
+        return self.lookup(key)[0]
+
+    def lookup(self, key, raw=False):
+        """Checks if key is in data, & whether it's due for a refresh
+            :param key (str)
+            :param raw (bool): return a compressed value as it's cached
+            :returns: (val, refresh) tuple, as LRUCache.lookup()
+        """
+
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None, False
+            now = now_ms()
+            deadline = entry.deadline
+            if now >= deadline + self.grace_ms:
+                self._remove(entry)
+                self.expirations += 1
+                self.misses += 1
+                return None, False
+            head = self.head
+            if head.next is not entry:
+                entry.prev.next = entry.next
+                entry.next.prev = entry.prev
+                entry.prev = head
+                entry.next = head.next
+                head.next.prev = entry
+                head.next = entry
+            self.hits += 1
+            val = entry.val
+            if now >= deadline:
+                self.stale_hits += 1
+                refresh = True
+            else:
+                refresh = now >= deadline - self.refresh_ahead_ms
+        if type(val) is CompressedValue and not raw:
+            val = self.compressor.decompress(val)
+        return val, refresh
+
+    def delete(self, key):
+        """Removes key from data, if it's there
+            :returns: True if key was cached
+        """
+
+        with self.lock:
+            entry = self.data.get(key)
+            if entry is None:
+                return False
+            self._remove(entry)
+            return True
+
+    def clear(self):
+        """Removes every entry
+            :returns: # of entries removed
+        """
+
+        with self.lock:
+            cleared = len(self.data)
+            self.data = {}
+            self.head.prev = self.head.next = self.head
+            self.expiry_heap = []
+            self.size = 0
+            self.compression_saved = 0
+            return cleared
+
+    def set(self, key, val, ttl_ms=None):
+        """Sets key-val pair, as the most recently used
+            :param key (str):
+            :param val (str):
+            :param ttl_ms (int): # of ms until the entry expires, if sooner
+                than the cache's TTL
+        """
+
+        if self.compressor is not None:
+            val = self.compressor.compress(val)
+        deadline = now_ms() + (self.ttl_ms if ttl_ms is None else min(ttl_ms, self.ttl_ms))
+        with self.lock:
+            old = self.data.get(key)
+            if old is not None:
+                self._remove(old)
+
+            entry_size = self._entry_size(key, val)
+            if self.max_memory and entry_size > self.max_memory * self.max_entry_fraction:
+                self.rejections += 1
+                return
+
+            # Reclaim expired entries first, so they don't push out live ones
+            self._sweep(SWEEP_BATCH)
+            head = self.head
+            while self.data and self._is_full(entry_size):
+                self._remove(head.prev)
+                self.evictions += 1
+            entry = Entry(key, val, deadline)
+            entry.prev = head
+            entry.next = head.next
+            head.next.prev = entry
+            head.next = entry
+            self.data[key] = entry
+            self.size += entry_size
+            if type(val) is CompressedValue:
+                self.compression_saved += val.saved
+            heapq.heappush(self.expiry_heap, (deadline, key))
+            if len(self.expiry_heap) > 2 * len(self.data) + SWEEP_BATCH:
+                self._rebuild_expiry_heap()
+
+    def sweep(self, max_entries=None):
+        """Removes expired entries, soonest deadline first
+            :param max_entries (int): max. # of heap records to examine, to
+                bound the time the lock is held
+            :returns: # of entries expired
+        """
+
+        with self.lock:
+            return self._sweep(max_entries)
+
+    def _sweep(self, max_entries):
+        # Entries are kept until their grace period is over, too
+        now = now_ms() - self.grace_ms
+        heap = self.expiry_heap
+        examined = expired = 0
+        while heap and heap[0][0] <= now:
+            if max_entries is not None and examined >= max_entries:
+                break
+            deadline, key = heapq.heappop(heap)
+            examined += 1
+            entry = self.data.get(key)
+            if entry is not None and entry.deadline == deadline:
+                self._remove(entry)
+                expired += 1
+        self.expirations += expired
+        return expired
+
+    def entries(self):
+        """Unexpired entries, least recently used first
+            :returns: list of (key, val, # of ms until expiry) tuples
+        """
+
+        now = now_ms()
+        entries = []
+        with self.lock:
+            entry = self.head.prev
+            while entry is not self.head:
+                if entry.deadline > now:
+                    entries.append((entry.key, entry.val, entry.deadline - now))
+                entry = entry.prev
+        if self.compressor is None:
+            return entries
+        return [(key, self.compressor.decompress(val), ttl_ms) for key, val, ttl_ms in entries]
+
+    def stats(self):
+        with self.lock:
+            stats = {
+                'keys': len(self.data),
+                'size': self.size,
+                'max_memory': self.max_memory,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'evictions': self.evictions,
+                'rejections': self.rejections,
+                'expirations': self.expirations,
+            }
+            if self.compressor is not None:
+                stats.update(self.compressor.stats(), compression_saved=self.compression_saved)
+            return stats
+
+    def _remove(self, entry):
+        """Unlinks an entry & takes it off the cache's size"""
+
+        del self.data[entry.key]
+        entry.prev.next = entry.next
+        entry.next.prev = entry.prev
+        self.size -= self._entry_size(entry.key, entry.val)
+        if type(entry.val) is CompressedValue:
+            self.compression_saved -= entry.val.saved
+
+    def _rebuild_expiry_heap(self):
+        """Drops heap records for entries that were re-set or evicted"""
+
+        self.expiry_heap = [(entry.deadline, key) for key, entry in self.data.iteritems()]
+        heapq.heapify(self.expiry_heap)
+
+    def _is_full(self, entry_size):
+        if self.capacity and len(self.data) >= self.capacity:
+            return True
+        return bool(self.max_memory) and self.size + entry_size > self.max_memory
+
+    def _entry_size(self, key, val):
+        return sys.getsizeof(key) + sys.getsizeof(val) + ENTRY_OVERHEAD
+
+    def __len__(self):
+        return len(self.data)
+
+    def __repr__(self):
+        return "%s(%s, %s keys)" % (self.__class__.__name__, self.capacity, len(self.data))
@@ -0,0 +1,210 @@
+import random
+import mock
+import unittest
+
+from compactcache import CompactLRUCache
+from compression import CompressedValue
+import proxy
+import threaded_proxy
+
+
+class TestCompactLRUCache(unittest.TestCase):
+
+    def test_no_args(self):
+        """Test instantiating CompactLRUCache w/o capacity & ttl raises TypeError"""
+
+        with self.assertRaises(TypeError):
+            CompactLRUCache(ttl=7200)
+
+        with self.assertRaises(TypeError):
+            CompactLRUCache(capacity=100)
+
+    def test_least_recently_used_evicted(self):
+        testcache = CompactLRUCache(capacity=3, ttl=15)
+        testcache.set('radish', 'moo')
+        testcache.set('rice', 'bap')
+        testcache.set('beef', 'sogogi')
+        testcache.get('radish')
+
+        testcache.set('egg', 'gyeran')
+        self.assertEqual(len(testcache), 3)
+        self.assertIsNone(testcache.get('rice'))
+        self.assertEqual([key for key, val, ttl_ms in testcache.entries()], ['beef', 'radish', 'egg'])
+        self.assertEqual(testcache.stats()['evictions'], 1)
+
+    def test_reset_key_moves_to_front(self):
+        testcache = CompactLRUCache(capacity=2, ttl=15)
+        testcache.set('radish', 'moo')
+        testcache.set('rice', 'bap')
+        testcache.set('radish', 'mu')
+        testcache.set('beef', 'sogogi')
+
+        self.assertIsNone(testcache.get('rice'))
+        self.assertEqual(testcache.get('radish'), 'mu')
+        self.assertEqual(testcache.stats()['evictions'], 1)
+
+    def test_delete(self):
+        testcache = CompactLRUCache(capacity=3, ttl=15)
+        testcache.set('radish', 'moo')
+        testcache.set('rice', 'bap')
+
+        self.assertTrue(testcache.delete('radish'))
+        self.assertFalse(testcache.delete('radish'))
+        self.assertIsNone(testcache.get('radish'))
+        self.assertEqual([key for key, val, ttl_ms in testcache.entries()], ['rice'])
+        self.assertEqual(testcache.size, testcache._entry_size('rice', 'bap'))
+
+    def test_clear(self):
+        testcache = CompactLRUCache(capacity=3, ttl=15)
+        testcache.set('radish', 'moo')
+        testcache.set('rice', 'bap')
+
+        self.assertEqual(testcache.clear(), 2)
+        self.assertEqual(testcache.entries(), [])
+        self.assertEqual(testcache.size, 0)
+        testcache.set('beef', 'sogogi')
+        self.assertEqual([key for key, val, ttl_ms in testcache.entries()], ['beef'])
+
+    @mock.patch('compactcache.monotonic')
+    def test_expiry_grace_and_refresh_ahead(self, clock_mock):
+        clock_mock.return_value = 1000.0
+        testcache = CompactLRUCache(capacity=3, ttl=10, grace=5, refresh_ahead=2)
+        testcache.set('radish', 'moo')
+        self.assertEqual(testcache.data['radish'].deadline, 1010000)
+
+        clock_mock.return_value = 1007.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', False))
+        clock_mock.return_value = 1008.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', True))
+        clock_mock.return_value = 1012.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', True))
+        self.assertEqual(testcache.stats()['stale_hits'], 1)
+
+        clock_mock.return_value = 1015.0
+        self.assertEqual(testcache.lookup('radish'), (None, False))
+        self.assertNotIn('radish', testcache.data)
+        self.assertEqual(testcache.size, 0)
+        self.assertEqual(testcache.stats()['expirations'], 1)
+
+    @mock.patch('compactcache.monotonic')
+    def test_ttl_ms_capped_at_cache_ttl(self, clock_mock):
+        clock_mock.return_value = 1000.0
+        testcache = CompactLRUCache(capacity=3, ttl=10)
+        testcache.set('short', 'moo', ttl_ms=2000)
+        testcache.set('long', 'bap', ttl_ms=60000)
+
+        self.assertEqual(testcache.entries(), [('short', 'moo', 2000), ('long', 'bap', 10000)])
+
+    @mock.patch('compactcache.monotonic')
+    def test_sweep_reclaims_expired_entries(self, clock_mock):
+        clock_mock.return_value = 1000.0
+        testcache = CompactLRUCache(capacity=10, ttl=10)
+        for key in ['a', 'b', 'c']:
+            testcache.set(key, 'val')
+        clock_mock.return_value = 1005.0
+        testcache.set('d', 'val')
+
+        clock_mock.return_value = 1012.0
+        self.assertEqual(testcache.sweep(max_entries=2), 2)
+        self.assertEqual(testcache.sweep(), 1)
+        self.assertEqual(testcache.data.keys(), ['d'])
+        self.assertEqual(testcache.stats()['expirations'], 3)
+
+    @mock.patch('compactcache.ENTRY_OVERHEAD', 0)
+    @mock.patch('compactcache.sys.getsizeof', len)
+    def test_max_memory(self):
+        """Test that LRU entries are evicted until a new entry fits the budget,
+            & that entries over max_entry_fraction of it aren't cached
+        """
+
+        testcache = CompactLRUCache(ttl=7200, max_memory=30, max_entry_fraction=0.7)
+        testcache.set('a', 'x' * 9)
+        testcache.set('b', 'x' * 9)
+        testcache.set('c', 'x' * 9)
+        self.assertEqual(testcache.size, 30)
+
+        testcache.set('d', 'x' * 19)
+        self.assertEqual([key for key, val, ttl_ms in testcache.entries()], ['c', 'd'])
+        self.assertEqual(testcache.size, 30)
+
+        testcache.set('e', 'x' * 29)
+        self.assertIsNone(testcache.get('e'))
+        stats = testcache.stats()
+        self.assertEqual(stats['evictions'], 2)
+        self.assertEqual(stats['rejections'], 1)
+
+    def test_large_values_cached_compressed(self):
+        val = '{"name": "Robert Kevin", "age": 111}' * 50
+        testcache = CompactLRUCache(capacity=5, ttl=7200, compress_threshold=100)
+        testcache.set('json', val)
+
+        self.assertEqual(testcache.get('json'), val)
+        self.assertIsInstance(testcache.lookup('json', raw=True)[0], CompressedValue)
+        self.assertGreater(testcache.stats()['compression_saved'], len(val) / 2)
+        self.assertEqual(testcache.entries()[0][1], val)
+
+        testcache.delete('json')
+        self.assertEqual(testcache.stats()['compression_saved'], 0)
+
+    def test_same_stats_as_lru_cache(self):
+        self.assertItemsEqual(
+            CompactLRUCache(capacity=5, ttl=60).stats(),
+            threaded_proxy.LRUCache(capacity=5, ttl=60).stats(),
+        )
+
+    def test_matches_lru_cache(self):
+        """Test that a random run of gets, sets & deletes leaves the same
+            entries, in the same order, as in an LRUCache
+        """
+
+        rand = random.Random(0)
+        testcache = CompactLRUCache(capacity=20, ttl=7200, max_memory=20000)
+        lru = threaded_proxy.LRUCache(capacity=20, ttl=7200, max_memory=20000)
+        for _ in xrange(5000):
+            key = 'key:%s' % rand.randint(0, 40)
+            op = rand.random()
+            if op < 0.5:
+                self.assertEqual(testcache.get(key), lru.get(key))
+            elif op < 0.9:
+                val = 'x' * rand.randint(0, 200)
+                testcache.set(key, val)
+                lru.set(key, val)
+            else:
+                self.assertEqual(testcache.delete(key), lru.delete(key))
+
+        self.assertEqual(
+            [key for key, val, ttl_ms in testcache.entries()],
+            [key for key, val, ttl_ms in lru.entries()],
+        )
+        self.assertEqual(testcache.stats()['evictions'], lru.stats()['evictions'])
+
+
+class TestCompactCacheSetting(unittest.TestCase):
+
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_threaded_proxy(self, patched_redis):
+        redis_proxy = threaded_proxy.RedisProxy(capacity=5, compact_cache=True)
+        self.assertIsInstance(redis_proxy.cache, CompactLRUCache)
+
+    def test_sharded(self):
+        testcache = threaded_proxy.ShardedLRUCache(capacity=8, ttl=60, shards=4, compact=True)
+        testcache.set('radish', 'moo')
+
+        self.assertTrue(all(isinstance(shard, CompactLRUCache) for shard in testcache.shards))
+        self.assertEqual(testcache.get('radish'), 'moo')
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_select_proxy(self, patched_redis, patched_client):
+        redis_proxy = proxy.RedisProxy(capacity=5, compact_cache=True)
+        self.assertIsInstance(redis_proxy.cache, CompactLRUCache)
+
+    def test_lru_only(self):
+        with self.assertRaises(ValueError):
+            proxy.RedisProxy(capacity=5, eviction_policy='arc', compact_cache=True)
+        with self.assertRaises(ValueError):
+            threaded_proxy.ShardedLRUCache(capacity=8, ttl=60, policy='slru', compact=True)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,143 @@
+"""Compression of large cached values.
+
+Values of at least `threshold` bytes are deflated with zlib before they're
+cached, and inflated again when they're read. A value that doesn't come out
+under `max_ratio` of its size is cached as it was. While most recent values
+aren't shrinking (e.g. they're already compressed), only one in SAMPLE_EVERY
+is tried, until values start shrinking again; the rest are cached as they
+are without spending time on them.
+
+Compressed values are kept as CompressedValue, a str subclass holding the
+original length & the zlib stream, so caches count them at their compressed
+size & can tell them apart from values that were left alone.
+"""
+
+import struct
+import zlib
+
+from metrics import clock
+
+
+DEFAULT_LEVEL = 6
+# A compressed value must be at most this fraction of the original to be kept
+DEFAULT_MAX_RATIO = 0.9
+# While the share of tried values that shrink is under ADAPT_BELOW, only
+# every SAMPLE_EVERY-th value is tried
+SAMPLE_EVERY = 16
+ADAPT_BELOW = 0.5
+EWMA_WEIGHT = 0.1
+
+RAW_SIZE = struct.Struct("<I")
+
+# Reply prefixes for clients that asked for values still compressed
+COMPRESSED_TAG = "z"
+RAW_TAG = "="
+
+
+class CompressedValue(str):
+    """Cached form of a compressed value: its length, then the zlib stream"""
+
+    __slots__ = ()
+
+    @property
+    def raw_size(self):
+        return RAW_SIZE.unpack_from(self)[0]
+
+    @property
+    def saved(self):
+        """Bytes saved by keeping the value compressed"""
+
+        return self.raw_size - len(self)
+
+
+class Compressor(object):
+    """Compresses values for a cache & keeps count of what it did"""
+
+    def __init__(self, threshold, level=DEFAULT_LEVEL, max_ratio=DEFAULT_MAX_RATIO):
+        """
+            :param threshold (int): values shorter than this many bytes are
+                left alone
+            :param level (int): zlib level, 1 (fastest) to 9 (smallest)
+            :param max_ratio (float): compressed values bigger than this
+                fraction of the original aren't kept
+        """
+
+        if not 1 <= level <= 9:
+            raise ValueError("Compression level must be 1-9")
+        self.threshold = threshold
+        self.level = level
+        self.max_ratio = max_ratio
+        # Moving average of whether tried values shrank enough
+        self.shrinking = 1.0
+        self.countdown = SAMPLE_EVERY
+
+        # Stats
+        self.compressed = 0
+        self.incompressible = 0
+        self.skipped = 0
+        self.decompressed = 0
+        self.compress_time = 0.0
+        self.decompress_time = 0.0
+
+    def compress(self, val):
+        """
+            :param val (str)
+            :returns: CompressedValue, or val if it's too short or didn't
+                shrink enough
+        """
+
+        if len(val) < self.threshold:
+            return val
+        if self.shrinking < ADAPT_BELOW:
+            self.countdown -= 1
+            if self.countdown > 0:
+                self.skipped += 1
+                return val
+            self.countdown = SAMPLE_EVERY
+        start = clock()
+        data = zlib.compress(val, self.level)
+        self.compress_time += clock() - start
+        shrank = RAW_SIZE.size + len(data) <= len(val) * self.max_ratio
+        self.shrinking += EWMA_WEIGHT * (shrank - self.shrinking)
+        if not shrank:
+            self.incompressible += 1
+            return val
+        self.compressed += 1
+        return CompressedValue(RAW_SIZE.pack(len(val)) + data)
+
+    def decompress(self, val):
+        """
+            :param val (str): as cached
+            :returns: the original value
+        """
+
+        if not isinstance(val, CompressedValue):
+            return val
+        start = clock()
+        data = zlib.decompress(buffer(val, RAW_SIZE.size))
+        self.decompress_time += clock() - start
+        self.decompressed += 1
+        return data
+
+    def stats(self):
+        return {
+            'compressed': self.compressed,
+            'incompressible': self.incompressible,
+            'compress_skipped': self.skipped,
+            'decompressed': self.decompressed,
+            'compress_time': self.compress_time,
+            'decompress_time': self.decompress_time,
+        }
+
+
+def tag_value(val):
+    """A value as sent to a client that asked for values still compressed:
+        COMPRESSED_TAG & the zlib stream, or RAW_TAG & the value as it is
+        :param val (str): as cached or fetched; None for a missing key
+    """
+
+    if val is None:
+        return None
+    if isinstance(val, CompressedValue):
+        return COMPRESSED_TAG + val[RAW_SIZE.size:]
+    return RAW_TAG + val
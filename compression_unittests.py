@@ -0,0 +1,81 @@
+import json
+import os
+import unittest
+import zlib
+
+from compression import (
+    CompressedValue,
+    Compressor,
+    RAW_SIZE,
+    SAMPLE_EVERY,
+    tag_value,
+)
+
+
+JSON_VALUE = json.dumps([{'id': i, 'name': 'user %s' % i, 'active': True} for i in xrange(50)])
+
+
+class TestCompressor(unittest.TestCase):
+
+    def test_short_value_left_alone(self):
+        compressor = Compressor(threshold=100)
+        val = compressor.compress('{"id": 1}')
+
+        self.assertEqual(val, '{"id": 1}')
+        self.assertNotIsInstance(val, CompressedValue)
+        self.assertEqual(compressor.stats()['compressed'], 0)
+
+    def test_round_trip(self):
+        compressor = Compressor(threshold=100)
+        val = compressor.compress(JSON_VALUE)
+
+        self.assertIsInstance(val, CompressedValue)
+        self.assertLess(len(val), len(JSON_VALUE) / 4)
+        self.assertEqual(val.raw_size, len(JSON_VALUE))
+        self.assertEqual(val.saved, len(JSON_VALUE) - len(val))
+        self.assertEqual(compressor.decompress(val), JSON_VALUE)
+        self.assertEqual(compressor.decompress('plain'), 'plain')
+
+    def test_incompressible_value_kept_as_is(self):
+        compressor = Compressor(threshold=100)
+        val = os.urandom(1000)
+
+        self.assertIs(compressor.compress(val), val)
+        self.assertEqual(compressor.stats()['incompressible'], 1)
+
+    def test_tries_fewer_values_while_they_do_not_shrink(self):
+        """Test that during a run of incompressible values only about one in
+            SAMPLE_EVERY is tried, & that compressible ones are picked up
+            again once they come back
+        """
+
+        compressor = Compressor(threshold=100)
+        for _ in xrange(SAMPLE_EVERY * 10):
+            compressor.compress(os.urandom(1000))
+
+        self.assertLess(compressor.incompressible, 20)
+        self.assertEqual(compressor.incompressible + compressor.skipped, SAMPLE_EVERY * 10)
+
+        for _ in xrange(SAMPLE_EVERY * 20):
+            compressor.compress(JSON_VALUE)
+        self.assertIsInstance(compressor.compress(JSON_VALUE), CompressedValue)
+
+    def test_level_checked(self):
+        with self.assertRaises(ValueError):
+            Compressor(threshold=100, level=10)
+
+
+class TestTagValue(unittest.TestCase):
+
+    def test_tags(self):
+        compressed = Compressor(threshold=100).compress(JSON_VALUE)
+
+        self.assertEqual(zlib.decompress(tag_value(compressed)[1:]), JSON_VALUE)
+        self.assertEqual(tag_value(compressed)[0], 'z')
+        self.assertEqual(tag_value(compressed)[1:], compressed[RAW_SIZE.size:])
+        self.assertEqual(tag_value('bar'), '=bar')
+        self.assertIsNone(tag_value(None))
+
+
+if __name__ == "__main__":
+    unittest.main()
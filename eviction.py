@@ -0,0 +1,305 @@
+"""Eviction policies for the proxies' caches.
+
+A policy tracks the keys a cache holds and picks which one to evict when the
+cache is full. The cache itself keeps the values, sizes & deadlines; it calls
+the policy's hooks as keys are read, added & removed:
+
+    hit(key)         a cached key was read
+    miss(key)        a key was read but isn't cached
+    add(key)         key was added to the cache
+    remove(key)      key left the cache for a reason other than eviction
+                     (it expired, or was overwritten)
+    evict(incoming)  the cache is full & incoming is about to be added:
+                     forget a key & return it, for the cache to drop
+
+Iterating over a policy gives the cached keys, roughly from the next to be
+evicted to the last; adding them to a new policy in that order rebuilds
+their recency order (e.g. when a cache snapshot is loaded).
+"""
+
+from collections import OrderedDict
+from itertools import chain
+
+
+def _touch(order, key):
+    """Moves key to the most recently used end of an OrderedDict"""
+
+    del order[key]
+    order[key] = None
+
+
+class LRUPolicy(object):
+    """Least Recently Used: evicts the key read or added longest ago"""
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.order = OrderedDict()
+
+    def hit(self, key):
+        _touch(self.order, key)
+
+    def miss(self, key):
+        pass
+
+    def add(self, key):
+        self.order[key] = None
+
+    def remove(self, key):
+        del self.order[key]
+
+    def evict(self, incoming):
+        return self.order.popitem(last=False)[0]
+
+    def __iter__(self):
+        return iter(self.order)
+
+
+class SLRUPolicy(object):
+    """Segmented LRU.
+
+    New keys start on probation; a key read again while on probation moves
+    to the protected segment. Evictions come from probation first, so keys
+    read only once (like those of a scan) can't push out the ones that are
+    read repeatedly. The protected segment holds at most protected_ratio of
+    capacity; its least recently used keys drop back to probation.
+    """
+
+    def __init__(self, capacity, protected_ratio=0.8):
+        self.capacity = capacity
+        self.protected_capacity = max(1, int(capacity * protected_ratio))
+        self.probation = OrderedDict()
+        self.protected = OrderedDict()
+
+    def hit(self, key):
+        if key in self.protected:
+            _touch(self.protected, key)
+            return
+        del self.probation[key]
+        self.protected[key] = None
+        if len(self.protected) > self.protected_capacity:
+            demoted = self.protected.popitem(last=False)[0]
+            self.probation[demoted] = None
+
+    def miss(self, key):
+        pass
+
+    def add(self, key):
+        self.probation[key] = None
+
+    def remove(self, key):
+        if key in self.probation:
+            del self.probation[key]
+        else:
+            del self.protected[key]
+
+    def victim(self):
+        """Key evict() would pick, without evicting it"""
+
+        segment = self.probation or self.protected
+        return next(iter(segment))
+
+    def evict(self, incoming):
+        segment = self.probation or self.protected
+        return segment.popitem(last=False)[0]
+
+    def __len__(self):
+        return len(self.probation) + len(self.protected)
+
+    def __iter__(self):
+        return chain(self.probation, self.protected)
+
+
+class ARCPolicy(object):
+    """Adaptive Replacement Cache (Megiddo & Modha).
+
+    Keys seen once (t1) and keys seen at least twice (t2) are kept in two
+    LRU lists, and recently evicted keys of each are remembered, without
+    values, in two ghost lists (b1, b2). A miss on a ghost key shifts the
+    target size p of t1 towards whichever list would have kept it, so the
+    split between recency & frequency adapts to the workload.
+    """
+
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.p = 0
+        self.t1 = OrderedDict()
+        self.t2 = OrderedDict()
+        self.b1 = OrderedDict()
+        self.b2 = OrderedDict()
+
+    def hit(self, key):
+        if key in self.t1:
+            del self.t1[key]
+            self.t2[key] = None
+        else:
+            _touch(self.t2, key)
+
+    def miss(self, key):
+        pass
+
+    def add(self, key):
+        if key in self.b1:
+            self.p = min(self.capacity, self.p + max(len(self.b2) // len(self.b1), 1))
+            del self.b1[key]
+            self.t2[key] = None
+        elif key in self.b2:
+            self.p = max(0, self.p - max(len(self.b1) // len(self.b2), 1))
+            del self.b2[key]
+            self.t2[key] = None
+        else:
+            self.t1[key] = None
+
+    def remove(self, key):
+        if key in self.t1:
+            del self.t1[key]
+        else:
+            del self.t2[key]
+
+    def evict(self, incoming):
+        t1_size = len(self.t1)
+        if self.t1 and (not self.t2 or t1_size > self.p or (incoming in self.b2 and t1_size == self.p)):
+            key = self.t1.popitem(last=False)[0]
+            self.b1[key] = None
+            if len(self.b1) > self.capacity:
+                self.b1.popitem(last=False)
+        else:
+            key = self.t2.popitem(last=False)[0]
+            self.b2[key] = None
+            if len(self.b2) > self.capacity:
+                self.b2.popitem(last=False)
+        return key
+
+    def __iter__(self):
+        # Ghost keys (b1, b2) aren't cached
+        return chain(self.t1, self.t2)
+
+
+# Halves every counter of a sketch row in one pass
+_HALVE = bytearray(i >> 1 for i in xrange(256))
+
+
+class CountMinSketch(object):
+    """Approximate access counts for TinyLFU, in 4-bit-style saturating
+    counters (max. 15) over depth rows.
+
+    After sample_size increments every counter is halved, so counts track
+    recent popularity and keys that were hot long ago fade out.
+    """
+
+    MAX_COUNT = 15
+
+    def __init__(self, width, depth=4, sample_size=None):
+        self.width = max(16, width)
+        self.depth = depth
+        self.rows = [bytearray(self.width) for _ in xrange(depth)]
+        self.sample_size = sample_size or 10 * self.width
+        self.additions = 0
+        self.resets = 0
+
+    def _indexes(self, key):
+        h = hash(key)
+        step = (h >> 17) | 1
+        width = self.width
+        return [(h + i * step) % width for i in xrange(self.depth)]
+
+    def increment(self, key):
+        for row, i in zip(self.rows, self._indexes(key)):
+            if row[i] < self.MAX_COUNT:
+                row[i] += 1
+        self.additions += 1
+        if self.additions >= self.sample_size:
+            self.rows = [row.translate(_HALVE) for row in self.rows]
+            self.additions //= 2
+            self.resets += 1
+
+    def estimate(self, key):
+        return min(row[i] for row, i in zip(self.rows, self._indexes(key)))
+
+
+class WTinyLFUPolicy(object):
+    """Window TinyLFU (Einziger, Friedman & Manes).
+
+    New keys enter a small LRU window (window_ratio of capacity). A key
+    leaving the window only gets into the main SLRU area if it has been
+    accessed more often, by a count-min sketch of recent accesses, than the
+    key main would evict for it; otherwise it's the one evicted. One-off
+    keys therefore pass through the window without disturbing main.
+    """
+
+    def __init__(self, capacity, window_ratio=0.01):
+        self.capacity = capacity
+        self.window_capacity = max(1, int(capacity * window_ratio))
+        self.window = OrderedDict()
+        self.main = SLRUPolicy(max(1, capacity - self.window_capacity))
+        self.sketch = CountMinSketch(capacity)
+
+        # Stats
+        self.admitted = 0
+        self.rejected = 0
+
+    def hit(self, key):
+        self.sketch.increment(key)
+        if key in self.window:
+            _touch(self.window, key)
+        else:
+            self.main.hit(key)
+
+    def miss(self, key):
+        self.sketch.increment(key)
+
+    def add(self, key):
+        self.window[key] = None
+        # While the cache isn't full, keys leaving the window go straight
+        # into main; once it is, evict() makes room in the window first
+        while len(self.window) > self.window_capacity:
+            self.main.add(self.window.popitem(last=False)[0])
+
+    def remove(self, key):
+        if key in self.window:
+            del self.window[key]
+        else:
+            self.main.remove(key)
+
+    def evict(self, incoming):
+        if not len(self.main):
+            return self.window.popitem(last=False)[0]
+        if len(self.window) < self.window_capacity:
+            # The window has room for incoming, so main gives up a key
+            return self.main.evict(incoming)
+        # incoming pushes the window's oldest key out: admit it into main
+        # only if it's more popular than main's victim
+        candidate = next(iter(self.window))
+        victim = self.main.victim()
+        del self.window[candidate]
+        if self.sketch.estimate(candidate) > self.sketch.estimate(victim):
+            self.main.remove(victim)
+            self.main.add(candidate)
+            self.admitted += 1
+            return victim
+        self.rejected += 1
+        return candidate
+
+    def __iter__(self):
+        # Window keys are the newest
+        return chain(self.main, self.window)
+
+
+POLICIES = {
+    'lru': LRUPolicy,
+    'slru': SLRUPolicy,
+    'arc': ARCPolicy,
+    'tinylfu': WTinyLFUPolicy,
+}
+
+
+def make_policy(name, capacity):
+    """Builds an eviction policy
+        :param name (str): one of POLICIES
+        :param capacity (int): # of keys the cache is expected to hold
+    """
+
+    try:
+        policy_cls = POLICIES[name]
+    except KeyError:
+        raise ValueError("Unknown eviction policy %r (choose from %s)" % (name, ", ".join(sorted(POLICIES))))
+    return policy_cls(capacity)
@@ -0,0 +1,222 @@
+import unittest
+
+from bench_hit_ratio import hit_ratio, scan_trace, zipf_trace
+from eviction import (
+    ARCPolicy,
+    CountMinSketch,
+    LRUPolicy,
+    make_policy,
+    SLRUPolicy,
+    WTinyLFUPolicy,
+)
+
+
+def fill(policy, keys):
+    for key in keys:
+        policy.add(key)
+
+
+class TestLRUPolicy(unittest.TestCase):
+
+    def test_evicts_least_recently_used(self):
+        """Test that a read key is evicted after keys read less recently"""
+
+        policy = LRUPolicy(3)
+        fill(policy, ['a', 'b', 'c'])
+        policy.hit('a')
+
+        self.assertEqual(policy.evict('d'), 'b')
+        self.assertEqual(policy.evict('d'), 'c')
+
+    def test_removed_key_not_evicted(self):
+        """Test that a removed (e.g. expired) key is forgotten"""
+
+        policy = LRUPolicy(3)
+        fill(policy, ['a', 'b'])
+        policy.remove('a')
+
+        self.assertEqual(policy.evict('c'), 'b')
+
+    def test_iterates_in_eviction_order(self):
+        policy = LRUPolicy(3)
+        fill(policy, ['a', 'b', 'c'])
+        policy.hit('a')
+
+        self.assertEqual(list(policy), ['b', 'c', 'a'])
+
+
+class TestSLRUPolicy(unittest.TestCase):
+
+    def test_reread_key_protected(self):
+        """Test that keys read twice outlive newer keys read once"""
+
+        policy = SLRUPolicy(4)
+        fill(policy, ['hot', 'a', 'b'])
+        policy.hit('hot')
+        fill(policy, ['c'])
+
+        self.assertEqual([policy.evict('x') for _ in xrange(3)], ['a', 'b', 'c'])
+        self.assertEqual(policy.evict('x'), 'hot')
+
+    def test_protected_overflow_demoted(self):
+        """Test that the protected segment's LRU key drops back to probation"""
+
+        policy = SLRUPolicy(2, protected_ratio=0.5)
+        fill(policy, ['a', 'b'])
+        policy.hit('a')
+        policy.hit('b')
+
+        self.assertEqual(policy.probation.keys(), ['a'])
+        self.assertEqual(policy.protected.keys(), ['b'])
+
+    def test_iterates_probation_then_protected(self):
+        policy = SLRUPolicy(4)
+        fill(policy, ['hot', 'a', 'b'])
+        policy.hit('hot')
+
+        self.assertEqual(list(policy), ['a', 'b', 'hot'])
+
+
+class TestARCPolicy(unittest.TestCase):
+
+    def test_evicted_keys_become_ghosts(self):
+        """Test that evicted keys are remembered without being cached"""
+
+        policy = ARCPolicy(2)
+        fill(policy, ['a', 'b'])
+
+        self.assertEqual(policy.evict('c'), 'a')
+        self.assertIn('a', policy.b1)
+        self.assertNotIn('a', policy.t1)
+
+    def test_ghost_hit_adapts_target(self):
+        """Test that re-adding a recently evicted key grows t1's target size
+            and goes straight to t2
+        """
+
+        policy = ARCPolicy(2)
+        fill(policy, ['a', 'b'])
+        policy.evict('c')
+        policy.add('c')
+        policy.evict('a')
+        policy.add('a')
+
+        self.assertEqual(policy.p, 1)
+        self.assertIn('a', policy.t2)
+
+    def test_ghosts_not_iterated(self):
+        policy = ARCPolicy(2)
+        fill(policy, ['a', 'b'])
+        policy.evict('c')
+        policy.add('c')
+
+        self.assertEqual(list(policy), ['b', 'c'])
+
+
+class TestCountMinSketch(unittest.TestCase):
+
+    def test_estimates_counts(self):
+        """Test that counts are estimated, & never under-estimated"""
+
+        sketch = CountMinSketch(1024)
+        for _ in xrange(5):
+            sketch.increment('hot')
+        sketch.increment('cold')
+
+        self.assertGreaterEqual(sketch.estimate('hot'), 5)
+        self.assertGreaterEqual(sketch.estimate('cold'), 1)
+        self.assertLess(sketch.estimate('cold'), 5)
+
+    def test_counts_halved_after_sample(self):
+        """Test that counts age, so old popularity fades"""
+
+        sketch = CountMinSketch(16, sample_size=10)
+        for _ in xrange(10):
+            sketch.increment('hot')
+
+        self.assertEqual(sketch.resets, 1)
+        self.assertEqual(sketch.estimate('hot'), 5)
+
+    def test_counters_saturate(self):
+        sketch = CountMinSketch(1024)
+        for _ in xrange(100):
+            sketch.increment('hot')
+        self.assertEqual(sketch.estimate('hot'), CountMinSketch.MAX_COUNT)
+
+
+class TestWTinyLFUPolicy(unittest.TestCase):
+
+    def test_unpopular_candidate_rejected(self):
+        """Test that a key leaving the window loses to a more popular victim"""
+
+        policy = WTinyLFUPolicy(3, window_ratio=0.34)
+        for key in ['a', 'b', 'c']:
+            policy.miss(key)
+            policy.add(key)
+        for _ in xrange(3):
+            policy.hit('a')
+            policy.hit('b')
+
+        # c's in the window & was read once; main's victim is more popular
+        policy.miss('d')
+        self.assertEqual(policy.evict('d'), 'c')
+        self.assertEqual(policy.rejected, 1)
+
+    def test_popular_candidate_admitted(self):
+        """Test that a key leaving the window displaces a less popular victim"""
+
+        policy = WTinyLFUPolicy(3, window_ratio=0.34)
+        for key in ['a', 'b', 'c']:
+            policy.miss(key)
+            policy.add(key)
+        for _ in xrange(3):
+            policy.hit('c')
+
+        self.assertEqual(policy.evict('d'), 'a')
+        self.assertEqual(policy.admitted, 1)
+        self.assertIn('c', policy.main.probation)
+
+    def test_window_keys_iterated_last(self):
+        policy = WTinyLFUPolicy(3, window_ratio=0.34)
+        fill(policy, ['a', 'b', 'c'])
+
+        self.assertEqual(list(policy), ['a', 'b', 'c'])
+
+
+class TestHitRatios(unittest.TestCase):
+    """Hit ratios replayed through LRUCache, as bench_hit_ratio.py does"""
+
+    def test_zipf_trace(self):
+        """Test that the frequency-aware policies beat LRU on a skewed trace"""
+
+        trace = zipf_trace(2000, 20000, seed=1)
+        lru = hit_ratio('lru', trace, 100)
+        self.assertGreater(lru, 0.3)
+        for policy in ['slru', 'arc', 'tinylfu']:
+            self.assertGreater(hit_ratio(policy, trace, 100), lru + 0.03, policy)
+
+    def test_scans_do_not_flush_hot_set(self):
+        """Test that one-off keys from scans don't evict the hot set"""
+
+        trace = scan_trace(hot_keys=40, scan_length=200, rounds=10, seed=1)
+        lru = hit_ratio('lru', trace, 100)
+        for policy in ['slru', 'arc', 'tinylfu']:
+            self.assertGreater(hit_ratio(policy, trace, 100), lru + 0.05, policy)
+
+    def test_lru_policy_matches_plain_lru(self):
+        """Test that the default policy still behaves as a plain LRU"""
+
+        trace = ['a', 'b', 'c', 'a', 'd', 'b', 'a']
+        # With room for 3: a b c miss, a hits, d evicts b, b evicts c, a hits
+        self.assertAlmostEqual(hit_ratio('lru', trace, 3), 2 / 7.0)
+
+
+class TestMakePolicy(unittest.TestCase):
+
+    def test_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            make_policy('mru', 10)
+
+
+if __name__ == "__main__":
+    unittest.main()
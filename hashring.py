@@ -0,0 +1,89 @@
+"""Consistent hash ring routing keys across backing Redis instances"""
+
+from bisect import bisect
+from collections import OrderedDict
+from hashlib import md5
+import struct
+
+
+DEFAULT_VNODES = 160
+DEFAULT_REDIS_PORT = 6379
+
+
+def ring_hash(data):
+    return struct.unpack_from("<Q", md5(data).digest())[0]
+
+
+def parse_backend(spec):
+    """Parses a --backend argument
+        :param spec (str): "host:port", or "host" for Redis's default port
+        :returns: (host, port) tuple
+    """
+
+    host, sep, port = spec.rpartition(':')
+    if not sep:
+        return spec, DEFAULT_REDIS_PORT
+    return host, int(port)
+
+
+class HashRing(object):
+    """Maps keys to nodes so that changing the nodes moves few keys.
+
+    Each node is hashed onto the ring at vnodes points ("node#0", "node#1",
+    ...), and a key belongs to the node owning the first point at or after
+    the key's own hash, wrapping around. Points depend only on node names,
+    not on the order nodes are listed in; adding a node takes about 1/N of
+    the keys, all from the others, and removing one hands only its own keys
+    to the rest.
+    """
+
+    def __init__(self, nodes=(), vnodes=DEFAULT_VNODES):
+        """
+            :param nodes (iterable): node names (str)
+            :param vnodes (int): # of ring points per node; more points
+                spread keys more evenly
+        """
+
+        self.vnodes = vnodes
+        self.nodes = []
+        self.points = []
+        self.owners = []
+        for node in nodes:
+            self.add(node)
+
+    def add(self, node):
+        if node in self.nodes:
+            return
+        self.nodes.append(node)
+        self._build()
+
+    def remove(self, node):
+        self.nodes.remove(node)
+        self._build()
+
+    def node_for(self, key):
+        if len(self.nodes) == 1:
+            return self.nodes[0]
+        if not self.nodes:
+            raise LookupError("No nodes in hash ring")
+        i = bisect(self.points, ring_hash(key))
+        return self.owners[i % len(self.owners)]
+
+    def split(self, keys):
+        """Groups keys by node
+            :returns: OrderedDict of node -> keys, in the order first seen
+        """
+
+        groups = OrderedDict()
+        for key in keys:
+            groups.setdefault(self.node_for(key), []).append(key)
+        return groups
+
+    def _build(self):
+        ring = sorted(
+            (ring_hash("%s#%s" % (node, i)), node)
+            for node in self.nodes
+            for i in xrange(self.vnodes)
+        )
+        self.points = [point for point, node in ring]
+        self.owners = [node for point, node in ring]
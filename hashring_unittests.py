@@ -0,0 +1,88 @@
+import unittest
+
+from hashring import HashRing, parse_backend
+
+
+KEYS = ["key:%s" % i for i in xrange(10000)]
+
+
+def assignments(ring):
+    return dict((key, ring.node_for(key)) for key in KEYS)
+
+
+class TestHashRing(unittest.TestCase):
+
+    def test_single_node_gets_every_key(self):
+        ring = HashRing(['a:6379'])
+        self.assertEqual(set(assignments(ring).values()), set(['a:6379']))
+
+    def test_empty_ring(self):
+        with self.assertRaises(LookupError):
+            HashRing().node_for('foo')
+
+    def test_routing_independent_of_node_order(self):
+        """Test that listing the same backends in another order routes keys
+            the same way
+        """
+
+        nodes = ['a:6379', 'b:6379', 'c:6379']
+        self.assertEqual(
+            assignments(HashRing(nodes)),
+            assignments(HashRing(reversed(nodes))),
+        )
+
+    def test_keys_spread_evenly(self):
+        nodes = ['a:6379', 'b:6379', 'c:6379', 'd:6379']
+        counts = dict.fromkeys(nodes, 0)
+        for node in assignments(HashRing(nodes)).itervalues():
+            counts[node] += 1
+
+        for node, count in counts.iteritems():
+            self.assertGreater(count, len(KEYS) / 4 * 0.8, node)
+            self.assertLess(count, len(KEYS) / 4 * 1.2, node)
+
+    def test_adding_node_moves_only_its_share(self):
+        """Test that a new node takes about 1/N of the keys, & that no key
+            moves between the existing nodes
+        """
+
+        ring = HashRing(['a:6379', 'b:6379', 'c:6379'])
+        before = assignments(ring)
+        ring.add('d:6379')
+        after = assignments(ring)
+
+        moved = [key for key in KEYS if before[key] != after[key]]
+        self.assertTrue(all(after[key] == 'd:6379' for key in moved))
+        self.assertGreater(len(moved), len(KEYS) / 4 * 0.8)
+        self.assertLess(len(moved), len(KEYS) / 4 * 1.2)
+
+    def test_removing_node_moves_only_its_keys(self):
+        ring = HashRing(['a:6379', 'b:6379', 'c:6379'])
+        before = assignments(ring)
+        ring.remove('b:6379')
+        after = assignments(ring)
+
+        for key in KEYS:
+            if before[key] != 'b:6379':
+                self.assertEqual(after[key], before[key])
+
+    def test_split_groups_keys_by_node(self):
+        ring = HashRing(['a:6379', 'b:6379'])
+        groups = ring.split(KEYS[:100])
+
+        self.assertEqual(sorted(sum(groups.values(), [])), sorted(KEYS[:100]))
+        for node, keys in groups.iteritems():
+            self.assertTrue(all(ring.node_for(key) == node for key in keys))
+
+
+class TestParseBackend(unittest.TestCase):
+
+    def test_host_and_port(self):
+        self.assertEqual(parse_backend('redis-2:6380'), ('redis-2', 6380))
+
+    def test_default_port(self):
+        self.assertEqual(parse_backend('redis-2'), ('redis-2', 6379))
+
+
+if __name__ == "__main__":
+    unittest.main()
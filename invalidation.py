@@ -0,0 +1,288 @@
+"""Write pass-through: which client commands are writes, the keys each one
+changes, & per-key versions for keeping fetches that raced a write out of
+the cache.
+
+A write goes to Redis as it is, & once Redis has replied, each key it
+names is invalidated: its version is bumped & it's deleted from the cache
+(and the negative cache). A miss notes the key's version before its fetch
+is sent, & after caching the value it fetched, deletes it again if the
+version has moved on. Either the write's delete comes after the miss's set
+& removes the value, or the miss sees the bump; a value fetched before the
+write landed can't stay cached.
+
+Keys share versions by hash, in `stripes` counters, so a write to one key
+also voids fetches of the others in its stripe; at worst they're fetched
+again on the next read.
+
+Writes that don't go through the proxy are announced by Redis itself, on a
+dedicated connection per backend (InvalidationFeed): each key it names is
+invalidated the same way. While that connection is down the proxy doesn't
+know what changed, so the cache is flushed (& every version bumped) when it
+drops & again once it's back, and nothing is cached in between.
+"""
+
+import multiprocessing
+import threading
+
+from resp import encode_command, parse_redis_reply, ProtocolError, RedisError
+
+
+DEFAULT_STRIPES = 4096
+
+# Write command -> (first key, last key, step) of its arguments, as in
+# Redis's COMMAND table; a last key of -1 is the last argument
+WRITE_COMMANDS = {
+    'APPEND': (1, 1, 1),
+    'DECR': (1, 1, 1),
+    'DECRBY': (1, 1, 1),
+    'DEL': (1, -1, 1),
+    'EXPIRE': (1, 1, 1),
+    'EXPIREAT': (1, 1, 1),
+    'GETDEL': (1, 1, 1),
+    'GETEX': (1, 1, 1),
+    'GETSET': (1, 1, 1),
+    'INCR': (1, 1, 1),
+    'INCRBY': (1, 1, 1),
+    'INCRBYFLOAT': (1, 1, 1),
+    'MSET': (1, -1, 2),
+    'MSETNX': (1, -1, 2),
+    'PERSIST': (1, 1, 1),
+    'PEXPIRE': (1, 1, 1),
+    'PEXPIREAT': (1, 1, 1),
+    'PSETEX': (1, 1, 1),
+    'RENAME': (1, 2, 1),
+    'RENAMENX': (1, 2, 1),
+    'SET': (1, 1, 1),
+    'SETEX': (1, 1, 1),
+    'SETNX': (1, 1, 1),
+    'SETRANGE': (1, 1, 1),
+    'UNLINK': (1, -1, 1),
+}
+
+# Replies to writes the proxy can't pass through, worded as Redis would
+CROSS_BACKEND_ERROR = "CROSSSLOT Keys of one write must all be on the same backend"
+
+INVALIDATION_MODES = ('tracking', 'keyspace')
+TRACKING_CHANNEL = "__redis__:invalidate"
+KEYSPACE_PREFIX = "__keyspace@0__:"
+# Seconds between attempts to reconnect a dropped invalidation connection
+RETRY_INTERVAL = 1.0
+
+
+def write_keys(args):
+    """Keys a client command writes to
+        :param args (list): command name & arguments
+        :returns: list of keys, or None if the command isn't a write
+    """
+
+    spec = WRITE_COMMANDS.get(args[0].upper())
+    if spec is None:
+        return None
+    first, last, step = spec
+    if last < 0:
+        last = len(args) + last
+    return args[first:last + 1:step]
+
+
+def arity_error(args):
+    return "ERR wrong number of arguments for '%s' command" % args[0].lower()
+
+
+class KeyVersions(object):
+    """Write counters, one per stripe of keys"""
+
+    def __init__(self, stripes=DEFAULT_STRIPES, shared=False):
+        """
+            :param stripes (int): # of counters
+            :param shared (bool): keep the counters in shared memory, for
+                worker processes forked afterwards
+        """
+
+        if shared:
+            self.counts = multiprocessing.RawArray('L', stripes)
+            self.lock = multiprocessing.Lock()
+        else:
+            self.counts = [0] * stripes
+            self.lock = threading.Lock()
+
+        # Stats
+        self.writes = 0
+        self.invalidated = 0
+        self.voided = 0
+
+    def current(self, key):
+        """Version to note before fetching key"""
+
+        return self.counts[hash(key) % len(self.counts)]
+
+    def bump(self, keys):
+        """Moves on the version of each key's stripe, once per stripe"""
+
+        stripes = set(hash(key) % len(self.counts) for key in keys)
+        with self.lock:
+            for stripe in stripes:
+                self.counts[stripe] += 1
+
+    def bump_all(self):
+        """Moves on every stripe's version, voiding every fetch in flight"""
+
+        with self.lock:
+            for stripe in xrange(len(self.counts)):
+                self.counts[stripe] += 1
+
+    def stats(self):
+        return {
+            'writes': self.writes,
+            'invalidated_keys': self.invalidated,
+            'voided_fetches': self.voided,
+        }
+
+
+class InvalidationFeed(object):
+    """Redis's notices of changed keys, read off a dedicated connection to
+    one backend.
+
+    In 'tracking' mode, the connection turns on CLIENT TRACKING in broadcast
+    mode, redirected to itself, & subscribes to __redis__:invalidate: Redis
+    then publishes the keys each write changes (only those starting with one
+    of `prefixes`, if any are given), and a nil when the database is
+    flushed. This needs Redis 6 or later.
+
+    In 'keyspace' mode, it pattern-subscribes to db 0's keyspace
+    notifications, which Redis only sends if notify-keyspace-events has K &
+    the classes of event to send (e.g. "KA"); a FLUSHALL isn't announced.
+
+    The engine owns the socket: it connects, has subscribe() run the
+    handshake, then passes whatever it reads to feed().
+    """
+
+    def __init__(self, name, mode='tracking', prefixes=()):
+        """
+            :param name (str): host:port of the backend
+            :param mode (str): tracking or keyspace
+            :param prefixes (list): key prefixes to track; all keys if empty
+        """
+
+        if mode not in INVALIDATION_MODES:
+            raise ValueError("Unknown invalidation mode %r" % mode)
+        self.name = name
+        self.mode = mode
+        self.prefixes = list(prefixes)
+        self.conn = None
+        self.inbuf = bytearray()
+        # Monotonic time of the next reconnect attempt, while disconnected
+        self.retry_at = 0
+
+        # Stats
+        self.messages = 0
+        self.keys = 0
+        self.flushes = 0
+        self.disconnects = 0
+
+    def subscribe(self, conn):
+        """Runs the handshake on a blocking connection
+            :param conn (RedisConnection): new connection to the backend;
+                closed if the handshake fails
+            :raises: RedisError if Redis refuses
+        """
+
+        try:
+            self._handshake(conn)
+        except Exception:
+            conn.close()
+            raise
+        self.conn = conn
+        # Any messages read along with the confirmation
+        self.inbuf = bytearray(conn.buf[conn.start:conn.end])
+        conn.start = conn.end
+
+    def _handshake(self, conn):
+        if self.mode == 'tracking':
+            conn.sendall(encode_command("CLIENT", "ID"))
+            client_id = self._check(conn.read_reply())
+            tracking = ["CLIENT", "TRACKING", "ON", "REDIRECT", client_id, "BCAST"]
+            for prefix in self.prefixes:
+                tracking.extend(["PREFIX", prefix])
+            conn.sendall(encode_command(*tracking) + encode_command("SUBSCRIBE", TRACKING_CHANNEL))
+            self._check(conn.read_reply())
+        else:
+            conn.sendall(
+                encode_command("CONFIG", "GET", "notify-keyspace-events")
+                + encode_command("PSUBSCRIBE", KEYSPACE_PREFIX + "*")
+            )
+            config = conn.read_reply()
+            # CONFIG may be renamed away; then there's nothing to check
+            if isinstance(config, list) and len(config) == 2 and "K" not in config[1]:
+                print "Keyspace notifications are off on %s: set notify-keyspace-events to KA" % self.name
+        self._check(conn.read_reply())
+
+    def feed(self, data):
+        """Parses the complete messages read so far
+            :param data (str): bytes read off the connection
+            :returns: list of invalidations: each a list of keys, or None
+                if every key must be invalidated
+        """
+
+        self.inbuf.extend(data)
+        invalidations = []
+        pos = 0
+        while True:
+            try:
+                reply, consumed = parse_redis_reply(self.inbuf, pos)
+            except ValueError:
+                raise ProtocolError("invalid message from %s" % self.name)
+            if not consumed:
+                break
+            pos += consumed
+            keys = self._keys(reply)
+            if keys is None:
+                self.flushes += 1
+            elif not keys:
+                continue
+            else:
+                self.keys += len(keys)
+            self.messages += 1
+            invalidations.append(keys)
+        del self.inbuf[:pos]
+        return invalidations
+
+    def close(self):
+        """Drops the connection, e.g. after a read failed"""
+
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.disconnects += 1
+        self.inbuf = bytearray()
+
+    def stats(self):
+        return {
+            'connected': int(self.conn is not None),
+            'messages': self.messages,
+            'invalidated_keys': self.keys,
+            'flushes': self.flushes,
+            'disconnects': self.disconnects,
+        }
+
+    def _keys(self, reply):
+        """Keys a message names: a list (empty for anything that isn't an
+            invalidation, e.g. a subscribe confirmation), or None for all
+        """
+
+        if not isinstance(reply, list):
+            return []
+        if self.mode == 'tracking':
+            if len(reply) != 3 or reply[0] != "message" or reply[1] != TRACKING_CHANNEL:
+                return []
+            keys = reply[2]
+            if keys is None:
+                return None
+            return keys if isinstance(keys, list) else [keys]
+        if len(reply) != 4 or reply[0] != "pmessage" or not reply[2].startswith(KEYSPACE_PREFIX):
+            return []
+        return [reply[2][len(KEYSPACE_PREFIX):]]
+
+    def _check(self, reply):
+        if isinstance(reply, RedisError):
+            raise reply
+        return reply
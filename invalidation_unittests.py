@@ -0,0 +1,200 @@
+import mock
+import os
+import socket
+import time
+import unittest
+
+from bench_proxy import FakeRedis
+from invalidation import InvalidationFeed, KeyVersions, TRACKING_CHANNEL, write_keys
+from resp import encode_command, encode_reply, RedisConnection, RedisError
+import threaded_proxy
+
+
+def wait_until(condition, timeout=5.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise AssertionError("timed out")
+        time.sleep(0.01)
+
+
+class TestWriteKeys(unittest.TestCase):
+
+    def test_single_key(self):
+        self.assertEqual(write_keys(['set', 'foo', 'bar', 'EX', '10']), ['foo'])
+        self.assertEqual(write_keys(['INCR', 'hits']), ['hits'])
+
+    def test_every_argument(self):
+        self.assertEqual(write_keys(['DEL', 'a', 'b', 'c']), ['a', 'b', 'c'])
+
+    def test_key_value_pairs(self):
+        self.assertEqual(write_keys(['MSET', 'a', '1', 'b', '2']), ['a', 'b'])
+
+    def test_rename(self):
+        self.assertEqual(write_keys(['RENAME', 'old', 'new']), ['old', 'new'])
+
+    def test_missing_key(self):
+        self.assertEqual(write_keys(['SET']), [])
+
+    def test_not_a_write(self):
+        self.assertIsNone(write_keys(['GET', 'foo']))
+        self.assertIsNone(write_keys(['FLUSHALL']))
+
+
+class TestKeyVersions(unittest.TestCase):
+
+    def test_bump(self):
+        versions = KeyVersions()
+        before = versions.current('foo')
+        versions.bump(['foo', 'foo'])
+
+        self.assertEqual(versions.current('foo'), before + 1)
+
+    def test_keys_share_stripes(self):
+        versions = KeyVersions(stripes=1)
+        versions.bump(['foo'])
+
+        self.assertEqual(versions.current('bar'), 1)
+
+    def test_bump_all(self):
+        versions = KeyVersions(stripes=8)
+        versions.bump(['foo'])
+        before = [versions.current(key) for key in ('foo', 'bar', 'baz')]
+        versions.bump_all()
+
+        self.assertEqual([versions.current(key) for key in ('foo', 'bar', 'baz')], [v + 1 for v in before])
+
+    def test_shared_with_forked_process(self):
+        versions = KeyVersions(shared=True)
+        pid = os.fork()
+        if pid == 0:
+            versions.bump(['foo'])
+            os._exit(0)
+        os.waitpid(pid, 0)
+
+        self.assertEqual(versions.current('foo'), 1)
+        self.assertEqual(versions.current('bar'), 0)
+
+
+class TestInvalidationFeed(unittest.TestCase):
+
+    def test_tracking_messages(self):
+        feed = InvalidationFeed('a:6379')
+        message = encode_reply(["message", TRACKING_CHANNEL, ["foo", "bar"]])
+
+        self.assertEqual(feed.feed(encode_reply(["subscribe", TRACKING_CHANNEL, "1"])), [])
+        self.assertEqual(feed.feed(message[:10]), [])
+        self.assertEqual(feed.feed(message[10:] + "*3\r\n$7\r\nmessage\r\n"), [["foo", "bar"]])
+        self.assertEqual(feed.feed("$20\r\n%s\r\n$-1\r\n" % TRACKING_CHANNEL), [None])
+        self.assertEqual(feed.stats()['invalidated_keys'], 2)
+        self.assertEqual(feed.stats()['flushes'], 1)
+
+    def test_keyspace_messages(self):
+        feed = InvalidationFeed('a:6379', mode='keyspace')
+        message = encode_reply(["pmessage", "__keyspace@0__:*", "__keyspace@0__:foo", "set"])
+
+        self.assertEqual(feed.feed(message + message.replace(":foo", ":bar")), [["foo"], ["bar"]])
+        self.assertEqual(feed.feed(encode_reply(["pmessage", "__keyspace@0__:*", "__keyevent@0__:del", "foo"])), [])
+
+    def test_refused_handshake_closes_connection(self):
+        """Test that a Redis without CLIENT TRACKING fails the subscribe"""
+
+        conn = mock.MagicMock()
+        conn.read_reply.return_value = RedisError("ERR unknown command 'CLIENT'")
+        feed = InvalidationFeed('a:6379')
+
+        with self.assertRaises(RedisError):
+            feed.subscribe(conn)
+        conn.close.assert_called_once_with()
+        self.assertIsNone(feed.conn)
+
+    def test_unknown_mode(self):
+        with self.assertRaises(ValueError):
+            InvalidationFeed('a:6379', mode='polling')
+
+
+class TestFakeRedisInvalidation(unittest.TestCase):
+    """Against a stand-in Redis that announces its writes"""
+
+    def setUp(self):
+        self.fake_redis = FakeRedis({'key:1': 'old', 'other:1': 'x'}).start()
+        self.writer = RedisConnection(socket.create_connection(self.fake_redis.server_address))
+
+    def tearDown(self):
+        self.writer.close()
+        self.fake_redis.stop()
+
+    def subscribe(self, feed):
+        feed.subscribe(RedisConnection(socket.create_connection(self.fake_redis.server_address)))
+        self.addCleanup(feed.close)
+
+    def write(self, *args):
+        self.writer.sendall(encode_command(*args))
+        return self.writer.read_reply()
+
+    def read(self, feed):
+        feed.conn.sock.settimeout(5)
+        invalidations = []
+        while not invalidations:
+            invalidations = feed.feed(feed.conn.sock.recv(4096))
+        return invalidations
+
+    def test_tracking(self):
+        feed = InvalidationFeed('fake', prefixes=['key:'])
+        self.subscribe(feed)
+
+        self.write("SET", "other:1", "y")
+        self.write("SET", "key:1", "new")
+        self.assertEqual(self.read(feed), [["key:1"]])
+        self.write("FLUSHALL")
+        self.assertEqual(self.read(feed), [None])
+
+    def test_keyspace(self):
+        feed = InvalidationFeed('fake', mode='keyspace')
+        self.subscribe(feed)
+
+        self.write("DEL", "key:1", "other:1")
+        self.assertEqual(self.read(feed), [["key:1"], ["other:1"]])
+
+
+
+class TestInvalidationListener(unittest.TestCase):
+    """Threaded proxy subscribed to a stand-in Redis"""
+
+    def setUp(self):
+        self.fake_redis = FakeRedis({'key:1': 'old'}).start()
+        self.writer = RedisConnection(socket.create_connection(self.fake_redis.server_address))
+        self.proxy = threaded_proxy.RedisProxy(
+            backends=[self.fake_redis.server_address],
+            capacity=5,
+            invalidation='tracking',
+        )
+
+    def tearDown(self):
+        self.writer.close()
+        self.fake_redis.stop()
+
+    def test_write_elsewhere_invalidates(self):
+        self.assertEqual(self.proxy.get('key:1'), 'old')
+        self.assertEqual(self.proxy.cache.get('key:1'), 'old')
+
+        self.writer.sendall(encode_command("SET", "key:1", "new"))
+        self.writer.read_reply()
+        wait_until(lambda: self.proxy.cache.get('key:1') is None)
+        self.assertEqual(self.proxy.get('key:1'), 'new')
+        self.assertEqual(self.proxy.stats()['invalidation']['invalidated_keys'], 1)
+
+    def test_lost_connection_flushes_cache(self):
+        self.proxy.get('key:1')
+        self.fake_redis.disconnect_subscribers()
+        wait_until(lambda: self.proxy.stats()['invalidation']['disconnects'] == 1)
+        self.assertIsNone(self.proxy.cache.get('key:1'))
+
+        # Resubscribed after RETRY_INTERVAL, & caching again
+        wait_until(lambda: self.proxy.stats()['invalidation']['connected'])
+        self.proxy.get('key:1')
+        self.assertEqual(self.proxy.cache.get('key:1'), 'old')
+
+
+if __name__ == "__main__":
+    unittest.main()
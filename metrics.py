@@ -0,0 +1,387 @@
+"""Counters & latency histograms for the proxies, reported by the STATS/INFO
+command on the client port and, optionally, as Prometheus text over HTTP.
+
+Recording is meant to be cheap enough to leave on: a sample is a couple of
+clock reads, an int conversion & a few attribute updates. Counts are bumped
+without a lock; under the GIL, a thread switch between reading & writing a
+count can now & then lose an increment, which is fine for metrics.
+"""
+
+import BaseHTTPServer
+from collections import OrderedDict
+import math
+import threading
+import time
+
+
+# Commands answered with the proxy's own metrics
+INFO_COMMANDS = ("INFO", "STATS")
+
+# Linear sub-buckets per power of two, so samples are recorded to within
+# 1/16 (about 6%) of their value
+SUB_BUCKET_BITS = 4
+SUB_BUCKETS = 1 << SUB_BUCKET_BITS
+# Largest sample tracked, in microseconds (about 70 minutes); longer ones
+# are counted as this
+MAX_MICROS = (1 << 32) - 1
+PERCENTILES = (50, 90, 99, 99.9)
+# Bucket bounds, in seconds, of the Prometheus histograms
+PROMETHEUS_BUCKETS = (
+    0.00005, 0.0001, 0.00025, 0.0005,
+    0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1.0, 2.5,
+)
+
+# Wall clock, for timing samples: monotonic() goes through ctypes & costs
+# about 1us a call, over 10x time.time(). A clock step skews a sample or
+# two; negative ones are counted as 0.
+clock = time.time
+
+
+def bucket_index(micros):
+    """Histogram bucket for a sample: exact below SUB_BUCKETS us, then
+        SUB_BUCKETS equal buckets per power of two
+    """
+
+    if micros < SUB_BUCKETS:
+        return micros
+    shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+    return (shift + 1) * SUB_BUCKETS + (micros >> shift) - SUB_BUCKETS
+
+
+def bucket_upper_bound(index):
+    """Largest sample, in us, that lands in bucket index"""
+
+    if index < SUB_BUCKETS:
+        return index
+    shift = index // SUB_BUCKETS - 1
+    sub_bucket = index % SUB_BUCKETS + SUB_BUCKETS
+    return ((sub_bucket + 1) << shift) - 1
+
+
+class Histogram(object):
+    """HDR-style latency histogram: log-linear buckets of microseconds, so
+    percentiles keep the same relative precision from 1us to an hour in a
+    fixed list of under 500 counts.
+    """
+
+    def __init__(self):
+        self.counts = [0] * (bucket_index(MAX_MICROS) + 1)
+        self.total = 0.0
+        self.max = 0
+
+    @property
+    def count(self):
+        # Summed when read, so record() has one count less to bump
+        return sum(self.counts)
+
+    def record(self, seconds):
+        """Adds one sample
+            :param seconds (float)
+        """
+
+        micros = int(seconds * 1000000)
+        # bucket_index(), inlined: this runs on every request
+        if micros < SUB_BUCKETS:
+            if micros < 0:
+                micros = 0
+            index = micros
+        else:
+            if micros > MAX_MICROS:
+                micros = MAX_MICROS
+            shift = micros.bit_length() - SUB_BUCKET_BITS - 1
+            index = (shift << SUB_BUCKET_BITS) + (micros >> shift)
+        self.counts[index] += 1
+        self.total += seconds
+        if micros > self.max:
+            self.max = micros
+
+    def percentile(self, pct):
+        """
+            :param pct (float): 0-100
+            :returns: seconds the pct-th percentile sample took, to within a
+                bucket (0 if nothing was recorded)
+        """
+
+        count = self.count
+        if not count:
+            return 0.0
+        target = max(1, int(math.ceil(count * pct / 100.0)))
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return min(bucket_upper_bound(index), self.max) / 1e6
+        return self.max / 1e6
+
+    def merge(self, other):
+        """Adds other's samples to this histogram"""
+
+        for index, count in enumerate(other.counts):
+            self.counts[index] += count
+        self.total += other.total
+        self.max = max(self.max, other.max)
+
+    def cumulative_counts(self, bounds):
+        """# of samples at or under each bound, to within a bucket
+            :param bounds (list): ascending, in seconds
+        """
+
+        counts = []
+        seen = 0
+        index = 0
+        for bound in bounds:
+            last = bucket_index(min(int(bound * 1000000), MAX_MICROS))
+            while index <= last:
+                seen += self.counts[index]
+                index += 1
+            counts.append(seen)
+        return counts
+
+
+class Metrics(object):
+    """A proxy's counters & latency histograms. Cache counts (hits, misses,
+    evictions, expiries) are kept by the caches themselves, & reported
+    alongside these from RedisProxy.stats().
+    """
+
+    def __init__(self):
+        self.started = clock()
+        self.connections_received = 0
+        self.connected_clients = 0
+        # Turned away at the connection limit
+        self.rejected_connections = 0
+        self.commands = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        # Time to answer a GET/MGET from the proxy's caches
+        self.hit_latency = Histogram()
+        # Time to answer a GET/MGET that went to Redis
+        self.miss_latency = Histogram()
+
+    def info(self, stats, section=None):
+        """Formats metrics like Redis's INFO reply: "# Section" headers &
+            "field:value" lines
+            :param stats (dict): RedisProxy.stats()
+            :param section (str): only report this section
+            :returns: str
+        """
+
+        sections = self._sections(stats)
+        if section is not None:
+            section = section.lower()
+            sections = OrderedDict(
+                (name, fields) for name, fields in sections.iteritems()
+                if name.lower() == section
+            )
+        lines = []
+        for name, fields in sections.iteritems():
+            if lines:
+                lines.append("")
+            lines.append("# %s" % name)
+            lines.extend("%s:%s" % field for field in fields)
+        return "\r\n".join(lines) + "\r\n"
+
+    def prometheus(self, stats):
+        """Formats metrics in the Prometheus text exposition format
+            :param stats (dict): RedisProxy.stats()
+            :returns: str
+        """
+
+        cache = stats['cache']
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            name = "redisproxy_" + name
+            lines.append("# HELP %s %s" % (name, help_text))
+            lines.append("# TYPE %s %s" % (name, kind))
+            for labels, value in samples:
+                lines.append("%s%s %s" % (name, labels, _number(value)))
+
+        metric('uptime_seconds', 'gauge', "Seconds since the proxy started.", [("", clock() - self.started)])
+        metric('connected_clients', 'gauge', "Open client connections.", [("", self.connected_clients)])
+        metric('connections_received_total', 'counter', "Client connections accepted.", [("", self.connections_received)])
+        metric('rejected_connections_total', 'counter', "Client connections turned away at the connection limit.", [("", self.rejected_connections)])
+        metric('commands_total', 'counter', "Client commands processed.", [("", self.commands)])
+        metric('net_input_bytes_total', 'counter', "Bytes read from clients.", [("", self.bytes_in)])
+        metric('net_output_bytes_total', 'counter', "Bytes written to clients.", [("", self.bytes_out)])
+        metric('cache_keys', 'gauge', "Keys in the cache.", [("", cache['keys'])])
+        metric('cache_size_bytes', 'gauge', "Approx. bytes used by the cache.", [("", cache['size'])])
+        metric('cache_hits_total', 'counter', "Cache lookups that found a value.", [("", cache['hits'])])
+        metric('cache_misses_total', 'counter', "Cache lookups that found nothing.", [("", cache['misses'])])
+        metric('cache_stale_hits_total', 'counter', "Expired values served within the grace period.", [("", cache['stale_hits'])])
+        metric('cache_evictions_total', 'counter', "Keys evicted to make room.", [("", cache['evictions'])])
+        metric('cache_expirations_total', 'counter', "Keys removed after their TTL.", [("", cache['expirations'])])
+        metric('cache_rejections_total', 'counter', "Values too big to cache.", [("", cache['rejections'])])
+        if 'compressed' in cache:
+            metric('compression_saved_bytes', 'gauge', "Bytes saved by caching values compressed.", [("", cache['compression_saved'])])
+            metric('compressed_values_total', 'counter', "Values cached compressed.", [("", cache['compressed'])])
+            metric('incompressible_values_total', 'counter', "Values cached as they were, as they didn't shrink enough.", [("", cache['incompressible'])])
+            metric('compression_skipped_values_total', 'counter', "Values not tried, while values weren't shrinking.", [("", cache['compress_skipped'])])
+            metric('compress_seconds_total', 'counter', "Time spent compressing values.", [("", cache['compress_time'])])
+            metric('decompress_seconds_total', 'counter', "Time spent decompressing values on hits.", [("", cache['decompress_time'])])
+        if 'writes' in stats:
+            writes = stats['writes']
+            metric('writes_total', 'counter', "Write commands passed through to Redis.", [("", writes['writes'])])
+            metric('invalidated_keys_total', 'counter', "Keys invalidated by writes.", [("", writes['invalidated_keys'])])
+            metric('voided_fetches_total', 'counter', "Values fetched before a write to their key, & so not cached.", [("", writes['voided_fetches'])])
+        if 'invalidation' in stats:
+            invalidation = stats['invalidation']
+            metric('invalidation_connected', 'gauge', "Backends whose changed keys are being announced.", [("", invalidation['connected'])])
+            metric('invalidation_messages_total', 'counter', "Invalidation messages from Redis.", [("", invalidation['messages'])])
+            metric('invalidation_keys_total', 'counter', "Keys invalidated on Redis's say-so.", [("", invalidation['invalidated_keys'])])
+            metric('invalidation_flushes_total', 'counter', "Database flushes announced by Redis.", [("", invalidation['flushes'])])
+            metric('invalidation_disconnects_total', 'counter', "Invalidation connections lost, each flushing the cache.", [("", invalidation['disconnects'])])
+        if 'negative_cache' in stats:
+            negative = stats['negative_cache']
+            metric('negative_cache_keys', 'gauge', "Keys remembered as missing from Redis.", [("", negative['keys'])])
+            metric('negative_cache_hits_total', 'counter', "Lookups answered as missing from Redis.", [("", negative['hits'])])
+        if 'replicas' in stats:
+            replicas = [
+                ('{backend="%s",replica="%s"}' % (backend, name), replica)
+                for backend, replica_stats in sorted(stats['replicas'].iteritems())
+                for name, replica in sorted(replica_stats.iteritems())
+            ]
+            metric('replica_healthy', 'gauge', "1 if the replica takes reads, 0 if ejected.", [(labels, int(replica['healthy'])) for labels, replica in replicas])
+            metric('replica_latency_seconds', 'gauge', "Moving average of the replica's response times.", [(labels, replica['ewma_ms'] / 1000.0) for labels, replica in replicas])
+            metric('replica_ejections_total', 'counter', "Times the replica was ejected.", [(labels, replica['ejections']) for labels, replica in replicas])
+
+        name = "redisproxy_request_duration_seconds"
+        lines.append("# HELP %s Time to answer a GET or MGET, by whether it went to Redis." % name)
+        lines.append("# TYPE %s histogram" % name)
+        for result, histogram in (('hit', self.hit_latency), ('miss', self.miss_latency)):
+            count = histogram.count
+            for bound, bucket_count in zip(PROMETHEUS_BUCKETS, histogram.cumulative_counts(PROMETHEUS_BUCKETS)):
+                lines.append('%s_bucket{result="%s",le="%s"} %s' % (name, result, _number(bound), bucket_count))
+            lines.append('%s_bucket{result="%s",le="+Inf"} %s' % (name, result, count))
+            lines.append('%s_sum{result="%s"} %s' % (name, result, _number(histogram.total)))
+            lines.append('%s_count{result="%s"} %s' % (name, result, count))
+        return "\n".join(lines) + "\n"
+
+    def _sections(self, stats):
+        cache = stats['cache']
+        lookups = cache['hits'] + cache['misses']
+        sections = OrderedDict()
+        sections['Server'] = [
+            ('uptime_in_seconds', int(clock() - self.started)),
+        ]
+        sections['Clients'] = [
+            ('connected_clients', self.connected_clients),
+            ('total_connections_received', self.connections_received),
+        ]
+        sections['Stats'] = [
+            ('total_commands_processed', self.commands),
+            ('total_net_input_bytes', self.bytes_in),
+            ('total_net_output_bytes', self.bytes_out),
+            ('rejected_connections', self.rejected_connections),
+            ('keyspace_hits', cache['hits']),
+            ('keyspace_misses', cache['misses']),
+            ('hit_ratio', "%.4f" % (float(cache['hits']) / lookups if lookups else 0.0)),
+            ('stale_hits', cache['stale_hits']),
+            ('evicted_keys', cache['evictions']),
+            ('expired_keys', cache['expirations']),
+            ('rejected_keys', cache['rejections']),
+        ]
+        if 'writes' in stats:
+            sections['Stats'].extend([
+                ('total_writes', stats['writes']['writes']),
+                ('invalidated_keys', stats['writes']['invalidated_keys']),
+                ('voided_fetches', stats['writes']['voided_fetches']),
+            ])
+        sections['Memory'] = [
+            ('cached_keys', cache['keys']),
+            ('used_memory', cache['size']),
+            ('max_memory', cache.get('max_memory') or 0),
+        ]
+        if 'compressed' in cache:
+            sections['Memory'].extend([
+                ('compression_saved_bytes', cache['compression_saved']),
+                ('compressed_values', cache['compressed']),
+                ('incompressible_values', cache['incompressible']),
+                ('compression_skipped_values', cache['compress_skipped']),
+                ('decompressed_values', cache['decompressed']),
+                ('compress_usec', int(cache['compress_time'] * 1000000)),
+                ('decompress_usec', int(cache['decompress_time'] * 1000000)),
+            ])
+        latency = []
+        for result, histogram in (('hit', self.hit_latency), ('miss', self.miss_latency)):
+            latency.append(('%s_count' % result, histogram.count))
+            for pct in PERCENTILES:
+                latency.append((
+                    '%s_p%s_usec' % (result, str(pct).replace('.', '_')),
+                    int(histogram.percentile(pct) * 1000000),
+                ))
+            latency.append(('%s_max_usec' % result, histogram.max))
+        sections['Latency'] = latency
+        if 'negative_cache' in stats:
+            negative = stats['negative_cache']
+            sections['Negative cache'] = [
+                ('negative_keys', negative['keys']),
+                ('negative_hits', negative['hits']),
+                ('negative_misses', negative['misses']),
+            ]
+        if 'invalidation' in stats:
+            invalidation = stats['invalidation']
+            sections['Invalidation'] = [
+                ('invalidation_connected', invalidation['connected']),
+                ('invalidation_messages', invalidation['messages']),
+                ('invalidation_keys', invalidation['invalidated_keys']),
+                ('invalidation_flushes', invalidation['flushes']),
+                ('invalidation_disconnects', invalidation['disconnects']),
+            ]
+        if 'replicas' in stats:
+            sections['Replicas'] = [
+                (name, "backend=%s,healthy=%s,ewma_ms=%.3f,pending=%s,requests=%s,errors=%s,ejections=%s" % (
+                    backend,
+                    int(replica['healthy']),
+                    replica['ewma_ms'],
+                    replica['pending'],
+                    replica['requests'],
+                    replica['errors'],
+                    replica['ejections'],
+                ))
+                for backend, replica_stats in sorted(stats['replicas'].iteritems())
+                for name, replica in sorted(replica_stats.iteritems())
+            ]
+        return sections
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+class MetricsRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serves the Prometheus text at /metrics"""
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        body = self.server.render()
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Scrapes every few seconds would drown out the proxy's own output
+        pass
+
+
+def start_metrics_server(address, render):
+    """Serves Prometheus metrics over HTTP from a background thread
+        :param address (tuple): (host, port) to listen on
+        :param render (callable): returns the metrics text
+        :returns: the HTTPServer
+    """
+
+    server = BaseHTTPServer.HTTPServer(address, MetricsRequestHandler)
+    server.render = render
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    print "Serving metrics on http://%s:%s/metrics" % server.server_address
+    return server
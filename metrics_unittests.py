@@ -0,0 +1,206 @@
+import unittest
+import urllib2
+
+from metrics import (
+    bucket_index,
+    bucket_upper_bound,
+    Histogram,
+    MAX_MICROS,
+    Metrics,
+    start_metrics_server,
+)
+
+
+def proxy_stats(**cache):
+    """Fakes RedisProxy.stats()"""
+
+    stats = {
+        'keys': 0,
+        'size': 0,
+        'max_memory': None,
+        'hits': 0,
+        'misses': 0,
+        'stale_hits': 0,
+        'evictions': 0,
+        'rejections': 0,
+        'expirations': 0,
+    }
+    stats.update(cache)
+    return {'cache': stats}
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_buckets_contiguous(self):
+        """Test that every value lands in a bucket whose bounds hold it, &
+            that buckets don't skip or overlap
+        """
+
+        previous = -1
+        for micros in xrange(5000):
+            index = bucket_index(micros)
+            self.assertIn(index, (previous, previous + 1))
+            self.assertLessEqual(micros, bucket_upper_bound(index))
+            if index:
+                self.assertGreater(micros, bucket_upper_bound(index - 1))
+            previous = index
+        self.assertEqual(bucket_upper_bound(bucket_index(MAX_MICROS)), MAX_MICROS)
+
+    def test_relative_precision(self):
+        for micros in (20, 999, 12345, 987654, 10 ** 9):
+            index = bucket_index(micros)
+            width = bucket_upper_bound(index) - bucket_upper_bound(index - 1)
+            self.assertLessEqual(width, micros / 16.0 + 1)
+
+    def test_percentiles(self):
+        histogram = Histogram()
+        for micros in xrange(1, 1001):
+            histogram.record(micros / 1e6)
+
+        self.assertEqual(histogram.count, 1000)
+        self.assertAlmostEqual(histogram.percentile(50), 0.0005, delta=0.0005 / 16)
+        self.assertAlmostEqual(histogram.percentile(99), 0.00099, delta=0.00099 / 16)
+        self.assertEqual(histogram.percentile(100), 0.001)
+        self.assertEqual(histogram.max, 1000)
+
+    def test_empty(self):
+        self.assertEqual(Histogram().percentile(99), 0.0)
+
+    def test_out_of_range_samples_clamped(self):
+        histogram = Histogram()
+        histogram.record(-0.5)
+        histogram.record(10 ** 6)
+
+        self.assertEqual(histogram.counts[0], 1)
+        self.assertEqual(histogram.counts[-1], 1)
+
+    def test_cumulative_counts(self):
+        histogram = Histogram()
+        for seconds in (0.00001, 0.0002, 0.0002, 0.003, 2.0):
+            histogram.record(seconds)
+
+        self.assertEqual(histogram.cumulative_counts([0.0001, 0.001, 0.01, 1.0]), [1, 3, 4, 4])
+
+
+class TestMetrics(unittest.TestCase):
+
+    def test_info_sections(self):
+        metrics = Metrics()
+        metrics.commands = 7
+        metrics.hit_latency.record(0.0001)
+        info = metrics.info(proxy_stats(hits=3, misses=1, evictions=2))
+
+        self.assertTrue(info.startswith("# Server\r\n"))
+        self.assertIn("\r\n\r\n# Stats\r\n", info)
+        self.assertIn("total_commands_processed:7\r\n", info)
+        self.assertIn("keyspace_hits:3\r\n", info)
+        self.assertIn("hit_ratio:0.7500\r\n", info)
+        self.assertIn("evicted_keys:2\r\n", info)
+        self.assertIn("hit_count:1\r\n", info)
+        self.assertIn("hit_p99_9_usec:", info)
+
+    def test_info_single_section(self):
+        info = Metrics().info(proxy_stats(), "latency")
+
+        self.assertTrue(info.startswith("# Latency\r\n"))
+        self.assertNotIn("# Stats", info)
+        self.assertEqual(Metrics().info(proxy_stats(), "nonesuch"), "\r\n")
+
+    def test_prometheus_format(self):
+        metrics = Metrics()
+        metrics.bytes_in = 42
+        metrics.miss_latency.record(0.002)
+        text = metrics.prometheus(proxy_stats(hits=5))
+
+        self.assertIn("# TYPE redisproxy_cache_hits_total counter\nredisproxy_cache_hits_total 5\n", text)
+        self.assertIn("redisproxy_net_input_bytes_total 42\n", text)
+        self.assertIn('redisproxy_request_duration_seconds_bucket{result="miss",le="0.001"} 0\n', text)
+        self.assertIn('redisproxy_request_duration_seconds_bucket{result="miss",le="0.0025"} 1\n', text)
+        self.assertIn('redisproxy_request_duration_seconds_bucket{result="miss",le="+Inf"} 1\n', text)
+        self.assertIn('redisproxy_request_duration_seconds_count{result="hit"} 0\n', text)
+
+    def test_replicas_reported(self):
+        stats = proxy_stats()
+        stats['replicas'] = {'a:1,b:2': {'a:1': {
+            'healthy': False,
+            'ewma_ms': 2.5,
+            'pending': 0,
+            'requests': 10,
+            'errors': 3,
+            'ejections': 1,
+        }}}
+
+        self.assertIn("a:1:backend=a:1,b:2,healthy=0,", Metrics().info(stats, "replicas"))
+        self.assertIn(
+            'redisproxy_replica_healthy{backend="a:1,b:2",replica="a:1"} 0\n',
+            Metrics().prometheus(stats),
+        )
+
+
+    def test_compression_reported(self):
+        stats = proxy_stats(
+            compressed=4,
+            incompressible=1,
+            compress_skipped=0,
+            decompressed=9,
+            compress_time=0.002,
+            decompress_time=0.0005,
+            compression_saved=12000,
+        )
+
+        info = Metrics().info(stats, "memory")
+        self.assertIn("compression_saved_bytes:12000\r\n", info)
+        self.assertIn("compress_usec:2000\r\n", info)
+        self.assertIn("redisproxy_compressed_values_total 4\n", Metrics().prometheus(stats))
+
+
+    def test_writes_reported(self):
+        stats = proxy_stats()
+        stats['writes'] = {'writes': 5, 'invalidated_keys': 7, 'voided_fetches': 1}
+
+        info = Metrics().info(stats, "stats")
+        self.assertIn("total_writes:5\r\n", info)
+        self.assertIn("voided_fetches:1\r\n", info)
+        self.assertIn("redisproxy_invalidated_keys_total 7\n", Metrics().prometheus(stats))
+
+    def test_invalidation_reported(self):
+        stats = proxy_stats()
+        stats['invalidation'] = {'connected': 1, 'messages': 4, 'invalidated_keys': 6, 'flushes': 0, 'disconnects': 2}
+
+        info = Metrics().info(stats, "invalidation")
+        self.assertIn("# Invalidation\r\n", info)
+        self.assertIn("invalidation_keys:6\r\n", info)
+        self.assertIn("redisproxy_invalidation_disconnects_total 2\n", Metrics().prometheus(stats))
+
+    def test_rejected_connections_reported(self):
+        metrics = Metrics()
+        metrics.rejected_connections = 3
+
+        self.assertIn("rejected_connections:3\r\n", metrics.info(proxy_stats(), "stats"))
+        self.assertIn("redisproxy_rejected_connections_total 3\n", metrics.prometheus(proxy_stats()))
+
+
+class TestMetricsServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = start_metrics_server(('127.0.0.1', 0), lambda: "redisproxy_up 1\n")
+        self.url = "http://127.0.0.1:%s" % self.server.server_address[1]
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def test_serves_metrics(self):
+        response = urllib2.urlopen(self.url + "/metrics", timeout=5)
+
+        self.assertEqual(response.read(), "redisproxy_up 1\n")
+        self.assertTrue(response.info()['Content-Type'].startswith("text/plain"))
+
+    def test_other_paths_not_found(self):
+        with self.assertRaises(urllib2.HTTPError) as raised:
+            urllib2.urlopen(self.url + "/", timeout=5)
+        self.assertEqual(raised.exception.code, 404)
+
+
+if __name__ == "__main__":
+    unittest.main()
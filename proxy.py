@@ -1,11 +1,72 @@
 from argparse import ArgumentParser
-from datetime import datetime
-from collections import OrderedDict
+from collections import deque, OrderedDict
+import errno
+import heapq
 import select
 import socket
+import sys
+
+from monotonic import monotonic
+
+from bloom import BloomFilter
+from compactcache import CompactLRUCache
+from compression import CompressedValue, Compressor, DEFAULT_LEVEL
+from eviction import make_policy, POLICIES
+from hashring import HashRing, parse_backend
+from invalidation import (
+    arity_error,
+    CROSS_BACKEND_ERROR,
+    INVALIDATION_MODES,
+    InvalidationFeed,
+    KeyVersions,
+    RETRY_INTERVAL,
+    write_keys,
+)
+from metrics import clock, INFO_COMMANDS, Metrics, start_metrics_server
+from resp import (
+    BulkStream,
+    encode_command,
+    encode_error,
+    encode_reply,
+    encode_ttl_commands,
+    encode_value,
+    encode_values,
+    GET_FORMAT_ERROR,
+    parse_pttl,
+    parse_redis_reply,
+    ProtocolError,
+    RedisConnection,
+    RedisError,
+    ReplyParser,
+    RequestParser,
+    STREAMED,
+)
+from shmcache import DEFAULT_SLOT_SIZE, SharedLRUCache
+from snapshot import load_snapshot, read_keys, save_snapshot, WARM_BATCH_SIZE
+from workers import fork_workers, set_reuse_port, stop_on_sigterm
 
 
 MAX_LISTENS = 5
+RECV_SIZE = 4096
+READ_EVENTS = select.POLLIN | select.POLLPRI | select.POLLHUP | select.POLLERR
+WRITE_EVENTS = READ_EVENTS | select.POLLOUT
+
+DEFAULT_CAPACITY = 1000
+DEFAULT_NEGATIVE_CAPACITY = 1000
+# Approx. bytes each cache entry costs on top of its key & value: the
+# OrderedDict slot & link, the (val, deadline) tuple and the expiry heap
+# record. Measured on 64-bit CPython 2.7.
+ENTRY_OVERHEAD = 400
+# Max. expired entries reclaimed per sweep slice
+SWEEP_BATCH = 100
+# Seconds between sweeps in the event-loop engine
+SWEEP_INTERVAL = 1.0
+
+
+def now_ms():
+    """Monotonic clock, in integer milliseconds"""
+
+    return int(monotonic() * 1000)
 
 
 class LastUpdatedDict(OrderedDict):
@@ -18,17 +79,86 @@ class LastUpdatedDict(OrderedDict):
 
 
 class LRUCache(object):
-    """Least Recently Used Cache supporting eviction based on capacity & TTL"""
+    """Least Recently Used Cache supporting eviction based on capacity & TTL.
 
-    def __init__(self, capacity=None, ttl=None):
+    Capacity is a number of keys, a memory budget in bytes, or both: entries
+    are evicted until a new one fits under each limit that is set. Which
+    entry goes first is up to the eviction policy (see eviction.py):
+    least recently used, unless another is chosen.
+
+    Each entry expires a fixed TTL after it is set, at an integer deadline
+    on the monotonic clock. Expired entries are removed when accessed, and
+    sweep() reclaims the rest in deadline order from a min-heap.
+
+    Optionally, an expired entry is kept for a grace period, during which
+    lookup() still returns it but flags it for refreshing; with
+    refresh_ahead, entries read shortly before they expire are flagged too.
+
+    With compress_threshold, values of that many bytes or more are kept
+    zlib-compressed (see compression.py) & inflated on each hit.
+    """
+
+    def __init__(self,
+        capacity=None,
+        ttl=None,
+        max_memory=None,
+        max_entry_fraction=0.5,
+        policy='lru',
+        grace=0,
+        refresh_ahead=0,
+        compress_threshold=None,
+        compress_level=DEFAULT_LEVEL,
+    ):
+        """
+            :param capacity (int): max. # of keys
+            :param ttl (int): # of seconds that a key can live in cache
+            :param max_memory (int): max. approx. bytes of keys, values &
+                entry overhead
+            :param max_entry_fraction (float): values whose entry would take
+                more than this fraction of max_memory are not cached
+            :param policy (str): eviction policy: lru, slru, arc or tinylfu
+            :param grace (int): # of seconds an expired entry is still served,
+                while it's refreshed
+            :param refresh_ahead (int): # of seconds before expiry during
+                which a read flags the entry for refreshing
+            :param compress_threshold (int): min. # of bytes of a value to
+                compress it. None disables compression
+            :param compress_level (int): zlib level, 1-9
+        """
 
-        if not capacity:
+        if not capacity and not max_memory:
             raise TypeError("Capacity cannot be None for LRUCache")
         if not ttl:
             raise TypeError("TTL cannot be None for LRUCache")
         self.capacity = capacity
         self.ttl = ttl
+        self.ttl_ms = int(ttl * 1000)
+        self.grace_ms = int(grace * 1000)
+        self.refresh_ahead_ms = int(refresh_ahead * 1000)
+        self.max_memory = max_memory
+        self.max_entry_fraction = max_entry_fraction
+        # Sized in keys; a memory-bounded cache holds at most this many
+        # entries, however small
+        self.policy = make_policy(policy, capacity or max(1, max_memory // max(ENTRY_OVERHEAD, 1)))
         self.cache = LastUpdatedDict()
+        # (deadline, key) per entry set; records for keys since re-set or
+        # evicted are skipped when popped
+        self.expiry_heap = []
+        self.compressor = None
+        if compress_threshold:
+            self.compressor = Compressor(compress_threshold, compress_level)
+
+        # Stats
+        self.size = 0
+        # Bytes the compressed values now cached would take uncompressed,
+        # less what they take
+        self.compression_saved = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.rejections = 0
+        self.expirations = 0
 
 
     def get(self, key):
@@ -37,25 +167,187 @@ class LRUCache(object):
             :returns: val (str) if exists or None
         """
 
-        if self.cache.get(key) is not None:
-            val, time_added = self.cache.pop(key)
-            if (datetime.now() - time_added).total_seconds() >= self.ttl:
-                return None
-            self.cache[key] = (val, datetime.now())
-            return val
-        else:
-            return None
+        return self.lookup(key)[0]
 
+    def lookup(self, key, raw=False):
+        """Checks if key is in cache, & whether it's due for a refresh
+            :param key (str)
+            :param raw (bool): return a compressed value as it's cached
+                (CompressedValue), rather than inflating it
+            :returns: (val, refresh) tuple. val is None if key isn't cached,
+                refresh is True if val is past its TTL (but within the grace
+                period) or about to reach it
+        """
+
+        val, refresh = self._lookup(key)
+        if type(val) is CompressedValue and not raw:
+            val = self.compressor.decompress(val)
+        return val, refresh
 
-    def set(self, key, val):
+    def _lookup(self, key):
+
+        entry = self.cache.get(key)
+        if entry is None:
+            self.misses += 1
+            self.policy.miss(key)
+            return None, False
+        val, deadline = entry
+        now = now_ms()
+        if now >= deadline:
+            if now < deadline + self.grace_ms:
+                self.policy.hit(key)
+                self.hits += 1
+                self.stale_hits += 1
+                return val, True
+            del self.cache[key]
+            self.policy.remove(key)
+            self._release(key, val)
+            self.expirations += 1
+            self.misses += 1
+            self.policy.miss(key)
+            return None, False
+        self.policy.hit(key)
+        self.hits += 1
+        return val, now >= deadline - self.refresh_ahead_ms
+
+    def delete(self, key):
+        """Removes key from cache, if it's there
+            :returns: True if key was cached
+        """
+
+        entry = self.cache.pop(key, None)
+        if entry is None:
+            return False
+        self.policy.remove(key)
+        self._release(key, entry[0])
+        return True
+
+    def clear(self):
+        """Removes every entry
+            :returns: # of entries removed
+        """
+
+        for key in self.cache:
+            self.policy.remove(key)
+        cleared = len(self.cache)
+        self.cache.clear()
+        self.expiry_heap = []
+        self.size = 0
+        self.compression_saved = 0
+        return cleared
+
+
+    def set(self, key, val, ttl_ms=None):
         """Sets key-val pair in self.cache
             :param key (str):
             :param val (str):
+            :param ttl_ms (int): # of ms until the entry expires, if sooner
+                than the cache's TTL
         """
 
-        if len(self.cache) >= self.capacity:
-            self.cache.popitem(last=False)
-        self.cache[key] = (val, datetime.now())
+        if self.compressor is not None:
+            val = self.compressor.compress(val)
+        if key in self.cache:
+            old_val, deadline = self.cache.pop(key)
+            self.policy.remove(key)
+            self._release(key, old_val)
+
+        entry_size = self._entry_size(key, val)
+        if self.max_memory and entry_size > self.max_memory * self.max_entry_fraction:
+            self.rejections += 1
+            return
+
+        # Reclaim expired entries first, so they don't push out live ones
+        self.sweep(SWEEP_BATCH)
+        while self.cache and self._is_full(entry_size):
+            old_key = self.policy.evict(key)
+            old_val, deadline = self.cache.pop(old_key)
+            self._release(old_key, old_val)
+            self.evictions += 1
+        deadline = now_ms() + (self.ttl_ms if ttl_ms is None else min(ttl_ms, self.ttl_ms))
+        self.cache[key] = (val, deadline)
+        self.policy.add(key)
+        self.size += entry_size
+        if type(val) is CompressedValue:
+            self.compression_saved += val.saved
+        heapq.heappush(self.expiry_heap, (deadline, key))
+        if len(self.expiry_heap) > 2 * len(self.cache) + SWEEP_BATCH:
+            self._rebuild_expiry_heap()
+
+    def sweep(self, max_entries=None):
+        """Removes expired entries, soonest deadline first
+            :param max_entries (int): max. # of heap records to examine, to
+                bound the time spent in one call
+            :returns: # of entries expired
+        """
+
+        # Entries are kept until their grace period is over, too
+        now = now_ms() - self.grace_ms
+        heap = self.expiry_heap
+        examined = expired = 0
+        while heap and heap[0][0] <= now:
+            if max_entries is not None and examined >= max_entries:
+                break
+            deadline, key = heapq.heappop(heap)
+            examined += 1
+            entry = self.cache.get(key)
+            if entry is not None and entry[1] == deadline:
+                del self.cache[key]
+                self.policy.remove(key)
+                self._release(key, entry[0])
+                expired += 1
+        self.expirations += expired
+        return expired
+
+    def entries(self):
+        """Unexpired entries, from the first the policy would evict to the last
+            :returns: list of (key, val, # of ms until expiry) tuples
+        """
+
+        now = now_ms()
+        decompress = self.compressor.decompress if self.compressor is not None else lambda val: val
+        return [
+            (key, decompress(val), deadline - now)
+            for key, (val, deadline) in ((key, self.cache[key]) for key in self.policy)
+            if deadline > now
+        ]
+
+    def stats(self):
+        stats = {
+            'keys': len(self.cache),
+            'size': self.size,
+            'max_memory': self.max_memory,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'evictions': self.evictions,
+            'rejections': self.rejections,
+            'expirations': self.expirations,
+        }
+        if self.compressor is not None:
+            stats.update(self.compressor.stats(), compression_saved=self.compression_saved)
+        return stats
+
+    def _rebuild_expiry_heap(self):
+        """Drops heap records for entries that were re-set or evicted"""
+
+        self.expiry_heap = [(deadline, key) for key, (val, deadline) in self.cache.iteritems()]
+        heapq.heapify(self.expiry_heap)
+
+    def _is_full(self, entry_size):
+        if self.capacity and len(self.cache) >= self.capacity:
+            return True
+        return bool(self.max_memory) and self.size + entry_size > self.max_memory
+
+    def _entry_size(self, key, val):
+        return sys.getsizeof(key) + sys.getsizeof(val) + ENTRY_OVERHEAD
+
+    def _release(self, key, val):
+        """Takes a removed entry off the cache's size"""
+
+        self.size -= self._entry_size(key, val)
+        if type(val) is CompressedValue:
+            self.compression_saved -= val.saved
 
 
 class RedisProxy(object):
@@ -67,6 +359,28 @@ class RedisProxy(object):
         capacity=100,
         ttl=7200,
         timeout=30,
+        stream_threshold=1024 * 1024,
+        max_memory=None,
+        max_entry_fraction=0.5,
+        negative_ttl=None,
+        negative_capacity=DEFAULT_NEGATIVE_CAPACITY,
+        absent_filter=False,
+        eviction_policy='lru',
+        grace=0,
+        refresh_ahead=0,
+        cache=None,
+        reuse_port=False,
+        backends=None,
+        snapshot_path=None,
+        snapshot_interval=None,
+        compress_threshold=None,
+        compress_level=DEFAULT_LEVEL,
+        compact_cache=False,
+        pass_writes=False,
+        versions=None,
+        invalidation=None,
+        tracking_prefixes=(),
+        key_ttl=False,
     ):
         """Settings are configurable for Redis Proxy:
             :param host_addr (str): IP address of backing Redis instance
@@ -74,23 +388,135 @@ class RedisProxy(object):
             :param capacity (int): number of keys to hold in cache
             :param ttl (int): # of seconds that a key can live in cache
             :param timeout (int), seconds after which to timeout network request
+            :param stream_threshold (int): values over this many bytes are
+                streamed straight to the client & not cached
+            :param max_memory (int): approx. bytes the cache may use
+            :param max_entry_fraction (float): largest share of max_memory
+                one entry may take
+            :param negative_ttl (int): # of seconds to remember that a key
+                doesn't exist in Redis. None disables negative caching
+            :param negative_capacity (int): max. # of absent keys remembered,
+                kept apart from capacity
+            :param absent_filter (bool): screen negative cache lookups with
+                a Bloom filter of keys recently found absent
+            :param eviction_policy (str): lru, slru, arc or tinylfu
+            :param grace (int): # of seconds an expired value is still served,
+                while it's refreshed
+            :param refresh_ahead (int): # of seconds before expiry during
+                which a hit refreshes the value
+            :param cache (SharedLRUCache): cache shared with other worker
+                processes, used instead of building one from the settings
+            :param reuse_port (bool): listen with SO_REUSEPORT, so other
+                workers can accept on the same port
+            :param backends (list): (host, port) of each backing Redis; keys
+                are sharded across them on a consistent hash ring. Defaults
+                to host_addr & port
+            :param snapshot_path (str): file the cache is saved to when the
+                proxy shuts down
+            :param snapshot_interval (float): seconds between saves of the
+                cache while running. None only saves on shutdown
+            :param compress_threshold (int): min. # of bytes of a value to
+                cache it compressed. None disables compression
+            :param compress_level (int): zlib level, 1-9
+            :param compact_cache (bool): keep the cache in a CompactLRUCache,
+                which takes less memory per key & less time per hit but
+                only evicts least recently used keys
+            :param pass_writes (bool): pass write commands (SET, DEL,
+                EXPIRE, ...) through to Redis, invalidating the keys they
+                write to
+            :param versions (KeyVersions): key versions shared with other
+                worker processes, used instead of this proxy's own
+            :param invalidation (str): have each backend announce changed
+                keys, with 'tracking' (CLIENT TRACKING) or 'keyspace'
+                (keyspace notifications). None relies on the TTL alone
+            :param tracking_prefixes (list): only track keys starting with
+                one of these; all keys if empty
+            :param key_ttl (bool): fetch each key's PTTL along with it, &
+                cache it no longer than it has left to live in Redis
         """
 
-        self.cache = LRUCache(capacity, ttl)
+        if cache is not None:
+            self.cache = cache
+        elif compact_cache:
+            if eviction_policy != 'lru':
+                raise ValueError("CompactLRUCache only evicts least recently used keys")
+            self.cache = CompactLRUCache(
+                capacity,
+                ttl,
+                max_memory,
+                max_entry_fraction,
+                grace,
+                refresh_ahead,
+                compress_threshold,
+                compress_level,
+            )
+        else:
+            self.cache = LRUCache(
+                capacity,
+                ttl,
+                max_memory,
+                max_entry_fraction,
+                eviction_policy,
+                grace,
+                refresh_ahead,
+                compress_threshold,
+                compress_level,
+            )
+        # Keys to re-fetch once the current client has its replies
+        self.refresh_keys = OrderedDict()
+        self.stream_threshold = stream_threshold
+        self.key_ttl = key_ttl
+
+        # Keys Redis had no value for, in their own cache so they never
+        # push out real values
+        self.negative_cache = None
+        self.absent_filter = None
+        self.filtered = 0
+        if negative_ttl:
+            self.negative_cache = LRUCache(negative_capacity, negative_ttl)
+            if absent_filter:
+                self.absent_filter = BloomFilter(negative_capacity)
 
         self.socket_list = []
+        self.parsers = {}
         self.max_listens = MAX_LISTENS
 
         if not host_addr:
             host_addr = ''
+        if not backends:
+            backends = [(host_addr, port)]
 
-        # Open Redis connection
-        self.redis_socket = self._open_redis_connection(host_addr, port, timeout)
-        self.socket_list.append(self.redis_socket)
+        # Open a connection to each Redis, named host:port on the ring
+        self.redis_conns = OrderedDict()
+        self.backend_addrs = {}
+        for backend_addr, backend_port in backends:
+            node = "%s:%s" % (backend_addr, backend_port)
+            redis_socket = self._open_redis_connection(backend_addr, backend_port, timeout)
+            self.redis_conns[node] = RedisConnection(redis_socket)
+            self.backend_addrs[node] = (backend_addr, backend_port)
+            self.socket_list.append(redis_socket)
+        self.ring = HashRing(self.redis_conns)
+        self.pass_writes = pass_writes
+        self.versions = versions if versions is not None else KeyVersions()
+        self.timeout = timeout
+        self.feeds = []
+        if invalidation:
+            for backend_addr, backend_port in backends:
+                feed = InvalidationFeed("%s:%s" % (backend_addr, backend_port), invalidation, tracking_prefixes)
+                # Up front, so a backend that can't announce changes fails fast
+                feed.subscribe(RedisConnection(self._open_redis_connection(backend_addr, backend_port, timeout)))
+                self.feeds.append(feed)
 
         # Open Client socket
-        self.client_socket = self._open_client_connection(host='', port=5555)
+        self.client_socket = self._open_client_connection(host='', port=5555, reuse_port=reuse_port)
         self.socket_list.append(self.client_socket)
+        self.metrics = Metrics()
+
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval = snapshot_interval
+        self.next_snapshot = None
+        if snapshot_path and snapshot_interval:
+            self.next_snapshot = monotonic() + snapshot_interval
         print "Running RedisProxy. Use CTRL-C to stop."
 
 
@@ -106,76 +532,556 @@ class RedisProxy(object):
         while running:
             # Listen for input sources (Redis & any client)
             try:
+                feeds = dict((feed.conn.sock, feed) for feed in self.feeds if feed.conn is not None)
                 in_ready, out_ready, err_ready = select.select(
-                    self.socket_list,
+                    self.socket_list + feeds.keys(),
                     [],
                     [],
                     0,
                 )
                 for src in in_ready:
+                    if src in feeds:
+                        self._on_feed_readable(feeds[src])
                     # New client connection, creates new client socket
-                    if src == self.client_socket:
+                    elif src == self.client_socket:
                         new_sock, addr = self.client_socket.accept()
-                        new_sock.sendall(
+                        self.metrics.connections_received += 1
+                        self.metrics.connected_clients += 1
+                        self._send(
+                            new_sock,
                             "Connected to RedisProxy\nYou can send GET {key} commands to the proxy\nUse QUIT to end connection\n",
                         )
                         self.socket_list.append(new_sock)
+                        self.parsers[new_sock] = RequestParser()
                     # Input from a client connection that we've already seen
                     else:
-                        data = src.recv(4096).strip()
-                        if data != "QUIT":
-                            data = data.split()
-                            if len(data) != 2 or data[0] != "GET":
-                                src.sendall("Please use Redis 'GET key' command format\n\r")
+                        try:
+                            data = src.recv(RECV_SIZE)
+                            if not data:
+                                self._remove_client(src)
                                 continue
-                            ret_val = self.get(data[1])
-                            if ret_val is None:
-                                src.sendall("Nothing exists for key %s in Redis\n\r" % (data[1]))
+                            self.metrics.bytes_in += len(data)
+                            try:
+                                commands = self.parsers[src].feed(data)
+                            except ProtocolError, e:
+                                self._send(src, encode_error("Protocol error: %s" % e))
+                                self._remove_client(src)
                                 continue
-                            ret_val = ret_val + "\n\r"
-                            src.sendall(ret_val)
-                        else:
-                            if src in self.socket_list:
-                                src.sendall("Bye-bye!\n")
-                                self.socket_list.remove(src)
-                                src.close()
+                            replies = []
+                            quit = False
+                            for args, inline in commands:
+                                self.metrics.commands += 1
+                                if args[0].upper() == "QUIT":
+                                    replies.append("Bye-bye!\n" if inline else "+OK\r\n")
+                                    quit = True
+                                    break
+                                stream = BulkStream(src, inline, replies)
+                                replies.append(self._handle_command(args, inline, stream))
+                                self.metrics.bytes_out += stream.bytes_sent
+                            # One write for the whole batch of pipelined commands
+                            if replies:
+                                self._send(src, "".join(replies))
+                            if self.refresh_keys:
+                                self._run_refreshes()
+                            if quit:
+                                self._remove_client(src)
                                 print "Client connection closed"
+                        except socket.error, e:
+                            # The client's connection failed, or a value
+                            # streamed to it was cut short by Redis's
+                            self._remove_client(src)
+                            print "Client connection dropped: %s" % e
+                if self.next_snapshot is not None and monotonic() >= self.next_snapshot:
+                    self.save_snapshot()
+                self._retry_feeds()
 
             except KeyboardInterrupt:
                 print "Shutting down RedisProxy"
                 running = False
-        self.redis_socket.close()
+        for redis_conn in self.redis_conns.itervalues():
+            redis_conn.close()
+        for feed in self.feeds:
+            feed.close()
         self.client_socket.close()
+        if self.snapshot_path:
+            saved = self.save_snapshot()
+            if saved is not None:
+                print "Saved %s keys to %s" % (saved, self.snapshot_path)
         print "Done"
 
-    def get(self, key):
+    def _remove_client(self, src):
+        if src in self.socket_list:
+            self.socket_list.remove(src)
+            self.parsers.pop(src, None)
+            src.close()
+            self.metrics.connected_clients -= 1
+
+    def _send(self, sock, data):
+        sock.sendall(data)
+        self.metrics.bytes_out += len(data)
+
+    def _handle_command(self, args, inline, stream_to=None):
+        """Runs one client command
+            :param args (list): command name & arguments
+            :param inline (bool): whether the client sent an inline command
+            :param stream_to (BulkStream): where to stream large values
+            :returns: reply (str) to send back to the client
+        """
+
+        if args[0].upper() in INFO_COMMANDS and len(args) <= 2:
+            return encode_value(None, self.info(*args[1:]), inline)
+        if args[0].upper() == "MGET" and len(args) > 1:
+            try:
+                vals = self.mget(args[1:])
+            except (RedisError, socket.error), e:
+                return encode_error("Redis error: %s" % e, inline)
+            return encode_values(args[1:], vals, inline)
+        if self.pass_writes and write_keys(args) is not None:
+            return encode_reply(self.write(args), inline)
+        if len(args) != 2 or args[0].upper() != "GET":
+            return encode_error(GET_FORMAT_ERROR, inline)
+        try:
+            ret_val = self.get(args[1], stream_to)
+        except (RedisError, socket.error), e:
+            if stream_to is not None and stream_to.started:
+                # Part of the value has gone out: no error can follow it, so
+                # the client is dropped (see run())
+                raise
+            return encode_error("Redis error: %s" % e, inline)
+        if ret_val is STREAMED:
+            return ""
+        return encode_value(args[1], ret_val, inline)
+
+    def get(self, key, stream_to=None):
         """Takes in a key, checks cache then backing Redis for value.
             Stores unstored keys in cache.
             :param key (str):
-            :returns: value stored in Redis, if not already in cache
+            :param stream_to (BulkStream): if given, values larger than
+                self.stream_threshold are written here instead of returned
+            :returns: value stored in Redis, if not already in cache, or
+                STREAMED if the value was streamed to stream_to
         """
 
+        start = clock()
         # First, check the cache
-        cached_val = self.cache.get(key)
+        cached_val = self._cached(key)
         if cached_val:
+            self.metrics.hit_latency.record(clock() - start)
             return cached_val
+        if self._known_absent(key):
+            self.metrics.hit_latency.record(clock() - start)
+            return None
+        version = self.versions.current(key)
         get_str = "*2\r\n$3\r\nGET\r\n$%s\r\n%s\r\n" % (len(key), key)
-        self.redis_socket.sendall(get_str)
+        if self.key_ttl:
+            get_str += encode_ttl_commands([key])
+        node = self.ring.node_for(key)
+        redis_conn = self.redis_conns[node]
+        try:
+            redis_conn.sendall(get_str)
+            # Nil bulk strings come back as None
+            redis_val = redis_conn.read_reply(stream_to, self.stream_threshold)
+            ttl_ms = self._read_ttls(redis_conn, 1)[0]
+        except socket.error:
+            self._reconnect(node)
+            raise
+        self.metrics.miss_latency.record(clock() - start)
+        if isinstance(redis_val, RedisError):
+            raise redis_val
+        if redis_val is not STREAMED:
+            # Same size limit whether or not the value could be streamed
+            self._store(key, redis_val, version, ttl_ms)
+        return redis_val
 
-        resp = self.redis_socket.recv(4096)
-        # If Redis responds w/ a nil bulk string, return None to client
-        if resp == "$-1\r\n":
+    def mget(self, keys):
+        """Takes in keys, answers cached ones from the cache & fetches the
+            rest from backing Redis in one MGET per backend
+            :param keys (list):
+            :returns: list of values, None for keys that don't exist
+        """
+
+        start = clock()
+        vals = [self._cached(key) for key in keys]
+        missing = self._missing_keys(keys, vals)
+        if not missing:
+            self.metrics.hit_latency.record(clock() - start)
+            return vals
+
+        try:
+            fetched = self._fetch_many(missing)
+        finally:
+            self.metrics.miss_latency.record(clock() - start)
+        return [fetched[key] if key in fetched else val for key, val in zip(keys, vals)]
+
+    def warm(self, keys, batch_size=WARM_BATCH_SIZE):
+        """Fetches keys into the cache ahead of any client asking for them,
+            e.g. before the proxy starts accepting connections
+            :param keys (list):
+            :param batch_size (int): max. # of keys per MGET round
+            :returns: # of keys Redis had values for
+        """
+
+        found = 0
+        for i in xrange(0, len(keys), batch_size):
+            fetched = self._fetch_many(keys[i:i + batch_size])
+            found += sum(1 for val in fetched.itervalues() if val is not None)
+        return found
+
+    def save_snapshot(self):
+        """Saves the cache to self.snapshot_path, & schedules the next save
+            :returns: # of keys saved, or None if the save failed
+        """
+
+        if self.snapshot_interval:
+            self.next_snapshot = monotonic() + self.snapshot_interval
+        try:
+            return save_snapshot(self.cache, self.snapshot_path)
+        except (IOError, OSError), e:
+            print "Could not save cache snapshot to %s: %s" % (self.snapshot_path, e)
             return None
-        msg_type, body = resp[0], resp[1:].split("\r\n")
-        length = body[0]
-        redis_val = body[1]
 
-        # Save it in the cache, if it's not already there
-        self.cache.set(key, redis_val)
+    def _fetch_many(self, keys):
+        """Gets keys from Redis in one MGET per backend & caches them
+            :returns: dict of key -> value (None for keys that don't exist)
+            :raises RedisError: if a backend replied with one, or
+                socket.error if its connection failed (it's reconnected),
+                after caching the other backends' values
+        """
 
-        return redis_val
+        versions = dict((key, self.versions.current(key)) for key in keys)
+        groups = self.ring.split(keys)
+        error = None
+        # Every backend gets its MGET before any reply is awaited
+        for node, node_keys in groups.items():
+            command = encode_command("MGET", *node_keys)
+            if self.key_ttl:
+                command += encode_ttl_commands(node_keys)
+            try:
+                self.redis_conns[node].sendall(command)
+            except socket.error, e:
+                self._reconnect(node)
+                error = e
+                del groups[node]
+        fetched = {}
+        ttls = {}
+        for node, node_keys in groups.iteritems():
+            # Read every reply, even after an error, so no connection is
+            # left with a reply nobody reads
+            try:
+                redis_vals = self.redis_conns[node].read_reply()
+                node_ttls = self._read_ttls(self.redis_conns[node], len(node_keys))
+            except socket.error, e:
+                self._reconnect(node)
+                error = e
+                continue
+            if isinstance(redis_vals, RedisError):
+                error = redis_vals
+                continue
+            fetched.update(zip(node_keys, redis_vals))
+            ttls.update(zip(node_keys, node_ttls))
+        for key, redis_val in fetched.iteritems():
+            self._store(key, redis_val, versions[key], ttls[key])
+        if error is not None:
+            raise error
+        return fetched
+
+    def _read_ttls(self, redis_conn, count):
+        """Reads the replies to the PTTLs pipelined after a GET or MGET of
+            count keys, if self.key_ttl
+            :returns: list of # of ms each key has left in Redis, or None
+        """
+
+        if not self.key_ttl:
+            return [None] * count
+        return [parse_pttl(redis_conn.read_reply()) for _ in xrange(count)]
+
+    def _missing_keys(self, keys, vals):
+        """Keys (once each) that neither cache can answer
+            :param keys (list):
+            :param vals (list): cached value per key, or None
+        """
+
+        missing = []
+        seen = set()
+        for key, val in zip(keys, vals):
+            if not val and key not in seen and not self._known_absent(key):
+                seen.add(key)
+                missing.append(key)
+        return missing
+
+    def _store(self, key, redis_val, version, ttl_ms=None):
+        """Caches a value fetched from Redis, or remembers that the key
+            doesn't exist (nil bulk strings come back as None)
+            :param version (int): key's version from before the fetch was
+                sent; if a write has moved it on since, the value is dropped
+            :param ttl_ms (int): # of ms the key has left in Redis, if it
+                expires; it's cached no longer than that
+        """
+
+        if self._invalidation_down():
+            return
+        if redis_val is None:
+            # Drop any stale value a refresh found gone
+            self.cache.delete(key)
+            self._remember_absent(key)
+        elif len(redis_val) <= self.stream_threshold and ttl_ms != 0:
+            self.cache.set(key, redis_val, ttl_ms)
+        else:
+            # Too large, or expired in Redis since it was read
+            self.cache.delete(key)
+        self._check_version(key, version)
+
+    def _check_version(self, key, version):
+        """Drops what was just cached for key if a write (through another
+            worker) has moved its version on since the fetch was sent.
+            Checked after caching, not before, so a write can't slip in
+            between.
+        """
+
+        if self.versions.current(key) != version:
+            self._drop(key)
+            self.versions.voided += 1
+
+    def write(self, args):
+        """Passes a write command through to Redis, then invalidates the
+            keys it names
+            :param args (list): command name & arguments
+            :returns: Redis's reply, as read_reply() returns it; a RedisError
+                for an error reply, or if the proxy couldn't send the write
+        """
+
+        keys = write_keys(args)
+        if not keys:
+            return RedisError(arity_error(args))
+        nodes = self.ring.split(keys)
+        if len(nodes) > 1:
+            return RedisError(CROSS_BACKEND_ERROR)
+        self.versions.writes += 1
+        node = nodes.keys()[0]
+        redis_conn = self.redis_conns[node]
+        try:
+            redis_conn.sendall(encode_command(*args))
+            return redis_conn.read_reply()
+        except socket.error, e:
+            self._reconnect(node)
+            return RedisError("Redis connection error: %s" % e)
+        finally:
+            # Even a write that failed may have reached Redis
+            self._invalidate(keys)
+
+    def _reconnect(self, node):
+        """Replaces a backend's connection after a command on it failed, so
+            a late reply to that command can't be read as the next one's.
+            If Redis can't be reached, the closed connection stays, & the
+            next command on it fails & tries again.
+        """
+
+        old_conn = self.redis_conns[node]
+        if old_conn.sock in self.socket_list:
+            self.socket_list.remove(old_conn.sock)
+        old_conn.close()
+        host, port = self.backend_addrs[node]
+        try:
+            redis_socket = self._open_redis_connection(host, port, self.timeout)
+        except socket.error, e:
+            print "Could not reconnect to Redis on %s: %s" % (node, e)
+            return
+        self.redis_conns[node] = RedisConnection(redis_socket)
+        self.socket_list.append(redis_socket)
+
+    def _invalidate(self, keys):
+        """Moves on keys' versions & drops them from the caches, so nothing
+            fetched before a write to them stays cached
+        """
+
+        self.versions.bump(keys)
+        for key in keys:
+            self._drop(key)
+        self.versions.invalidated += len(keys)
+
+    def _drop(self, key):
+        self.cache.delete(key)
+        if self.negative_cache is not None:
+            self.negative_cache.delete(key)
+
+    def _on_feed_readable(self, feed):
+        try:
+            data = feed.conn.sock.recv(RECV_SIZE)
+            if not data:
+                raise socket.error("Connection closed by Redis")
+            invalidations = feed.feed(data)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            self._lose_feed(feed, e)
+            return
+        except ProtocolError, e:
+            self._lose_feed(feed, e)
+            return
+        self._apply_invalidations(invalidations)
+
+    def _lose_feed(self, feed, error):
+        """Flushes the caches once a backend's changes stop being announced,
+            & schedules a reconnect
+        """
+
+        print "Lost invalidation connection to %s: %s" % (feed.name, error)
+        feed.close()
+        feed.retry_at = monotonic() + RETRY_INTERVAL
+        self._flush()
+
+    def _retry_feeds(self):
+        """Resubscribes dropped invalidation connections that are due a retry
+            :returns: monotonic time of the next retry, or None
+        """
 
-    def _open_client_connection(self, host=None, port=None, timeout=30):
+        next_retry = None
+        for feed in self.feeds:
+            if feed.conn is not None:
+                continue
+            if monotonic() >= feed.retry_at:
+                host, port = parse_backend(feed.name)
+                try:
+                    # Blocks the loop for up to the timeout, but only while
+                    # the backend is unreachable
+                    feed.subscribe(RedisConnection(self._open_redis_connection(host, port, self.timeout)))
+                except (socket.error, ProtocolError, RedisError), e:
+                    print "Could not resubscribe to invalidations from %s: %s" % (feed.name, e)
+                    feed.retry_at = monotonic() + RETRY_INTERVAL
+                else:
+                    print "Resubscribed to invalidations from %s" % feed.name
+                    # Writes made while it was down went unannounced
+                    self._flush()
+                    self._feed_subscribed(feed)
+                    continue
+            if next_retry is None or feed.retry_at < next_retry:
+                next_retry = feed.retry_at
+        return next_retry
+
+    def _feed_subscribed(self, feed):
+        pass
+
+    def _apply_invalidations(self, invalidations):
+        """Invalidates the keys a backend announced changes to
+            :param invalidations (list): as InvalidationFeed.feed() returns
+        """
+
+        for keys in invalidations:
+            if keys is None:
+                self._flush()
+                continue
+            self.versions.bump(keys)
+            for key in keys:
+                self._drop(key)
+
+    def _flush(self):
+        """Empties both caches & voids every fetch in flight, for when it
+            isn't known what changed in Redis
+        """
+
+        self.versions.bump_all()
+        self.cache.clear()
+        if self.negative_cache is not None:
+            self.negative_cache.clear()
+
+    def _invalidation_down(self):
+        """Whether a backend's changes aren't being announced, so nothing
+            fetched now can be cached
+        """
+
+        return any(feed.conn is None for feed in self.feeds)
+
+    def _cached(self, key):
+        """Value for key from the cache, if any. A value that's stale or about
+            to expire is scheduled for a refresh.
+        """
+
+        cached_val, refresh = self.cache.lookup(key)
+        if cached_val and refresh:
+            self._schedule_refresh(key)
+        return cached_val
+
+    def _schedule_refresh(self, key):
+        self.refresh_keys[key] = None
+
+    def _run_refreshes(self):
+        """Re-fetches the keys scheduled for a refresh. Runs after replies
+            are sent, so the client that read a stale value isn't kept waiting.
+        """
+
+        while self.refresh_keys:
+            key = self.refresh_keys.popitem(last=False)[0]
+            version = self.versions.current(key)
+            node = self.ring.node_for(key)
+            redis_conn = self.redis_conns[node]
+            command = encode_command("GET", key)
+            if self.key_ttl:
+                command += encode_ttl_commands([key])
+            try:
+                redis_conn.sendall(command)
+                redis_val = redis_conn.read_reply()
+                ttl_ms = self._read_ttls(redis_conn, 1)[0]
+            except socket.error, e:
+                self._reconnect(node)
+                print "Refresh of %s failed: %s" % (key, e)
+                continue
+            if isinstance(redis_val, RedisError):
+                print "Refresh of %s failed: %s" % (key, redis_val)
+                continue
+            self._store(key, redis_val, version, ttl_ms)
+
+    def _known_absent(self, key):
+        """Checks the negative cache for a key Redis recently had no value for"""
+
+        if self.negative_cache is None:
+            return False
+        if self.absent_filter is not None and key not in self.absent_filter:
+            # Never found absent (since the filter last reset): skip the lookup
+            self.filtered += 1
+            return False
+        return self.negative_cache.get(key) is not None
+
+    def _remember_absent(self, key):
+        if self.negative_cache is None:
+            return
+        self.negative_cache.set(key, True)
+        if self.absent_filter is not None:
+            self.absent_filter.add(key)
+
+    def stats(self):
+        """Cache stats, with negative entries reported separately
+            :returns: dict with 'cache' & (if enabled) 'negative_cache' stats
+        """
+
+        stats = {'cache': self.cache.stats()}
+        if self.pass_writes:
+            stats['writes'] = self.versions.stats()
+        if self.feeds:
+            stats['invalidation'] = dict(
+                (name, sum(feed.stats()[name] for feed in self.feeds))
+                for name in self.feeds[0].stats()
+            )
+        if self.negative_cache is not None:
+            negative = self.negative_cache.stats()
+            if self.absent_filter is not None:
+                # Lookups the filter screened out were misses too
+                negative['misses'] += self.filtered
+                negative['filtered'] = self.filtered
+                negative['filter_resets'] = self.absent_filter.resets
+            stats['negative_cache'] = negative
+        return stats
+
+    def info(self, section=None):
+        """Reply to the STATS/INFO command
+            :param section (str): only report this section, e.g. "latency"
+        """
+
+        return self.metrics.info(self.stats(), section)
+
+    def prometheus(self):
+        return self.metrics.prometheus(self.stats())
+
+    def _open_client_connection(self, host=None, port=None, timeout=30, reuse_port=False):
 
         if not host:
             host = 'localhost'
@@ -184,6 +1090,8 @@ class RedisProxy(object):
         try:
             my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                set_reuse_port(my_socket)
             my_socket.settimeout(timeout)
             my_socket.bind((host, port))
             my_socket.listen(MAX_LISTENS)
@@ -195,6 +1103,582 @@ class RedisProxy(object):
         return my_socket
 
 
+class PendingReply(object):
+    """Slot in a client's reply queue, filled in once the value is known"""
+
+    __slots__ = ('data', 'inline', 'start')
+
+    def __init__(self, data=None, inline=False, start=None):
+        self.data = data
+        self.inline = inline
+        # When the command came in, for its latency
+        self.start = start
+
+    def resolve(self, key, redis_val):
+        if isinstance(redis_val, RedisError):
+            self.data = encode_error("Redis error: %s" % redis_val, self.inline)
+        else:
+            self.data = encode_value(key, redis_val, self.inline)
+
+
+class PendingMultiReply(object):
+    """Reply slot for an MGET, filled in once every missing key is known"""
+
+    __slots__ = ('data', 'inline', 'start', 'keys', 'vals', 'positions', 'remaining', 'error')
+
+    def __init__(self, keys, vals, missing, inline=False, start=None):
+        """
+            :param keys (list): keys the client asked for
+            :param vals (list): cached value per key, or None
+            :param missing (list): keys waiting on Redis, once each
+            :param inline (bool): whether the client sent an inline command
+            :param start (float): when the command came in, for its latency
+        """
+
+        self.data = None
+        self.inline = inline
+        self.start = start
+        self.keys = keys
+        self.vals = vals
+        self.positions = {}
+        for i, key in enumerate(keys):
+            self.positions.setdefault(key, []).append(i)
+        self.remaining = len(missing)
+        self.error = None
+
+    def resolve(self, key, redis_val):
+        if isinstance(redis_val, RedisError):
+            self.error = redis_val
+        else:
+            for i in self.positions[key]:
+                self.vals[i] = redis_val
+        self.remaining -= 1
+        if self.remaining:
+            return
+        if self.error is not None:
+            self.data = encode_error("Redis error: %s" % self.error, self.inline)
+        else:
+            self.data = encode_values(self.keys, self.vals, self.inline)
+
+
+class PendingWrite(object):
+    """A write in flight to Redis, & the reply slot of the client that sent it"""
+
+    __slots__ = ('keys', 'conn', 'reply')
+
+    def __init__(self, keys, conn, reply):
+        self.keys = keys
+        self.conn = conn
+        self.reply = reply
+
+
+class ClientConnection(object):
+    """Per-client state for the event-loop engine"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.parser = RequestParser()
+        self.outbuf = ""
+        self.replies = deque()
+        self.closing = False
+        self.closed = False
+
+
+class BackendConnection(object):
+    """Per-Redis state for the event-loop engine"""
+
+    def __init__(self, sock):
+        self.sock = sock
+        # Key of each GET (list of keys of each MGET, or PendingWrite) sent,
+        # in the order they were sent
+        self.in_flight = deque()
+        # Misses not yet sent
+        self.batch = []
+        self.inbuf = bytearray()
+        # Keeps its place in a reply at the front of inbuf not all read yet
+        self.parser = ReplyParser()
+        self.outbuf = ""
+
+
+class EventLoopRedisProxy(RedisProxy):
+    """RedisProxy served by a non-blocking, poll-driven event loop.
+
+    Unlike RedisProxy.run(), the loop sleeps in poll() until a socket is
+    ready, and cache misses are pipelined to Redis instead of blocking the
+    loop: each GET is written to the backend straight away and replies are
+    matched back to waiting clients in FIFO order. Misses for a key that
+    already has a GET in flight wait on that GET's reply rather than sending
+    their own. Between events, expired cache entries are swept in batches of
+    SWEEP_BATCH.
+
+    With batch_size > 1, misses from every client handled in one pass of the
+    loop go to Redis together, as MGETs of up to batch_size keys, instead of
+    a GET each.
+
+    With several backends, each has its own pipeline & batch; a client's
+    MGET is answered once every backend it was split across has replied.
+
+    Writes passed through are pipelined the same way. As replies come back
+    in the order commands were sent, a GET sent before a write reads the
+    old value: its waiters are detached, so clients asking after the write
+    wait on a GET of their own, & the old value isn't cached. Keys a backend
+    announces changes to are handled alike, its invalidation connection
+    being polled with the others.
+    """
+
+    def __init__(self, *args, **kwargs):
+        """Takes RedisProxy's settings, plus:
+            :param batch_size (int): max. # of keys per MGET sent to Redis.
+                1 sends a GET per miss
+        """
+
+        self.batch_size = kwargs.pop('batch_size', 1)
+        super(EventLoopRedisProxy, self).__init__(*args, **kwargs)
+        self.poller = select.poll()
+        self.connections = {}
+        self.backends = OrderedDict(
+            (node, BackendConnection(redis_conn.sock))
+            for node, redis_conn in self.redis_conns.iteritems()
+        )
+        self.backend_fds = dict(
+            (backend.sock.fileno(), backend) for backend in self.backends.itervalues()
+        )
+        self.feed_fds = {}
+        # Clients with replies readied this pass of the loop, sent at its end
+        self.ready_clients = set()
+        # key -> [(ClientConnection, PendingReply), ...] waiting on it
+        self.waiters = {}
+        # key -> version noted when its fetch (the one waiters wait on) was queued
+        self.fetch_versions = {}
+        # key -> deque of waiter lists of fetches sent before a write to key,
+        # oldest first
+        self.detached = {}
+
+        # Backend calls saved by waiting on an in-flight GET
+        self.coalesced = 0
+
+    def run(self):
+        self.client_socket.setblocking(0)
+        self.poller.register(self.client_socket, READ_EVENTS)
+        for backend in self.backends.itervalues():
+            backend.sock.setblocking(0)
+            self.poller.register(backend.sock, READ_EVENTS)
+        for feed in self.feeds:
+            self._feed_subscribed(feed)
+        listen_fd = self.client_socket.fileno()
+
+        next_sweep = monotonic() + SWEEP_INTERVAL
+        next_retry = None
+        running = True
+        while running:
+            try:
+                timeout = max(0, min(next_sweep, next_retry or next_sweep) - monotonic())
+                for fd, event in self.poller.poll(timeout * 1000):
+                    if fd == listen_fd:
+                        self._accept()
+                    elif fd in self.feed_fds:
+                        self._on_feed_readable(self.feed_fds[fd])
+                    elif fd in self.backend_fds:
+                        backend = self.backend_fds[fd]
+                        if event & select.POLLOUT:
+                            self._flush_redis(backend)
+                        if event & READ_EVENTS:
+                            self._on_redis_readable(backend)
+                    elif fd in self.connections:
+                        conn = self.connections[fd]
+                        if event & select.POLLOUT:
+                            self._flush_client(conn)
+                        if event & READ_EVENTS and fd in self.connections:
+                            self._on_client_readable(conn)
+                # Whatever this pass collected goes out now
+                for backend in self.backends.itervalues():
+                    if backend.batch:
+                        self._send_batch(backend)
+                        self._flush_redis(backend)
+                self._flush_ready_clients()
+                if monotonic() >= next_sweep:
+                    # A full batch means there may be more; go again next pass
+                    swept = self.cache.sweep(SWEEP_BATCH)
+                    if self.negative_cache is not None:
+                        swept = max(swept, self.negative_cache.sweep(SWEEP_BATCH))
+                    if swept < SWEEP_BATCH:
+                        next_sweep = monotonic() + SWEEP_INTERVAL
+                    if self.next_snapshot is not None and monotonic() >= self.next_snapshot:
+                        self.save_snapshot()
+                next_retry = self._retry_feeds()
+            except KeyboardInterrupt:
+                print "Shutting down RedisProxy"
+                running = False
+            except RedisError, e:
+                print "Lost connection to Redis: %s" % e
+                running = False
+        for conn in self.connections.values():
+            conn.sock.close()
+        for backend in self.backends.itervalues():
+            backend.sock.close()
+        for feed in self.feeds:
+            feed.close()
+        self.client_socket.close()
+        if self.snapshot_path:
+            saved = self.save_snapshot()
+            if saved is not None:
+                print "Saved %s keys to %s" % (saved, self.snapshot_path)
+        print "Done"
+
+    def _accept(self):
+        try:
+            new_sock, addr = self.client_socket.accept()
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise
+        new_sock.setblocking(0)
+        # Replies are written whole, once per pass: Nagle's algorithm would
+        # only hold them back for the client's delayed ACK
+        new_sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.metrics.connections_received += 1
+        self.metrics.connected_clients += 1
+        conn = ClientConnection(new_sock)
+        self.connections[new_sock.fileno()] = conn
+        self.poller.register(new_sock, READ_EVENTS)
+        self._queue_reply(
+            conn,
+            "Connected to RedisProxy\nYou can send GET {key} commands to the proxy\nUse QUIT to end connection\n",
+        )
+        self.ready_clients.add(conn)
+
+    def _on_client_readable(self, conn):
+        try:
+            data = conn.sock.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            data = ""
+        if not data:
+            self._close_client(conn)
+            return
+        self._process_client_input(conn, data)
+
+    def _process_client_input(self, conn, data):
+        """Handles every complete command in the client's input, then sends
+            the misses to Redis in one write; the client's ready replies go
+            out at the end of the pass
+        """
+
+        self.metrics.bytes_in += len(data)
+        try:
+            commands = conn.parser.feed(data)
+        except ProtocolError, e:
+            self._queue_reply(conn, encode_error("Protocol error: %s" % e))
+            conn.closing = True
+            commands = []
+        for args, inline in commands:
+            if conn.closing:
+                break
+            self._dispatch(conn, args, inline)
+        for backend in self.backends.itervalues():
+            if backend.outbuf:
+                self._flush_redis(backend)
+        self.ready_clients.add(conn)
+
+    def _dispatch(self, conn, args, inline):
+        self.metrics.commands += 1
+        if args[0].upper() == "QUIT":
+            self._queue_reply(conn, "Bye-bye!\n" if inline else "+OK\r\n")
+            conn.closing = True
+            return
+        if args[0].upper() in INFO_COMMANDS and len(args) <= 2:
+            self._queue_reply(conn, encode_value(None, self.info(*args[1:]), inline))
+            return
+        if args[0].upper() == "MGET" and len(args) > 1:
+            self._dispatch_mget(conn, args[1:], inline)
+            return
+        if self.pass_writes and write_keys(args) is not None:
+            self._dispatch_write(conn, args, inline)
+            return
+        if len(args) != 2 or args[0].upper() != "GET":
+            self._queue_reply(conn, encode_error(GET_FORMAT_ERROR, inline))
+            return
+        key = args[1]
+        start = clock()
+        cached_val = self._cached(key)
+        if cached_val:
+            self._queue_reply(conn, encode_value(key, cached_val, inline))
+            self.metrics.hit_latency.record(clock() - start)
+            return
+        if self._known_absent(key):
+            self._queue_reply(conn, encode_value(key, None, inline))
+            self.metrics.hit_latency.record(clock() - start)
+            return
+        reply = PendingReply(inline=inline, start=start)
+        conn.replies.append(reply)
+        self._wait_for(key, conn, reply)
+
+    def _dispatch_mget(self, conn, keys, inline):
+        start = clock()
+        vals = [self._cached(key) for key in keys]
+        missing = self._missing_keys(keys, vals)
+        if not missing:
+            self._queue_reply(conn, encode_values(keys, vals, inline))
+            self.metrics.hit_latency.record(clock() - start)
+            return
+        reply = PendingMultiReply(keys, vals, missing, inline, start)
+        conn.replies.append(reply)
+        for key in missing:
+            self._wait_for(key, conn, reply)
+
+    def _dispatch_write(self, conn, args, inline):
+        keys = write_keys(args)
+        if not keys:
+            self._queue_reply(conn, encode_reply(RedisError(arity_error(args)), inline))
+            return
+        nodes = self.ring.split(keys)
+        if len(nodes) > 1:
+            self._queue_reply(conn, encode_reply(RedisError(CROSS_BACKEND_ERROR), inline))
+            return
+        backend = self.backends[nodes.keys()[0]]
+        # Misses queued before the write go out before it, so they read
+        # what clients asking before the write should see
+        if backend.batch:
+            self._send_batch(backend)
+        reply = PendingReply(inline=inline)
+        conn.replies.append(reply)
+        backend.in_flight.append(PendingWrite(keys, conn, reply))
+        backend.outbuf += encode_command(*args)
+        self.versions.writes += 1
+        for key in keys:
+            self._drop(key)
+            self._detach(key)
+
+    def _detach(self, key):
+        """Leaves whoever waits on key's fetch in flight waiting on it, but
+            keeps what it reads out of the cache, & has later misses send a
+            fetch of their own
+        """
+
+        if key in self.waiters:
+            self.detached.setdefault(key, deque()).append(self.waiters.pop(key))
+            del self.fetch_versions[key]
+
+    def _apply_invalidations(self, invalidations):
+        for keys in invalidations:
+            for key in keys or ():
+                self._detach(key)
+        super(EventLoopRedisProxy, self)._apply_invalidations(invalidations)
+
+    def _flush(self):
+        for key in self.waiters.keys():
+            self._detach(key)
+        super(EventLoopRedisProxy, self)._flush()
+
+    def _feed_subscribed(self, feed):
+        feed.conn.sock.setblocking(0)
+        self.feed_fds[feed.conn.sock.fileno()] = feed
+        self.poller.register(feed.conn.sock, READ_EVENTS)
+
+    def _lose_feed(self, feed, error):
+        self.poller.unregister(feed.conn.sock)
+        del self.feed_fds[feed.conn.sock.fileno()]
+        super(EventLoopRedisProxy, self)._lose_feed(feed, error)
+
+    def _finish_write(self, write, redis_val):
+        """Replies to a write & invalidates its keys, now Redis has it"""
+
+        write.reply.data = encode_reply(redis_val, write.reply.inline)
+        self._invalidate(write.keys)
+        # GETs queued since the write was sent went out after it, so they
+        # read the new value; the bump just now mustn't void them
+        for key in set(write.keys):
+            if key in self.fetch_versions:
+                self.fetch_versions[key] += 1
+
+    def _wait_for(self, key, conn, reply):
+        """Has reply resolved with key's value once Redis sends it"""
+
+        if key in self.waiters:
+            self.waiters[key].append((conn, reply))
+            self.coalesced += 1
+            return
+        self.waiters[key] = [(conn, reply)]
+        self._queue_fetch(key)
+
+    def _schedule_refresh(self, key):
+        """Pipelines a GET for key that no client waits on; the reply just
+            updates the cache
+        """
+
+        if key not in self.waiters:
+            self.waiters[key] = []
+            self._queue_fetch(key)
+
+    def _queue_fetch(self, key):
+        self.fetch_versions[key] = self.versions.current(key)
+        backend = self.backends[self.ring.node_for(key)]
+        backend.batch.append(key)
+        if len(backend.batch) >= self.batch_size:
+            self._send_batch(backend)
+
+    def _send_batch(self, backend):
+        if len(backend.batch) == 1:
+            backend.in_flight.append(backend.batch[0])
+            backend.outbuf += encode_command("GET", backend.batch[0])
+        else:
+            backend.in_flight.append(backend.batch)
+            backend.outbuf += encode_command("MGET", *backend.batch)
+        if self.key_ttl:
+            backend.outbuf += encode_ttl_commands(backend.batch)
+        backend.batch = []
+
+    def _on_redis_readable(self, backend):
+        try:
+            data = backend.sock.recv(RECV_SIZE)
+        except socket.error, e:
+            if e.args[0] in (errno.EAGAIN, errno.EWOULDBLOCK):
+                return
+            raise RedisError(e)
+        if not data:
+            raise RedisError("connection closed by Redis")
+        self._process_redis_input(backend, data)
+
+    def _process_redis_input(self, backend, data):
+        """Matches complete replies from backend to the GETs & MGETs in
+            flight on it, oldest first
+        """
+
+        backend.inbuf.extend(data)
+        answered = set()
+        consumed_total = 0
+        while backend.in_flight:
+            sent = backend.in_flight[0]
+            redis_val, consumed = backend.parser.parse(backend.inbuf, consumed_total)
+            if not consumed:
+                break
+            if isinstance(sent, PendingWrite):
+                consumed_total += consumed
+                backend.in_flight.popleft()
+                backend.parser.reset()
+                self._finish_write(sent, redis_val)
+                answered.add(sent.conn)
+                continue
+            keys = sent if isinstance(sent, list) else [sent]
+            ttls = [None] * len(keys)
+            if self.key_ttl:
+                # Not answered until the PTTLs sent after it are in too
+                ttls, ttl_consumed = self._parse_ttls(backend.inbuf, consumed_total + consumed, len(keys))
+                if ttls is None:
+                    break
+                consumed += ttl_consumed
+            consumed_total += consumed
+            backend.in_flight.popleft()
+            backend.parser.reset()
+            if not isinstance(sent, list):
+                redis_val = [redis_val]
+            elif isinstance(redis_val, RedisError):
+                redis_val = [redis_val] * len(sent)
+            for key, val, ttl_ms in zip(keys, redis_val, ttls):
+                self._answer(key, val, answered, ttl_ms)
+        del backend.inbuf[:consumed_total]
+        backend.parser.discard(consumed_total)
+        self.ready_clients.update(answered)
+
+    def _parse_ttls(self, buf, pos, count):
+        """Parses the replies to count PTTLs, starting at pos in buf
+            :returns: (list of # of ms each key has left in Redis or None,
+                # of bytes parsed) tuple, or (None, 0) if they aren't all in
+        """
+
+        ttls = []
+        start = pos
+        for _ in xrange(count):
+            reply, consumed = parse_redis_reply(buf, pos)
+            if not consumed:
+                return None, 0
+            ttls.append(parse_pttl(reply))
+            pos += consumed
+        return ttls, pos - start
+
+    def _answer(self, key, redis_val, answered, ttl_ms=None):
+        """Stores key's value from Redis & fills in every reply waiting on it"""
+
+        detached = self.detached.get(key)
+        if detached:
+            # Sent before a write to key: answer whoever asked before the
+            # write, but don't cache what may be the old value
+            waiters = detached.popleft()
+            if not detached:
+                del self.detached[key]
+        else:
+            waiters = self.waiters.pop(key)
+            version = self.fetch_versions.pop(key)
+            if not isinstance(redis_val, RedisError):
+                self._store(key, redis_val, version, ttl_ms)
+        for conn, reply in waiters:
+            reply.resolve(key, redis_val)
+            if reply.data is not None:
+                self.metrics.miss_latency.record(clock() - reply.start)
+            answered.add(conn)
+
+    def _queue_reply(self, conn, data):
+        conn.replies.append(PendingReply(data))
+
+    def _flush_ready_clients(self):
+        """Writes the replies each client got this pass, in one write per
+            client, however many backends answered it
+        """
+
+        ready, self.ready_clients = self.ready_clients, set()
+        for conn in ready:
+            self._flush_client(conn)
+
+    def _flush_client(self, conn):
+        """Writes as much of the client's ready replies as the socket takes"""
+
+        if conn.closed:
+            return
+        while conn.replies and conn.replies[0].data is not None:
+            conn.outbuf += conn.replies.popleft().data
+        if conn.outbuf:
+            try:
+                sent = conn.sock.send(conn.outbuf)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    self._close_client(conn)
+                    return
+                sent = 0
+            conn.outbuf = conn.outbuf[sent:]
+            self.metrics.bytes_out += sent
+        if conn.outbuf:
+            self.poller.modify(conn.sock, WRITE_EVENTS)
+        elif conn.closing and not conn.replies:
+            self._close_client(conn)
+            print "Client connection closed"
+        else:
+            self.poller.modify(conn.sock, READ_EVENTS)
+
+    def _flush_redis(self, backend):
+        if backend.outbuf:
+            try:
+                sent = backend.sock.send(backend.outbuf)
+            except socket.error, e:
+                if e.args[0] not in (errno.EAGAIN, errno.EWOULDBLOCK):
+                    raise RedisError(e)
+                sent = 0
+            backend.outbuf = backend.outbuf[sent:]
+        if backend.outbuf:
+            self.poller.modify(backend.sock, WRITE_EVENTS)
+        else:
+            self.poller.modify(backend.sock, READ_EVENTS)
+
+    def _close_client(self, conn):
+        if conn.closed:
+            return
+        conn.closed = True
+        self.metrics.connected_clients -= 1
+        self.connections.pop(conn.sock.fileno(), None)
+        self.poller.unregister(conn.sock)
+        conn.sock.close()
+
+
 if __name__ == "__main__":
 
     parser = ArgumentParser()
@@ -222,12 +1706,338 @@ if __name__ == "__main__":
         '--capacity',
         type=int,
         dest='capacity',
-        default=1000,
+        default=None,
         action='store',
         required=False,
-        help='Enter max. # of cache keys before LRU eviction',
+        help='Enter max. # of cache keys before LRU eviction (Defaults to %s, or no limit with --max-memory)' % DEFAULT_CAPACITY,
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=int,
+        dest='max_memory',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter max. approx. bytes used by the cache before LRU eviction',
+    )
+
+    parser.add_argument(
+        '--max-entry-fraction',
+        type=float,
+        dest='max_entry_fraction',
+        default=0.5,
+        action='store',
+        required=False,
+        help='Enter largest fraction of --max-memory a single entry may use',
+    )
+
+    parser.add_argument(
+        '--engine',
+        type=str,
+        dest='engine',
+        default='select',
+        choices=['select', 'eventloop'],
+        action='store',
+        required=False,
+        help='Enter serving engine: select (default) or non-blocking eventloop',
+    )
+
+    parser.add_argument(
+        '--stream-threshold',
+        type=int,
+        dest='stream_threshold',
+        default=1024 * 1024,
+        action='store',
+        required=False,
+        help='Enter size (in bytes) above which values are streamed, not cached',
+    )
+
+    parser.add_argument(
+        '--negative-ttl',
+        type=int,
+        dest='negative_ttl',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter TTL (in sec.) for remembering keys missing from Redis (Defaults to off)',
+    )
+
+    parser.add_argument(
+        '--negative-capacity',
+        type=int,
+        dest='negative_capacity',
+        default=DEFAULT_NEGATIVE_CAPACITY,
+        action='store',
+        required=False,
+        help='Enter max. # of missing keys remembered, on top of --capacity',
+    )
+
+    parser.add_argument(
+        '--absent-filter',
+        dest='absent_filter',
+        default=False,
+        action='store_true',
+        required=False,
+        help='Screen negative cache lookups with a Bloom filter',
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        dest='batch_size',
+        default=1,
+        action='store',
+        required=False,
+        help='Enter max. # of cache misses per MGET to Redis, for the eventloop engine (Defaults to 1, a GET per miss)',
+    )
+
+    parser.add_argument(
+        '--eviction-policy',
+        type=str,
+        dest='eviction_policy',
+        default='lru',
+        choices=sorted(POLICIES),
+        action='store',
+        required=False,
+        help='Enter which cache keys to evict first: lru (default), slru, arc or tinylfu',
+    )
+
+    parser.add_argument(
+        '--grace',
+        type=int,
+        dest='grace',
+        default=0,
+        action='store',
+        required=False,
+        help='Enter # of sec. an expired key is still served while it is refreshed',
+    )
+
+    parser.add_argument(
+        '--refresh-ahead',
+        type=int,
+        dest='refresh_ahead',
+        default=0,
+        action='store',
+        required=False,
+        help='Enter # of sec. before expiry during which a hit refreshes the key',
+    )
+
+    parser.add_argument(
+        '--compress-threshold',
+        type=int,
+        dest='compress_threshold',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter min. size (in bytes) of a value to cache it zlib-compressed (Defaults to off)',
+    )
+
+    parser.add_argument(
+        '--compress-level',
+        type=int,
+        dest='compress_level',
+        default=DEFAULT_LEVEL,
+        action='store',
+        required=False,
+        help='Enter zlib level for --compress-threshold, 1 (fastest) to 9 (smallest) (Defaults to %s)' % DEFAULT_LEVEL,
+    )
+
+    parser.add_argument(
+        '--compact-cache',
+        dest='compact_cache',
+        default=False,
+        action='store_true',
+        required=False,
+        help='Keep the cache in a compact store, with less memory per key & faster hits (lru eviction policy only)',
+    )
+
+    parser.add_argument(
+        '--pass-writes',
+        dest='pass_writes',
+        default=False,
+        action='store_true',
+        required=False,
+        help='Pass write commands (SET, DEL, EXPIRE, ...) through to Redis, invalidating the keys they write to',
+    )
+
+    parser.add_argument(
+        '--invalidation',
+        type=str,
+        dest='invalidation',
+        default=None,
+        choices=INVALIDATION_MODES,
+        action='store',
+        required=False,
+        help='Enter how Redis announces changed keys to the proxy: tracking (CLIENT TRACKING, Redis 6+) or keyspace (keyspace notifications) (Defaults to relying on the TTL)',
+    )
+
+    parser.add_argument(
+        '--tracking-prefix',
+        type=str,
+        dest='tracking_prefixes',
+        default=[],
+        action='append',
+        required=False,
+        help='Enter a key prefix to track with --invalidation tracking; may be given more than once (Defaults to all keys)',
+    )
+
+    parser.add_argument(
+        '--key-ttl',
+        dest='key_ttl',
+        default=False,
+        action='store_true',
+        required=False,
+        help="Fetch each key's PTTL with it & cache it no longer than it has left in Redis (--ttl stays the max.)",
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        dest='workers',
+        default=1,
+        action='store',
+        required=False,
+        help='Enter # of worker processes accepting on the same port & sharing one cache (Defaults to 1)',
+    )
+
+    parser.add_argument(
+        '--slot-size',
+        type=int,
+        dest='slot_size',
+        default=DEFAULT_SLOT_SIZE,
+        action='store',
+        required=False,
+        help='Enter bytes per entry of the --workers shared cache; larger entries are not cached',
+    )
+
+    parser.add_argument(
+        '--backend',
+        type=parse_backend,
+        dest='backends',
+        default=None,
+        action='append',
+        required=False,
+        help='Enter host:port of a backing Redis; repeat to shard keys across several (Defaults to --addr on port 6379)',
+    )
+
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        dest='metrics_port',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter port to serve Prometheus metrics on, at /metrics; each --workers worker uses the next port up (Defaults to off)',
+    )
+
+    parser.add_argument(
+        '--snapshot',
+        type=str,
+        dest='snapshot',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter file to save the cache to on shutdown & load it from on startup (Defaults to off)',
+    )
+
+    parser.add_argument(
+        '--snapshot-interval',
+        type=float,
+        dest='snapshot_interval',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter seconds between saves of the cache to --snapshot while running (Defaults to only on shutdown)',
+    )
+
+    parser.add_argument(
+        '--warm-keys',
+        type=str,
+        dest='warm_keys',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter file of keys, one per line, to fetch into the cache before accepting clients',
     )
 
     args = parser.parse_args()
+    if not args.capacity and not args.max_memory:
+        args.capacity = DEFAULT_CAPACITY
+    if args.workers > 1 and args.eviction_policy != 'lru':
+        parser.error("--workers only supports the lru eviction policy")
+    if args.workers > 1 and args.compress_threshold:
+        parser.error("--compress-threshold isn't supported with --workers")
+    if args.compact_cache and (args.eviction_policy != 'lru' or args.workers > 1):
+        parser.error("--compact-cache only supports the lru eviction policy, without --workers")
+    if args.tracking_prefixes and args.invalidation != 'tracking':
+        parser.error("--tracking-prefix needs --invalidation tracking")
+
+    engine_args = {}
+    if args.engine == 'eventloop':
+        proxy_cls = EventLoopRedisProxy
+        engine_args['batch_size'] = args.batch_size
+    else:
+        proxy_cls = RedisProxy
+
+    if args.workers > 1:
+        # One cache for all workers, so capacity isn't multiplied by them
+        engine_args['cache'] = SharedLRUCache(
+            args.capacity,
+            args.ttl,
+            args.max_memory,
+            args.slot_size,
+            args.grace,
+            args.refresh_ahead,
+        )
+        engine_args['reuse_port'] = True
+        # A write through one worker must void fetches in flight in the others
+        engine_args['versions'] = KeyVersions(shared=True)
+
+    def serve(worker_id=None):
+        # So the cache is saved on SIGTERM, as on CTRL-C
+        stop_on_sigterm()
+        # Workers share one cache; one of them loading & saving it is enough
+        first_worker = not worker_id
+        redis_proxy = proxy_cls(
+            host_addr=args.addr,
+            ttl=args.ttl,
+            capacity=args.capacity,
+            stream_threshold=args.stream_threshold,
+            max_memory=args.max_memory,
+            max_entry_fraction=args.max_entry_fraction,
+            negative_ttl=args.negative_ttl,
+            negative_capacity=args.negative_capacity,
+            absent_filter=args.absent_filter,
+            eviction_policy=args.eviction_policy,
+            grace=args.grace,
+            refresh_ahead=args.refresh_ahead,
+            backends=args.backends,
+            compress_threshold=args.compress_threshold,
+            compress_level=args.compress_level,
+            compact_cache=args.compact_cache,
+            pass_writes=args.pass_writes,
+            invalidation=args.invalidation,
+            tracking_prefixes=args.tracking_prefixes,
+            key_ttl=args.key_ttl,
+            snapshot_path=args.snapshot if first_worker else None,
+            snapshot_interval=args.snapshot_interval,
+            **engine_args
+        )
+        if args.snapshot and first_worker:
+            loaded, skipped = load_snapshot(redis_proxy.cache, args.snapshot)
+            print "Loaded %s keys from %s (%s had expired)" % (loaded, args.snapshot, skipped)
+        if args.warm_keys and first_worker:
+            keys = read_keys(args.warm_keys)
+            print "Warmed %s of %s keys from %s" % (redis_proxy.warm(keys), len(keys), args.warm_keys)
+        if args.metrics_port:
+            # Scrapes are answered from a thread, reading the counts as the
+            # loop updates them. Each worker has its own counts, so each
+            # gets its own port.
+            start_metrics_server(('', args.metrics_port + (worker_id or 0)), redis_proxy.prometheus)
+        redis_proxy.run()
 
-    RedisProxy(host_addr=args.addr, ttl=args.ttl, capacity=args.capacity).run()
+    if args.workers > 1:
+        fork_workers(args.workers, serve)
+    else:
+        serve()
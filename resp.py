@@ -0,0 +1,505 @@
+"""Redis protocol (RESP) helpers shared by the proxy front ends"""
+
+import shlex
+import socket
+
+
+# Same limits Redis itself applies to client requests
+MAX_INLINE_SIZE = 64 * 1024
+MAX_BULK_SIZE = 512 * 1024 * 1024
+
+# Per-connection read buffer for replies from Redis
+REPLY_BUFFER_SIZE = 64 * 1024
+
+# Returned by RedisConnection.read_reply() once a value has been streamed
+STREAMED = object()
+
+GET_FORMAT_ERROR = "Please use Redis 'GET key' command format"
+
+
+class ProtocolError(Exception):
+    """Bytes received aren't a valid RESP or inline command/reply"""
+
+
+class RedisError(Exception):
+    """Error reply sent back by the backing Redis"""
+
+
+class StatusReply(str):
+    """+status reply from Redis, e.g. OK"""
+
+    __slots__ = ()
+
+
+class IntegerReply(str):
+    """:integer reply from Redis, as its digits"""
+
+    __slots__ = ()
+
+
+class RequestParser(object):
+    """Incremental parser for client commands, in RESP or inline form.
+
+    Bytes are fed in as they are read off the socket. Every complete command
+    is split out of the buffer, so a client can pipeline any number of
+    commands per read; a partial command waits in the buffer for more input.
+    """
+
+    def __init__(self):
+        self.buf = bytearray()
+
+    def feed(self, data):
+        """Adds data to the buffer and parses out all complete commands
+            :param data (str): bytes read from the client
+            :returns: list of (args, inline) tuples. args is the list of
+                command arguments, inline is True for inline commands
+            :raises ProtocolError: on malformed input
+        """
+
+        self.buf.extend(data)
+        commands = []
+        pos = 0
+        while pos < len(self.buf):
+            inline = self.buf[pos] != ord("*")
+            if inline:
+                args, next_pos = self._parse_inline(pos)
+            else:
+                args, next_pos = self._parse_multibulk(pos)
+            if next_pos is None:
+                break
+            pos = next_pos
+            # Blank lines & empty multibulks are ignored, like Redis does
+            if args:
+                commands.append((args, inline))
+        del self.buf[:pos]
+        return commands
+
+    def _parse_inline(self, pos):
+        end = self.buf.find("\n", pos)
+        if end == -1:
+            if len(self.buf) - pos > MAX_INLINE_SIZE:
+                raise ProtocolError("too big inline request")
+            return None, None
+        line = str(self.buf[pos:end]).strip()
+        try:
+            # Quoting lets inline keys contain spaces: GET "my key"
+            args = shlex.split(line)
+        except ValueError:
+            raise ProtocolError("unbalanced quotes in request")
+        return args, end + 1
+
+    def _parse_multibulk(self, pos):
+        end = self._find_line_end(pos)
+        if end is None:
+            return None, None
+        count = self._parse_int(pos + 1, end, "multibulk length")
+        pos = end + 2
+        args = []
+        for _ in xrange(count):
+            end = self._find_line_end(pos)
+            if end is None:
+                return None, None
+            if self.buf[pos] != ord("$"):
+                raise ProtocolError("expected '$', got '%s'" % chr(self.buf[pos]))
+            length = self._parse_int(pos + 1, end, "bulk length")
+            if length < 0 or length > MAX_BULK_SIZE:
+                raise ProtocolError("invalid bulk length")
+            start = end + 2
+            if len(self.buf) < start + length + 2:
+                return None, None
+            args.append(str(self.buf[start:start + length]))
+            pos = start + length + 2
+        return args, pos
+
+    def _find_line_end(self, pos):
+        end = self.buf.find("\r\n", pos)
+        if end == -1:
+            if len(self.buf) - pos > MAX_INLINE_SIZE:
+                raise ProtocolError("too big multibulk header")
+            return None
+        return end
+
+    def _parse_int(self, start, end, what):
+        try:
+            return int(str(self.buf[start:end]))
+        except ValueError:
+            raise ProtocolError("invalid %s" % what)
+
+
+def parse_redis_reply(buf, pos=0):
+    """Parses one complete Redis reply out of a buffer, without blocking
+        :param buf (bytearray): bytes read from Redis so far
+        :param pos (int): offset in buf where the reply starts
+        :returns: (reply, consumed) tuple. consumed is 0 if buf does not yet
+            hold a complete reply. reply is the bulk string value, None for
+            a nil bulk string, a list for a multibulk reply, a RedisError
+            for an error reply, or a StatusReply or IntegerReply
+    """
+
+    header_end = buf.find("\r\n", pos)
+    if header_end == -1:
+        return None, 0
+    msg_type, header = str(buf[pos:pos + 1]), str(buf[pos + 1:header_end])
+    if msg_type == "-":
+        return RedisError(header), header_end + 2 - pos
+    if msg_type == "*":
+        count = int(header)
+        if count == -1:
+            return None, header_end + 2 - pos
+        items = []
+        item_pos = header_end + 2
+        for _ in xrange(count):
+            item, consumed = parse_redis_reply(buf, item_pos)
+            if not consumed:
+                return None, 0
+            items.append(item)
+            item_pos += consumed
+        return items, item_pos - pos
+    if msg_type == "+":
+        return StatusReply(header), header_end + 2 - pos
+    if msg_type != "$":
+        return IntegerReply(header), header_end + 2 - pos
+    length = int(header)
+    if length == -1:
+        return None, header_end + 2 - pos
+    end = header_end + 2 + length
+    if len(buf) < end + 2:
+        return None, 0
+    return str(buf[header_end + 2:end]), end + 2 - pos
+
+
+class ReplyParser(object):
+    """Parses the reply at the front of a buffer that's still being read
+    into, one item at a time.
+
+    parse_redis_reply() starts over from a reply's first byte each time it's
+    called, so a multibulk reply arriving over many reads would be parsed
+    again in full after each one. This keeps the items of the multibulk
+    (and any nested in it) parsed so far, & where the next one starts, so
+    each read only parses what it added. A reply that's complete is kept
+    too, until reset(), in case the caller can't use it yet.
+    """
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        """Forgets the reply parsed so far, once the caller is done with it"""
+
+        # Offset in the buffer of the reply being parsed, or None
+        self.start = None
+        # Offset of its next item to parse
+        self.pos = 0
+        # (items so far, # of items) of each multibulk open, outermost first
+        self.open = []
+        self.reply = None
+
+    def discard(self, count):
+        """Shifts the offsets kept after count bytes were deleted from the
+            front of the buffer, none of them belonging to the reply
+        """
+
+        if self.start is not None:
+            self.start -= count
+            self.pos -= count
+
+    def parse(self, buf, pos=0):
+        """Parses the reply starting at pos in buf, going on from where the
+            last call left off if it was for the same reply
+            :param buf (bytearray): bytes read from Redis so far
+            :param pos (int): offset in buf where the reply starts
+            :returns: (reply, consumed) tuple, as parse_redis_reply()
+        """
+
+        if self.start != pos:
+            self.reset()
+            self.start = self.pos = pos
+        while self.reply is None:
+            if self.open and len(self.open[-1][0]) == self.open[-1][1]:
+                item = self.open.pop()[0]
+            else:
+                header_end = buf.find("\r\n", self.pos)
+                if header_end == -1:
+                    return None, 0
+                if buf[self.pos] == ord("*"):
+                    count = int(str(buf[self.pos + 1:header_end]))
+                    if count > 0:
+                        self.open.append(([], count))
+                        self.pos = header_end + 2
+                        continue
+                item, consumed = parse_redis_reply(buf, self.pos)
+                if not consumed:
+                    return None, 0
+                self.pos += consumed
+            if not self.open:
+                # Wrapped so a nil reply isn't taken for one not yet parsed
+                self.reply = (item,)
+            else:
+                self.open[-1][0].append(item)
+        return self.reply[0], self.pos - self.start
+
+
+class RedisConnection(object):
+    """Blocking connection to Redis with a buffered, length-aware reader.
+
+    Bulk replies are read by their $<len> header, then exactly that many
+    bytes, so values of any size, or containing CRLF, come back whole and
+    nothing is left behind to corrupt the next reply. Reads go into one
+    preallocated buffer per connection with recv_into().
+    """
+
+    def __init__(self, sock, buffer_size=REPLY_BUFFER_SIZE):
+        self.sock = sock
+        self.buf = bytearray(buffer_size)
+        self.view = memoryview(self.buf)
+        # Unread bytes are self.buf[self.start:self.end]
+        self.start = 0
+        self.end = 0
+
+    def sendall(self, data):
+        self.sock.sendall(data)
+
+    def close(self):
+        self.sock.close()
+
+    def read_reply(self, stream_to=None, stream_threshold=None):
+        """Reads one complete reply from Redis
+            :param stream_to (BulkStream): where to write bulk values larger
+                than stream_threshold, instead of returning them
+            :param stream_threshold (int): size in bytes above which bulk
+                values are streamed
+            :returns: str for bulk replies, StatusReply & IntegerReply for
+                status & integer replies, None for nil,
+                a list for multibulk replies, a RedisError for error replies,
+                or STREAMED if the value was written to stream_to
+        """
+
+        line = self._read_line()
+        msg_type, header = line[:1], line[1:]
+        if msg_type == "-":
+            return RedisError(header)
+        if msg_type == "+":
+            return StatusReply(header)
+        if msg_type == ":":
+            return IntegerReply(header)
+        if msg_type == "*":
+            count = int(header)
+            if count == -1:
+                return None
+            return [self.read_reply() for _ in xrange(count)]
+        if msg_type != "$":
+            raise ProtocolError("unexpected reply type %r from Redis" % msg_type)
+
+        length = int(header)
+        if length == -1:
+            return None
+        if stream_to is not None and stream_threshold is not None and length > stream_threshold:
+            stream_to.start(length)
+            self._stream(length, stream_to)
+            self._skip_crlf()
+            stream_to.finish()
+            return STREAMED
+        if length <= self.end - self.start:
+            val = str(self.buf[self.start:self.start + length])
+            self.start += length
+        else:
+            val = bytearray(length)
+            self._read_into(memoryview(val))
+            val = str(val)
+        self._skip_crlf()
+        return val
+
+    def _fill(self):
+        """Reads more bytes from Redis onto the end of the buffer"""
+
+        if self.start == self.end:
+            self.start = self.end = 0
+        elif self.end == len(self.buf):
+            # Slide the unread bytes to the front to make room
+            unread = self.end - self.start
+            self.buf[:unread] = self.buf[self.start:self.end]
+            self.start, self.end = 0, unread
+            if self.end == len(self.buf):
+                raise ProtocolError("reply line from Redis is too long")
+        received = self.sock.recv_into(self.view[self.end:])
+        if not received:
+            raise socket.error("Connection closed by Redis")
+        self.end += received
+
+    def _read_line(self):
+        while True:
+            line_end = self.buf.find("\r\n", self.start, self.end)
+            if line_end != -1:
+                line = str(self.buf[self.start:line_end])
+                self.start = line_end + 2
+                return line
+            self._fill()
+
+    def _read_into(self, view):
+        """Fills view exactly: from the buffer first, then straight from the
+            socket, skipping the intermediate buffer
+        """
+
+        buffered = min(len(view), self.end - self.start)
+        view[:buffered] = self.view[self.start:self.start + buffered]
+        self.start += buffered
+        pos = buffered
+        while pos < len(view):
+            received = self.sock.recv_into(view[pos:])
+            if not received:
+                raise socket.error("Connection closed by Redis")
+            pos += received
+
+    def _stream(self, length, stream_to):
+        remaining = length
+        buffered = min(remaining, self.end - self.start)
+        if buffered:
+            stream_to.write(self.view[self.start:self.start + buffered])
+            self.start += buffered
+            remaining -= buffered
+        while remaining:
+            # Nothing is left unread, so reuse the whole buffer as scratch
+            self.start = self.end = 0
+            received = self.sock.recv_into(self.view, min(remaining, len(self.buf)))
+            if not received:
+                raise socket.error("Connection closed by Redis")
+            stream_to.write(self.view[:received])
+            remaining -= received
+
+    def _skip_crlf(self):
+        while self.end - self.start < 2:
+            self._fill()
+        self.start += 2
+
+
+class BulkStream(object):
+    """Writes one bulk value to a client socket as it's read from Redis, so
+    the value is never copied into a str (or cached).
+
+    Replies queued ahead of it in the same pipelined batch are sent first,
+    so the client still sees its replies in order.
+    """
+
+    def __init__(self, sock, inline=False, queued=None):
+        """
+            :param sock: client socket
+            :param inline (bool): whether the client sent an inline command
+            :param queued (list): replies not yet sent to the client
+        """
+
+        self.sock = sock
+        self.inline = inline
+        self.queued = queued if queued is not None else []
+        self.started = False
+        # Including the queued replies sent ahead of the value
+        self.bytes_sent = 0
+
+    def start(self, length):
+        self.started = True
+        if not self.inline:
+            self.queued.append("$%d\r\n" % length)
+        if self.queued:
+            data = "".join(self.queued)
+            self.sock.sendall(data)
+            self.bytes_sent += len(data)
+            del self.queued[:]
+
+    def write(self, chunk):
+        self.sock.sendall(chunk)
+        self.bytes_sent += len(chunk)
+
+    def finish(self):
+        self.sock.sendall("\n\r" if self.inline else "\r\n")
+        self.bytes_sent += 2
+
+
+def encode_command(*args):
+    """Formats a command for Redis as a RESP multibulk"""
+
+    parts = ["*%d\r\n" % len(args)]
+    for arg in args:
+        parts.append("$%d\r\n%s\r\n" % (len(arg), arg))
+    return "".join(parts)
+
+
+def encode_ttl_commands(keys):
+    """Formats a PTTL of each key, to pipeline after the GET/MGET of them"""
+
+    return "".join(encode_command("PTTL", key) for key in keys)
+
+
+def parse_pttl(reply):
+    """Remaining lifetime of a key, from Redis's reply to PTTL
+        :param reply: as read_reply() returns it
+        :returns: # of ms (0 if the key no longer exists), or None if the
+            key has no expiry or the PTTL failed
+    """
+
+    if isinstance(reply, RedisError):
+        return None
+    ttl_ms = int(reply)
+    if ttl_ms == -1:
+        return None
+    # -2: the key was deleted or expired after it was read
+    return max(ttl_ms, 0)
+
+
+def encode_value(key, val, inline=False):
+    """Formats a GET reply for the client
+        :param key (str):
+        :param val (str): value, or None if nothing exists for key
+        :param inline (bool): reply in the human-readable inline format,
+            rather than as a RESP bulk string
+    """
+
+    if inline:
+        if val is None:
+            return "Nothing exists for key %s in Redis\n\r" % (key)
+        return val + "\n\r"
+    if val is None:
+        return "$-1\r\n"
+    return "$%d\r\n%s\r\n" % (len(val), val)
+
+
+def encode_values(keys, vals, inline=False):
+    """Formats an MGET reply for the client
+        :param keys (list):
+        :param vals (list): value per key, None for keys that don't exist
+        :param inline (bool): reply with one inline line per key, rather
+            than as a RESP multibulk
+    """
+
+    replies = [encode_value(key, val, inline) for key, val in zip(keys, vals)]
+    if not inline:
+        replies.insert(0, "*%d\r\n" % len(vals))
+    return "".join(replies)
+
+
+def encode_reply(reply, inline=False):
+    """Formats any reply from Redis for the client, e.g. to a write passed
+        through
+        :param reply: as read_reply() returns it
+        :param inline (bool): reply in the human-readable inline format,
+            like redis-cli's, rather than as RESP
+    """
+
+    if isinstance(reply, RedisError):
+        return "%s\n\r" % reply if inline else "-%s\r\n" % reply
+    if isinstance(reply, StatusReply):
+        return reply + "\n\r" if inline else "+%s\r\n" % reply
+    if isinstance(reply, IntegerReply):
+        return "(integer) %s\n\r" % reply if inline else ":%s\r\n" % reply
+    if reply is None:
+        return "(nil)\n\r" if inline else "$-1\r\n"
+    if isinstance(reply, list):
+        items = "".join(encode_reply(item, inline) for item in reply)
+        return items if inline else "*%d\r\n%s" % (len(reply), items)
+    return reply + "\n\r" if inline else "$%d\r\n%s\r\n" % (len(reply), reply)
+
+
+def encode_error(msg, inline=False):
+    """Formats an error reply for the client"""
+
+    if inline:
+        return msg + "\n\r"
+    return "-ERR %s\r\n" % msg
@@ -0,0 +1,324 @@
+import mock
+import socket
+import unittest
+
+from resp import (
+    BulkStream,
+    encode_command,
+    encode_error,
+    encode_reply,
+    encode_ttl_commands,
+    encode_value,
+    encode_values,
+    parse_pttl,
+    parse_redis_reply,
+    IntegerReply,
+    ProtocolError,
+    RedisConnection,
+    RedisError,
+    ReplyParser,
+    RequestParser,
+    StatusReply,
+    STREAMED,
+)
+
+
+def fake_recv_into(*chunks):
+    """Fakes socket.recv_into, handing out chunks (or raising them, if they
+        are exceptions) in order
+    """
+
+    chunks = list(chunks)
+
+    def recv_into(buf, nbytes=0):
+        chunk = chunks.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+        size = min(nbytes or len(buf), len(buf))
+        if len(chunk) > size:
+            chunk, rest = chunk[:size], chunk[size:]
+            chunks.insert(0, rest)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+    return recv_into
+
+
+class TestRequestParser(unittest.TestCase):
+
+    def test_inline_command(self):
+        """Test that an inline command is split into its arguments"""
+
+        parser = RequestParser()
+        self.assertEqual(parser.feed("GET name\r\n"), [(['GET', 'name'], True)])
+
+    def test_inline_quoted_key_with_spaces(self):
+        """Test that quoted inline arguments may contain spaces"""
+
+        parser = RequestParser()
+        self.assertEqual(parser.feed('GET "my key"\n'), [(['GET', 'my key'], True)])
+
+    def test_multibulk_command(self):
+        """Test that a RESP multibulk command is parsed, spaces & CRLF included"""
+
+        parser = RequestParser()
+        self.assertEqual(
+            parser.feed("*2\r\n$3\r\nGET\r\n$8\r\nmy\r\nkey!\r\n"),
+            [(['GET', 'my\r\nkey!'], False)],
+        )
+
+    def test_pipelined_commands_in_one_read(self):
+        """Test that every complete command in a single read is returned"""
+
+        parser = RequestParser()
+        data = "*2\r\n$3\r\nGET\r\n$1\r\na\r\n" * 100 + "GET b\n"
+        commands = parser.feed(data)
+        self.assertEqual(len(commands), 101)
+        self.assertEqual(commands[-1], (['GET', 'b'], True))
+
+    def test_partial_command_waits_for_more_input(self):
+        """Test that a command split across reads is returned once complete"""
+
+        parser = RequestParser()
+        self.assertEqual(parser.feed("*2\r\n$3\r\nGET\r\n$4\r\nna"), [])
+        self.assertEqual(parser.feed("me\r\nGET fo"), [(['GET', 'name'], False)])
+        self.assertEqual(parser.feed("o\n"), [(['GET', 'foo'], True)])
+
+    def test_blank_lines_ignored(self):
+        """Test that empty inline lines don't produce commands"""
+
+        parser = RequestParser()
+        self.assertEqual(parser.feed("\r\n\nGET a\n"), [(['GET', 'a'], True)])
+
+    def test_malformed_input_raises(self):
+        """Test that invalid lengths & unbalanced quotes raise ProtocolError"""
+
+        with self.assertRaises(ProtocolError):
+            RequestParser().feed("*x\r\n")
+        with self.assertRaises(ProtocolError):
+            RequestParser().feed("*1\r\n+GET\r\n")
+        with self.assertRaises(ProtocolError):
+            RequestParser().feed('GET "name\n')
+
+
+class TestParseRedisReply(unittest.TestCase):
+
+    def test_incomplete_reply(self):
+        """Test that a partially received reply consumes nothing"""
+
+        self.assertEqual(parse_redis_reply(bytearray("$5\r\nbla")), (None, 0))
+        self.assertEqual(parse_redis_reply(bytearray("$5")), (None, 0))
+
+    def test_bulk_and_nil_replies(self):
+        """Test that bulk & nil replies are parsed from the given offset"""
+
+        buf = bytearray("$5\r\nblarf\r\n$-1\r\n")
+        self.assertEqual(parse_redis_reply(buf), ("blarf", 11))
+        self.assertEqual(parse_redis_reply(buf, 11), (None, 5))
+
+    def test_error_reply(self):
+        """Test that an error reply is returned as a RedisError"""
+
+        reply, consumed = parse_redis_reply(bytearray("-ERR oops\r\n"))
+        self.assertIsInstance(reply, RedisError)
+        self.assertEqual(consumed, 11)
+
+    def test_multibulk_reply(self):
+        """Test that an MGET reply is parsed once all of its items are in"""
+
+        buf = bytearray("*3\r\n$3\r\nfoo\r\n$-1\r\n$3\r\nbar\r\n")
+        self.assertEqual(parse_redis_reply(buf), (["foo", None, "bar"], len(buf)))
+        self.assertEqual(parse_redis_reply(buf[:-3]), (None, 0))
+
+    def test_status_and_integer_replies(self):
+        """Test that status & integer replies keep their type"""
+
+        buf = bytearray("+OK\r\n:42\r\n")
+        self.assertIsInstance(parse_redis_reply(buf)[0], StatusReply)
+        self.assertEqual(parse_redis_reply(buf), ("OK", 5))
+        self.assertIsInstance(parse_redis_reply(buf, 5)[0], IntegerReply)
+        self.assertEqual(parse_redis_reply(buf, 5), ("42", 5))
+
+
+class TestReplyParser(unittest.TestCase):
+
+    @mock.patch('resp.parse_redis_reply', wraps=parse_redis_reply)
+    def test_items_parsed_once(self, patched_parse):
+        """Test that a multibulk reply read a byte at a time isn't parsed
+            again from its start after each byte
+        """
+
+        data = "*3\r\n$3\r\nfoo\r\n*2\r\n$-1\r\n:1\r\n$3\r\nbar\r\n"
+        buf = bytearray("+OK\r\n")
+        parser = ReplyParser()
+        for char in data[:-1]:
+            buf.extend(char)
+            self.assertEqual(parser.parse(buf, 5), (None, 0))
+        buf.extend(data[-1])
+        self.assertEqual(parser.parse(buf, 5), (["foo", [None, "1"], "bar"], len(data)))
+        # Never from the reply's first byte, nor back to an item already done
+        positions = [call[0][1] for call in patched_parse.call_args_list]
+        self.assertGreater(min(positions), 5)
+        self.assertEqual(positions, sorted(positions))
+
+    def test_kept_until_reset(self):
+        """Test that a complete reply is kept, across the buffer being
+            trimmed, until reset
+        """
+
+        buf = bytearray("+OK\r\n$3\r\nfoo\r\n")
+        parser = ReplyParser()
+        self.assertEqual(parser.parse(buf, 5), ("foo", 9))
+        del buf[:5]
+        parser.discard(5)
+        buf[4:7] = "bar"
+        self.assertEqual(parser.parse(buf, 0), ("foo", 9))
+        parser.reset()
+        self.assertEqual(parser.parse(buf, 0), ("bar", 9))
+
+    def test_nil_and_empty_multibulk(self):
+        parser = ReplyParser()
+        self.assertEqual(parser.parse(bytearray("*-1\r\n")), (None, 5))
+        parser.reset()
+        self.assertEqual(parser.parse(bytearray("*0\r\n")), ([], 4))
+
+class TestRedisConnection(unittest.TestCase):
+
+    def _conn(self, *chunks, **kwargs):
+        sock = mock.MagicMock()
+        sock.recv_into.side_effect = fake_recv_into(*chunks)
+        return RedisConnection(sock, **kwargs)
+
+    def test_value_larger_than_buffer(self):
+        """Test that a value bigger than the read buffer comes back whole"""
+
+        value = "x" * 10000
+        conn = self._conn("$10000\r\n" + value + "\r\n$-1\r\n", buffer_size=1024)
+
+        self.assertEqual(conn.read_reply(), value)
+        self.assertIsNone(conn.read_reply())
+
+    def test_value_containing_crlf(self):
+        """Test that the length header, not CRLF, decides where a value ends"""
+
+        conn = self._conn("$4\r\na\r\nb\r\n")
+        self.assertEqual(conn.read_reply(), "a\r\nb")
+
+    def test_replies_split_across_reads(self):
+        """Test that replies arriving a few bytes at a time are reassembled"""
+
+        conn = self._conn("$", "5\r", "\nbl", "arf\r", "\n+OK\r\n:3\r\n")
+        self.assertEqual(conn.read_reply(), "blarf")
+        self.assertIsInstance(conn.read_reply(), StatusReply)
+        self.assertIsInstance(conn.read_reply(), IntegerReply)
+
+    def test_multibulk_and_error_replies(self):
+        """Test that MGET-style & error replies are decoded"""
+
+        conn = self._conn("*2\r\n$1\r\na\r\n$-1\r\n-ERR nope\r\n")
+        self.assertEqual(conn.read_reply(), ["a", None])
+        self.assertIsInstance(conn.read_reply(), RedisError)
+
+    def test_closed_connection_raises(self):
+        """Test that Redis hanging up mid-reply raises socket.error"""
+
+        conn = self._conn("$5\r\nbl", "")
+        with self.assertRaises(socket.error):
+            conn.read_reply()
+
+    def test_large_value_streamed(self):
+        """Test that values over the threshold go to the stream, not a str"""
+
+        value = "y" * 5000
+        conn = self._conn("$5000\r\n" + value[:100], value[100:] + "\r\n$1\r\nz\r\n", buffer_size=1024)
+        client = mock.MagicMock()
+        # Chunks are views of the reused read buffer, so copy them as sent
+        sent = []
+        client.sendall.side_effect = lambda data: sent.append(str(bytearray(data)))
+        queued = ["$1\r\na\r\n"]
+
+        reply = conn.read_reply(BulkStream(client, queued=queued), stream_threshold=1000)
+
+        self.assertIs(reply, STREAMED)
+        self.assertEqual("".join(sent), "$1\r\na\r\n$5000\r\n" + value + "\r\n")
+        self.assertEqual(queued, [])
+        # The next reply on the connection is intact
+        self.assertEqual(conn.read_reply(), "z")
+
+    def test_small_value_not_streamed(self):
+        """Test that values under the threshold are returned as usual"""
+
+        conn = self._conn("$3\r\nbar\r\n")
+        client = mock.MagicMock()
+
+        self.assertEqual(conn.read_reply(BulkStream(client), stream_threshold=1000), "bar")
+        client.sendall.assert_not_called()
+
+
+class TestEncoding(unittest.TestCase):
+
+    def test_encode_value(self):
+        """Test that values are encoded inline or as RESP bulk strings"""
+
+        self.assertEqual(encode_value('name', 'Bob', inline=True), "Bob\n\r")
+        self.assertEqual(
+            encode_value('name', None, inline=True),
+            "Nothing exists for key name in Redis\n\r",
+        )
+        self.assertEqual(encode_value('name', 'Bob'), "$3\r\nBob\r\n")
+        self.assertEqual(encode_value('name', None), "$-1\r\n")
+
+    def test_encode_values(self):
+        """Test that MGET replies are a line per key inline, or a RESP multibulk"""
+
+        self.assertEqual(
+            encode_values(['name', 'age'], ['Bob', None], inline=True),
+            "Bob\n\rNothing exists for key age in Redis\n\r",
+        )
+        self.assertEqual(encode_values(['name', 'age'], ['Bob', None]), "*2\r\n$3\r\nBob\r\n$-1\r\n")
+
+    def test_encode_command(self):
+        """Test that commands to Redis are encoded as RESP multibulks"""
+
+        self.assertEqual(encode_command("GET", "foo"), "*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n")
+        self.assertEqual(
+            encode_command("MGET", "a", "bc"),
+            "*3\r\n$4\r\nMGET\r\n$1\r\na\r\n$2\r\nbc\r\n",
+        )
+
+    def test_encode_reply(self):
+        """Test that any reply from Redis is passed on as it came, or
+            readably to inline clients
+        """
+
+        replies = [StatusReply("OK"), IntegerReply("2"), None, "Bob", RedisError("WRONGTYPE no")]
+        self.assertEqual(
+            "".join(encode_reply(reply) for reply in replies),
+            "+OK\r\n:2\r\n$-1\r\n$3\r\nBob\r\n-WRONGTYPE no\r\n",
+        )
+        self.assertEqual(
+            "".join(encode_reply(reply, inline=True) for reply in replies),
+            "OK\n\r(integer) 2\n\r(nil)\n\rBob\n\rWRONGTYPE no\n\r",
+        )
+        self.assertEqual(encode_reply(["a", None]), "*2\r\n$1\r\na\r\n$-1\r\n")
+
+    def test_pttl(self):
+        """Test that PTTLs are pipelined per key & their replies read as ms
+            left, None for no expiry & 0 for a key that's gone
+        """
+
+        self.assertEqual(encode_ttl_commands(['a']), "*2\r\n$4\r\nPTTL\r\n$1\r\na\r\n")
+        self.assertEqual(
+            [parse_pttl(reply) for reply in [IntegerReply("5000"), IntegerReply("-1"), IntegerReply("-2")]],
+            [5000, None, 0],
+        )
+        self.assertIsNone(parse_pttl(RedisError("ERR unknown command 'PTTL'")))
+
+    def test_encode_error(self):
+        """Test that errors are encoded inline or as RESP errors"""
+
+        self.assertEqual(encode_error("oops", inline=True), "oops\n\r")
+        self.assertEqual(encode_error("oops"), "-ERR oops\r\n")
+
+
+if __name__ == "__main__":
+    unittest.main()
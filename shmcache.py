@@ -0,0 +1,369 @@
+"""Cache shared by proxy worker processes, in one shared-memory mapping.
+
+The mapping is a hash table of fixed-size slots, grouped into sets of
+`ways` slots: a key can only live in the set its hash picks, so finding it
+means checking at most `ways` slots. Each slot holds a header, then the key
+and value bytes:
+
+    seq        (uint32)  even when the slot is stable, odd while it's written
+    hash       (uint32)  crc32 of the key
+    deadline   (int64)   ms on the monotonic clock; 0 for an empty slot
+    accessed   (int64)   ms on the monotonic clock of the last read or write
+    key_len    (uint16)
+    val_len    (uint32)
+
+Reads take no lock. They are seqlock reads: a reader copies the slot, then
+checks that seq is still the even value it started with, and retries
+otherwise. Writers take one of `lock_stripes` process-shared locks (picked
+by set), bump seq to odd, write, then bump it back to even. This relies on
+the writer's stores becoming visible in order, as they do on x86.
+
+Eviction is LRU within a set: when a set is full, the slot read least
+recently goes (an expired slot goes first). As in LRUCache, entries expire
+a fixed TTL after they're set and reads don't extend it.
+
+The mapping must be created before the workers are forked; each worker's
+hit & miss counts are its own.
+"""
+
+import mmap
+from multiprocessing import Lock
+import struct
+import zlib
+
+from monotonic import monotonic
+
+
+DEFAULT_SLOT_SIZE = 1024
+DEFAULT_WAYS = 8
+DEFAULT_LOCK_STRIPES = 64
+# Times a reader retries a slot that's being written before treating the
+# read as a miss (e.g. if the writer died mid-write)
+MAX_READ_RETRIES = 100
+
+HEADER = struct.Struct("<IIqqHI")
+HEADER_SIZE = 32
+SEQ = struct.Struct("<I")
+BODY = struct.Struct("<IqqHI")
+TIMESTAMP = struct.Struct("<q")
+DEADLINE_OFFSET = 8
+ACCESSED_OFFSET = 16
+
+
+def now_ms():
+    """Monotonic clock in integer ms; the same clock in every process"""
+
+    return int(monotonic() * 1000)
+
+
+def key_hash(key):
+    return zlib.crc32(key) & 0xffffffff
+
+
+class SharedLRUCache(object):
+    """Fixed-size cache in shared memory, usable from forked workers (and
+    threads within them) at once. Same interface as LRUCache.
+    """
+
+    def __init__(self,
+        capacity=None,
+        ttl=None,
+        max_memory=None,
+        slot_size=DEFAULT_SLOT_SIZE,
+        grace=0,
+        refresh_ahead=0,
+        ways=DEFAULT_WAYS,
+        lock_stripes=DEFAULT_LOCK_STRIPES,
+    ):
+        """
+            :param capacity (int): max. # of keys, rounded up to a multiple
+                of ways
+            :param ttl (int): # of seconds that a key can live in cache
+            :param max_memory (int): bytes of shared memory; used to size
+                the table if capacity isn't given
+            :param slot_size (int): bytes per slot. Entries whose key & value
+                don't fit in slot_size - HEADER_SIZE bytes aren't cached
+            :param grace (int): # of seconds an expired entry is still served,
+                while it's refreshed
+            :param refresh_ahead (int): # of seconds before expiry during
+                which a read flags the entry for refreshing
+            :param ways (int): # of slots a key may be stored in
+            :param lock_stripes (int): # of locks writers are spread over
+        """
+
+        if not capacity and not max_memory:
+            raise TypeError("Capacity cannot be None for SharedLRUCache")
+        if not ttl:
+            raise TypeError("TTL cannot be None for SharedLRUCache")
+        if slot_size <= HEADER_SIZE:
+            raise ValueError("Slot size must be over %s bytes" % HEADER_SIZE)
+        if not capacity:
+            capacity = max(1, max_memory // slot_size)
+        self.ttl = ttl
+        self.ttl_ms = int(ttl * 1000)
+        self.grace_ms = int(grace * 1000)
+        self.refresh_ahead_ms = int(refresh_ahead * 1000)
+        self.slot_size = slot_size
+        self.max_entry_size = slot_size - HEADER_SIZE
+        self.ways = ways
+        self.num_sets = (capacity + ways - 1) // ways
+        self.capacity = self.num_sets * ways
+        self.buf = mmap.mmap(-1, self.capacity * slot_size)
+        self.locks = [Lock() for _ in xrange(min(lock_stripes, self.num_sets))]
+        self.sweep_cursor = 0
+
+        # Stats, of this process only
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.rejections = 0
+        self.expirations = 0
+
+    def get(self, key):
+        """Checks if key is in cache
+            :param key (str)
+            :returns: val (str) if exists or None
+        """
+
+        return self.lookup(key)[0]
+
+    def lookup(self, key, raw=False):
+        """Checks if key is in cache, & whether it's due for a refresh
+            :param key (str)
+            :param raw (bool): for LRUCache's interface; values here are
+                never compressed
+            :returns: (val, refresh) tuple, as LRUCache.lookup()
+        """
+
+        found = self._find(key, key_hash(key))
+        if found is None:
+            self.misses += 1
+            return None, False
+        offset, deadline, val = found
+        now = now_ms()
+        if now >= deadline:
+            if now < deadline + self.grace_ms:
+                self._touch(offset, now)
+                self.hits += 1
+                self.stale_hits += 1
+                return val, True
+            # Left in place: the set's next write reclaims the slot
+            self.misses += 1
+            return None, False
+        self._touch(offset, now)
+        self.hits += 1
+        return val, now >= deadline - self.refresh_ahead_ms
+
+    def set(self, key, val, ttl_ms=None):
+        """Sets key-val pair, evicting the set's least recently read entry
+            if there's no free slot
+            :param key (str):
+            :param val (str):
+            :param ttl_ms (int): # of ms until the entry expires, if sooner
+                than the cache's TTL
+        """
+
+        if len(key) + len(val) > self.max_entry_size or len(key) > 0xffff:
+            self.rejections += 1
+            return
+        h = key_hash(key)
+        set_index = h % self.num_sets
+        with self._lock(set_index):
+            now = now_ms()
+            offset = self._slot_for(key, h, set_index, now)
+            ttl_ms = self.ttl_ms if ttl_ms is None else min(ttl_ms, self.ttl_ms)
+            self._write(offset, h, now + ttl_ms, now, key, val)
+
+    def delete(self, key):
+        """Removes key from cache, if it's there
+            :returns: True if key was cached
+        """
+
+        h = key_hash(key)
+        with self._lock(h % self.num_sets):
+            found = self._find(key, h)
+            if found is None:
+                return False
+            self._clear(found[0])
+            return True
+
+    def clear(self):
+        """Empties every slot, a set at a time
+            :returns: # of entries removed
+        """
+
+        cleared = 0
+        set_bytes = self.ways * self.slot_size
+        for set_index in xrange(self.num_sets):
+            start = set_index * set_bytes
+            with self._lock(set_index):
+                for offset in xrange(start, start + set_bytes, self.slot_size):
+                    if TIMESTAMP.unpack_from(self.buf, offset + DEADLINE_OFFSET)[0]:
+                        self._clear(offset)
+                        cleared += 1
+        return cleared
+
+    def sweep(self, max_entries=None):
+        """Empties expired slots, going round the table a slice at a time.
+            The table's memory is fixed, so this only frees slots ahead of
+            time (set() reuses expired slots anyway)
+            :param max_entries (int): max. # of slots to examine
+            :returns: # of entries expired
+        """
+
+        # Entries are kept until their grace period is over, too
+        now = now_ms() - self.grace_ms
+        buf = self.buf
+        num_slots = self.capacity
+        if max_entries is None or max_entries > num_slots:
+            max_entries = num_slots
+        expired = 0
+        for _ in xrange(max_entries):
+            slot = self.sweep_cursor
+            self.sweep_cursor = (slot + 1) % num_slots
+            offset = slot * self.slot_size
+            deadline = TIMESTAMP.unpack_from(buf, offset + DEADLINE_OFFSET)[0]
+            if not deadline or deadline > now:
+                continue
+            with self._lock(slot // self.ways):
+                deadline = TIMESTAMP.unpack_from(buf, offset + DEADLINE_OFFSET)[0]
+                if deadline and deadline <= now:
+                    self._clear(offset)
+                    expired += 1
+        self.expirations += expired
+        return expired
+
+    def entries(self):
+        """Unexpired entries, least recently read first, across the whole
+            table
+            :returns: list of (key, val, # of ms until expiry) tuples
+        """
+
+        buf = self.buf
+        now = now_ms()
+        found = []
+        for offset in xrange(0, len(buf), self.slot_size):
+            data_start = offset + HEADER_SIZE
+            for _ in xrange(MAX_READ_RETRIES):
+                seq, slot_hash, deadline, accessed, key_len, val_len = HEADER.unpack_from(buf, offset)
+                if seq & 1:
+                    continue
+                data = None
+                if deadline > now:
+                    data = buf[data_start:data_start + key_len + val_len]
+                if SEQ.unpack_from(buf, offset)[0] == seq:
+                    break
+            else:
+                continue
+            if data is not None:
+                found.append((accessed, data[:key_len], data[key_len:], deadline - now))
+        found.sort()
+        return [(key, val, remaining) for accessed, key, val, remaining in found]
+
+    def stats(self):
+        """Hit & miss counts are this process's; keys are counted across
+            the whole table, so this takes time in proportion to capacity
+        """
+
+        now = now_ms() - self.grace_ms
+        keys = 0
+        for offset in xrange(DEADLINE_OFFSET, len(self.buf), self.slot_size):
+            deadline = TIMESTAMP.unpack_from(self.buf, offset)[0]
+            if deadline and deadline > now:
+                keys += 1
+        return {
+            'keys': keys,
+            'capacity': self.capacity,
+            'size': len(self.buf),
+            'hits': self.hits,
+            'misses': self.misses,
+            'stale_hits': self.stale_hits,
+            'evictions': self.evictions,
+            'rejections': self.rejections,
+            'expirations': self.expirations,
+        }
+
+    def _lock(self, set_index):
+        return self.locks[set_index % len(self.locks)]
+
+    def _find(self, key, h):
+        """Seqlock read of the slot holding key, if any
+            :returns: (offset, deadline, val) or None
+        """
+
+        buf = self.buf
+        key_len = len(key)
+        start = (h % self.num_sets) * self.ways * self.slot_size
+        for offset in xrange(start, start + self.ways * self.slot_size, self.slot_size):
+            data_start = offset + HEADER_SIZE
+            for _ in xrange(MAX_READ_RETRIES):
+                seq, slot_hash, deadline, accessed, slot_key_len, val_len = HEADER.unpack_from(buf, offset)
+                if seq & 1:
+                    continue
+                data = None
+                if deadline and slot_hash == h and slot_key_len == key_len:
+                    data = buf[data_start:data_start + key_len + val_len]
+                if SEQ.unpack_from(buf, offset)[0] == seq:
+                    break
+            else:
+                continue
+            if data is not None and data[:key_len] == key:
+                return offset, deadline, data[key_len:]
+        return None
+
+    def _slot_for(self, key, h, set_index, now):
+        """Picks the slot to write key to: its own, else an empty one, else
+            an expired one, else the one read least recently. Called with
+            the set's lock held.
+        """
+
+        buf = self.buf
+        expired_before = now - self.grace_ms
+        empty = expired = victim = None
+        oldest = None
+        start = set_index * self.ways * self.slot_size
+        for offset in xrange(start, start + self.ways * self.slot_size, self.slot_size):
+            seq, slot_hash, deadline, accessed, key_len, val_len = HEADER.unpack_from(buf, offset)
+            if not deadline:
+                if empty is None:
+                    empty = offset
+                continue
+            data_start = offset + HEADER_SIZE
+            if slot_hash == h and buf[data_start:data_start + key_len] == key:
+                return offset
+            if deadline <= expired_before:
+                if expired is None:
+                    expired = offset
+            elif oldest is None or accessed < oldest:
+                victim, oldest = offset, accessed
+        if empty is not None:
+            return empty
+        if expired is not None:
+            self.expirations += 1
+            return expired
+        self.evictions += 1
+        return victim
+
+    def _write(self, offset, h, deadline, now, key, val):
+        buf = self.buf
+        seq = SEQ.unpack_from(buf, offset)[0]
+        SEQ.pack_into(buf, offset, (seq + 1) & 0xffffffff)
+        data_start = offset + HEADER_SIZE
+        buf[data_start:data_start + len(key) + len(val)] = key + val
+        BODY.pack_into(buf, offset + 4, h, deadline, now, len(key), len(val))
+        SEQ.pack_into(buf, offset, (seq + 2) & 0xffffffff)
+
+    def _clear(self, offset):
+        buf = self.buf
+        seq = SEQ.unpack_from(buf, offset)[0]
+        SEQ.pack_into(buf, offset, (seq + 1) & 0xffffffff)
+        TIMESTAMP.pack_into(buf, offset + DEADLINE_OFFSET, 0)
+        SEQ.pack_into(buf, offset, (seq + 2) & 0xffffffff)
+
+    def _touch(self, offset, now):
+        """Records a read for LRU. Not under the lock: if it races with a
+            write, either timestamp is a fine one to keep
+        """
+
+        TIMESTAMP.pack_into(self.buf, offset + ACCESSED_OFFSET, now)
@@ -0,0 +1,174 @@
+import os
+import mock
+import unittest
+
+from shmcache import HEADER_SIZE, key_hash, SEQ, SharedLRUCache
+from workers import fork_workers
+
+
+class TestSharedLRUCache(unittest.TestCase):
+
+    def test_cache_no_args(self):
+        with self.assertRaises(TypeError):
+            SharedLRUCache()
+
+    def test_capacity_rounded_up_to_whole_sets(self):
+        testcache = SharedLRUCache(capacity=10, ttl=10, ways=4)
+        self.assertEqual(testcache.num_sets, 3)
+        self.assertEqual(testcache.capacity, 12)
+
+    def test_sized_by_max_memory(self):
+        testcache = SharedLRUCache(ttl=10, max_memory=64 * 1024, slot_size=1024)
+        self.assertEqual(testcache.capacity, 64)
+
+    def test_get_set(self):
+        testcache = SharedLRUCache(capacity=16, ttl=10)
+        testcache.set('radish', 'moo')
+        testcache.set('turnip', '')
+
+        self.assertEqual(testcache.get('radish'), 'moo')
+        self.assertEqual(testcache.get('turnip'), '')
+        self.assertIsNone(testcache.get('beet'))
+
+    def test_set_overwrites(self):
+        testcache = SharedLRUCache(capacity=16, ttl=10)
+        testcache.set('radish', 'moo')
+        testcache.set('radish', 'baa')
+
+        self.assertEqual(testcache.get('radish'), 'baa')
+        self.assertEqual(testcache.stats()['keys'], 1)
+
+    def test_oversized_entry_refused(self):
+        testcache = SharedLRUCache(capacity=16, ttl=10, slot_size=HEADER_SIZE + 8)
+        testcache.set('radish', 'mo')
+        testcache.set('radish', 'moo')
+
+        self.assertEqual(testcache.get('radish'), 'mo')
+        self.assertEqual(testcache.stats()['rejections'], 1)
+
+    @mock.patch('shmcache.monotonic')
+    def test_full_set_evicts_least_recently_read(self, clock_mock):
+        """Test that a full set gives up the slot read longest ago"""
+
+        testcache = SharedLRUCache(capacity=3, ttl=100, ways=3)
+        for i, key in enumerate(['a', 'b', 'c']):
+            clock_mock.return_value = 1000.0 + i
+            testcache.set(key, key)
+        clock_mock.return_value = 1010.0
+        testcache.get('a')
+        testcache.set('d', 'd')
+
+        self.assertIsNone(testcache.get('b'))
+        self.assertEqual(testcache.get('a'), 'a')
+        self.assertEqual(testcache.stats()['evictions'], 1)
+
+    @mock.patch('shmcache.monotonic')
+    def test_expired_slot_reused_first(self, clock_mock):
+        clock_mock.return_value = 1000.0
+        testcache = SharedLRUCache(capacity=2, ttl=10, ways=2)
+        testcache.set('a', 'a')
+        clock_mock.return_value = 1005.0
+        testcache.set('b', 'b')
+
+        clock_mock.return_value = 1011.0
+        testcache.set('c', 'c')
+
+        self.assertEqual(testcache.get('b'), 'b')
+        self.assertEqual(testcache.stats()['expirations'], 1)
+        self.assertEqual(testcache.stats()['evictions'], 0)
+
+    @mock.patch('shmcache.monotonic')
+    def test_entries_expire(self, clock_mock):
+        """Test that entries expire TTL after they're set, & reads don't extend it"""
+
+        clock_mock.return_value = 1000.0
+        testcache = SharedLRUCache(capacity=16, ttl=10)
+        testcache.set('radish', 'moo')
+
+        clock_mock.return_value = 1009.999
+        self.assertEqual(testcache.get('radish'), 'moo')
+        clock_mock.return_value = 1010.0
+        self.assertIsNone(testcache.get('radish'))
+
+    @mock.patch('shmcache.monotonic')
+    def test_stale_entry_served_within_grace(self, clock_mock):
+        clock_mock.return_value = 1000.0
+        testcache = SharedLRUCache(capacity=16, ttl=10, grace=5, refresh_ahead=2)
+        testcache.set('radish', 'moo')
+
+        clock_mock.return_value = 1007.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', False))
+        clock_mock.return_value = 1008.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', True))
+        clock_mock.return_value = 1012.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', True))
+        clock_mock.return_value = 1015.0
+        self.assertEqual(testcache.lookup('radish'), (None, False))
+        self.assertEqual(testcache.stats()['stale_hits'], 1)
+
+    def test_delete(self):
+        testcache = SharedLRUCache(capacity=16, ttl=10)
+        testcache.set('radish', 'moo')
+
+        self.assertTrue(testcache.delete('radish'))
+        self.assertFalse(testcache.delete('radish'))
+        self.assertIsNone(testcache.get('radish'))
+
+    def test_clear(self):
+        testcache = SharedLRUCache(capacity=16, ttl=10)
+        testcache.set('radish', 'moo')
+        testcache.set('rice', 'bap')
+
+        self.assertEqual(testcache.clear(), 2)
+        self.assertEqual(testcache.entries(), [])
+        self.assertIsNone(testcache.get('rice'))
+
+    @mock.patch('shmcache.monotonic')
+    def test_sweep_empties_expired_slots(self, clock_mock):
+        clock_mock.return_value = 1000.0
+        testcache = SharedLRUCache(capacity=16, ttl=10)
+        testcache.set('radish', 'moo')
+        clock_mock.return_value = 1005.0
+        testcache.set('turnip', 'baa')
+
+        clock_mock.return_value = 1012.0
+        self.assertEqual(testcache.sweep(), 1)
+        self.assertEqual(testcache.stats()['keys'], 1)
+        self.assertEqual(testcache.get('turnip'), 'baa')
+
+    def test_slot_being_written_not_read(self):
+        """Test that a reader doesn't return a slot whose seq is odd, i.e.
+            one a writer is part way through
+        """
+
+        testcache = SharedLRUCache(capacity=1, ttl=10, ways=1)
+        testcache.set('radish', 'moo')
+        SEQ.pack_into(testcache.buf, 0, 3)
+
+        self.assertIsNone(testcache.get('radish'))
+        SEQ.pack_into(testcache.buf, 0, 4)
+        self.assertEqual(testcache.get('radish'), 'moo')
+
+    def test_hash_collision_checks_key(self):
+        testcache = SharedLRUCache(capacity=16, ttl=10)
+        testcache.set('radish', 'moo')
+
+        with mock.patch('shmcache.key_hash', return_value=key_hash('radish')):
+            self.assertIsNone(testcache.get('radisj'))
+
+    def test_shared_with_forked_workers(self):
+        """Test that entries set by one worker process are read by the others"""
+
+        testcache = SharedLRUCache(capacity=64, ttl=10)
+
+        def serve(worker_id):
+            testcache.set('key%s' % worker_id, 'val%s' % worker_id)
+
+        with open(os.devnull, 'w') as devnull, mock.patch('sys.stdout', devnull):
+            self.assertEqual(fork_workers(4, serve), 0)
+        for worker_id in xrange(4):
+            self.assertEqual(testcache.get('key%s' % worker_id), 'val%s' % worker_id)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+"""Cache snapshots: saving the cache to a file & loading it back on startup,
+so a restarted proxy doesn't begin with every read going to Redis.
+
+The file is a header, then one record per entry:
+
+    magic      (8 bytes) "RPSNAP01"
+    saved_at   (double)  wall clock time of the save, in seconds
+    count      (uint32)  # of entries
+
+    key_len    (uint32)
+    val_len    (uint32)
+    ttl_ms     (int64)   ms the entry had left to live when saved
+    key, val   (key_len + val_len bytes)
+
+Cache deadlines are on the monotonic clock, which restarts with the
+machine, so entries carry their remaining TTL instead; on loading, the time
+since saved_at is taken off it and entries that expired meanwhile are
+skipped. Entries are saved from the first the cache would evict to the
+last, so setting them in file order brings back their recency order.
+
+A save writes to a temporary file & renames it over the old one, so a
+crash mid-save leaves the previous snapshot in place.
+"""
+
+import errno
+import mmap
+import os
+import struct
+import threading
+import time
+
+
+MAGIC = "RPSNAP01"
+HEADER = struct.Struct("<8sdI")
+ENTRY = struct.Struct("<IIq")
+
+DEFAULT_INTERVAL = 300.0
+# Max. # of keys per MGET round when warming the cache from a key list
+WARM_BATCH_SIZE = 100
+
+
+def save_snapshot(cache, path):
+    """Writes cache's unexpired entries to path
+        :param cache (LRUCache): or any cache with entries()
+        :param path (str): file to write
+        :returns: # of entries saved
+    """
+
+    entries = cache.entries()
+    tmp_path = "%s.tmp" % path
+    with open(tmp_path, 'wb') as f:
+        f.write(HEADER.pack(MAGIC, time.time(), len(entries)))
+        for key, val, ttl_ms in entries:
+            f.write(ENTRY.pack(len(key), len(val), ttl_ms))
+            f.write(key)
+            f.write(val)
+        f.flush()
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    return len(entries)
+
+
+def load_snapshot(cache, path):
+    """Sets the entries saved in path that haven't expired since
+        :param cache (LRUCache): or any cache whose set() takes ttl_ms
+        :param path (str): file written by save_snapshot()
+        :returns: (# loaded, # skipped as expired) tuple; (0, 0) if there's
+            no file
+        :raises ValueError: if path isn't a snapshot
+    """
+
+    try:
+        f = open(path, 'rb')
+    except IOError, e:
+        if e.errno == errno.ENOENT:
+            return 0, 0
+        raise
+    with f:
+        if os.fstat(f.fileno()).st_size < HEADER.size:
+            raise ValueError("%s is not a cache snapshot" % path)
+        buf = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    try:
+        magic, saved_at, count = HEADER.unpack_from(buf, 0)
+        if magic != MAGIC:
+            raise ValueError("%s is not a cache snapshot" % path)
+        elapsed_ms = int(max(0, time.time() - saved_at) * 1000)
+        offset = HEADER.size
+        loaded = skipped = 0
+        for _ in xrange(count):
+            if offset + ENTRY.size > len(buf):
+                break
+            key_len, val_len, ttl_ms = ENTRY.unpack_from(buf, offset)
+            key_start = offset + ENTRY.size
+            offset = key_start + key_len + val_len
+            if offset > len(buf):
+                break
+            ttl_ms -= elapsed_ms
+            if ttl_ms <= 0:
+                skipped += 1
+                continue
+            cache.set(buf[key_start:key_start + key_len], buf[key_start + key_len:offset], ttl_ms)
+            loaded += 1
+        if loaded + skipped < count:
+            print "Snapshot %s is truncated: read %s of %s entries" % (path, loaded + skipped, count)
+        return loaded, skipped
+    finally:
+        buf.close()
+
+
+class Snapshotter(threading.Thread):
+    """Background thread saving the cache every interval"""
+
+    def __init__(self, cache, path, interval=DEFAULT_INTERVAL):
+        super(Snapshotter, self).__init__()
+        self.daemon = True
+        self.cache = cache
+        self.path = path
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                save_snapshot(self.cache, self.path)
+            except (IOError, OSError), e:
+                print "Could not save cache snapshot to %s: %s" % (self.path, e)
+
+    def stop(self):
+        self.stopped.set()
+
+
+def read_keys(path):
+    """Reads a --warm-keys file: one key per line, blank lines skipped
+        :returns: list of keys (str)
+    """
+
+    with open(path) as f:
+        return [line.rstrip('\r\n') for line in f if line.strip()]
@@ -0,0 +1,155 @@
+import os
+import mock
+import shutil
+import tempfile
+import unittest
+
+import proxy
+from shmcache import SharedLRUCache
+from snapshot import HEADER, load_snapshot, read_keys, save_snapshot
+import threaded_proxy
+
+
+class TestSnapshot(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'cache.snap')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_round_trip(self):
+        cache = threaded_proxy.LRUCache(capacity=5, ttl=60)
+        cache.set('foo', 'bar')
+        cache.set('crlf', 'a\r\nb')
+        cache.set('empty', '')
+
+        self.assertEqual(save_snapshot(cache, self.path), 3)
+        loaded = threaded_proxy.LRUCache(capacity=5, ttl=60)
+
+        self.assertEqual(load_snapshot(loaded, self.path), (3, 0))
+        self.assertEqual(loaded.get('foo'), 'bar')
+        self.assertEqual(loaded.get('crlf'), 'a\r\nb')
+        self.assertEqual(loaded.get('empty'), '')
+
+    def test_recency_order_kept(self):
+        """Test that the key read least recently before the save is still
+            the first evicted after loading
+        """
+
+        cache = proxy.LRUCache(capacity=3, ttl=60)
+        cache.set('a', '1')
+        cache.set('b', '2')
+        cache.set('c', '3')
+        cache.get('a')
+
+        save_snapshot(cache, self.path)
+        loaded = proxy.LRUCache(capacity=3, ttl=60)
+        load_snapshot(loaded, self.path)
+        loaded.set('d', '4')
+
+        self.assertIsNone(loaded.get('b'))
+        self.assertEqual(loaded.get('a'), '1')
+
+    @mock.patch('snapshot.time')
+    @mock.patch('threaded_proxy.monotonic')
+    def test_remaining_ttl_kept(self, patched_monotonic, patched_time):
+        """Test that entries keep the TTL they had left, less the time since
+            the save, & that ones that ran out meanwhile aren't loaded
+        """
+
+        patched_monotonic.return_value = 100
+        cache = threaded_proxy.LRUCache(capacity=5, ttl=60)
+        cache.set('old', 'x')
+        patched_monotonic.return_value = 140
+        cache.set('new', 'y')
+        patched_time.time.return_value = 1000
+        save_snapshot(cache, self.path)
+
+        # Restarted 30s later, with the monotonic clock starting over
+        patched_time.time.return_value = 1030
+        patched_monotonic.return_value = 5
+        loaded = threaded_proxy.LRUCache(capacity=5, ttl=60)
+
+        self.assertEqual(load_snapshot(loaded, self.path), (1, 1))
+        self.assertIsNone(loaded.get('old'))
+        self.assertEqual(loaded.data['new'], ('y', (5 + 30) * 1000))
+
+    def test_ttl_capped_at_cache_ttl(self):
+        cache = threaded_proxy.LRUCache(capacity=5, ttl=60)
+        cache.set('foo', 'bar')
+        save_snapshot(cache, self.path)
+
+        loaded = threaded_proxy.LRUCache(capacity=5, ttl=1)
+        load_snapshot(loaded, self.path)
+
+        self.assertLessEqual(loaded.data['foo'][1] - threaded_proxy.now_ms(), 1000)
+
+    def test_sharded_cache(self):
+        cache = threaded_proxy.ShardedLRUCache(capacity=50, ttl=60, shards=4)
+        for i in xrange(20):
+            cache.set('key:%s' % i, str(i))
+
+        save_snapshot(cache, self.path)
+        loaded = threaded_proxy.ShardedLRUCache(capacity=50, ttl=60, shards=4)
+
+        self.assertEqual(load_snapshot(loaded, self.path), (20, 0))
+        self.assertEqual(loaded.get('key:7'), '7')
+
+    def test_shared_cache(self):
+        cache = SharedLRUCache(capacity=16, ttl=60)
+        cache.set('foo', 'bar')
+        cache.set('baz', 'qux')
+
+        save_snapshot(cache, self.path)
+        loaded = SharedLRUCache(capacity=16, ttl=60)
+
+        self.assertEqual(load_snapshot(loaded, self.path), (2, 0))
+        self.assertEqual(loaded.get('baz'), 'qux')
+
+    def test_missing_file(self):
+        cache = proxy.LRUCache(capacity=5, ttl=60)
+        self.assertEqual(load_snapshot(cache, self.path), (0, 0))
+
+    def test_not_a_snapshot(self):
+        with open(self.path, 'wb') as f:
+            f.write("*1\r\n$3\r\nfoo\r\n" * 10)
+
+        with self.assertRaises(ValueError):
+            load_snapshot(proxy.LRUCache(capacity=5, ttl=60), self.path)
+
+    def test_truncated_file(self):
+        """Test that the whole entries before a cut-off one are still loaded"""
+
+        cache = proxy.LRUCache(capacity=5, ttl=60)
+        cache.set('foo', 'bar')
+        cache.set('baz', 'qux')
+        save_snapshot(cache, self.path)
+        with open(self.path, 'r+b') as f:
+            f.truncate(os.path.getsize(self.path) - 2)
+
+        loaded = proxy.LRUCache(capacity=5, ttl=60)
+        with open(os.devnull, 'w') as devnull, mock.patch('sys.stdout', devnull):
+            self.assertEqual(load_snapshot(loaded, self.path), (1, 0))
+        self.assertEqual(loaded.get('foo'), 'bar')
+
+    def test_save_replaces_old_snapshot(self):
+        cache = proxy.LRUCache(capacity=5, ttl=60)
+        save_snapshot(cache, self.path)
+        cache.set('foo', 'bar')
+        save_snapshot(cache, self.path)
+
+        self.assertEqual(os.listdir(self.dir), ['cache.snap'])
+        self.assertGreater(os.path.getsize(self.path), HEADER.size)
+
+    def test_read_keys(self):
+        keys_path = os.path.join(self.dir, 'keys')
+        with open(keys_path, 'w') as f:
+            f.write("foo\nbar baz\n\nqux\r\n")
+
+        self.assertEqual(read_keys(keys_path), ['foo', 'bar baz', 'qux'])
+
+
+if __name__ == "__main__":
+    unittest.main()
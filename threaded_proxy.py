@@ -1,45 +1,386 @@
 from argparse import ArgumentParser
-from datetime import datetime
-from collections import OrderedDict
+from contextlib import contextmanager
+from collections import deque, OrderedDict
+from functools import partial
+import heapq
+import Queue
+import random
+import select
 import socket
 import SocketServer
 import sys
-from threading import RLock
+from threading import Condition, Lock, RLock
 import threading
 import time
 
+from monotonic import monotonic
+
+from bloom import BloomFilter
+from compactcache import CompactLRUCache
+from compression import CompressedValue, Compressor, DEFAULT_LEVEL, tag_value
+from eviction import make_policy, POLICIES
+from hashring import HashRing, parse_backend
+from invalidation import (
+    arity_error,
+    CROSS_BACKEND_ERROR,
+    INVALIDATION_MODES,
+    InvalidationFeed,
+    KeyVersions,
+    RETRY_INTERVAL,
+    write_keys,
+)
+from metrics import clock, INFO_COMMANDS, Metrics, start_metrics_server
+from resp import (
+    BulkStream,
+    encode_command,
+    encode_error,
+    encode_reply,
+    encode_ttl_commands,
+    encode_value,
+    encode_values,
+    GET_FORMAT_ERROR,
+    parse_pttl,
+    ProtocolError,
+    RedisConnection,
+    RedisError,
+    RequestParser,
+    STREAMED,
+)
+from shmcache import DEFAULT_SLOT_SIZE, SharedLRUCache
+from snapshot import load_snapshot, read_keys, save_snapshot, Snapshotter, WARM_BATCH_SIZE
+from workers import fork_workers, set_reuse_port, stop_on_sigterm
+
+
+DEFAULT_CAPACITY = 1000
+DEFAULT_NEGATIVE_CAPACITY = 1000
+DEFAULT_BATCH_SIZE = 64
+DEFAULT_MAX_OUTSTANDING = 128
+# Max. keys waiting for a background refresh; more are dropped
+MAX_PENDING_REFRESHES = 1000
+# Seconds a replica may take to reply before it's ejected
+DEFAULT_REPLICA_TIMEOUT = 1.0
+# Seconds between PINGs of ejected replicas
+DEFAULT_PROBE_INTERVAL = 1.0
+# Weight of the latest response time in a replica's moving average
+EWMA_WEIGHT = 0.3
+# Error replies from a replica that can't serve reads right now, as opposed
+# to errors about the request itself
+REPLICA_DOWN_ERRORS = ('LOADING', 'MASTERDOWN', 'BUSY')
+# Approx. bytes each cache entry costs on top of its key & value: the
+# OrderedDict slot & link, the (val, deadline) tuple and the expiry heap
+# record. Measured on 64-bit CPython 2.7.
+ENTRY_OVERHEAD = 400
+# Max. expired entries reclaimed per sweep slice
+SWEEP_BATCH = 100
+RECV_SIZE = 4096
+# Worker threads serving client connections
+DEFAULT_THREADS = 32
+# Open client connections, beyond which new ones are turned away; below the
+# usual limit of 1024 open files
+DEFAULT_MAX_CONNECTIONS = 1000
+# Connections the kernel queues until they're accepted, as Redis's tcp-backlog
+DEFAULT_BACKLOG = 511
+# Max. seconds between checks for idle client connections
+IDLE_CHECK_INTERVAL = 1.0
+MAX_CLIENTS_ERROR = "max number of clients reached"
+
+
+def now_ms():
+    """Monotonic clock, in integer milliseconds"""
+
+    return int(monotonic() * 1000)
+
 
 class ThreadedTCPRequestHandler(SocketServer.BaseRequestHandler):
-    """Overwrites BaseHandler class"""
+    """Serves one client connection.
 
-    def handle(self):
-        data = "You are connected to the RedisProxy. Type QUIT to close connection\n"
+    As a plain SocketServer handler, handle() answers the client until it
+    leaves. ThreadedTCPServer creates it with pooled=True instead, & has a
+    worker thread call handle_read() each time the client has sent something.
+    """
+
+    def __init__(self, request, client_address, server, pooled=False):
+        if not pooled:
+            SocketServer.BaseRequestHandler.__init__(self, request, client_address, server)
+            return
+        self.request = request
+        self.client_address = client_address
+        self.server = server
+        self.setup()
+
+    def setup(self):
+        self.metrics = self.server.proxy.metrics
+        self.metrics.connections_received += 1
+        self.metrics.connected_clients += 1
+        self.parser = RequestParser()
+        # Set by CLIENT COMPRESSION ON: values are sent tagged, & compressed
+        # ones as they're cached (see compression.tag_value)
+        self.raw = False
+        self.last_active = monotonic()
+
+    def finish(self):
+        self.metrics.connected_clients -= 1
+
+    def send(self, data):
         self.request.sendall(data)
-        while True:
-            data = self.request.recv(1024).strip()
-            if data:
-                if data == "QUIT":
-                    break
-                data = data.split()
-                if len(data) != 2 or data[0] != "GET":
-                    self.request.sendall("Please use Redis 'GET key' command format\n\r")
+        self.metrics.bytes_out += len(data)
+
+    def handle(self):
+        self.greet()
+        while self.handle_read():
+            pass
+
+    def greet(self):
+        self.send("You are connected to the RedisProxy. Type QUIT to close connection\n")
+
+    def handle_read(self):
+        """Reads what the client sent & answers every complete command in it
+            :returns: False once the connection is closed
+        """
+
+        data = self.request.recv(RECV_SIZE)
+        if not data:
+            # Client hung up without sending QUIT
+            self.request.close()
+            return False
+        self.last_active = monotonic()
+        self.metrics.bytes_in += len(data)
+        try:
+            commands = self.parser.feed(data)
+        except ProtocolError, e:
+            self.send(encode_error("Protocol error: %s" % e))
+            self.request.close()
+            return False
+        replies = []
+        for args, inline in commands:
+            self.metrics.commands += 1
+            if args[0].upper() == "QUIT":
+                replies.append("Bye\n" if inline else "+OK\r\n")
+                self.send("".join(replies))
+                self.request.close()
+                return False
+            if args[0].upper() in INFO_COMMANDS and len(args) <= 2:
+                replies.append(encode_value(None, self.server.proxy.info(*args[1:]), inline))
+                continue
+            if len(args) == 3 and args[0].upper() == "CLIENT" and args[1].upper() == "COMPRESSION":
+                if args[2].upper() not in ("ON", "OFF"):
+                    replies.append(encode_error("CLIENT COMPRESSION takes ON or OFF", inline))
                     continue
-                ret_val = self.server.proxy.get(data[1])
-                if ret_val is None:
-                    self.request.sendall(
-                        "Nothing exists for key %s in Redis\n\r" % (data[1]),
-                    )
+                self.raw = args[2].upper() == "ON"
+                replies.append("OK\n" if inline else "+OK\r\n")
+                continue
+            if args[0].upper() == "MGET" and len(args) > 1:
+                try:
+                    if self.raw:
+                        vals = [tag_value(val) for val in self.server.proxy.mget(args[1:], raw=True)]
+                    else:
+                        vals = self.server.proxy.mget(args[1:])
+                except FETCH_ERRORS, e:
+                    replies.append(encode_error("Redis error: %s" % e, inline))
                     continue
-                ret_val = ret_val + "\n\r"
-                self.request.sendall(ret_val)
-            else:
-                self.request.sendall("Command cannot be blank\n\r")
-        self.request.sendall("Bye\n")
-        self.request.close()
+                replies.append(encode_values(args[1:], vals, inline))
+                continue
+            if self.server.proxy.pass_writes and write_keys(args) is not None:
+                try:
+                    replies.append(encode_reply(self.server.proxy.write(args), inline))
+                except FETCH_ERRORS, e:
+                    replies.append(encode_error("Redis error: %s" % e, inline))
+                continue
+            if len(args) != 2 or args[0].upper() != "GET":
+                replies.append(encode_error(GET_FORMAT_ERROR, inline))
+                continue
+            stream = BulkStream(self.request, inline, replies)
+            try:
+                if self.raw:
+                    # Streamed values couldn't be tagged, so they're sent whole
+                    ret_val = tag_value(self.server.proxy.get(args[1], raw=True))
+                else:
+                    ret_val = self.server.proxy.get(args[1], stream)
+            except FETCH_ERRORS, e:
+                if stream.started:
+                    # Part of the value has gone out: no error can follow it
+                    self.request.close()
+                    return False
+                replies.append(encode_error("Redis error: %s" % e, inline))
+                continue
+            finally:
+                self.metrics.bytes_out += stream.bytes_sent
+            if ret_val is not STREAMED:
+                replies.append(encode_value(args[1], ret_val, inline))
+        # One write for the whole batch of pipelined commands
+        if replies:
+            self.send("".join(replies))
+        return True
+
+
+class ThreadedTCPServer(SocketServer.TCPServer):
+    """Serves client connections from a fixed pool of worker threads, rather
+    than a thread per connection.
+
+    A dispatcher thread polls the connections waiting on their clients, &
+    queues each one that has sent something for the next free worker, which
+    reads it once, answers the commands in it & hands the connection back.
+    At most max_connections are open at once: beyond that, a new connection
+    is sent an error & closed, as Redis does. With idle_timeout, connections
+    idle that long are closed.
+    """
+
+    allow_reuse_address = True
+
+    def __init__(self,
+        server_address,
+        handler_cls,
+        reuse_port=False,
+        threads=DEFAULT_THREADS,
+        max_connections=DEFAULT_MAX_CONNECTIONS,
+        backlog=DEFAULT_BACKLOG,
+        idle_timeout=None,
+    ):
+        """
+            :param reuse_port (bool): listen with SO_REUSEPORT, so other
+                workers can accept on the same port
+            :param threads (int): # of worker threads
+            :param max_connections (int): max. # of open client connections
+            :param backlog (int): max. # of connections the kernel queues
+                until they're accepted
+            :param idle_timeout (float): # of seconds a client may send
+                nothing, or take to read a reply, before its connection is
+                closed. None keeps connections open
+        """
+
+        if not threads or threads < 1:
+            raise TypeError("threads must be a positive int for ThreadedTCPServer")
+        if not max_connections or max_connections < 1:
+            raise TypeError("max_connections must be a positive int for ThreadedTCPServer")
+        self.reuse_port = reuse_port
+        self.max_connections = max_connections
+        self.request_queue_size = backlog
+        self.idle_timeout = idle_timeout
+        self.lock = Lock()
+        self.connections = 0
+        # Connections the client has sent something on, for the workers
+        self.ready = Queue.Queue()
+        # Connections the workers are done with, for the dispatcher to poll
+        self.returned = deque()
+        self.wake_recv, self.wake_send = socket.socketpair()
+        self.wake_send.setblocking(0)
+        self.stopped = threading.Event()
+        SocketServer.TCPServer.__init__(self, server_address, handler_cls)
+        self.workers = [threading.Thread(target=self._work) for _ in xrange(threads)]
+        self.dispatcher = threading.Thread(target=self._dispatch)
+        for thread in [self.dispatcher] + self.workers:
+            thread.daemon = True
+            thread.start()
+
+    def server_bind(self):
+        if self.reuse_port:
+            set_reuse_port(self.socket)
+        SocketServer.TCPServer.server_bind(self)
 
+    def process_request(self, request, client_address):
+        """Admits a connection serve_forever() accepted, or turns it away if
+            max_connections are open
+        """
+
+        with self.lock:
+            admitted = self.connections < self.max_connections
+            if admitted:
+                self.connections += 1
+        if not admitted:
+            self.proxy.metrics.rejected_connections += 1
+            try:
+                request.sendall(encode_error(MAX_CLIENTS_ERROR))
+            except socket.error:
+                pass
+            self.shutdown_request(request)
+            return
+        # Also bounds how long a worker waits on a client that isn't reading
+        # its replies
+        request.settimeout(self.idle_timeout)
+        handler = self.RequestHandlerClass(request, client_address, self, pooled=True)
+        try:
+            handler.greet()
+        except socket.error:
+            self._close(handler)
+            return
+        self._hand_back(handler)
+
+    def server_close(self):
+        SocketServer.TCPServer.server_close(self)
+        self.stopped.set()
+        self._wake()
+        for _ in self.workers:
+            self.ready.put(None)
+        for thread in [self.dispatcher] + self.workers:
+            thread.join()
+
+    def _hand_back(self, handler):
+        self.returned.append(handler)
+        self._wake()
+
+    def _wake(self):
+        try:
+            self.wake_send.send("x")
+        except socket.error:
+            # Buffer full: the dispatcher has wake-ups pending already
+            pass
 
-class ThreadedTCPServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
-    pass
+    def _dispatch(self):
+        poller = select.poll()
+        poller.register(self.wake_recv, select.POLLIN)
+        wake_fd = self.wake_recv.fileno()
+        # fd -> handler, of the connections waiting on their clients
+        idle = {}
+        interval = IDLE_CHECK_INTERVAL
+        if self.idle_timeout:
+            interval = min(interval, self.idle_timeout / 2.0)
+        next_check = monotonic() + interval
+        while not self.stopped.is_set():
+            for fd, event in poller.poll(interval * 1000):
+                if fd == wake_fd:
+                    self.wake_recv.recv(RECV_SIZE)
+                    continue
+                poller.unregister(fd)
+                self.ready.put(idle.pop(fd))
+            while self.returned:
+                handler = self.returned.popleft()
+                fd = handler.request.fileno()
+                idle[fd] = handler
+                poller.register(fd, select.POLLIN)
+            if self.idle_timeout and monotonic() >= next_check:
+                next_check = monotonic() + interval
+                cutoff = monotonic() - self.idle_timeout
+                for fd, handler in idle.items():
+                    if handler.last_active < cutoff:
+                        poller.unregister(fd)
+                        del idle[fd]
+                        self._close(handler)
+        for handler in idle.values():
+            self._close(handler)
+
+    def _work(self):
+        while True:
+            handler = self.ready.get()
+            if handler is None:
+                return
+            try:
+                still_open = handler.handle_read()
+            except socket.error:
+                # Including a client that didn't read its replies in time
+                still_open = False
+            except Exception:
+                self.handle_error(handler.request, handler.client_address)
+                still_open = False
+            if still_open:
+                self._hand_back(handler)
+            else:
+                self._close(handler)
+
+    def _close(self, handler):
+        self.shutdown_request(handler.request)
+        handler.finish()
+        with self.lock:
+            self.connections -= 1
 
 
 class LastUpdatedDict(OrderedDict):
@@ -52,18 +393,87 @@ class LastUpdatedDict(OrderedDict):
 
 
 class LRUCache(object):
-    """Least Recently Used Cache supporting eviction based on capacity & TTL"""
+    """Least Recently Used Cache supporting eviction based on capacity & TTL.
+
+    Capacity is a number of keys, a memory budget in bytes, or both: entries
+    are evicted until a new one fits under each limit that is set. Which
+    entry goes first is up to the eviction policy (see eviction.py):
+    least recently used, unless another is chosen.
+
+    Each entry expires a fixed TTL after it is set, at an integer deadline
+    on the monotonic clock. Expired entries are removed when accessed, and
+    sweep() reclaims the rest in deadline order from a min-heap.
 
-    def __init__(self, capacity=None, ttl=None):
+    Optionally, an expired entry is kept for a grace period, during which
+    lookup() still returns it but flags it for refreshing; with
+    refresh_ahead, entries read shortly before they expire are flagged too.
 
-        if not capacity:
+    With compress_threshold, values of that many bytes or more are kept
+    zlib-compressed (see compression.py) & inflated on each hit.
+    """
+
+    def __init__(self,
+        capacity=None,
+        ttl=None,
+        max_memory=None,
+        max_entry_fraction=0.5,
+        policy='lru',
+        grace=0,
+        refresh_ahead=0,
+        compress_threshold=None,
+        compress_level=DEFAULT_LEVEL,
+    ):
+        """
+            :param capacity (int): max. # of keys
+            :param ttl (int): # of seconds that a key can live in cache
+            :param max_memory (int): max. approx. bytes of keys, values &
+                entry overhead
+            :param max_entry_fraction (float): values whose entry would take
+                more than this fraction of max_memory are not cached
+            :param policy (str): eviction policy: lru, slru, arc or tinylfu
+            :param grace (int): # of seconds an expired entry is still served,
+                while it's refreshed
+            :param refresh_ahead (int): # of seconds before expiry during
+                which a read flags the entry for refreshing
+            :param compress_threshold (int): min. # of bytes of a value to
+                compress it. None disables compression
+            :param compress_level (int): zlib level, 1-9
+        """
+
+        if not capacity and not max_memory:
             raise TypeError("Capacity cannot be None for LRUCache")
         if not ttl:
             raise TypeError("TTL cannot be None for LRUCache")
         self.capacity = capacity
         self.ttl = ttl
+        self.ttl_ms = int(ttl * 1000)
+        self.grace_ms = int(grace * 1000)
+        self.refresh_ahead_ms = int(refresh_ahead * 1000)
+        self.max_memory = max_memory
+        self.max_entry_fraction = max_entry_fraction
+        # Sized in keys; a memory-bounded cache holds at most this many
+        # entries, however small
+        self.policy = make_policy(policy, capacity or max(1, max_memory // max(ENTRY_OVERHEAD, 1)))
         self.lock = RLock()
         self.data = LastUpdatedDict()
+        # (deadline, key) per entry set; records for keys since re-set or
+        # evicted are skipped when popped
+        self.expiry_heap = []
+        self.compressor = None
+        if compress_threshold:
+            self.compressor = Compressor(compress_threshold, compress_level)
+
+        # Stats
+        self.size = 0
+        # Bytes the compressed values now cached would take uncompressed,
+        # less what they take
+        self.compression_saved = 0
+        self.hits = 0
+        self.misses = 0
+        self.stale_hits = 0
+        self.evictions = 0
+        self.rejections = 0
+        self.expirations = 0
 
 
     def get(self, key):
@@ -72,169 +482,2349 @@ class LRUCache(object):
             :returns: val (str) if exists or None
         """
 
+        return self.lookup(key)[0]
+
+    def lookup(self, key, raw=False):
+        """Checks if key is in data, & whether it's due for a refresh
+            :param key (str)
+            :param raw (bool): return a compressed value as it's cached
+                (CompressedValue), rather than inflating it
+            :returns: (val, refresh) tuple. val is None if key isn't cached,
+                refresh is True if val is past its TTL (but within the grace
+                period) or about to reach it
+        """
+
+        val, refresh = self._lookup(key)
+        if type(val) is CompressedValue and not raw:
+            val = self.compressor.decompress(val)
+        return val, refresh
+
+    def _lookup(self, key):
+
+        now = now_ms()
         with self.lock:
-            if self.data.get(key) is not None:
-                val, time_added = self.data.get(key)
-                if (datetime.now() - time_added).total_seconds() >= self.ttl:
-                    return None
-                self.data[key] = (val, datetime.now())
-                return val
-            else:
-                return None
+            entry = self.data.get(key)
+            if entry is None:
+                self.misses += 1
+                self.policy.miss(key)
+                return None, False
+            val, deadline = entry
+            if now >= deadline:
+                if now < deadline + self.grace_ms:
+                    self.policy.hit(key)
+                    self.hits += 1
+                    self.stale_hits += 1
+                    return val, True
+                del self.data[key]
+                self.policy.remove(key)
+                self._release(key, val)
+                self.expirations += 1
+                self.misses += 1
+                self.policy.miss(key)
+                return None, False
+            self.policy.hit(key)
+            self.hits += 1
+            return val, now >= deadline - self.refresh_ahead_ms
+
+    def delete(self, key):
+        """Removes key from data, if it's there
+            :returns: True if key was cached
+        """
+
+        with self.lock:
+            entry = self.data.pop(key, None)
+            if entry is None:
+                return False
+            self.policy.remove(key)
+            self._release(key, entry[0])
+            return True
+
+    def clear(self):
+        """Removes every entry
+            :returns: # of entries removed
+        """
+
+        with self.lock:
+            for key in self.data:
+                self.policy.remove(key)
+            cleared = len(self.data)
+            self.data.clear()
+            self.expiry_heap = []
+            self.size = 0
+            self.compression_saved = 0
+            return cleared
 
 
-    def set(self, key, val):
+    def set(self, key, val, ttl_ms=None):
         """Sets key-val pair in self.data
             :param key (str):
             :param val (str):
+            :param ttl_ms (int): # of ms until the entry expires, if sooner
+                than the cache's TTL
+        """
+
+        if self.compressor is not None:
+            # Outside the lock, so other threads' hits don't wait on zlib
+            val = self.compressor.compress(val)
+        deadline = now_ms() + (self.ttl_ms if ttl_ms is None else min(ttl_ms, self.ttl_ms))
+        with self.lock:
+            if key in self.data:
+                old_val, old_deadline = self.data.pop(key)
+                self.policy.remove(key)
+                self._release(key, old_val)
+
+            entry_size = self._entry_size(key, val)
+            if self.max_memory and entry_size > self.max_memory * self.max_entry_fraction:
+                self.rejections += 1
+                return
+
+            # Reclaim expired entries first, so they don't push out live ones
+            self._sweep(SWEEP_BATCH)
+            while self.data and self._is_full(entry_size):
+                old_key = self.policy.evict(key)
+                old_val, old_deadline = self.data.pop(old_key)
+                self._release(old_key, old_val)
+                self.evictions += 1
+            self.data[key] = (val, deadline)
+            self.policy.add(key)
+            self.size += entry_size
+            if type(val) is CompressedValue:
+                self.compression_saved += val.saved
+            heapq.heappush(self.expiry_heap, (deadline, key))
+            if len(self.expiry_heap) > 2 * len(self.data) + SWEEP_BATCH:
+                self._rebuild_expiry_heap()
+
+    def sweep(self, max_entries=None):
+        """Removes expired entries, soonest deadline first
+            :param max_entries (int): max. # of heap records to examine, to
+                bound the time the lock is held
+            :returns: # of entries expired
+        """
+
+        with self.lock:
+            return self._sweep(max_entries)
+
+    def _sweep(self, max_entries):
+        # Entries are kept until their grace period is over, too
+        now = now_ms() - self.grace_ms
+        heap = self.expiry_heap
+        examined = expired = 0
+        while heap and heap[0][0] <= now:
+            if max_entries is not None and examined >= max_entries:
+                break
+            deadline, key = heapq.heappop(heap)
+            examined += 1
+            entry = self.data.get(key)
+            if entry is not None and entry[1] == deadline:
+                del self.data[key]
+                self.policy.remove(key)
+                self._release(key, entry[0])
+                expired += 1
+        self.expirations += expired
+        return expired
+
+    def entries(self):
+        """Unexpired entries, from the first the policy would evict to the last
+            :returns: list of (key, val, # of ms until expiry) tuples
         """
 
+        now = now_ms()
+        with self.lock:
+            entries = [
+                (key, val, deadline - now)
+                for key, (val, deadline) in ((key, self.data[key]) for key in self.policy)
+                if deadline > now
+            ]
+        if self.compressor is None:
+            return entries
+        return [(key, self.compressor.decompress(val), ttl_ms) for key, val, ttl_ms in entries]
+
+    def stats(self):
         with self.lock:
-            if len(self.data) >= self.capacity:
-                self.data.popitem(last=False)
-            self.data[key] = (val, datetime.now())
+            stats = {
+                'keys': len(self.data),
+                'size': self.size,
+                'max_memory': self.max_memory,
+                'hits': self.hits,
+                'misses': self.misses,
+                'stale_hits': self.stale_hits,
+                'evictions': self.evictions,
+                'rejections': self.rejections,
+                'expirations': self.expirations,
+            }
+            if self.compressor is not None:
+                stats.update(self.compressor.stats(), compression_saved=self.compression_saved)
+            return stats
+
+    def _rebuild_expiry_heap(self):
+        """Drops heap records for entries that were re-set or evicted"""
+
+        self.expiry_heap = [(deadline, key) for key, (val, deadline) in self.data.iteritems()]
+        heapq.heapify(self.expiry_heap)
+
+    def _is_full(self, entry_size):
+        if self.capacity and len(self.data) >= self.capacity:
+            return True
+        return bool(self.max_memory) and self.size + entry_size > self.max_memory
+
+    def _entry_size(self, key, val):
+        return sys.getsizeof(key) + sys.getsizeof(val) + ENTRY_OVERHEAD
+
+    def _release(self, key, val):
+        """Takes a removed entry off the cache's size"""
+
+        self.size -= self._entry_size(key, val)
+        if type(val) is CompressedValue:
+            self.compression_saved -= val.saved
 
     def __repr__(self):
         return "%s(%s, %s)" % (self.__class__.__name__, self.capacity, self.data)
 
 
-class RedisProxy(object):
-    """Lightweight Read Cache for Redis GET commands"""
+class ShardedLRUCache(object):
+    """LRUCache split into independent segments chosen by key hash.
+
+    Each shard has its own plain Lock, so threads only contend when their
+    keys land on the same shard, rather than on one lock for every hit.
+    Eviction is per shard, each with its own policy state.
+    """
 
     def __init__(self,
-        host_addr=None,
-        port=6379,
-        capacity=100,
-        ttl=7200,
-        timeout=30,
+        capacity=None,
+        ttl=None,
+        max_memory=None,
+        max_entry_fraction=0.5,
+        shards=16,
+        per_shard=False,
+        policy='lru',
+        grace=0,
+        refresh_ahead=0,
+        compress_threshold=None,
+        compress_level=DEFAULT_LEVEL,
+        compact=False,
     ):
-        """Settings are configurable for Redis Proxy:
-            :param host_addr (str): IP address of backing Redis instance
-            :param port (int): Port for Redis socket
-            :param capacity (int): number of keys to hold in cache
+        """
+            :param capacity (int): max. # of keys
             :param ttl (int): # of seconds that a key can live in cache
-            :param timeout (int), seconds after which to timeout network request
+            :param max_memory (int): max. approx. bytes of keys, values &
+                entry overhead
+            :param max_entry_fraction (float): values whose entry would take
+                more than this fraction of max_memory are not cached
+            :param shards (int): # of segments
+            :param per_shard (bool): apply capacity & max_memory to each shard,
+                rather than splitting them evenly across shards
+            :param policy (str): eviction policy: lru, slru, arc or tinylfu
+            :param grace (int): # of seconds an expired entry is still served,
+                while it's refreshed
+            :param refresh_ahead (int): # of seconds before expiry during
+                which a read flags the entry for refreshing
+            :param compress_threshold (int): as LRUCache
+            :param compress_level (int): as LRUCache
+            :param compact (bool): use CompactLRUCache shards; policy must
+                be lru
         """
 
-        self.cache = LRUCache(capacity, ttl)
+        if not shards or shards < 1:
+            raise TypeError("shards must be a positive int for ShardedLRUCache")
+        if compact and policy != 'lru':
+            raise ValueError("CompactLRUCache only evicts least recently used keys")
+        if not per_shard:
+            if capacity:
+                capacity = -(-capacity // shards)
+            if max_memory:
+                # Keep the same largest-entry limit as one unsharded cache
+                max_entry_fraction = min(1.0, max_entry_fraction * shards)
+                max_memory = -(-max_memory // shards)
+        self.capacity = capacity
+        self.ttl = ttl
+        self.shards = []
+        for _ in xrange(shards):
+            if compact:
+                shard = CompactLRUCache(
+                    capacity,
+                    ttl,
+                    max_memory,
+                    max_entry_fraction,
+                    grace,
+                    refresh_ahead,
+                    compress_threshold,
+                    compress_level,
+                )
+            else:
+                shard = LRUCache(
+                    capacity,
+                    ttl,
+                    max_memory,
+                    max_entry_fraction,
+                    policy,
+                    grace,
+                    refresh_ahead,
+                    compress_threshold,
+                    compress_level,
+                )
+                # get & set never re-enter, so the cheaper non-reentrant lock will do
+                shard.lock = Lock()
+            self.shards.append(shard)
 
-        if not host_addr:
-            host_addr = ''
+    def _shard(self, key):
+        return self.shards[hash(key) % len(self.shards)]
 
-        self.redis_socket = self._open_redis_connection(host_addr, port, timeout)
-        print "Running RedisProxy. Use CTRL-C to stop."
+    def get(self, key):
+        """Checks if key is in its shard
+            :param key (str)
+            :returns: val (str) if exists or None
+        """
 
+        return self._shard(key).get(key)
 
-    def _open_redis_connection(self, host_addr, port, timeout):
-        """Open Redis connection"""
+    def lookup(self, key, raw=False):
+        """Checks if key is in its shard, & whether it's due for a refresh
+            :param key (str)
+            :param raw (bool): as LRUCache.lookup()
+            :returns: (val, refresh) tuple, as LRUCache.lookup()
+        """
 
-        redis_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        redis_socket.settimeout(timeout)
-        redis_socket.connect((host_addr, port))
-        print "Connected to Redis on %s:%s" % (host_addr, port)
-        return redis_socket
+        return self._shard(key).lookup(key, raw)
 
+    def delete(self, key):
+        return self._shard(key).delete(key)
 
-    def get(self, key):
-        """Takes in a key, checks cache then backing Redis for value.
-            Stores unstored keys in cache.
+    def clear(self):
+        """Clears each shard in turn
+            :returns: # of entries removed
+        """
+
+        return sum(shard.clear() for shard in self.shards)
+
+    def set(self, key, val, ttl_ms=None):
+        """Sets key-val pair in its shard
             :param key (str):
-            :returns: value stored in Redis, if not already in cache
+            :param val (str):
+            :param ttl_ms (int): as LRUCache.set()
         """
 
-        # First, check the cache
-        cached_val = self.cache.get(key)
-        if cached_val:
-            return cached_val
-        get_str = "*2\r\n$3\r\nGET\r\n$%s\r\n%s\r\n" % (len(key), key)
-        self.redis_socket.sendall(get_str)
+        self._shard(key).set(key, val, ttl_ms)
 
-        resp = self.redis_socket.recv(4096)
-        # If Redis responds w/ a nil bulk string, return None to client
-        if resp == "$-1\r\n":
-            return None
-        msg_type, body = resp[0], resp[1:].split("\r\n")
-        length = body[0]
-        redis_val = body[1]
+    def sweep(self, max_entries=None):
+        """Sweeps each shard in turn, so only one shard's lock is held at a time
+            :param max_entries (int): max. # of heap records to examine per shard
+            :returns: # of entries expired
+        """
 
-        # Save it in the cache, if it's not already there
-        self.cache.set(key, redis_val)
+        return sum(shard.sweep(max_entries) for shard in self.shards)
 
-        return redis_val
+    def entries(self):
+        """Each shard's entries in turn, as LRUCache.entries(); order is only
+            kept within a shard, which is where each key goes back to
+        """
 
-    def _open_connection(self, host=None, port=None, timeout=30):
+        return [entry for shard in self.shards for entry in shard.entries()]
 
-        if not host:
-            host = socket.gethostname()
-        if not port:
-            raise TypeError("No port for listening socket passed in")
+    def stats(self):
+        totals = {
+            'keys': 0,
+            'size': 0,
+            'max_memory': None,
+            'hits': 0,
+            'misses': 0,
+            'stale_hits': 0,
+            'evictions': 0,
+            'rejections': 0,
+            'expirations': 0,
+        }
+        for shard in self.shards:
+            for name, count in shard.stats().items():
+                if count is not None:
+                    totals[name] = (totals.get(name) or 0) + count
+        totals['shards'] = len(self.shards)
+        return totals
+
+    def __repr__(self):
+        return "%s(%s, %s shards)" % (self.__class__.__name__, self.capacity, len(self.shards))
+
+
+class ExpirySweeper(threading.Thread):
+    """Background thread reclaiming expired cache entries.
+
+    Every interval it sweeps the cache in batches of SWEEP_BATCH, dropping
+    the lock between batches so client threads aren't held up for long.
+    """
+
+    def __init__(self, cache, interval=1.0):
+        super(ExpirySweeper, self).__init__()
+        self.daemon = True
+        self.cache = cache
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            while self.cache.sweep(SWEEP_BATCH) >= SWEEP_BATCH:
+                pass
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Refresher(threading.Thread):
+    """Background thread re-fetching cache entries that are stale or about
+    to expire, so the client that noticed doesn't wait on Redis.
+
+    Each key is queued at most once until its refresh is done. If the queue
+    is full, the request is dropped: the entry is still served until its
+    grace period ends, after which the next read is a plain miss.
+    """
+
+    def __init__(self, fetch, max_pending=MAX_PENDING_REFRESHES):
+        """
+            :param fetch (callable): takes a key, fetches & caches its value
+            :param max_pending (int): max. # of keys waiting to be refreshed
+        """
+
+        super(Refresher, self).__init__()
+        self.daemon = True
+        self.fetch = fetch
+        self.queue = Queue.Queue(max_pending)
+        self.lock = Lock()
+        self.pending = set()
+
+        # Stats
+        self.refreshes = 0
+        self.failures = 0
+        self.dropped = 0
+
+    def request(self, key):
+        """Queues key for a refresh, unless it's already queued"""
+
+        with self.lock:
+            if key in self.pending:
+                return
+            self.pending.add(key)
         try:
-            my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-            my_socket.settimeout(timeout)
-            my_socket.bind((host, port))
-            my_socket.listen(MAX_LISTENS)
-            print "Listening on %s:%s" % (host, port)
-        except socket.error, (value, msg):
-            if my_socket:
-                    my_socket.close()
-            print "Could not open socket: ", msg
-            sys.exit(1)
-        return my_socket
+            self.queue.put_nowait(key)
+        except Queue.Full:
+            with self.lock:
+                self.pending.discard(key)
+                self.dropped += 1
 
+    def run(self):
+        while True:
+            key = self.queue.get()
+            if key is None:
+                return
+            failed = False
+            try:
+                self.fetch(key)
+            except Exception, e:
+                print "Refresh of %s failed: %s" % (key, e)
+                failed = True
+            with self.lock:
+                self.pending.discard(key)
+                self.refreshes += 1
+                self.failures += failed
 
-if __name__ == "__main__":
+    def stop(self):
+        self.queue.put(None)
 
-    parser = ArgumentParser()
-    parser.add_argument(
-        '--addr',
-        type=str,
-        dest='addr',
-        default='',
-        action='store',
-        required=False,
-        help='Enter addr of backing Redis (Defaults to '')',
-    )
+    def stats(self):
+        with self.lock:
+            return {
+                'pending': len(self.pending),
+                'refreshes': self.refreshes,
+                'failures': self.failures,
+                'dropped': self.dropped,
+            }
 
-    parser.add_argument(
-        '--ttl',
-        type=int,
-        dest='ttl',
-        default=7200,
-        action='store',
-        required=False,
-        help='Enter TTL (in sec. for keys in cache)',
-    )
 
-    parser.add_argument(
-        '--capacity',
-        type=int,
-        dest='capacity',
-        default=1000,
-        action='store',
-        required=False,
-        help='Enter max. # of cache keys before LRU eviction',
-    )
+class FetchTimeoutError(Exception):
+    """An in-flight fetch for the same key didn't finish within the timeout"""
 
-    args = parser.parse_args()
 
-    redis_proxy = RedisProxy(host_addr=args.addr, ttl=args.ttl, capacity=args.capacity)
+class InFlightCall(object):
+    """One backend fetch that other requests for the same key can wait on"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight(object):
+    """Coalesces concurrent fetches of the same key into one backend call.
+
+    The first caller for a key runs the fetch; callers arriving while it is
+    in flight wait for its result (or its exception) instead of going to
+    Redis themselves.
+    """
+
+    def __init__(self, timeout=None):
+        """
+            :param timeout (float): seconds a waiting caller waits for the
+                in-flight fetch, or None to wait forever
+        """
+
+        self.timeout = timeout
+        self.lock = Lock()
+        self.calls = {}
+
+        # Backend calls saved by waiting on an in-flight fetch
+        self.coalesced = 0
 
-    CLIENT_HOST, CLIENT_PORT = "localhost", 5555
-    server = ThreadedTCPServer((CLIENT_HOST, CLIENT_PORT), ThreadedTCPRequestHandler)
-    server.proxy = redis_proxy
-    ip, port = server.server_address
+    def do(self, key, fetch):
+        """Runs fetch() for key, unless a fetch for key is already in flight
+            :param key (str):
+            :param fetch (callable): fetches the value for key
+            :returns: (result, shared) tuple. shared is True if the result
+                came from another caller's fetch
+            :raises FetchTimeoutError: if the in-flight fetch took too long
+        """
+
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = InFlightCall()
+            else:
+                self.coalesced += 1
 
-    server_thread = threading.Thread(target=server.serve_forever)
-    server_thread.daemon = True
-    server_thread.start()
+        if not leader:
+            if not call.done.wait(self.timeout):
+                raise FetchTimeoutError("Timed out waiting on in-flight fetch of %s" % (key,))
+            if call.error is not None:
+                raise call.error
+            return call.result, True
 
-    while True:
         try:
-            print "Serving RedisProxy on %s:%s" % (CLIENT_HOST, port)
-            time.sleep(10)
-        except KeyboardInterrupt:
-            server.shutdown()
-            server.server_close()
-            print "RedisProxy is shutdown. Exiting."
-            sys.exit(1)
+            call.result = fetch()
+        except Exception, e:
+            call.error = e
+            raise
+        finally:
+            with self.lock:
+                del self.calls[key]
+            call.done.set()
+        return call.result, False
+
+
+class MissBatch(object):
+    """Keys collected for one MGET, & its outcome"""
+
+    def __init__(self):
+        self.keys = []
+        self.done = threading.Event()
+        self.results = None
+        self.error = None
+
+
+class MissBatcher(object):
+    """Collects cache misses from all client threads into MGETs.
+
+    The first miss opens a batch and holds it open for up to window seconds,
+    or until max_keys misses have joined, then sends the whole batch to
+    Redis as one MGET and hands every waiting thread its own value. Misses
+    arriving while a batch is being fetched open the next one.
+    """
+
+    def __init__(self, fetch_many, window, max_keys=DEFAULT_BATCH_SIZE, timeout=None):
+        """
+            :param fetch_many (callable): takes a list of keys, returns the
+                list of their values
+            :param window (float): max. seconds a batch waits for more keys
+            :param max_keys (int): batch size that is sent without waiting
+            :param timeout (float): seconds a thread waits on a batch another
+                thread is sending, or None to wait forever
+        """
+
+        self.fetch_many = fetch_many
+        self.window = window
+        self.max_keys = max_keys
+        self.timeout = timeout
+        self.cond = Condition(Lock())
+        self.open_batch = None
+
+        # Stats
+        self.batches = 0
+        self.batched_keys = 0
+
+    def get(self, key):
+        """Adds key to the open batch & waits for its value
+            :param key (str):
+            :returns: value from Redis, or None if key doesn't exist
+            :raises FetchTimeoutError: if the batch took too long
+        """
+
+        with self.cond:
+            batch = self.open_batch
+            leader = batch is None
+            if leader:
+                batch = self.open_batch = MissBatch()
+            index = len(batch.keys)
+            batch.keys.append(key)
+            if len(batch.keys) >= self.max_keys:
+                # Full: wake the leader to send it now
+                self.open_batch = None
+                self.cond.notify_all()
+            if leader:
+                deadline = monotonic() + self.window
+                while self.open_batch is batch:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        self.open_batch = None
+                        break
+                    self.cond.wait(remaining)
+                self.batches += 1
+                self.batched_keys += len(batch.keys)
+
+        if leader:
+            try:
+                batch.results = self.fetch_many(batch.keys)
+            except Exception, e:
+                batch.error = e
+            batch.done.set()
+        elif not batch.done.wait(self.timeout):
+            raise FetchTimeoutError("Timed out waiting on batched fetch of %s" % key)
+        if batch.error is not None:
+            raise batch.error
+        return batch.results[index]
+
+    def stats(self):
+        with self.cond:
+            return {
+                'batches': self.batches,
+                'batched_keys': self.batched_keys,
+            }
+
+
+class PoolTimeoutError(Exception):
+    """No Redis connection became free within the pool's timeout"""
+
+
+# What answering a client's command from Redis can fail with; the client is
+# sent a Redis error instead
+FETCH_ERRORS = (RedisError, FetchTimeoutError, PoolTimeoutError, socket.error)
+
+
+class RedisConnectionPool(object):
+    """Bounded pool of Redis connections, checked out one request at a time"""
+
+    def __init__(self, connect, max_size=8, timeout=None):
+        """
+            :param connect (callable): opens & returns a new Redis socket
+            :param max_size (int): max. # of open connections to Redis
+            :param timeout (float): seconds to wait for a free connection,
+                or None to wait forever
+        """
+
+        if not max_size or max_size < 1:
+            raise TypeError("max_size must be a positive int for RedisConnectionPool")
+        self.connect = connect
+        self.max_size = max_size
+        self.timeout = timeout
+        self.cond = Condition(Lock())
+        self.idle = []
+        self.size = 0
+
+        # Metrics
+        self.checkouts = 0
+        self.waits = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        self.reconnects = 0
+
+    def acquire(self):
+        """Checks out an idle connection, opening a new one if the pool can
+            still grow, otherwise waiting for one to be released
+            :returns: Redis socket
+        """
+
+        start = None
+        with self.cond:
+            while not self.idle and self.size >= self.max_size:
+                if start is None:
+                    start = time.time()
+                    self.waits += 1
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.time() - start)
+                    if remaining <= 0:
+                        self._record_wait(start)
+                        raise PoolTimeoutError(
+                            "No Redis connection free after %ss" % self.timeout,
+                        )
+                self.cond.wait(remaining)
+            if start is not None:
+                self._record_wait(start)
+            self.checkouts += 1
+            if self.idle:
+                return self.idle.pop()
+            # Reserve the slot now, connect outside the lock
+            self.size += 1
+        try:
+            return self.connect()
+        except Exception:
+            with self.cond:
+                self.size -= 1
+                self.cond.notify()
+            raise
+
+    def _record_wait(self, start):
+        waited = time.time() - start
+        self.wait_time += waited
+        self.max_wait_time = max(self.max_wait_time, waited)
+
+    def release(self, conn, discard=False):
+        """Returns a connection to the pool
+            :param conn: socket from acquire()
+            :param discard (bool): close conn instead, e.g. after a socket error
+        """
+
+        if discard:
+            try:
+                conn.close()
+            except socket.error:
+                pass
+        with self.cond:
+            if discard:
+                self.size -= 1
+                self.reconnects += 1
+            else:
+                self.idle.append(conn)
+            self.cond.notify()
+
+    @contextmanager
+    def connection(self):
+        """Checks out a connection for the duration of a with-block. If the
+            block raises, the connection may hold a half-read reply, so it
+            is closed instead of going back to the pool.
+        """
+
+        conn = self.acquire()
+        try:
+            yield conn
+        except Exception:
+            self.release(conn, discard=True)
+            raise
+        else:
+            self.release(conn)
+
+    def stats(self):
+        with self.cond:
+            return {
+                'size': self.size,
+                'idle': len(self.idle),
+                'max_size': self.max_size,
+                'checkouts': self.checkouts,
+                'waits': self.waits,
+                'wait_time': self.wait_time,
+                'max_wait_time': self.max_wait_time,
+                'reconnects': self.reconnects,
+            }
+
+
+class PendingRequest(object):
+    """Reply slot for one request sent over a MultiplexedRedisConnection"""
+
+    def __init__(self, replies=1):
+        """
+            :param replies (int): # of replies to wait for, e.g. 2 for a GET
+                pipelined with a PTTL
+        """
+
+        self.done = threading.Event()
+        self.replies = replies
+        self.results = []
+        self.error = None
+
+
+class MultiplexedRedisConnection(object):
+    """One Redis connection shared by every client thread.
+
+    Requests are written back-to-back as they arrive, without waiting for
+    the replies to earlier ones, and a reader thread hands each reply to the
+    oldest request still waiting on one, since Redis answers in order. At
+    most max_outstanding requests are in flight at once; callers beyond that
+    wait for a reply to free a slot.
+
+    If the connection breaks, every request in flight on it fails with the
+    socket error, and the next request opens a new connection.
+    """
+
+    def __init__(self, connect, max_outstanding=DEFAULT_MAX_OUTSTANDING, timeout=None):
+        """
+            :param connect (callable): opens & returns a new RedisConnection
+            :param max_outstanding (int): max. # of requests awaiting replies
+            :param timeout (float): seconds to wait for a free slot & for a
+                reply, or None to wait forever
+        """
+
+        if not max_outstanding or max_outstanding < 1:
+            raise TypeError("max_outstanding must be a positive int for MultiplexedRedisConnection")
+        self.connect = connect
+        self.max_outstanding = max_outstanding
+        self.timeout = timeout
+        # Held while writing, so requests go out in the order they're queued
+        self.lock = Lock()
+        self.conn = None
+        self.pending = deque()
+        self.slots = Condition(Lock())
+        self.outstanding = 0
+
+        # Metrics
+        self.requests = 0
+        self.slot_waits = 0
+        self.reconnects = 0
+
+    def call(self, command, replies=1):
+        """Sends command & waits for its reply
+            :param command (str): RESP-encoded command, or several pipelined
+            :param replies (int): # of replies command gets
+            :returns: reply, as RedisConnection.read_reply() returns it, or
+                a list of them if replies > 1
+            :raises socket.error: if the connection broke before the reply
+            :raises FetchTimeoutError: if no slot or no reply came in time
+        """
+
+        self._take_slot()
+        request = PendingRequest(replies)
+        conn = None
+        try:
+            with self.lock:
+                conn = self._connection()
+                self.pending.append(request)
+                conn.sendall(command)
+        except Exception, e:
+            if conn is None:
+                # Never queued, so nothing else will give the slot back
+                self._free_slots(1)
+                raise
+            self._reset(conn, e)
+        if not request.done.wait(self.timeout):
+            raise FetchTimeoutError("Timed out waiting on a reply from Redis")
+        if request.error is not None:
+            raise request.error
+        if replies == 1:
+            return request.results[0]
+        return request.results
+
+    def open(self):
+        """Opens the connection now, rather than on the first request"""
+
+        with self.lock:
+            self._connection()
+
+    def _take_slot(self):
+        start = time.time()
+        with self.slots:
+            if self.outstanding >= self.max_outstanding:
+                self.slot_waits += 1
+            while self.outstanding >= self.max_outstanding:
+                remaining = None
+                if self.timeout is not None:
+                    remaining = self.timeout - (time.time() - start)
+                    if remaining <= 0:
+                        raise FetchTimeoutError(
+                            "%s requests to Redis still outstanding after %ss"
+                            % (self.outstanding, self.timeout),
+                        )
+                self.slots.wait(remaining)
+            self.outstanding += 1
+            self.requests += 1
+
+    def _free_slots(self, count):
+        with self.slots:
+            self.outstanding -= count
+            self.slots.notify(count)
+
+    def _connection(self):
+        """Current connection, opened (with its reader) if there is none.
+            Called with self.lock held.
+        """
+
+        if self.conn is None:
+            self.conn = self.connect()
+            reader = threading.Thread(target=self._read_replies, args=(self.conn,))
+            reader.daemon = True
+            reader.start()
+        return self.conn
+
+    def _read_replies(self, conn):
+        while True:
+            try:
+                reply = conn.read_reply()
+            except socket.timeout:
+                with self.lock:
+                    idle = not self.pending
+                    current = self.conn is conn
+                if idle and current:
+                    # Nothing was asked, so nothing is late
+                    continue
+                self._reset(conn, socket.error("Timed out reading from Redis"))
+                return
+            except (socket.error, ProtocolError), e:
+                self._reset(conn, e)
+                return
+            with self.lock:
+                if self.conn is not conn:
+                    return
+                request = self.pending[0]
+                request.results.append(reply)
+                if len(request.results) < request.replies:
+                    continue
+                self.pending.popleft()
+            request.done.set()
+            self._free_slots(1)
+
+    def _reset(self, conn, error):
+        """Closes a broken connection & fails every request waiting on it"""
+
+        with self.lock:
+            if self.conn is not conn:
+                return
+            self.conn = None
+            failed = list(self.pending)
+            self.pending.clear()
+            self.reconnects += 1
+        try:
+            conn.close()
+        except socket.error:
+            pass
+        for request in failed:
+            request.error = error
+            request.done.set()
+        if failed:
+            self._free_slots(len(failed))
+
+    def stats(self):
+        with self.slots:
+            return {
+                'outstanding': self.outstanding,
+                'max_outstanding': self.max_outstanding,
+                'requests': self.requests,
+                'slot_waits': self.slot_waits,
+                'reconnects': self.reconnects,
+            }
+
+
+def parse_replica_set(spec):
+    """Parses a --backend argument: host:port, or host:port,host:port,...
+        for replicas of the same data
+        :returns: list of (host, port)
+    """
+
+    return [parse_backend(addr) for addr in spec.split(',')]
+
+
+class RedisBackend(object):
+    """One backing Redis: a pool of connections to it (or one multiplexed
+    connection), and with batching on, the batcher sharing MGETs to it
+    """
+
+    def __init__(self, connect, pool_size, multiplex, max_outstanding, timeout):
+        self.pool = None
+        self.mux = None
+        if multiplex:
+            self.mux = MultiplexedRedisConnection(connect, max_outstanding, timeout)
+        else:
+            self.pool = RedisConnectionPool(connect, max_size=pool_size, timeout=timeout)
+        self.batcher = None
+
+    def open(self):
+        """Connects up front, so a bad address fails fast"""
+
+        if self.mux is not None:
+            self.mux.open()
+        else:
+            self.pool.release(self.pool.acquire())
+
+    def call(self, command, stream_to=None, stream_threshold=None, replies=1):
+        """Sends command & reads its reply
+            :param replies (int): # of replies command gets, if several
+                commands are pipelined in it; only the first is streamed.
+                More than 1 returns a list of them
+        """
+
+        if self.mux is not None:
+            # Replies are read by the connection's reader thread, which
+            # can't wait on one slow client, so nothing is streamed
+            return self.mux.call(command, replies)
+        with self.pool.connection() as redis_conn:
+            redis_conn.sendall(command)
+            reply = redis_conn.read_reply(stream_to, stream_threshold)
+            if replies == 1:
+                return reply
+            return [reply] + [redis_conn.read_reply() for _ in xrange(replies - 1)]
+
+    def write(self, command):
+        """Sends a write command & reads its reply"""
+
+        return self.call(command)
+
+
+class Replica(object):
+    """One member of a ReplicaSet, with its health & response times"""
+
+    def __init__(self, name, backend):
+        self.name = name
+        self.backend = backend
+        self.healthy = True
+        # Moving average of response times, in seconds
+        self.ewma = 0.0
+        self.pending = 0
+
+        # Stats
+        self.requests = 0
+        self.errors = 0
+        self.ejections = 0
+
+    def cost(self):
+        # Requests already queued on a replica hold up the next one too
+        return self.ewma * (self.pending + 1)
+
+    def record(self, elapsed):
+        if self.ewma:
+            self.ewma = EWMA_WEIGHT * elapsed + (1 - EWMA_WEIGHT) * self.ewma
+        else:
+            self.ewma = elapsed
+
+
+class ReplicaSet(object):
+    """Replicas of the same data, used in place of one RedisBackend.
+
+    Each request goes to the cheaper of two healthy replicas picked at
+    random (power of two choices), cost being the moving average of a
+    replica's response times times its # of requests in flight. That steers
+    requests away from a slow replica without herding them all onto the
+    fastest one.
+
+    A replica that times out, drops its connection or answers with one of
+    REPLICA_DOWN_ERRORS (e.g. LOADING, while it restarts) is ejected, & the
+    request retried once on another. Ejected replicas are PINGed every
+    probe_interval by a background thread & re-admitted once they answer.
+    If every replica is ejected, requests go to them anyway.
+    """
+
+    def __init__(self, replicas, probe_interval=DEFAULT_PROBE_INTERVAL, rand=None):
+        """
+            :param replicas (list): (name, RedisBackend) per replica
+            :param probe_interval (float): seconds between probes of ejected
+                replicas. None doesn't start the probing thread
+            :param rand (random.Random): source of the random choices
+        """
+
+        self.replicas = [Replica(name, backend) for name, backend in replicas]
+        self.lock = Lock()
+        self.rand = rand or random.Random()
+        self.batcher = None
+        for replica in self.replicas:
+            try:
+                replica.backend.open()
+            except socket.error, e:
+                self._eject(replica, e)
+        self.prober = None
+        if probe_interval:
+            self.prober = ReplicaProber(self, probe_interval)
+            self.prober.start()
+
+    def open(self):
+        # Replicas were connected to (or ejected) on creation
+        pass
+
+    def call(self, command, stream_to=None, stream_threshold=None, replies=1):
+        """Sends command to a replica & reads its reply, retrying once on
+            another replica if the first one fails
+            :param replies (int): as RedisBackend.call()
+        """
+
+        replica = self._choose()
+        try:
+            reply = self._call(replica, command, stream_to, stream_threshold, replies)
+        except (socket.error, FetchTimeoutError):
+            retry = self._choose(exclude=replica)
+            if retry is None or (stream_to is not None and stream_to.started):
+                raise
+            return self._call(retry, command, stream_to, stream_threshold, replies)
+        if _is_down_error(reply, replies):
+            retry = self._choose(exclude=replica)
+            if retry is not None:
+                return self._call(retry, command, stream_to, stream_threshold, replies)
+        return reply
+
+    def write(self, command):
+        """Sends a write command to the primary, the first replica listed, &
+            reads its reply. Writes aren't retried, or sent to the others,
+            which would refuse them.
+        """
+
+        return self.replicas[0].backend.call(command)
+
+    def probe(self):
+        """PINGs each ejected replica, re-admitting those that answer"""
+
+        with self.lock:
+            ejected = [replica for replica in self.replicas if not replica.healthy]
+        for replica in ejected:
+            start = monotonic()
+            try:
+                reply = replica.backend.call(encode_command("PING"))
+            except (socket.error, FetchTimeoutError, PoolTimeoutError):
+                continue
+            if reply != "PONG":
+                continue
+            with self.lock:
+                replica.healthy = True
+                replica.ewma = monotonic() - start
+            print "Re-admitted replica %s" % replica.name
+
+    def stats(self):
+        with self.lock:
+            return dict(
+                (replica.name, {
+                    'healthy': replica.healthy,
+                    'ewma_ms': replica.ewma * 1000,
+                    'pending': replica.pending,
+                    'requests': replica.requests,
+                    'errors': replica.errors,
+                    'ejections': replica.ejections,
+                })
+                for replica in self.replicas
+            )
+
+    def _choose(self, exclude=None):
+        """Power of two choices among the healthy replicas other than
+            exclude
+            :returns: a Replica, or None if exclude is given & no other
+                replica is healthy
+        """
+
+        with self.lock:
+            candidates = [r for r in self.replicas if r.healthy and r is not exclude]
+            if not candidates:
+                if exclude is not None:
+                    return None
+                candidates = self.replicas
+            if len(candidates) == 1:
+                return candidates[0]
+            first, second = self.rand.sample(candidates, 2)
+            return first if first.cost() <= second.cost() else second
+
+    def _call(self, replica, command, stream_to, stream_threshold, replies=1):
+        with self.lock:
+            replica.pending += 1
+            replica.requests += 1
+        start = monotonic()
+        try:
+            reply = replica.backend.call(command, stream_to, stream_threshold, replies)
+        except (socket.error, FetchTimeoutError), e:
+            self._eject(replica, e)
+            raise
+        finally:
+            with self.lock:
+                replica.pending -= 1
+        if _is_down_error(reply, replies):
+            self._eject(replica, reply)
+        else:
+            with self.lock:
+                replica.record(monotonic() - start)
+        return reply
+
+    def _eject(self, replica, error):
+        with self.lock:
+            replica.errors += 1
+            if not replica.healthy:
+                return
+            replica.healthy = False
+            replica.ejections += 1
+        print "Ejected replica %s: %s" % (replica.name, error)
+
+
+def _is_down_error(reply, replies=1):
+    if replies > 1:
+        # A replica that can't serve reads refuses the first command too
+        reply = reply[0]
+    return isinstance(reply, RedisError) and str(reply).startswith(REPLICA_DOWN_ERRORS)
+
+
+class ReplicaProber(threading.Thread):
+    """Background thread probing a ReplicaSet's ejected replicas"""
+
+    def __init__(self, replica_set, interval=DEFAULT_PROBE_INTERVAL):
+        super(ReplicaProber, self).__init__()
+        self.daemon = True
+        self.replica_set = replica_set
+        self.interval = interval
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            self.replica_set.probe()
+
+    def stop(self):
+        self.stopped.set()
+
+
+class InvalidationListener(threading.Thread):
+    """Background thread reading one backend's InvalidationFeed.
+
+    If the connection drops, the proxy's caches are flushed & nothing is
+    cached until it's back, retried every RETRY_INTERVAL seconds; then the
+    caches are flushed again, as writes made meanwhile went unannounced.
+    """
+
+    def __init__(self, feed, connect, proxy, interval=RETRY_INTERVAL):
+        """
+            :param feed (InvalidationFeed): subscribed already
+            :param connect (callable): opens a new RedisConnection to the
+                feed's backend
+            :param proxy (RedisProxy): whose caches to invalidate
+        """
+
+        super(InvalidationListener, self).__init__()
+        self.daemon = True
+        self.feed = feed
+        self.connect = connect
+        self.proxy = proxy
+        self.interval = interval
+        self.stopped = threading.Event()
+        # Quiet is normal here, so reads don't time out
+        feed.conn.sock.settimeout(None)
+
+    def run(self):
+        while not self.stopped.is_set():
+            if self.feed.conn is None and not self._resubscribe():
+                self.stopped.wait(self.interval)
+                continue
+            try:
+                data = self.feed.conn.sock.recv(RECV_SIZE)
+                if not data:
+                    raise socket.error("Connection closed by Redis")
+                invalidations = self.feed.feed(data)
+            except (socket.error, ProtocolError), e:
+                print "Lost invalidation connection to %s: %s" % (self.feed.name, e)
+                self.feed.close()
+                self.proxy._flush()
+                continue
+            self.proxy._apply_invalidations(invalidations)
+
+    def _resubscribe(self):
+        try:
+            self.feed.subscribe(self.connect())
+        except (socket.error, ProtocolError, RedisError), e:
+            print "Could not resubscribe to invalidations from %s: %s" % (self.feed.name, e)
+            return False
+        self.feed.conn.sock.settimeout(None)
+        print "Resubscribed to invalidations from %s" % self.feed.name
+        self.proxy._flush()
+        return True
+
+    def stop(self):
+        self.stopped.set()
+
+
+class RedisProxy(object):
+    """Lightweight Read Cache for Redis GET commands"""
+
+    def __init__(self,
+        host_addr=None,
+        port=6379,
+        capacity=100,
+        ttl=7200,
+        timeout=30,
+        pool_size=8,
+        stream_threshold=1024 * 1024,
+        max_memory=None,
+        max_entry_fraction=0.5,
+        shards=1,
+        per_shard_capacity=False,
+        negative_ttl=None,
+        negative_capacity=DEFAULT_NEGATIVE_CAPACITY,
+        absent_filter=False,
+        batch_window=None,
+        batch_size=DEFAULT_BATCH_SIZE,
+        multiplex=False,
+        max_outstanding=DEFAULT_MAX_OUTSTANDING,
+        eviction_policy='lru',
+        grace=0,
+        refresh_ahead=0,
+        cache=None,
+        backends=None,
+        replica_timeout=DEFAULT_REPLICA_TIMEOUT,
+        probe_interval=DEFAULT_PROBE_INTERVAL,
+        compress_threshold=None,
+        compress_level=DEFAULT_LEVEL,
+        compact_cache=False,
+        pass_writes=False,
+        versions=None,
+        invalidation=None,
+        tracking_prefixes=(),
+        key_ttl=False,
+    ):
+        """Settings are configurable for Redis Proxy:
+            :param host_addr (str): IP address of backing Redis instance
+            :param port (int): Port for Redis socket
+            :param capacity (int): number of keys to hold in cache
+            :param ttl (int): # of seconds that a key can live in cache
+            :param timeout (int), seconds after which to timeout network request
+            :param pool_size (int): max. # of connections to Redis
+            :param stream_threshold (int): values over this many bytes are
+                streamed straight to the client & not cached
+            :param max_memory (int): approx. bytes the cache may use
+            :param max_entry_fraction (float): largest share of max_memory
+                one entry may take
+            :param shards (int): # of independently locked cache segments
+            :param per_shard_capacity (bool): apply capacity & max_memory to
+                each shard instead of the cache as a whole
+            :param negative_ttl (int): # of seconds to remember that a key
+                doesn't exist in Redis. None disables negative caching
+            :param negative_capacity (int): max. # of absent keys remembered,
+                kept apart from capacity
+            :param absent_filter (bool): screen negative cache lookups with
+                a Bloom filter of keys recently found absent
+            :param batch_window (float): seconds a cache miss waits for misses
+                from other clients to share one MGET. None sends each miss
+                as its own GET
+            :param batch_size (int): max. # of keys per MGET
+            :param multiplex (bool): pipeline every request over one shared
+                Redis connection instead of checking connections out of a pool
+            :param max_outstanding (int): max. # of requests in flight on the
+                multiplexed connection
+            :param eviction_policy (str): lru, slru, arc or tinylfu
+            :param grace (int): # of seconds an expired value is still served,
+                while it's refreshed in the background
+            :param refresh_ahead (int): # of seconds before expiry during
+                which a hit refreshes the value in the background
+            :param cache (SharedLRUCache): cache shared with other worker
+                processes, used instead of building one from the settings
+            :param backends (list): (host, port) of each backing Redis; keys
+                are sharded across them on a consistent hash ring, with a
+                pool (or multiplexed connection) each. A list of (host, port)
+                in place of one is a set of replicas of the same data.
+                Defaults to host_addr & port
+            :param replica_timeout (float): seconds a replica may take to
+                reply before it's ejected
+            :param probe_interval (float): seconds between PINGs of ejected
+                replicas
+            :param compress_threshold (int): min. # of bytes of a value to
+                cache it compressed. None disables compression
+            :param compress_level (int): zlib level, 1-9
+            :param compact_cache (bool): keep the cache in a CompactLRUCache,
+                which takes less memory per key & less time per hit but
+                only evicts least recently used keys
+            :param pass_writes (bool): pass write commands (SET, DEL,
+                EXPIRE, ...) through to Redis, invalidating the keys they
+                write to
+            :param versions (KeyVersions): key versions shared with other
+                worker processes, used instead of this proxy's own
+            :param invalidation (str): have each backend announce changed
+                keys, with 'tracking' (CLIENT TRACKING) or 'keyspace'
+                (keyspace notifications). None relies on the TTL alone
+            :param tracking_prefixes (list): only track keys starting with
+                one of these; all keys if empty
+            :param key_ttl (bool): fetch each key's PTTL along with it, &
+                cache it no longer than it has left to live in Redis
+        """
+
+        if cache is not None:
+            self.cache = cache
+        elif shards > 1:
+            self.cache = ShardedLRUCache(
+                capacity,
+                ttl,
+                max_memory,
+                max_entry_fraction,
+                shards=shards,
+                per_shard=per_shard_capacity,
+                policy=eviction_policy,
+                grace=grace,
+                refresh_ahead=refresh_ahead,
+                compress_threshold=compress_threshold,
+                compress_level=compress_level,
+                compact=compact_cache,
+            )
+        elif compact_cache:
+            if eviction_policy != 'lru':
+                raise ValueError("CompactLRUCache only evicts least recently used keys")
+            self.cache = CompactLRUCache(
+                capacity,
+                ttl,
+                max_memory,
+                max_entry_fraction,
+                grace,
+                refresh_ahead,
+                compress_threshold,
+                compress_level,
+            )
+        else:
+            self.cache = LRUCache(
+                capacity,
+                ttl,
+                max_memory,
+                max_entry_fraction,
+                eviction_policy,
+                grace,
+                refresh_ahead,
+                compress_threshold,
+                compress_level,
+            )
+        self.stream_threshold = stream_threshold
+        self.key_ttl = key_ttl
+
+        # Keys Redis had no value for, in their own cache so they never
+        # push out real values
+        self.negative_cache = None
+        self.absent_filter = None
+        self.absent_lock = Lock()
+        self.filtered = 0
+        if negative_ttl:
+            if shards > 1:
+                self.negative_cache = ShardedLRUCache(negative_capacity, negative_ttl, shards=shards)
+            else:
+                self.negative_cache = LRUCache(negative_capacity, negative_ttl)
+            if absent_filter:
+                self.absent_filter = BloomFilter(negative_capacity)
+
+        if not host_addr:
+            host_addr = ''
+        if not backends:
+            backends = [(host_addr, port)]
+
+        # Backends are named host:port (host:port,host:port,... for replica
+        # sets) on the ring
+        self.backends = OrderedDict()
+        # Address each backend's invalidations come from: a replica set's
+        # first, which writes go to
+        primaries = []
+        for addrs in backends:
+            if isinstance(addrs, tuple):
+                addrs = [addrs]
+            primaries.append(addrs[0])
+            names = ["%s:%s" % addr for addr in addrs]
+            if len(addrs) == 1:
+                connect = partial(self._connect_redis, addrs[0][0], addrs[0][1], timeout)
+                backend = RedisBackend(connect, pool_size, multiplex, max_outstanding, timeout)
+                backend.open()
+            else:
+                backend = ReplicaSet(
+                    [
+                        (name, RedisBackend(
+                            partial(self._connect_redis, host, port, replica_timeout),
+                            pool_size,
+                            multiplex,
+                            max_outstanding,
+                            replica_timeout,
+                        ))
+                        for name, (host, port) in zip(names, addrs)
+                    ],
+                    probe_interval,
+                )
+            if batch_window:
+                backend.batcher = MissBatcher(
+                    partial(self._send_mget, backend),
+                    batch_window,
+                    batch_size,
+                    timeout,
+                )
+            self.backends[",".join(names)] = backend
+        self.ring = HashRing(self.backends)
+        self.pass_writes = pass_writes
+        self.versions = versions if versions is not None else KeyVersions()
+        self.feeds = []
+        if invalidation:
+            for host, port in primaries:
+                feed = InvalidationFeed("%s:%s" % (host, port), invalidation, tracking_prefixes)
+                # Up front, so a backend that can't announce changes fails fast
+                feed.subscribe(self._connect_redis(host, port, timeout))
+                InvalidationListener(feed, partial(self._connect_redis, host, port, timeout), self).start()
+                self.feeds.append(feed)
+        self.single_flight = SingleFlight(timeout)
+        self.refresher = None
+        if grace or refresh_ahead:
+            self.refresher = Refresher(self._refresh)
+            self.refresher.start()
+        self.metrics = Metrics()
+        print "Running RedisProxy. Use CTRL-C to stop."
+
+
+    def _open_redis_connection(self, host_addr, port, timeout):
+        """Open Redis connection"""
+
+        redis_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        redis_socket.settimeout(timeout)
+        redis_socket.connect((host_addr, port))
+        print "Connected to Redis on %s:%s" % (host_addr, port)
+        return redis_socket
+
+    def _connect_redis(self, host_addr, port, timeout):
+        return RedisConnection(self._open_redis_connection(host_addr, port, timeout))
+
+
+    def get(self, key, stream_to=None, raw=False):
+        """Takes in a key, checks cache then backing Redis for value.
+            Stores unstored keys in cache.
+            :param key (str):
+            :param stream_to (BulkStream): if given, values larger than
+                self.stream_threshold are written here instead of returned
+            :param raw (bool): return a cached value that's compressed as
+                it is (CompressedValue)
+            :returns: value stored in Redis, if not already in cache, or
+                STREAMED if the value was streamed to stream_to
+        """
+
+        start = clock()
+        # First, check the cache
+        cached_val = self._cached(key, raw)
+        if cached_val:
+            self.metrics.hit_latency.record(clock() - start)
+            return cached_val
+        if self._known_absent(key):
+            self.metrics.hit_latency.record(clock() - start)
+            return None
+
+        # Then share any fetch of the same key another thread has in flight,
+        # unless it was sent before a write to the key
+        flight = (key, self.versions.current(key))
+        redis_val, shared = self.single_flight.do(flight, partial(self._fetch, key, stream_to))
+        if shared and redis_val is STREAMED:
+            # The value went to the other thread's client, not to ours
+            redis_val = self._fetch(key, stream_to)
+        self.metrics.miss_latency.record(clock() - start)
+        return redis_val
+
+    def mget(self, keys, raw=False):
+        """Takes in keys, answers cached ones from the cache & fetches the
+            rest from backing Redis in one MGET per backend
+            :param keys (list):
+            :param raw (bool): as get()
+            :returns: list of values, None for keys that don't exist
+        """
+
+        start = clock()
+        vals = [self._cached(key, raw) for key in keys]
+        missing = []
+        seen = set()
+        for key, val in zip(keys, vals):
+            if not val and key not in seen and not self._known_absent(key):
+                seen.add(key)
+                missing.append(key)
+        if not missing:
+            self.metrics.hit_latency.record(clock() - start)
+            return vals
+
+        fetched = self._fetch_many(missing)
+        self.metrics.miss_latency.record(clock() - start)
+        return [fetched[key] if key in fetched else val for key, val in zip(keys, vals)]
+
+    def warm(self, keys, batch_size=WARM_BATCH_SIZE):
+        """Fetches keys into the cache ahead of any client asking for them,
+            e.g. before the proxy starts accepting connections
+            :param keys (list):
+            :param batch_size (int): max. # of keys per MGET round
+            :returns: # of keys Redis had values for
+        """
+
+        found = 0
+        for i in xrange(0, len(keys), batch_size):
+            fetched = self._fetch_many(keys[i:i + batch_size])
+            found += sum(1 for val in fetched.itervalues() if val is not None)
+        return found
+
+    def _cached(self, key, raw=False):
+        """Value for key from the cache, if any. A value that's stale or about
+            to expire is refreshed in the background.
+        """
+
+        cached_val, refresh = self.cache.lookup(key, raw)
+        if cached_val and refresh:
+            self.refresher.request(key)
+        return cached_val
+
+    def _refresh(self, key):
+        # Shares the fetch with any client that misses on key meanwhile
+        self.single_flight.do((key, self.versions.current(key)), partial(self._fetch, key))
+
+    def _fetch(self, key, stream_to=None):
+        """Gets key from Redis & caches it"""
+
+        version = self.versions.current(key)
+        backend = self.backends[self.ring.node_for(key)]
+        if backend.batcher is not None:
+            # Batched values come back whole in the MGET reply, so nothing
+            # is streamed
+            redis_val, ttl_ms = backend.batcher.get(key)
+        else:
+            redis_val, ttl_ms = self._send_get(backend, key, stream_to)
+        if redis_val is STREAMED:
+            return redis_val
+        self._store(key, redis_val, version, ttl_ms)
+        return redis_val
+
+    def _send_get(self, backend, key, stream_to=None):
+        """Gets key from one backend, with its PTTL if self.key_ttl. A
+            plain RedisBackend is retried once here if its connection breaks;
+            a ReplicaSet retries on another replica itself, so isn't
+            :returns: (value, # of ms it has left in Redis or None) tuple
+        """
+
+        command = encode_command("GET", key)
+        replies = 1
+        if self.key_ttl:
+            command += encode_ttl_commands([key])
+            replies = 2
+        try:
+            reply = self._send_to_redis(backend, command, stream_to, replies)
+        except socket.error:
+            if not isinstance(backend, RedisBackend) or (stream_to is not None and stream_to.started):
+                raise
+            # The broken connection was dropped from the pool; GET is
+            # idempotent, so retry once on a fresh one
+            reply = self._send_to_redis(backend, command, stream_to, replies)
+        redis_val, ttl_ms = reply, None
+        if self.key_ttl:
+            redis_val, ttl_ms = reply[0], parse_pttl(reply[1])
+        if isinstance(redis_val, RedisError):
+            raise redis_val
+        return redis_val, ttl_ms
+
+    def _fetch_many(self, keys):
+        """Gets keys from Redis in one MGET per backend & caches them
+            :returns: dict of key -> value (None for keys that don't exist)
+        """
+
+        versions = dict((key, self.versions.current(key)) for key in keys)
+        fetched = {}
+        ttls = {}
+        for node, node_keys in self.ring.split(keys).iteritems():
+            for key, (redis_val, ttl_ms) in zip(node_keys, self._send_mget(self.backends[node], node_keys)):
+                fetched[key] = redis_val
+                ttls[key] = ttl_ms
+        for key, redis_val in fetched.iteritems():
+            self._store(key, redis_val, versions[key], ttls[key])
+        return fetched
+
+    def _send_mget(self, backend, keys):
+        """Gets keys from one backend in one MGET, pipelined with a PTTL of
+            each if self.key_ttl. Retried as _send_get()
+            :returns: list of (value, # of ms it has left in Redis or None)
+                tuples; the value is None for keys that don't exist
+        """
+
+        command = encode_command("MGET", *keys)
+        replies = 1
+        if self.key_ttl:
+            command += encode_ttl_commands(keys)
+            replies += len(keys)
+        try:
+            reply = self._send_to_redis(backend, command, replies=replies)
+        except socket.error:
+            if not isinstance(backend, RedisBackend):
+                raise
+            # Like GET, MGET is safe to retry once on a fresh connection
+            reply = self._send_to_redis(backend, command, replies=replies)
+        redis_vals, ttls = reply, [None] * len(keys)
+        if self.key_ttl:
+            redis_vals, ttls = reply[0], [parse_pttl(ttl_reply) for ttl_reply in reply[1:]]
+        if isinstance(redis_vals, RedisError):
+            raise redis_vals
+        return zip(redis_vals, ttls)
+
+    def _store(self, key, redis_val, version, ttl_ms=None):
+        """Caches a value fetched from Redis, or remembers that the key
+            doesn't exist (nil bulk strings come back as None)
+            :param version (int): key's version from before the fetch was
+                sent; if a write has moved it on since, the value is dropped
+            :param ttl_ms (int): # of ms the key has left in Redis, if it
+                expires; it's cached no longer than that
+        """
+
+        if self._invalidation_down():
+            return
+        if redis_val is None:
+            # Drop any stale value a refresh found gone
+            self.cache.delete(key)
+            self._remember_absent(key)
+        elif len(redis_val) <= self.stream_threshold and ttl_ms != 0:
+            self.cache.set(key, redis_val, ttl_ms)
+        else:
+            # Too large, or expired in Redis since it was read
+            self.cache.delete(key)
+        # Checked after caching, not before, so a write can't slip in between
+        if self.versions.current(key) != version:
+            self._drop(key)
+            self.versions.voided += 1
+
+    def write(self, args):
+        """Passes a write command through to Redis, then invalidates the
+            keys it names
+            :param args (list): command name & arguments
+            :returns: Redis's reply, as read_reply() returns it; a RedisError
+                for an error reply, or if the proxy couldn't send the write
+        """
+
+        keys = write_keys(args)
+        if not keys:
+            return RedisError(arity_error(args))
+        nodes = self.ring.split(keys)
+        if len(nodes) > 1:
+            return RedisError(CROSS_BACKEND_ERROR)
+        self.versions.writes += 1
+        try:
+            return self.backends[nodes.keys()[0]].write(encode_command(*args))
+        except socket.error, e:
+            return RedisError("Redis connection error: %s" % e)
+        finally:
+            # Even a write that failed may have reached Redis
+            self._invalidate(keys)
+
+    def _invalidate(self, keys):
+        """Moves on keys' versions & drops them from the caches, so nothing
+            fetched before a write to them stays cached
+        """
+
+        self.versions.bump(keys)
+        for key in keys:
+            self._drop(key)
+        self.versions.invalidated += len(keys)
+
+    def _drop(self, key):
+        self.cache.delete(key)
+        if self.negative_cache is not None:
+            self.negative_cache.delete(key)
+
+    def _apply_invalidations(self, invalidations):
+        """Invalidates the keys a backend announced changes to
+            :param invalidations (list): as InvalidationFeed.feed() returns
+        """
+
+        for keys in invalidations:
+            if keys is None:
+                self._flush()
+                continue
+            self.versions.bump(keys)
+            for key in keys:
+                self._drop(key)
+
+    def _flush(self):
+        """Empties both caches & voids every fetch in flight, for when it
+            isn't known what changed in Redis
+        """
+
+        self.versions.bump_all()
+        self.cache.clear()
+        if self.negative_cache is not None:
+            self.negative_cache.clear()
+
+    def _invalidation_down(self):
+        """Whether a backend's changes aren't being announced, so nothing
+            fetched now can be cached
+        """
+
+        return any(feed.conn is None for feed in self.feeds)
+
+    def _known_absent(self, key):
+        """Checks the negative cache for a key Redis recently had no value for"""
+
+        if self.negative_cache is None:
+            return False
+        # Read without the lock: a racing reset can only make the filter
+        # miss a key, which costs a trip to Redis, never a wrong reply
+        if self.absent_filter is not None and key not in self.absent_filter:
+            with self.absent_lock:
+                self.filtered += 1
+            return False
+        return self.negative_cache.get(key) is not None
+
+    def _remember_absent(self, key):
+        if self.negative_cache is None:
+            return
+        self.negative_cache.set(key, True)
+        if self.absent_filter is not None:
+            with self.absent_lock:
+                self.absent_filter.add(key)
+
+    def stats(self):
+        """Cache stats, with negative entries reported separately
+            :returns: dict with 'cache' & (if enabled) 'negative_cache' stats
+        """
+
+        stats = {'cache': self.cache.stats()}
+        if self.refresher is not None:
+            stats['refresh'] = self.refresher.stats()
+        if self.pass_writes:
+            stats['writes'] = self.versions.stats()
+        if self.feeds:
+            stats['invalidation'] = dict(
+                (name, sum(feed.stats()[name] for feed in self.feeds))
+                for name in self.feeds[0].stats()
+            )
+        replica_sets = dict(
+            (node, backend.stats())
+            for node, backend in self.backends.iteritems()
+            if isinstance(backend, ReplicaSet)
+        )
+        if replica_sets:
+            stats['replicas'] = replica_sets
+        if self.negative_cache is not None:
+            negative = self.negative_cache.stats()
+            if self.absent_filter is not None:
+                # Lookups the filter screened out were misses too
+                with self.absent_lock:
+                    negative['misses'] += self.filtered
+                    negative['filtered'] = self.filtered
+                    negative['filter_resets'] = self.absent_filter.resets
+            stats['negative_cache'] = negative
+        return stats
+
+    def info(self, section=None):
+        """Reply to the STATS/INFO command
+            :param section (str): only report this section, e.g. "latency"
+        """
+
+        return self.metrics.info(self.stats(), section)
+
+    def prometheus(self):
+        return self.metrics.prometheus(self.stats())
+
+    def _send_to_redis(self, backend, command, stream_to=None, replies=1):
+        return backend.call(command, stream_to, self.stream_threshold, replies)
+
+    def _open_connection(self, host=None, port=None, timeout=30):
+
+        if not host:
+            host = socket.gethostname()
+        if not port:
+            raise TypeError("No port for listening socket passed in")
+        try:
+            my_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            my_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            my_socket.settimeout(timeout)
+            my_socket.bind((host, port))
+            my_socket.listen(DEFAULT_BACKLOG)
+            print "Listening on %s:%s" % (host, port)
+        except socket.error, (value, msg):
+            if my_socket:
+                    my_socket.close()
+            print "Could not open socket: ", msg
+            sys.exit(1)
+        return my_socket
+
+
+if __name__ == "__main__":
+
+    parser = ArgumentParser()
+    parser.add_argument(
+        '--addr',
+        type=str,
+        dest='addr',
+        default='',
+        action='store',
+        required=False,
+        help='Enter addr of backing Redis (Defaults to '')',
+    )
+
+    parser.add_argument(
+        '--ttl',
+        type=int,
+        dest='ttl',
+        default=7200,
+        action='store',
+        required=False,
+        help='Enter TTL (in sec. for keys in cache)',
+    )
+
+    parser.add_argument(
+        '--capacity',
+        type=int,
+        dest='capacity',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter max. # of cache keys before LRU eviction (Defaults to %s, or no limit with --max-memory)' % DEFAULT_CAPACITY,
+    )
+
+    parser.add_argument(
+        '--max-memory',
+        type=int,
+        dest='max_memory',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter max. approx. bytes used by the cache before LRU eviction',
+    )
+
+    parser.add_argument(
+        '--max-entry-fraction',
+        type=float,
+        dest='max_entry_fraction',
+        default=0.5,
+        action='store',
+        required=False,
+        help='Enter largest fraction of --max-memory a single entry may use',
+    )
+
+    parser.add_argument(
+        '--pool-size',
+        type=int,
+        dest='pool_size',
+        default=8,
+        action='store',
+        required=False,
+        help='Enter max. # of connections to backing Redis',
+    )
+
+    parser.add_argument(
+        '--stream-threshold',
+        type=int,
+        dest='stream_threshold',
+        default=1024 * 1024,
+        action='store',
+        required=False,
+        help='Enter size (in bytes) above which values are streamed, not cached',
+    )
+
+    parser.add_argument(
+        '--shards',
+        type=int,
+        dest='shards',
+        default=1,
+        action='store',
+        required=False,
+        help='Enter # of independently locked cache segments (Defaults to 1)',
+    )
+
+    parser.add_argument(
+        '--per-shard-capacity',
+        dest='per_shard_capacity',
+        default=False,
+        action='store_true',
+        required=False,
+        help='Apply --capacity/--max-memory to each shard, not the whole cache',
+    )
+
+    parser.add_argument(
+        '--sweep-interval',
+        type=float,
+        dest='sweep_interval',
+        default=1.0,
+        action='store',
+        required=False,
+        help='Enter seconds between background sweeps of expired cache keys',
+    )
+
+    parser.add_argument(
+        '--negative-ttl',
+        type=int,
+        dest='negative_ttl',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter TTL (in sec.) for remembering keys missing from Redis (Defaults to off)',
+    )
+
+    parser.add_argument(
+        '--negative-capacity',
+        type=int,
+        dest='negative_capacity',
+        default=DEFAULT_NEGATIVE_CAPACITY,
+        action='store',
+        required=False,
+        help='Enter max. # of missing keys remembered, on top of --capacity',
+    )
+
+    parser.add_argument(
+        '--absent-filter',
+        dest='absent_filter',
+        default=False,
+        action='store_true',
+        required=False,
+        help='Screen negative cache lookups with a Bloom filter',
+    )
+
+    parser.add_argument(
+        '--batch-window',
+        type=int,
+        dest='batch_window',
+        default=0,
+        action='store',
+        required=False,
+        help='Enter microseconds a cache miss waits to share an MGET with other misses (Defaults to 0, a GET per miss)',
+    )
+
+    parser.add_argument(
+        '--batch-size',
+        type=int,
+        dest='batch_size',
+        default=DEFAULT_BATCH_SIZE,
+        action='store',
+        required=False,
+        help='Enter max. # of keys per batched MGET',
+    )
+
+    parser.add_argument(
+        '--multiplex',
+        dest='multiplex',
+        default=False,
+        action='store_true',
+        required=False,
+        help='Pipeline all requests over one shared Redis connection instead of --pool-size connections',
+    )
+
+    parser.add_argument(
+        '--max-outstanding',
+        type=int,
+        dest='max_outstanding',
+        default=DEFAULT_MAX_OUTSTANDING,
+        action='store',
+        required=False,
+        help='Enter max. # of requests in flight on the --multiplex connection',
+    )
+
+    parser.add_argument(
+        '--eviction-policy',
+        type=str,
+        dest='eviction_policy',
+        default='lru',
+        choices=sorted(POLICIES),
+        action='store',
+        required=False,
+        help='Enter which cache keys to evict first: lru (default), slru, arc or tinylfu',
+    )
+
+    parser.add_argument(
+        '--grace',
+        type=int,
+        dest='grace',
+        default=0,
+        action='store',
+        required=False,
+        help='Enter # of sec. an expired key is still served while it is refreshed in the background',
+    )
+
+    parser.add_argument(
+        '--refresh-ahead',
+        type=int,
+        dest='refresh_ahead',
+        default=0,
+        action='store',
+        required=False,
+        help='Enter # of sec. before expiry during which a hit refreshes the key in the background',
+    )
+
+    parser.add_argument(
+        '--compress-threshold',
+        type=int,
+        dest='compress_threshold',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter min. size (in bytes) of a value to cache it zlib-compressed (Defaults to off)',
+    )
+
+    parser.add_argument(
+        '--compress-level',
+        type=int,
+        dest='compress_level',
+        default=DEFAULT_LEVEL,
+        action='store',
+        required=False,
+        help='Enter zlib level for --compress-threshold, 1 (fastest) to 9 (smallest) (Defaults to %s)' % DEFAULT_LEVEL,
+    )
+
+    parser.add_argument(
+        '--compact-cache',
+        dest='compact_cache',
+        default=False,
+        action='store_true',
+        required=False,
+        help='Keep the cache in a compact store, with less memory per key & faster hits (lru eviction policy only)',
+    )
+
+    parser.add_argument(
+        '--pass-writes',
+        dest='pass_writes',
+        default=False,
+        action='store_true',
+        required=False,
+        help='Pass write commands (SET, DEL, EXPIRE, ...) through to Redis, invalidating the keys they write to',
+    )
+
+    parser.add_argument(
+        '--invalidation',
+        type=str,
+        dest='invalidation',
+        default=None,
+        choices=INVALIDATION_MODES,
+        action='store',
+        required=False,
+        help='Enter how Redis announces changed keys to the proxy: tracking (CLIENT TRACKING, Redis 6+) or keyspace (keyspace notifications) (Defaults to relying on the TTL)',
+    )
+
+    parser.add_argument(
+        '--tracking-prefix',
+        type=str,
+        dest='tracking_prefixes',
+        default=[],
+        action='append',
+        required=False,
+        help='Enter a key prefix to track with --invalidation tracking; may be given more than once (Defaults to all keys)',
+    )
+
+    parser.add_argument(
+        '--key-ttl',
+        dest='key_ttl',
+        default=False,
+        action='store_true',
+        required=False,
+        help="Fetch each key's PTTL with it & cache it no longer than it has left in Redis (--ttl stays the max.)",
+    )
+
+    parser.add_argument(
+        '--workers',
+        type=int,
+        dest='workers',
+        default=1,
+        action='store',
+        required=False,
+        help='Enter # of worker processes accepting on the same port & sharing one cache (Defaults to 1)',
+    )
+
+    parser.add_argument(
+        '--threads',
+        type=int,
+        dest='threads',
+        default=DEFAULT_THREADS,
+        action='store',
+        required=False,
+        help='Enter # of threads serving client connections, per worker process (Defaults to %s)' % DEFAULT_THREADS,
+    )
+
+    parser.add_argument(
+        '--max-connections',
+        type=int,
+        dest='max_connections',
+        default=DEFAULT_MAX_CONNECTIONS,
+        action='store',
+        required=False,
+        help='Enter max. # of open client connections, per worker process; more are sent an error & closed (Defaults to %s)' % DEFAULT_MAX_CONNECTIONS,
+    )
+
+    parser.add_argument(
+        '--backlog',
+        type=int,
+        dest='backlog',
+        default=DEFAULT_BACKLOG,
+        action='store',
+        required=False,
+        help='Enter max. # of connections waiting to be accepted; capped by net.core.somaxconn (Defaults to %s)' % DEFAULT_BACKLOG,
+    )
+
+    parser.add_argument(
+        '--idle-timeout',
+        type=float,
+        dest='idle_timeout',
+        default=0,
+        action='store',
+        required=False,
+        help='Enter # of seconds after which an idle client connection is closed (Defaults to 0, never)',
+    )
+
+    parser.add_argument(
+        '--slot-size',
+        type=int,
+        dest='slot_size',
+        default=DEFAULT_SLOT_SIZE,
+        action='store',
+        required=False,
+        help='Enter bytes per entry of the --workers shared cache; larger entries are not cached',
+    )
+
+    parser.add_argument(
+        '--backend',
+        type=parse_replica_set,
+        dest='backends',
+        default=None,
+        action='append',
+        required=False,
+        help='Enter host:port of a backing Redis, or host:port,host:port,... for replicas of the same data; repeat to shard keys across several (Defaults to --addr on port 6379)',
+    )
+
+    parser.add_argument(
+        '--metrics-port',
+        type=int,
+        dest='metrics_port',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter port to serve Prometheus metrics on, at /metrics; each --workers worker uses the next port up (Defaults to off)',
+    )
+
+    parser.add_argument(
+        '--replica-timeout',
+        type=float,
+        dest='replica_timeout',
+        default=DEFAULT_REPLICA_TIMEOUT,
+        action='store',
+        required=False,
+        help='Enter seconds a replica may take to reply before it is ejected',
+    )
+
+    parser.add_argument(
+        '--probe-interval',
+        type=float,
+        dest='probe_interval',
+        default=DEFAULT_PROBE_INTERVAL,
+        action='store',
+        required=False,
+        help='Enter seconds between PINGs of ejected replicas',
+    )
+
+    parser.add_argument(
+        '--snapshot',
+        type=str,
+        dest='snapshot',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter file to save the cache to on shutdown & load it from on startup (Defaults to off)',
+    )
+
+    parser.add_argument(
+        '--snapshot-interval',
+        type=float,
+        dest='snapshot_interval',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter seconds between saves of the cache to --snapshot while running (Defaults to only on shutdown)',
+    )
+
+    parser.add_argument(
+        '--warm-keys',
+        type=str,
+        dest='warm_keys',
+        default=None,
+        action='store',
+        required=False,
+        help='Enter file of keys, one per line, to fetch into the cache before accepting clients',
+    )
+
+    args = parser.parse_args()
+    if not args.capacity and not args.max_memory:
+        args.capacity = DEFAULT_CAPACITY
+    if args.workers > 1 and (args.eviction_policy != 'lru' or args.shards > 1):
+        parser.error("--workers only supports the lru eviction policy, without --shards")
+    if args.workers > 1 and args.compress_threshold:
+        parser.error("--compress-threshold isn't supported with --workers")
+    if args.compact_cache and (args.eviction_policy != 'lru' or args.workers > 1):
+        parser.error("--compact-cache only supports the lru eviction policy, without --workers")
+    if args.tracking_prefixes and args.invalidation != 'tracking':
+        parser.error("--tracking-prefix needs --invalidation tracking")
+
+    cache = None
+    versions = None
+    if args.workers > 1:
+        # One cache for all workers, so capacity isn't multiplied by them
+        cache = SharedLRUCache(
+            args.capacity,
+            args.ttl,
+            args.max_memory,
+            args.slot_size,
+            args.grace,
+            args.refresh_ahead,
+        )
+        # A write through one worker must void fetches in flight in the others
+        versions = KeyVersions(shared=True)
+
+    def serve(worker_id=None):
+        # So the cache is saved on SIGTERM, as on CTRL-C
+        stop_on_sigterm()
+        redis_proxy = RedisProxy(
+            host_addr=args.addr,
+            ttl=args.ttl,
+            capacity=args.capacity,
+            pool_size=args.pool_size,
+            stream_threshold=args.stream_threshold,
+            max_memory=args.max_memory,
+            max_entry_fraction=args.max_entry_fraction,
+            shards=args.shards,
+            per_shard_capacity=args.per_shard_capacity,
+            negative_ttl=args.negative_ttl,
+            negative_capacity=args.negative_capacity,
+            absent_filter=args.absent_filter,
+            batch_window=args.batch_window / 1e6,
+            batch_size=args.batch_size,
+            multiplex=args.multiplex,
+            max_outstanding=args.max_outstanding,
+            eviction_policy=args.eviction_policy,
+            grace=args.grace,
+            refresh_ahead=args.refresh_ahead,
+            cache=cache,
+            backends=args.backends,
+            replica_timeout=args.replica_timeout,
+            probe_interval=args.probe_interval,
+            compress_threshold=args.compress_threshold,
+            compress_level=args.compress_level,
+            compact_cache=args.compact_cache,
+            pass_writes=args.pass_writes,
+            versions=versions,
+            invalidation=args.invalidation,
+            tracking_prefixes=args.tracking_prefixes,
+            key_ttl=args.key_ttl,
+        )
+
+        # Workers share one cache; one of them sweeping, loading & saving
+        # it is enough
+        snapshotter = None
+        if not worker_id:
+            ExpirySweeper(redis_proxy.cache, args.sweep_interval).start()
+            if args.snapshot:
+                loaded, skipped = load_snapshot(redis_proxy.cache, args.snapshot)
+                print "Loaded %s keys from %s (%s had expired)" % (loaded, args.snapshot, skipped)
+                if args.snapshot_interval:
+                    snapshotter = Snapshotter(redis_proxy.cache, args.snapshot, args.snapshot_interval)
+                    snapshotter.start()
+            if args.warm_keys:
+                keys = read_keys(args.warm_keys)
+                print "Warmed %s of %s keys from %s" % (redis_proxy.warm(keys), len(keys), args.warm_keys)
+        if redis_proxy.negative_cache is not None:
+            ExpirySweeper(redis_proxy.negative_cache, args.sweep_interval).start()
+        if args.metrics_port:
+            # Each worker has its own counts, so each gets its own port
+            start_metrics_server(('', args.metrics_port + (worker_id or 0)), redis_proxy.prometheus)
+
+        CLIENT_HOST, CLIENT_PORT = "localhost", 5555
+        server = ThreadedTCPServer(
+            (CLIENT_HOST, CLIENT_PORT),
+            ThreadedTCPRequestHandler,
+            reuse_port=cache is not None,
+            threads=args.threads,
+            max_connections=args.max_connections,
+            backlog=args.backlog,
+            idle_timeout=args.idle_timeout or None,
+        )
+        server.proxy = redis_proxy
+        ip, port = server.server_address
+
+        server_thread = threading.Thread(target=server.serve_forever)
+        server_thread.daemon = True
+        server_thread.start()
+
+        while True:
+            try:
+                print "Serving RedisProxy on %s:%s" % (CLIENT_HOST, port)
+                time.sleep(10)
+            except KeyboardInterrupt:
+                server.shutdown()
+                server.server_close()
+                if snapshotter is not None:
+                    # So its save can't race the last one
+                    snapshotter.stop()
+                    snapshotter.join()
+                if args.snapshot and not worker_id:
+                    saved = save_snapshot(redis_proxy.cache, args.snapshot)
+                    print "Saved %s keys to %s" % (saved, args.snapshot)
+                print "RedisProxy is shutdown. Exiting."
+                sys.exit(1)
+
+    if args.workers > 1:
+        fork_workers(args.workers, serve)
+    else:
+        serve()
@@ -1,12 +1,52 @@
+from functools import partial
+import socket
+import threading
 import time
 import mock
 import unittest
 
 from threaded_proxy import (
+    ExpirySweeper,
+    FetchTimeoutError,
     LastUpdatedDict,
     LRUCache,
+    MissBatcher,
+    MultiplexedRedisConnection,
+    PoolTimeoutError,
+    RedisConnectionPool,
     RedisProxy,
+    Refresher,
+    ReplicaSet,
+    ShardedLRUCache,
+    SingleFlight,
+    STREAMED,
+    ThreadedTCPRequestHandler,
+    ThreadedTCPServer,
 )
+from compression import CompressedValue, Compressor
+from metrics import Metrics
+from resp import encode_command, RedisConnection, RedisError, RequestParser, StatusReply
+
+
+
+def fake_recv_into(*chunks):
+    """Fakes socket.recv_into, handing out chunks (or raising them, if they
+        are exceptions) in order
+    """
+
+    chunks = list(chunks)
+
+    def recv_into(buf, nbytes=0):
+        chunk = chunks.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+        size = min(nbytes or len(buf), len(buf))
+        if len(chunk) > size:
+            chunk, rest = chunk[:size], chunk[size:]
+            chunks.insert(0, rest)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+    return recv_into
 
 
 class TestLastUpdatedDict(unittest.TestCase):
@@ -62,16 +102,16 @@ class TestLRUCache(unittest.TestCase):
         )
 
 
-    @mock.patch('threaded_proxy.datetime')
-    def test_timestamp_added_with_set(self, dt_mock):
-        """Test that correct datetime is added for inserted data"""
+    @mock.patch('threaded_proxy.monotonic')
+    def test_deadline_added_with_set(self, clock_mock):
+        """Test that inserted data expires TTL after the monotonic clock's now"""
 
-        dt_mock.now.return_value = "2017-09-25 00:00:00"
+        clock_mock.return_value = 1000.0
 
         testcache = LRUCache(capacity=100, ttl=7200)
         testcache.set('radish', 'moo')
-        val, timestamp = testcache.data['radish']
-        self.assertEqual(timestamp, "2017-09-25 00:00:00")
+        val, deadline = testcache.data['radish']
+        self.assertEqual(deadline, (1000 + 7200) * 1000)
 
     def test_get_not_in_cache_returns_None(self):
         """Test that getting a nonexistent value returns None"""
@@ -96,6 +136,290 @@ class TestLRUCache(unittest.TestCase):
         testcache.set('radish', 'moo')
         self.assertEqual(testcache.get('radish'), 'moo')
 
+    @mock.patch('threaded_proxy.monotonic')
+    def test_expired_entry_removed_on_access(self, clock_mock):
+        """Test that an expired get drops the entry & counts an expiration"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=3, ttl=10)
+        testcache.set('radish', 'moo')
+
+        clock_mock.return_value = 1009.999
+        self.assertEqual(testcache.get('radish'), 'moo')
+        clock_mock.return_value = 1010.0
+        self.assertIsNone(testcache.get('radish'))
+
+        self.assertNotIn('radish', testcache.data)
+        self.assertEqual(testcache.size, 0)
+        self.assertEqual(testcache.stats()['expirations'], 1)
+        self.assertEqual(testcache.stats()['evictions'], 0)
+
+    @mock.patch('threaded_proxy.monotonic')
+    def test_stale_entry_served_within_grace(self, clock_mock):
+        """Test that an expired entry is returned, flagged for a refresh,
+            until its grace period ends
+        """
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=3, ttl=10, grace=5)
+        testcache.set('radish', 'moo')
+
+        clock_mock.return_value = 1012.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', True))
+        self.assertEqual(testcache.stats()['stale_hits'], 1)
+
+        clock_mock.return_value = 1015.0
+        self.assertEqual(testcache.lookup('radish'), (None, False))
+        self.assertEqual(testcache.stats()['expirations'], 1)
+
+    @mock.patch('threaded_proxy.monotonic')
+    def test_refresh_ahead_of_expiry(self, clock_mock):
+        """Test that a hit close to the deadline is flagged for a refresh"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=3, ttl=10, refresh_ahead=2)
+        testcache.set('radish', 'moo')
+
+        clock_mock.return_value = 1007.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', False))
+        clock_mock.return_value = 1008.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', True))
+
+    @mock.patch('threaded_proxy.monotonic')
+    def test_hits_do_not_extend_ttl(self, clock_mock):
+        """Test that an entry expires TTL after it was set, however often it's read"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=3, ttl=10)
+        testcache.set('radish', 'moo')
+        clock_mock.return_value = 1005.0
+        testcache.get('radish')
+
+        clock_mock.return_value = 1010.0
+        self.assertIsNone(testcache.get('radish'))
+
+    @mock.patch('threaded_proxy.monotonic')
+    def test_sweep_reclaims_expired_entries(self, clock_mock):
+        """Test that sweep removes expired entries in bounded batches"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=10, ttl=10)
+        for key in ['a', 'b', 'c']:
+            testcache.set(key, 'val')
+        clock_mock.return_value = 1005.0
+        testcache.set('d', 'val')
+
+        clock_mock.return_value = 1012.0
+        self.assertEqual(testcache.sweep(max_entries=2), 2)
+        self.assertEqual(testcache.sweep(), 1)
+        self.assertEqual(testcache.data.keys(), ['d'])
+        self.assertEqual(testcache.stats()['expirations'], 3)
+
+    @mock.patch('threaded_proxy.monotonic')
+    def test_expired_entries_reclaimed_before_eviction(self, clock_mock):
+        """Test that a full cache drops expired entries rather than live ones"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=2, ttl=10)
+        testcache.set('old', 'val')
+        clock_mock.return_value = 1005.0
+        testcache.set('live', 'val')
+
+        clock_mock.return_value = 1011.0
+        testcache.set('new', 'val')
+
+        self.assertEqual(testcache.data.keys(), ['live', 'new'])
+        self.assertEqual(testcache.stats()['evictions'], 0)
+        self.assertEqual(testcache.stats()['expirations'], 1)
+
+    def test_max_memory_only(self):
+        """Test that a cache can be bounded by bytes alone"""
+
+        testcache = LRUCache(ttl=7200, max_memory=10000)
+        testcache.set('radish', 'moo')
+        self.assertEqual(testcache.get('radish'), 'moo')
+
+    @mock.patch('threaded_proxy.ENTRY_OVERHEAD', 0)
+    @mock.patch('threaded_proxy.sys.getsizeof', len)
+    def test_max_memory_evicts_until_entry_fits(self):
+        """Test that LRU entries are evicted until a new entry fits the budget"""
+
+        testcache = LRUCache(ttl=7200, max_memory=30, max_entry_fraction=1)
+        testcache.set('a', 'x' * 9)
+        testcache.set('b', 'x' * 9)
+        testcache.set('c', 'x' * 9)
+        self.assertEqual(testcache.size, 30)
+
+        testcache.set('d', 'x' * 19)
+        self.assertEqual(testcache.data.keys(), ['c', 'd'])
+        self.assertEqual(testcache.size, 30)
+        self.assertEqual(testcache.stats()['evictions'], 2)
+
+    @mock.patch('threaded_proxy.ENTRY_OVERHEAD', 0)
+    @mock.patch('threaded_proxy.sys.getsizeof', len)
+    def test_oversized_entry_refused(self):
+        """Test that entries over max_entry_fraction of the budget aren't cached"""
+
+        testcache = LRUCache(ttl=7200, max_memory=100, max_entry_fraction=0.25)
+        testcache.set('a', 'small')
+        testcache.set('big', 'x' * 30)
+        testcache.set('a', 'x' * 30)
+
+        self.assertIsNone(testcache.get('big'))
+        # The old value for a re-set key is dropped, not left stale
+        self.assertIsNone(testcache.get('a'))
+        self.assertEqual(testcache.size, 0)
+        self.assertEqual(testcache.stats()['rejections'], 2)
+
+    def test_updating_key_in_full_cache_keeps_others(self):
+        """Test that re-setting a cached key doesn't evict another key"""
+
+        testcache = LRUCache(capacity=2, ttl=7200)
+        testcache.set('radish', 'moo')
+        testcache.set('rice', 'bap')
+        testcache.set('radish', 'mu')
+
+        self.assertEqual(testcache.get('rice'), 'bap')
+        self.assertEqual(testcache.get('radish'), 'mu')
+        self.assertEqual(testcache.stats()['evictions'], 0)
+
+    def test_large_values_cached_compressed(self):
+        """Test that values over the threshold are kept compressed, counted
+            at their compressed size, & read back whole
+        """
+
+        val = '{"name": "Robert Kevin", "age": 111}' * 50
+        testcache = LRUCache(capacity=5, ttl=7200, compress_threshold=100)
+        plain = LRUCache(capacity=5, ttl=7200)
+        testcache.set('json', val)
+        plain.set('json', val)
+        testcache.set('short', 'bar')
+
+        self.assertEqual(testcache.get('json'), val)
+        self.assertIsInstance(testcache.lookup('json', raw=True)[0], CompressedValue)
+        self.assertEqual(testcache.get('short'), 'bar')
+        self.assertLess(testcache.size, plain.size - len(val) / 2)
+        stats = testcache.stats()
+        self.assertEqual(stats['compressed'], 1)
+        self.assertEqual(stats['decompressed'], 1)
+        self.assertGreater(stats['compression_saved'], len(val) / 2)
+        self.assertEqual(testcache.entries()[0][1], val)
+
+        testcache.delete('json')
+        self.assertEqual(testcache.stats()['compression_saved'], 0)
+
+
+class TestShardedLRUCache(unittest.TestCase):
+
+    def test_get_set_across_shards(self):
+        """Test that every key set is found again, whatever its shard"""
+
+        testcache = ShardedLRUCache(capacity=100, ttl=7200, shards=4)
+        for i in range(20):
+            testcache.set('key%s' % i, 'val%s' % i)
+        for i in range(20):
+            self.assertEqual(testcache.get('key%s' % i), 'val%s' % i)
+        self.assertIsNone(testcache.get('ddeok'))
+        self.assertEqual(testcache.stats()['keys'], 20)
+
+    def test_global_capacity_split_across_shards(self):
+        """Test that a global capacity is divided evenly between shards"""
+
+        testcache = ShardedLRUCache(capacity=10, ttl=7200, shards=4)
+        self.assertEqual([shard.capacity for shard in testcache.shards], [3] * 4)
+
+        testcache = ShardedLRUCache(max_memory=4000, ttl=7200, shards=4)
+        self.assertEqual([shard.max_memory for shard in testcache.shards], [1000] * 4)
+        self.assertEqual(testcache.shards[0].max_entry_fraction, 1.0)
+
+    def test_clear(self):
+        testcache = ShardedLRUCache(capacity=100, ttl=7200, shards=4)
+        for i in range(20):
+            testcache.set('key%s' % i, 'val%s' % i)
+
+        self.assertEqual(testcache.clear(), 20)
+        self.assertEqual(testcache.stats()['keys'], 0)
+        self.assertEqual(testcache.stats()['size'], 0)
+
+    def test_per_shard_capacity(self):
+        """Test that per_shard gives every shard the full capacity"""
+
+        testcache = ShardedLRUCache(capacity=10, ttl=7200, shards=4, per_shard=True)
+        self.assertEqual([shard.capacity for shard in testcache.shards], [10] * 4)
+
+    def test_shard_eviction_is_lru(self):
+        """Test that a full shard evicts its own least recently used key"""
+
+        testcache = ShardedLRUCache(capacity=2, ttl=7200, shards=1)
+        testcache.set('radish', 'moo')
+        testcache.set('rice', 'bap')
+        testcache.get('radish')
+        testcache.set('beef', 'sogogi')
+
+        self.assertIsNone(testcache.get('rice'))
+        self.assertEqual(testcache.get('radish'), 'moo')
+        self.assertEqual(testcache.stats()['evictions'], 1)
+
+    def test_compression_stats_summed(self):
+        testcache = ShardedLRUCache(capacity=100, ttl=7200, shards=4, compress_threshold=10)
+        for i in range(8):
+            testcache.set('key%s' % i, 'val' * 20)
+
+        self.assertEqual(testcache.get('key3'), 'val' * 20)
+        self.assertEqual(testcache.stats()['compressed'], 8)
+
+
+class TestExpirySweeper(unittest.TestCase):
+
+    def test_background_sweep(self):
+        """Test that the sweeper thread reclaims expired entries untouched by gets"""
+
+        testcache = ShardedLRUCache(capacity=100, ttl=0.05, shards=4)
+        for i in range(10):
+            testcache.set('key%s' % i, 'val')
+        sweeper = ExpirySweeper(testcache, interval=0.01)
+        sweeper.start()
+        time.sleep(0.2)
+        sweeper.stop()
+        sweeper.join(1)
+
+        self.assertEqual(testcache.stats()['keys'], 0)
+        self.assertEqual(testcache.stats()['expirations'], 10)
+
+
+class TestRefresher(unittest.TestCase):
+
+    def test_key_queued_once(self):
+        """Test that a key already waiting for a refresh isn't queued again"""
+
+        refresher = Refresher(mock.MagicMock())
+        refresher.request('foo')
+        refresher.request('foo')
+
+        self.assertEqual(refresher.queue.qsize(), 1)
+        self.assertEqual(refresher.stats()['pending'], 1)
+
+    def test_full_queue_drops_requests(self):
+        refresher = Refresher(mock.MagicMock(), max_pending=1)
+        refresher.request('foo')
+        refresher.request('bar')
+
+        self.assertEqual(refresher.stats()['dropped'], 1)
+        self.assertEqual(refresher.stats()['pending'], 1)
+
+    def test_refreshes_in_background(self):
+        fetched = threading.Event()
+        fetch = mock.MagicMock(side_effect=lambda key: fetched.set())
+        refresher = Refresher(fetch)
+        refresher.start()
+        refresher.request('foo')
+
+        self.assertTrue(fetched.wait(1))
+        refresher.stop()
+        refresher.join(1)
+        fetch.assert_called_once_with('foo')
+        self.assertEqual(refresher.stats()['pending'], 0)
+
 
 class RedisProxyTests(unittest.TestCase):
 
@@ -103,40 +427,965 @@ class RedisProxyTests(unittest.TestCase):
     def setUp(self, patched_redis):
         """Sets up a test proxy with mocked Redis and client connections"""
 
+        self.redis_socket = patched_redis.return_value
         self.testproxy = RedisProxy(capacity=5, ttl=7200)
+        # Connections the pool opens after setUp get the same mocked socket
+        self.testproxy._open_redis_connection = patched_redis
         self.testproxy.cache.set('foo', 'bar')
 
     def test_cached_val_returned(self):
         """Test that a value in the proxy's cache is returned, w/o calling Redis"""
 
-        self.testproxy.redis_socket.recv.return_value = "$3\r\nbar\r\n"
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$3\r\nbar\r\n")
 
         cached_val = self.testproxy.get('foo')
 
         self.assertEqual(cached_val, 'bar')
-        self.testproxy.redis_socket.sendall.assert_not_called()
-        self.testproxy.redis_socket.recv.assert_not_called()
+        self.redis_socket.sendall.assert_not_called()
+        self.redis_socket.recv_into.assert_not_called()
 
 
     def test_nil_string_returned_from_Redis(self):
         """Test that a nil string from Redis cause proxy to return None"""
 
         # Mocking out a nil return from backing Redis
-        self.testproxy.redis_socket.recv.return_value = "$-1\r\n"
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$-1\r\n")
 
         self.assertIsNone(self.testproxy.get('blarf'))
-        self.testproxy.redis_socket.sendall.assert_called()
-        self.testproxy.redis_socket.recv.assert_called()
+        self.redis_socket.sendall.assert_called()
+        self.redis_socket.recv_into.assert_called()
 
 
     def test_cache_new_data(self):
         """Test that data fetched from Redis is put into the proxy's cache"""
 
-        self.testproxy.redis_socket.recv.return_value = "$5\r\nblarf\r\n"
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$5\r\nblarf\r\n")
 
         ret_val = self.testproxy.get('baz')
         self.assertEqual(ret_val, self.testproxy.cache.get('baz'))
 
+    def test_hit_and_miss_latency_recorded(self):
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$3\r\nqux\r\n")
+
+        self.testproxy.get('foo')
+        self.testproxy.get('baz')
+        self.testproxy.mget(['foo'])
+
+        self.assertEqual(self.testproxy.metrics.hit_latency.count, 2)
+        self.assertEqual(self.testproxy.metrics.miss_latency.count, 1)
+        self.assertIn("keyspace_hits:2\r\n", self.testproxy.info())
+
+    def test_broken_connection_retried(self):
+        """Test that a socket error drops the connection & retries the GET once"""
+
+        self.redis_socket.recv_into.side_effect = fake_recv_into(socket.error("reset"), "$5\r\nblarf\r\n")
+
+        self.assertEqual(self.testproxy.get('baz'), 'blarf')
+        self.redis_socket.close.assert_called_once_with()
+        self.assertEqual(self.testproxy.backends.values()[0].pool.stats()['reconnects'], 1)
+
+    def test_replica_set_not_retried_again(self):
+        """Test that a GET or MGET a ReplicaSet already retried on another
+            replica isn't retried on top of that
+        """
+
+        first, second = fake_replica(*[socket.error("reset")] * 4), fake_replica(*[socket.error("reset")] * 4)
+        node = self.testproxy.backends.keys()[0]
+        self.testproxy.backends[node] = ReplicaSet([('r0', first), ('r1', second)], probe_interval=None)
+
+        with self.assertRaises(socket.error):
+            self.testproxy._send_get(self.testproxy.backends[node], 'baz')
+        self.assertEqual(first.call.call_count + second.call.call_count, 2)
+        for replica in self.testproxy.backends[node].replicas:
+            replica.healthy = True
+        with self.assertRaises(socket.error):
+            self.testproxy._send_mget(self.testproxy.backends[node], ['baz', 'blarf'])
+        self.assertEqual(first.call.call_count + second.call.call_count, 4)
+
+    def test_shared_streamed_value_fetched_again(self):
+        """Test that a value streamed to another thread's client is re-fetched"""
+
+        self.testproxy.single_flight.do = mock.MagicMock(return_value=(STREAMED, True))
+        self.testproxy._fetch = mock.MagicMock(return_value=STREAMED)
+        stream = mock.MagicMock()
+
+        self.assertIs(self.testproxy.get('blob', stream), STREAMED)
+        self.testproxy._fetch.assert_called_once_with('blob', stream)
+
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_nil_reply_negatively_cached(self, patched_redis):
+        """Test that a missing key is remembered apart from the value cache"""
+
+        testproxy = RedisProxy(capacity=5, ttl=7200, negative_ttl=60, shards=4)
+        testproxy._open_redis_connection = patched_redis
+        patched_redis.return_value.recv_into.side_effect = fake_recv_into("$-1\r\n")
+
+        self.assertIsNone(testproxy.get('blarf'))
+        self.assertIsNone(testproxy.get('blarf'))
+
+        self.assertEqual(patched_redis.return_value.sendall.call_count, 1)
+        stats = testproxy.stats()
+        self.assertEqual(stats['negative_cache']['keys'], 1)
+        self.assertEqual(stats['negative_cache']['hits'], 1)
+        self.assertEqual(stats['cache']['keys'], 0)
+
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_multiplexed_miss_cached(self, patched_redis):
+        """Test that a miss sent over the multiplexed connection is cached"""
+
+        server, patched_redis.return_value = socket.socketpair()
+        self.addCleanup(server.close)
+        testproxy = RedisProxy(capacity=5, ttl=7200, multiplex=True)
+
+        def answer():
+            server.recv(4096)
+            server.sendall("$3\r\nqux\r\n")
+        threading.Thread(target=answer).start()
+
+        self.assertEqual(testproxy.get('baz', mock.MagicMock()), 'qux')
+        self.assertEqual(testproxy.cache.get('baz'), 'qux')
+        self.assertEqual(testproxy.backends.values()[0].mux.stats()['requests'], 1)
+
+    @mock.patch('threaded_proxy.monotonic')
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_stale_hit_refreshed_in_background(self, patched_redis, clock_mock):
+        """Test that a stale value is returned at once, & re-fetched by the
+            refresher thread
+        """
+
+        clock_mock.return_value = 100
+        testproxy = RedisProxy(capacity=5, ttl=10, grace=60)
+        testproxy.refresher.stop()
+        testproxy.refresher.join(1)
+        testproxy._open_redis_connection = patched_redis
+        patched_redis.return_value.recv_into.side_effect = fake_recv_into("$3\r\nqux\r\n")
+        testproxy.cache.set('foo', 'bar')
+
+        clock_mock.return_value = 115
+        self.assertEqual(testproxy.get('foo'), 'bar')
+        patched_redis.return_value.sendall.assert_not_called()
+        self.assertEqual(testproxy.refresher.queue.get_nowait(), 'foo')
+
+        testproxy._refresh('foo')
+        self.assertEqual(testproxy.cache.lookup('foo'), ('qux', False))
+
+    def test_mget_fetches_only_missing_keys(self):
+        """Test that MGET answers cached keys locally & fetches the rest at once"""
+
+        self.redis_socket.recv_into.side_effect = fake_recv_into("*2\r\n$3\r\nqux\r\n$-1\r\n")
+
+        vals = self.testproxy.mget(['foo', 'baz', 'blarf', 'baz'])
+
+        self.assertEqual(vals, ['bar', 'qux', None, 'qux'])
+        self.redis_socket.sendall.assert_called_once_with(
+            "*3\r\n$4\r\nMGET\r\n$3\r\nbaz\r\n$5\r\nblarf\r\n",
+        )
+        self.assertEqual(self.testproxy.cache.get('baz'), 'qux')
+
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_mget_split_across_backends(self, patched_redis):
+        """Test that an MGET's missing keys go to the backend each hashes
+            to, & the replies are merged back in order
+        """
+
+        sockets = {'a': mock.MagicMock(), 'b': mock.MagicMock()}
+        patched_redis.side_effect = lambda host, port, timeout: sockets[host]
+        testproxy = RedisProxy(capacity=5, ttl=7200, backends=[('a', 6379), ('b', 6379)])
+        sockets['a'].recv_into.side_effect = fake_recv_into("*1\r\n$3\r\nqux\r\n")
+        sockets['b'].recv_into.side_effect = fake_recv_into("*1\r\n$-1\r\n")
+
+        self.assertEqual(testproxy.mget(['zap', 'baz']), [None, 'qux'])
+        sockets['a'].sendall.assert_called_once_with("*2\r\n$4\r\nMGET\r\n$3\r\nbaz\r\n")
+        sockets['b'].sendall.assert_called_once_with("*2\r\n$4\r\nMGET\r\n$3\r\nzap\r\n")
+
+    def test_warm_fetches_keys_in_batches(self):
+        self.redis_socket.recv_into.side_effect = fake_recv_into(
+            "*2\r\n$1\r\n1\r\n$-1\r\n*1\r\n$1\r\n3\r\n",
+        )
+
+        self.assertEqual(self.testproxy.warm(['a', 'b', 'c'], batch_size=2), 2)
+        self.assertEqual(self.redis_socket.sendall.call_count, 2)
+        self.assertEqual(self.testproxy.cache.get('c'), '3')
+        self.assertEqual(self.testproxy.stats()['cache']['misses'], 0)
+
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_key_ttl_fetched_with_get(self, patched_redis):
+        """Test that a miss pipelines a PTTL after its GET, & caches the value
+            no longer than Redis keeps it
+        """
+
+        testproxy = RedisProxy(capacity=5, ttl=7200, key_ttl=True)
+        patched_redis.return_value.recv_into.side_effect = fake_recv_into("$3\r\nqux\r\n:5000\r\n")
+
+        self.assertEqual(testproxy.get('baz'), 'qux')
+        patched_redis.return_value.sendall.assert_called_once_with(
+            encode_command("GET", "baz") + encode_command("PTTL", "baz"),
+        )
+        key, val, ttl_ms = testproxy.cache.entries()[0]
+        self.assertTrue(4000 < ttl_ms <= 5000)
+
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_key_ttl_fetched_with_mget(self, patched_redis):
+        """Test that keys without an expiry keep the cache's TTL, & keys gone
+            by the time of their PTTL aren't cached
+        """
+
+        testproxy = RedisProxy(capacity=5, ttl=60, key_ttl=True)
+        patched_redis.return_value.recv_into.side_effect = fake_recv_into(
+            "*3\r\n$1\r\n1\r\n$1\r\n2\r\n$1\r\n3\r\n:5000\r\n:-1\r\n:-2\r\n",
+        )
+
+        self.assertEqual(testproxy.mget(['a', 'b', 'c']), ['1', '2', '3'])
+        ttls = dict((key, ttl_ms) for key, val, ttl_ms in testproxy.cache.entries())
+        self.assertTrue(4000 < ttls['a'] <= 5000)
+        self.assertTrue(59000 < ttls['b'] <= 60000)
+        self.assertNotIn('c', ttls)
+
+    def test_batched_miss_cached(self):
+        """Test that a miss fetched through the batcher is cached"""
+
+        backend = self.testproxy.backends.values()[0]
+        backend.batcher = MissBatcher(partial(self.testproxy._send_mget, backend), window=0.01)
+        self.redis_socket.recv_into.side_effect = fake_recv_into("*1\r\n$3\r\nqux\r\n")
+
+        self.assertEqual(self.testproxy.get('baz', mock.MagicMock()), 'qux')
+        self.assertEqual(self.testproxy.cache.get('baz'), 'qux')
+        self.redis_socket.sendall.assert_called_once_with("*2\r\n$4\r\nMGET\r\n$3\r\nbaz\r\n")
+
+    def test_write_invalidates_key(self):
+        self.redis_socket.recv_into.side_effect = fake_recv_into("+OK\r\n")
+
+        self.assertEqual(self.testproxy.write(['SET', 'foo', 'baz']), 'OK')
+        self.redis_socket.sendall.assert_called_once_with(encode_command('SET', 'foo', 'baz'))
+        self.assertIsNone(self.testproxy.cache.get('foo'))
+        self.assertEqual(self.testproxy.versions.stats()['invalidated_keys'], 1)
+
+    def test_write_to_closed_connection_returns_error(self):
+        self.redis_socket.recv_into.side_effect = fake_recv_into("")
+        reply = self.testproxy.write(['SET', 'foo', 'baz'])
+
+        self.assertIsInstance(reply, RedisError)
+        self.assertEqual(str(reply), "Redis connection error: Connection closed by Redis")
+        self.assertIsNone(self.testproxy.cache.get('foo'))
+
+    def test_fetch_racing_write_not_cached(self):
+        """Test that a value fetched while a write to its key went through
+            is returned, but not cached
+        """
+
+        recv_into = fake_recv_into("$3\r\nold\r\n")
+
+        def write_lands_meanwhile(buf, nbytes=0):
+            self.testproxy._invalidate(['baz'])
+            return recv_into(buf, nbytes)
+        self.redis_socket.recv_into.side_effect = write_lands_meanwhile
+
+        self.assertEqual(self.testproxy.get('baz'), 'old')
+        self.assertIsNone(self.testproxy.cache.get('baz'))
+        self.assertEqual(self.testproxy.versions.stats()['voided_fetches'], 1)
+
+    def test_cross_backend_write_refused(self):
+        self.testproxy.ring.split = lambda keys: {'a': keys[:1], 'b': keys[1:]}
+
+        reply = self.testproxy.write(['DEL', 'foo', 'baz'])
+        self.assertIsInstance(reply, RedisError)
+        self.assertTrue(str(reply).startswith('CROSSSLOT'))
+        self.redis_socket.sendall.assert_not_called()
+        self.assertEqual(self.testproxy.cache.get('foo'), 'bar')
+
+
+class TestThreadedTCPRequestHandler(unittest.TestCase):
+
+    def _handle(self, *reads):
+        request = mock.MagicMock()
+        request.recv.side_effect = list(reads) + [""]
+        server = mock.MagicMock()
+        server.proxy.get.side_effect = lambda key, stream_to=None: {'foo': 'bar'}.get(key)
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server)
+        return request
+
+    def test_pipelined_replies_sent_in_one_write(self):
+        """Test that replies to every command in one read go out together"""
+
+        request = self._handle("*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n*2\r\n$3\r\nGET\r\n$3\r\nbaz\r\n")
+
+        self.assertEqual(
+            request.sendall.call_args_list[1],
+            mock.call("$3\r\nbar\r\n$-1\r\n"),
+        )
+
+    def test_quit_stops_processing(self):
+        """Test that commands pipelined after QUIT are not run"""
+
+        request = self._handle("GET foo\nQUIT\nGET foo\n")
+
+        request.sendall.assert_called_with("bar\n\rBye\n")
+        request.close.assert_called_once_with()
+
+    def test_info_answered_by_proxy(self):
+        request = mock.MagicMock()
+        request.recv.side_effect = ["INFO latency\n", ""]
+        server = mock.MagicMock()
+        server.proxy.info.return_value = "# Latency\r\n"
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server)
+
+        server.proxy.info.assert_called_once_with("latency")
+        request.sendall.assert_called_with("# Latency\r\n\n\r")
+
+    def test_connection_counted(self):
+        """Test that a connection, its commands & its bytes are counted, &
+            that it stops counting as connected once it closes
+        """
+
+        request = mock.MagicMock()
+        request.recv.side_effect = ["GET foo\n", ""]
+        server = mock.MagicMock()
+        server.proxy.get.return_value = 'bar'
+        server.proxy.metrics = Metrics()
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server)
+
+        metrics = server.proxy.metrics
+        self.assertEqual(metrics.connections_received, 1)
+        self.assertEqual(metrics.connected_clients, 0)
+        self.assertEqual(metrics.commands, 1)
+        self.assertEqual(metrics.bytes_in, 8)
+        self.assertEqual(metrics.bytes_out, sum(len(c[0][0]) for c in request.sendall.call_args_list))
+
+    def test_compressed_values_passed_through(self):
+        """Test that after CLIENT COMPRESSION ON, values come back tagged, &
+            compressed ones as they're cached
+        """
+
+        compressed = Compressor(threshold=10).compress('bar' * 20)
+        request = mock.MagicMock()
+        request.recv.side_effect = [
+            encode_command("CLIENT", "COMPRESSION", "ON") + encode_command("GET", "foo")
+            + encode_command("MGET", "foo", "baz"),
+            "",
+        ]
+        server = mock.MagicMock()
+        server.proxy.get.return_value = compressed
+        server.proxy.mget.return_value = [compressed, 'qux']
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server)
+
+        server.proxy.get.assert_called_once_with('foo', raw=True)
+        server.proxy.mget.assert_called_once_with(['foo', 'baz'], raw=True)
+        tagged = 'z' + compressed[4:]
+        request.sendall.assert_called_with(
+            "+OK\r\n$%d\r\n%s\r\n*2\r\n$%d\r\n%s\r\n$4\r\n=qux\r\n" % (
+                len(tagged), tagged, len(tagged), tagged,
+            ),
+        )
+
+
+    def test_writes_passed_through(self):
+        request = mock.MagicMock()
+        request.recv.side_effect = ["SET foo 1\nINCR n\n", ""]
+        server = mock.MagicMock()
+        server.proxy.pass_writes = True
+        server.proxy.write.return_value = StatusReply('OK')
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server)
+
+        server.proxy.write.assert_any_call(['SET', 'foo', '1'])
+        request.sendall.assert_called_with("OK\n\rOK\n\r")
+
+    def test_writes_refused_unless_passed_through(self):
+        request = mock.MagicMock()
+        request.recv.side_effect = ["SET foo 1\n", ""]
+        server = mock.MagicMock()
+        server.proxy.pass_writes = False
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server)
+
+        server.proxy.write.assert_not_called()
+        request.sendall.assert_called_with("Please use Redis 'GET key' command format\n\r")
+
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_pool_timeout_answered(self, patched_redis):
+        """Test that GETs & MGETs that find no free Redis connection get an
+            error, & the client stays connected
+        """
+
+        testproxy = RedisProxy(capacity=5, ttl=7200, timeout=0.05, pool_size=1)
+        testproxy.backends.values()[0].pool.acquire()
+        request = mock.MagicMock()
+        request.recv.side_effect = ["GET baz\nMGET baz qux\nINFO clients\n", ""]
+        server = mock.MagicMock()
+        server.proxy = testproxy
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server)
+
+        replies = request.sendall.call_args_list[1][0][0]
+        self.assertTrue(replies.startswith("Redis error: "))
+        self.assertEqual(replies.count("Redis error: "), 2)
+        self.assertIn("# Clients", replies)
+
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_batch_timeout_answered(self, patched_redis):
+        """Test that a GET waiting on a batched fetch that takes too long
+            gets an error
+        """
+
+        testproxy = RedisProxy(capacity=5, ttl=7200, timeout=0.05, batch_window=0.5)
+        batcher = testproxy.backends.values()[0].batcher
+        batcher.fetch_many = mock.MagicMock(side_effect=lambda keys: [(None, None)] * len(keys))
+        # Opens the batch & holds it for the window
+        leader = threading.Thread(target=testproxy.get, args=('baz',))
+        leader.start()
+        self.addCleanup(leader.join)
+        while batcher.open_batch is None:
+            time.sleep(0.001)
+        request = mock.MagicMock()
+        request.recv.side_effect = ["GET qux\n", ""]
+        server = mock.MagicMock()
+        server.proxy = testproxy
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server)
+
+        request.sendall.assert_called_with("Redis error: Timed out waiting on batched fetch of qux\n\r")
+
+    @mock.patch('threaded_proxy.RedisProxy._open_redis_connection')
+    def test_multiplexed_mget_timeout_answered(self, patched_redis):
+        """Test that an MGET Redis doesn't answer in time gets an error"""
+
+        server, patched_redis.return_value = socket.socketpair()
+        self.addCleanup(server.close)
+        testproxy = RedisProxy(capacity=5, ttl=7200, timeout=0.05, multiplex=True)
+        request = mock.MagicMock()
+        request.recv.side_effect = ["MGET baz qux\n", ""]
+        server_mock = mock.MagicMock()
+        server_mock.proxy = testproxy
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server_mock)
+
+        request.sendall.assert_called_with("Redis error: Timed out waiting on a reply from Redis\n\r")
+
+    def test_write_connection_error_answered(self):
+        request = mock.MagicMock()
+        request.recv.side_effect = ["SET foo 1\n", ""]
+        server = mock.MagicMock()
+        server.proxy.pass_writes = True
+        server.proxy.write.side_effect = socket.error("Connection reset by peer")
+        ThreadedTCPRequestHandler(request, ('127.0.0.1', 0), server)
+
+        request.sendall.assert_called_with("Redis error: Connection reset by peer\n\r")
+
+
+class TestThreadedTCPServer(unittest.TestCase):
+    """Against a real socket"""
+
+    def start(self, **kwargs):
+        server = ThreadedTCPServer(('127.0.0.1', 0), ThreadedTCPRequestHandler, **kwargs)
+        server.proxy = mock.MagicMock()
+        server.proxy.metrics = Metrics()
+        server.proxy.pass_writes = False
+        server.proxy.get.side_effect = lambda key, stream_to=None: {'foo': 'bar'}.get(key)
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server
+
+    def connect(self, server):
+        client = socket.create_connection(server.server_address)
+        client.settimeout(5)
+        self.addCleanup(client.close)
+        self.assertIn("RedisProxy", client.recv(4096))
+        return client
+
+    def wait_for(self, condition):
+        deadline = time.time() + 5
+        while not condition():
+            self.assertLess(time.time(), deadline)
+            time.sleep(0.01)
+
+    def test_many_connections_served_by_few_threads(self):
+        server = self.start(threads=2, backlog=64)
+        threads = threading.active_count()
+        clients = [self.connect(server) for _ in xrange(20)]
+        for client in clients:
+            client.sendall("GET foo\n")
+        for client in clients:
+            self.assertEqual(client.recv(4096), "bar\n\r")
+
+        self.assertEqual(threading.active_count(), threads)
+        self.assertEqual(server.request_queue_size, 64)
+        self.assertEqual(server.proxy.metrics.connected_clients, 20)
+
+    def test_connection_over_limit_turned_away(self):
+        server = self.start(threads=2, max_connections=2)
+        first = self.connect(server)
+        self.connect(server)
+        refused = socket.create_connection(server.server_address)
+        self.addCleanup(refused.close)
+        refused.settimeout(5)
+
+        self.assertEqual(refused.recv(4096), "-ERR max number of clients reached\r\n")
+        self.assertEqual(refused.recv(4096), "")
+        self.assertEqual(server.proxy.metrics.rejected_connections, 1)
+
+        # Closing a connection makes room for another
+        first.sendall("QUIT\n")
+        self.assertEqual(first.recv(4096), "Bye\n")
+        self.wait_for(lambda: server.connections == 1)
+        self.connect(server).sendall("GET foo\n")
+
+    def test_idle_connection_closed(self):
+        server = self.start(threads=1, idle_timeout=0.2)
+        client = self.connect(server)
+        client.sendall("GET foo\n")
+        self.assertEqual(client.recv(4096), "bar\n\r")
+
+        self.assertEqual(client.recv(4096), "")
+        self.wait_for(lambda: server.proxy.metrics.connected_clients == 0)
+        self.assertEqual(server.connections, 0)
+
+
+class TestSingleFlight(unittest.TestCase):
+
+    def _start_waiter(self, single_flight, key, fetch):
+        results = []
+
+        def wait():
+            try:
+                results.append(single_flight.do(key, fetch))
+            except Exception, e:
+                results.append(e)
+        waiter = threading.Thread(target=wait)
+        waiter.start()
+        # Let the waiter join the in-flight call
+        time.sleep(0.05)
+        return waiter, results
+
+    def test_concurrent_calls_share_one_fetch(self):
+        """Test that a caller arriving mid-fetch gets the leader's result"""
+
+        single_flight = SingleFlight(timeout=5)
+        release = threading.Event()
+        fetch = mock.MagicMock(side_effect=lambda: release.wait() and 'bar')
+
+        leader, leader_results = self._start_waiter(single_flight, 'foo', fetch)
+        waiter, results = self._start_waiter(single_flight, 'foo', fetch)
+        release.set()
+        leader.join(1)
+        waiter.join(1)
+
+        self.assertEqual(leader_results, [('bar', False)])
+        self.assertEqual(results, [('bar', True)])
+        self.assertEqual(fetch.call_count, 1)
+        self.assertEqual(single_flight.coalesced, 1)
+        self.assertEqual(single_flight.calls, {})
+
+    def test_error_propagated_to_waiters(self):
+        """Test that the leader's exception is raised in every waiting caller"""
+
+        single_flight = SingleFlight(timeout=5)
+        release = threading.Event()
+
+        def fetch():
+            release.wait()
+            raise socket.error("reset")
+
+        leader, leader_results = self._start_waiter(single_flight, 'foo', fetch)
+        waiter, results = self._start_waiter(single_flight, 'foo', fetch)
+        release.set()
+        leader.join(1)
+        waiter.join(1)
+
+        self.assertIsInstance(leader_results[0], socket.error)
+        self.assertIsInstance(results[0], socket.error)
+
+    def test_waiter_times_out(self):
+        """Test that a waiter gives up on a slow in-flight fetch"""
+
+        single_flight = SingleFlight(timeout=0.05)
+        release = threading.Event()
+        leader, leader_results = self._start_waiter(single_flight, 'foo', release.wait)
+
+        with self.assertRaises(FetchTimeoutError):
+            single_flight.do('foo', release.wait)
+        release.set()
+        leader.join(1)
+
+    def test_later_call_fetches_again(self):
+        """Test that calls after a fetch finished aren't coalesced"""
+
+        single_flight = SingleFlight()
+        single_flight.do('foo', lambda: 'bar')
+        self.assertEqual(single_flight.do('foo', lambda: 'baz'), ('baz', False))
+        self.assertEqual(single_flight.coalesced, 0)
+
+
+class TestMissBatcher(unittest.TestCase):
+
+    def _start_getters(self, batcher, keys):
+        results = {}
+
+        def get(key):
+            try:
+                results[key] = batcher.get(key)
+            except Exception, e:
+                results[key] = e
+        getters = [threading.Thread(target=get, args=(key,)) for key in keys]
+        for getter in getters:
+            getter.start()
+        for getter in getters:
+            getter.join(1)
+        return results
+
+    def test_concurrent_misses_share_one_mget(self):
+        """Test that misses within the window go out as one batch"""
+
+        fetch_many = mock.MagicMock(side_effect=lambda keys: [key.upper() for key in keys])
+        batcher = MissBatcher(fetch_many, window=0.2, max_keys=3)
+
+        results = self._start_getters(batcher, ['a', 'b', 'c'])
+
+        self.assertEqual(results, {'a': 'A', 'b': 'B', 'c': 'C'})
+        self.assertEqual(fetch_many.call_count, 1)
+        self.assertEqual(sorted(fetch_many.call_args[0][0]), ['a', 'b', 'c'])
+        self.assertEqual(batcher.stats(), {'batches': 1, 'batched_keys': 3})
+
+    def test_full_batch_sent_before_window_ends(self):
+        """Test that a batch reaching max_keys doesn't wait out the window"""
+
+        batcher = MissBatcher(lambda keys: keys, window=10, max_keys=2)
+
+        start = time.time()
+        results = self._start_getters(batcher, ['a', 'b'])
+
+        self.assertEqual(results, {'a': 'a', 'b': 'b'})
+        self.assertLess(time.time() - start, 1)
+
+    def test_lone_miss_sent_after_window(self):
+        """Test that a miss nobody joins is sent once the window is up"""
+
+        fetch_many = mock.MagicMock(return_value=[None])
+        batcher = MissBatcher(fetch_many, window=0.01)
+
+        self.assertIsNone(batcher.get('a'))
+        fetch_many.assert_called_once_with(['a'])
+
+    def test_error_propagated_to_batch(self):
+        """Test that a failed MGET is raised in every thread in the batch"""
+
+        batcher = MissBatcher(mock.MagicMock(side_effect=socket.error("reset")), window=0.2, max_keys=2)
+
+        results = self._start_getters(batcher, ['a', 'b'])
+
+        self.assertIsInstance(results['a'], socket.error)
+        self.assertIsInstance(results['b'], socket.error)
+
+
+class TestMultiplexedRedisConnection(unittest.TestCase):
+
+    def _fake_redis(self):
+        """Socket pair: the proxy's end wrapped in a RedisConnection, and
+            the end a test answers from
+        """
+
+        server, client = socket.socketpair()
+        self.addCleanup(server.close)
+        return server, RedisConnection(client)
+
+    def _read_commands(self, server, count):
+        parser = RequestParser()
+        commands = []
+        while len(commands) < count:
+            commands.extend(args for args, inline in parser.feed(server.recv(4096)))
+        return commands
+
+    def _start_call(self, mux, key):
+        results = []
+
+        def call():
+            try:
+                results.append(mux.call(encode_command("GET", key)))
+            except Exception, e:
+                results.append(e)
+        caller = threading.Thread(target=call)
+        caller.start()
+        return caller, results
+
+    def test_requests_pipelined_and_matched_in_order(self):
+        """Test that requests go out without waiting & replies reach the
+            right callers
+        """
+
+        server, conn = self._fake_redis()
+        mux = MultiplexedRedisConnection(lambda: conn, timeout=5)
+        calls = dict((key, self._start_call(mux, key)) for key in ['a', 'b', 'c'])
+
+        # All three are written before Redis has answered any of them
+        commands = self._read_commands(server, 3)
+        self.assertEqual(mux.stats()['outstanding'], 3)
+        server.sendall("".join("$1\r\n%s\r\n" % key.upper() for cmd, key in commands))
+        for caller, results in calls.values():
+            caller.join(1)
+
+        self.assertEqual(dict((key, results) for key, (caller, results) in calls.items()), {
+            'a': ['A'],
+            'b': ['B'],
+            'c': ['C'],
+        })
+        self.assertEqual(mux.stats()['outstanding'], 0)
+
+    def test_pipelined_replies_gathered(self):
+        """Test that a request pipelining several commands gets all their
+            replies, & the next request the one after
+        """
+
+        server, conn = self._fake_redis()
+        mux = MultiplexedRedisConnection(lambda: conn, timeout=5)
+        results = []
+        first = threading.Thread(
+            target=lambda: results.append(mux.call(encode_command("GET", "a") + encode_command("PTTL", "a"), 2)),
+        )
+        first.start()
+        self._read_commands(server, 2)
+        second, second_results = self._start_call(mux, 'b')
+        self._read_commands(server, 1)
+
+        server.sendall("$1\r\nA\r\n:5000\r\n$1\r\nB\r\n")
+        first.join(1)
+        second.join(1)
+        self.assertEqual(results, [['A', '5000']])
+        self.assertEqual(second_results, ['B'])
+
+    def test_max_outstanding_applies_backpressure(self):
+        """Test that a request waits for a free slot, & times out without one"""
+
+        server, conn = self._fake_redis()
+        mux = MultiplexedRedisConnection(lambda: conn, max_outstanding=1, timeout=0.1)
+        caller, results = self._start_call(mux, 'a')
+        self._read_commands(server, 1)
+
+        with self.assertRaises(FetchTimeoutError):
+            mux.call(encode_command("GET", "b"))
+        self.assertEqual(mux.stats()['slot_waits'], 1)
+
+        # The first request gave up too, but holds its slot until Redis answers
+        caller.join(1)
+        self.assertIsInstance(results[0], FetchTimeoutError)
+        self.assertEqual(mux.stats()['outstanding'], 1)
+        server.sendall("$1\r\nA\r\n")
+
+        caller, results = self._start_call(mux, 'c')
+        self._read_commands(server, 1)
+        server.sendall("$1\r\nC\r\n")
+        caller.join(1)
+        self.assertEqual(results, ['C'])
+
+    def test_broken_connection_fails_pending_and_reconnects(self):
+        """Test that requests in flight on a dropped connection fail, and
+            the next request opens a new one
+        """
+
+        first_server, first_conn = self._fake_redis()
+        second_server, second_conn = self._fake_redis()
+        connect = mock.MagicMock(side_effect=[first_conn, second_conn])
+        mux = MultiplexedRedisConnection(connect, timeout=5)
+
+        caller, results = self._start_call(mux, 'a')
+        self._read_commands(first_server, 1)
+        first_server.close()
+        caller.join(1)
+        self.assertIsInstance(results[0], socket.error)
+
+        caller, results = self._start_call(mux, 'b')
+        self._read_commands(second_server, 1)
+        second_server.sendall("$1\r\nB\r\n")
+        caller.join(1)
+        self.assertEqual(results, ['B'])
+        self.assertEqual(mux.stats()['reconnects'], 1)
+
+
+class TestRedisConnectionPool(unittest.TestCase):
+
+    def test_grows_lazily_up_to_max_size(self):
+        """Test that connections are only opened when none are idle"""
+
+        connect = mock.MagicMock(side_effect=lambda: mock.MagicMock())
+        pool = RedisConnectionPool(connect, max_size=2)
+
+        first = pool.acquire()
+        pool.release(first)
+        self.assertIs(pool.acquire(), first)
+        self.assertEqual(connect.call_count, 1)
+
+        second = pool.acquire()
+        self.assertIsNot(second, first)
+        self.assertEqual(connect.call_count, 2)
+        self.assertEqual(pool.stats()['size'], 2)
+
+    def test_exhausted_pool_times_out(self):
+        """Test that waiting on a full pool raises PoolTimeoutError & is counted"""
+
+        pool = RedisConnectionPool(mock.MagicMock, max_size=1, timeout=0.05)
+        pool.acquire()
+
+        with self.assertRaises(PoolTimeoutError):
+            pool.acquire()
+        self.assertEqual(pool.stats()['waits'], 1)
+        self.assertGreater(pool.stats()['wait_time'], 0)
+
+    def test_waiter_gets_released_connection(self):
+        """Test that a blocked checkout is handed the next released connection"""
+
+        pool = RedisConnectionPool(mock.MagicMock, max_size=1, timeout=5)
+        conn = pool.acquire()
+        checked_out = []
+        waiter = threading.Thread(target=lambda: checked_out.append(pool.acquire()))
+        waiter.start()
+        time.sleep(0.05)
+        pool.release(conn)
+        waiter.join(1)
+
+        self.assertEqual(checked_out, [conn])
+
+    def test_failed_block_discards_connection(self):
+        """Test that an error inside connection() closes & replaces the socket"""
+
+        connect = mock.MagicMock(side_effect=lambda: mock.MagicMock())
+        pool = RedisConnectionPool(connect, max_size=1)
+
+        with self.assertRaises(socket.error):
+            with pool.connection() as conn:
+                raise socket.error("broken pipe")
+        conn.close.assert_called_once_with()
+
+        with pool.connection() as new_conn:
+            self.assertIsNot(new_conn, conn)
+        self.assertEqual(pool.stats()['idle'], 1)
+
+
+def fake_replica(*replies):
+    """Fakes a RedisBackend whose call() hands out replies in order, raising
+        those that are exceptions (other than RedisError replies)
+    """
+
+    replies = list(replies)
+
+    def call(*args):
+        reply = replies.pop(0)
+        if isinstance(reply, Exception) and not isinstance(reply, RedisError):
+            raise reply
+        return reply
+
+    backend = mock.MagicMock()
+    backend.call.side_effect = call
+    return backend
+
+
+class TestReplicaSet(unittest.TestCase):
+
+    def make_set(self, *backends):
+        names = ['r%s:6379' % i for i in xrange(len(backends))]
+        return ReplicaSet(zip(names, backends), probe_interval=None)
+
+    def test_picks_cheaper_of_two(self):
+        """Test that of the two replicas sampled, the one with the lower
+            average response time gets the request
+        """
+
+        slow, fast = fake_replica('slow'), fake_replica('fast')
+        replicas = self.make_set(slow, fast)
+        replicas.replicas[0].ewma = 0.1
+        replicas.replicas[1].ewma = 0.001
+
+        self.assertEqual(replicas.call('GET foo'), 'fast')
+        self.assertFalse(slow.call.called)
+
+    def test_writes_go_to_primary(self):
+        primary, replica = fake_replica('OK'), fake_replica()
+        replicas = self.make_set(primary, replica)
+        replicas.replicas[0].ewma = 0.1
+        replicas.replicas[1].ewma = 0.001
+
+        self.assertEqual(replicas.write('SET foo bar'), 'OK')
+        self.assertFalse(replica.call.called)
+
+    def test_pending_requests_add_to_cost(self):
+        replicas = self.make_set(fake_replica('busy'), fake_replica('idle'))
+        replicas.replicas[0].ewma = 0.001
+        replicas.replicas[0].pending = 10
+        replicas.replicas[1].ewma = 0.005
+
+        self.assertEqual(replicas.call('GET foo'), 'idle')
+
+    @mock.patch('threaded_proxy.monotonic')
+    def test_response_times_averaged(self, clock_mock):
+        clock_mock.side_effect = [0.0, 0.1, 1.0, 1.2]
+        replicas = self.make_set(fake_replica('bar', 'baz'))
+        replicas.call('GET foo')
+        self.assertAlmostEqual(replicas.replicas[0].ewma, 0.1)
+        replicas.call('GET foo')
+        self.assertAlmostEqual(replicas.replicas[0].ewma, 0.3 * 0.2 + 0.7 * 0.1)
+
+    def test_socket_error_ejects_and_retries(self):
+        replicas = self.make_set(fake_replica(socket.error("reset")), fake_replica('bar'))
+        replicas.replicas[1].ewma = 1.0
+
+        self.assertEqual(replicas.call('GET foo'), 'bar')
+        stats = replicas.stats()
+        self.assertFalse(stats['r0:6379']['healthy'])
+        self.assertEqual(stats['r0:6379']['ejections'], 1)
+        self.assertTrue(stats['r1:6379']['healthy'])
+
+    def test_timeout_raised_if_no_other_replica(self):
+        replicas = self.make_set(fake_replica(FetchTimeoutError()), fake_replica())
+        replicas.replicas[1].healthy = False
+
+        with self.assertRaises(FetchTimeoutError):
+            replicas.call('GET foo')
+        self.assertFalse(replicas.replicas[0].healthy)
+
+    def test_loading_reply_ejects_and_retries(self):
+        replicas = self.make_set(
+            fake_replica(RedisError("LOADING Redis is loading the dataset in memory")),
+            fake_replica('bar'),
+        )
+        replicas.replicas[1].ewma = 1.0
+
+        self.assertEqual(replicas.call('GET foo'), 'bar')
+        self.assertFalse(replicas.replicas[0].healthy)
+
+    def test_request_errors_not_ejected(self):
+        """Test that an error about the request itself goes back to the
+            client, & the replica stays in
+        """
+
+        error = RedisError("WRONGTYPE Operation against a key holding the wrong kind of value")
+        replicas = self.make_set(fake_replica(error), fake_replica())
+        replicas.replicas[1].ewma = 1.0
+
+        self.assertIs(replicas.call('GET foo'), error)
+        self.assertTrue(replicas.replicas[0].healthy)
+
+    def test_all_ejected_still_tries(self):
+        replicas = self.make_set(fake_replica('bar'))
+        replicas.replicas[0].healthy = False
+
+        self.assertEqual(replicas.call('GET foo'), 'bar')
+
+    def test_probe_readmits_replica(self):
+        """Test that an ejected replica is back in once it answers a PING"""
+
+        backend = fake_replica(socket.error("refused"), 'PONG')
+        replicas = self.make_set(backend)
+        replicas.replicas[0].healthy = False
+
+        replicas.probe()
+        self.assertFalse(replicas.replicas[0].healthy)
+        replicas.probe()
+        self.assertTrue(replicas.replicas[0].healthy)
+        backend.call.assert_called_with(encode_command("PING"))
+
+    def test_unreachable_replica_ejected_on_start(self):
+        backend = fake_replica()
+        backend.open.side_effect = socket.error("refused")
+        replicas = self.make_set(backend, fake_replica())
+
+        self.assertFalse(replicas.replicas[0].healthy)
+        self.assertTrue(replicas.replicas[1].healthy)
+
 
 if __name__ == "__main__":
     unittest.main()
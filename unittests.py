@@ -1,12 +1,57 @@
+import socket
+import threading
 import time
 import mock
 import unittest
 
+from bench_proxy import FakeRedis, make_data
+from bloom import BloomFilter
+from compression import CompressedValue
+from invalidation import InvalidationFeed, TRACKING_CHANNEL
 from proxy import (
+    BulkStream,
+    ClientConnection,
+    EventLoopRedisProxy,
     LastUpdatedDict,
     LRUCache,
     RedisProxy,
 )
+from resp import encode_command, encode_reply, RedisConnection
+
+
+
+def client_input(testproxy, conn, data):
+    """Handles a client's input as one pass of the event loop would"""
+
+    testproxy._process_client_input(conn, data)
+    testproxy._flush_ready_clients()
+
+
+def redis_input(testproxy, backend, data):
+    """Handles a backend's input as one pass of the event loop would"""
+
+    testproxy._process_redis_input(backend, data)
+    testproxy._flush_ready_clients()
+
+
+def fake_recv_into(*chunks):
+    """Fakes socket.recv_into, handing out chunks (or raising them, if they
+        are exceptions) in order
+    """
+
+    chunks = list(chunks)
+
+    def recv_into(buf, nbytes=0):
+        chunk = chunks.pop(0)
+        if isinstance(chunk, Exception):
+            raise chunk
+        size = min(nbytes or len(buf), len(buf))
+        if len(chunk) > size:
+            chunk, rest = chunk[:size], chunk[size:]
+            chunks.insert(0, rest)
+        buf[:len(chunk)] = chunk
+        return len(chunk)
+    return recv_into
 
 
 class TestLastUpdatedDict(unittest.TestCase):
@@ -62,16 +107,16 @@ class TestLRUCache(unittest.TestCase):
         )
 
 
-    @mock.patch('proxy.datetime')
-    def test_timestamp_added_with_set(self, dt_mock):
-        """Test that correct datetime is added for inserted data"""
+    @mock.patch('proxy.monotonic')
+    def test_deadline_added_with_set(self, clock_mock):
+        """Test that inserted data expires TTL after the monotonic clock's now"""
 
-        dt_mock.now.return_value = "2017-09-25 00:00:00"
+        clock_mock.return_value = 1000.0
 
         testcache = LRUCache(capacity=100, ttl=7200)
         testcache.set('radish', 'moo')
-        val, timestamp = testcache.cache['radish']
-        self.assertEqual(timestamp, "2017-09-25 00:00:00")
+        val, deadline = testcache.cache['radish']
+        self.assertEqual(deadline, (1000 + 7200) * 1000)
 
     def test_get_not_in_cache_returns_None(self):
         """Test that getting a nonexistent value returns None"""
@@ -96,6 +141,231 @@ class TestLRUCache(unittest.TestCase):
         testcache.set('radish', 'moo')
         self.assertEqual(testcache.get('radish'), 'moo')
 
+    @mock.patch('proxy.monotonic')
+    def test_expired_entry_removed_on_access(self, clock_mock):
+        """Test that an expired get drops the entry & counts an expiration"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=3, ttl=10)
+        testcache.set('radish', 'moo')
+
+        clock_mock.return_value = 1009.999
+        self.assertEqual(testcache.get('radish'), 'moo')
+        clock_mock.return_value = 1010.0
+        self.assertIsNone(testcache.get('radish'))
+
+        self.assertNotIn('radish', testcache.cache)
+        self.assertEqual(testcache.size, 0)
+        self.assertEqual(testcache.stats()['expirations'], 1)
+        self.assertEqual(testcache.stats()['evictions'], 0)
+
+    @mock.patch('proxy.monotonic')
+    def test_stale_entry_served_within_grace(self, clock_mock):
+        """Test that an expired entry is returned, flagged for a refresh,
+            until its grace period ends
+        """
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=3, ttl=10, grace=5)
+        testcache.set('radish', 'moo')
+
+        clock_mock.return_value = 1012.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', True))
+        self.assertEqual(testcache.stats()['stale_hits'], 1)
+
+        clock_mock.return_value = 1015.0
+        self.assertEqual(testcache.lookup('radish'), (None, False))
+        self.assertEqual(testcache.stats()['expirations'], 1)
+
+    @mock.patch('proxy.monotonic')
+    def test_refresh_ahead_of_expiry(self, clock_mock):
+        """Test that a hit close to the deadline is flagged for a refresh"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=3, ttl=10, refresh_ahead=2)
+        testcache.set('radish', 'moo')
+
+        clock_mock.return_value = 1007.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', False))
+        clock_mock.return_value = 1008.0
+        self.assertEqual(testcache.lookup('radish'), ('moo', True))
+
+    def test_delete(self):
+        testcache = LRUCache(capacity=3, ttl=10)
+        testcache.set('radish', 'moo')
+        testcache.delete('radish')
+        testcache.delete('radish')
+
+        self.assertIsNone(testcache.get('radish'))
+        self.assertEqual(testcache.size, 0)
+
+    def test_clear(self):
+        testcache = LRUCache(capacity=3, ttl=10, policy='slru')
+        testcache.set('radish', 'moo')
+        testcache.set('rice', 'bap')
+
+        self.assertEqual(testcache.clear(), 2)
+        self.assertIsNone(testcache.get('radish'))
+        self.assertEqual(testcache.size, 0)
+        self.assertEqual(testcache.entries(), [])
+        testcache.set('beef', 'sogogi')
+        self.assertEqual(testcache.get('beef'), 'sogogi')
+
+    @mock.patch('proxy.monotonic')
+    def test_hits_do_not_extend_ttl(self, clock_mock):
+        """Test that an entry expires TTL after it was set, however often it's read"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=3, ttl=10)
+        testcache.set('radish', 'moo')
+        clock_mock.return_value = 1005.0
+        testcache.get('radish')
+
+        clock_mock.return_value = 1010.0
+        self.assertIsNone(testcache.get('radish'))
+
+    @mock.patch('proxy.monotonic')
+    def test_sweep_reclaims_expired_entries(self, clock_mock):
+        """Test that sweep removes expired entries in bounded batches"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=10, ttl=10)
+        for key in ['a', 'b', 'c']:
+            testcache.set(key, 'val')
+        clock_mock.return_value = 1005.0
+        testcache.set('d', 'val')
+
+        clock_mock.return_value = 1012.0
+        self.assertEqual(testcache.sweep(max_entries=2), 2)
+        self.assertEqual(testcache.sweep(), 1)
+        self.assertEqual(testcache.cache.keys(), ['d'])
+        self.assertEqual(testcache.stats()['expirations'], 3)
+
+    @mock.patch('proxy.monotonic')
+    def test_expired_entries_reclaimed_before_eviction(self, clock_mock):
+        """Test that a full cache drops expired entries rather than live ones"""
+
+        clock_mock.return_value = 1000.0
+        testcache = LRUCache(capacity=2, ttl=10)
+        testcache.set('old', 'val')
+        clock_mock.return_value = 1005.0
+        testcache.set('live', 'val')
+
+        clock_mock.return_value = 1011.0
+        testcache.set('new', 'val')
+
+        self.assertEqual(testcache.cache.keys(), ['live', 'new'])
+        self.assertEqual(testcache.stats()['evictions'], 0)
+        self.assertEqual(testcache.stats()['expirations'], 1)
+
+    def test_max_memory_only(self):
+        """Test that a cache can be bounded by bytes alone"""
+
+        testcache = LRUCache(ttl=7200, max_memory=10000)
+        testcache.set('radish', 'moo')
+        self.assertEqual(testcache.get('radish'), 'moo')
+
+    @mock.patch('proxy.ENTRY_OVERHEAD', 0)
+    @mock.patch('proxy.sys.getsizeof', len)
+    def test_max_memory_evicts_until_entry_fits(self):
+        """Test that LRU entries are evicted until a new entry fits the budget"""
+
+        testcache = LRUCache(ttl=7200, max_memory=30, max_entry_fraction=1)
+        testcache.set('a', 'x' * 9)
+        testcache.set('b', 'x' * 9)
+        testcache.set('c', 'x' * 9)
+        self.assertEqual(testcache.size, 30)
+
+        testcache.set('d', 'x' * 19)
+        self.assertEqual(testcache.cache.keys(), ['c', 'd'])
+        self.assertEqual(testcache.size, 30)
+        self.assertEqual(testcache.stats()['evictions'], 2)
+
+    @mock.patch('proxy.ENTRY_OVERHEAD', 0)
+    @mock.patch('proxy.sys.getsizeof', len)
+    def test_oversized_entry_refused(self):
+        """Test that entries over max_entry_fraction of the budget aren't cached"""
+
+        testcache = LRUCache(ttl=7200, max_memory=100, max_entry_fraction=0.25)
+        testcache.set('a', 'small')
+        testcache.set('big', 'x' * 30)
+        testcache.set('a', 'x' * 30)
+
+        self.assertIsNone(testcache.get('big'))
+        # The old value for a re-set key is dropped, not left stale
+        self.assertIsNone(testcache.get('a'))
+        self.assertEqual(testcache.size, 0)
+        self.assertEqual(testcache.stats()['rejections'], 2)
+
+    def test_updating_key_in_full_cache_keeps_others(self):
+        """Test that re-setting a cached key doesn't evict another key"""
+
+        testcache = LRUCache(capacity=2, ttl=7200)
+        testcache.set('radish', 'moo')
+        testcache.set('rice', 'bap')
+        testcache.set('radish', 'mu')
+
+        self.assertEqual(testcache.get('rice'), 'bap')
+        self.assertEqual(testcache.get('radish'), 'mu')
+        self.assertEqual(testcache.stats()['evictions'], 0)
+
+    def test_large_values_cached_compressed(self):
+        """Test that values over the threshold are kept compressed, counted
+            at their compressed size, & read back whole
+        """
+
+        val = '{"name": "Robert Kevin", "age": 111}' * 50
+        testcache = LRUCache(capacity=5, ttl=7200, compress_threshold=100)
+        plain = LRUCache(capacity=5, ttl=7200)
+        testcache.set('json', val)
+        plain.set('json', val)
+        testcache.set('short', 'bar')
+
+        self.assertEqual(testcache.get('json'), val)
+        self.assertIsInstance(testcache.lookup('json', raw=True)[0], CompressedValue)
+        self.assertEqual(testcache.get('short'), 'bar')
+        self.assertLess(testcache.size, plain.size - len(val) / 2)
+        stats = testcache.stats()
+        self.assertEqual(stats['compressed'], 1)
+        self.assertEqual(stats['decompressed'], 1)
+        self.assertGreater(stats['compression_saved'], len(val) / 2)
+        self.assertEqual(testcache.entries()[0][1], val)
+
+        testcache.delete('json')
+        self.assertEqual(testcache.stats()['compression_saved'], 0)
+
+
+class TestBloomFilter(unittest.TestCase):
+
+    def test_added_keys_always_found(self):
+        """Test that the filter has no false negatives"""
+
+        bloom = BloomFilter(1000)
+        keys = ["key:%s" % i for i in xrange(1000)]
+        for key in keys:
+            bloom.add(key)
+        self.assertTrue(all(key in bloom for key in keys))
+
+    def test_false_positive_rate(self):
+        """Test that keys never added are mostly reported absent"""
+
+        bloom = BloomFilter(1000, error_rate=0.01)
+        for i in xrange(1000):
+            bloom.add("key:%s" % i)
+        false_positives = sum("other:%s" % i in bloom for i in xrange(10000))
+        self.assertLess(false_positives, 300)
+
+    def test_reset_when_full(self):
+        """Test that the filter starts over once capacity keys were added"""
+
+        bloom = BloomFilter(2)
+        bloom.add('a')
+        bloom.add('b')
+        bloom.add('c')
+        self.assertEqual(bloom.resets, 1)
+        self.assertIn('c', bloom)
+        self.assertEqual(bloom.count, 1)
+
 
 class RedisProxyTests(unittest.TestCase):
 
@@ -104,7 +374,7 @@ class RedisProxyTests(unittest.TestCase):
     def setUp(self, patched_redis, patched_client):
         """Sets up a test proxy with mocked Redis and client connections"""
 
-        patched_redis.return_value = mock.MagicMock()
+        self.redis_socket = patched_redis.return_value
 
         self.testproxy = RedisProxy(capacity=5, ttl=7200)
         self.testproxy.cache.set('foo', 'bar')
@@ -112,34 +382,800 @@ class RedisProxyTests(unittest.TestCase):
     def test_cached_val_returned(self):
         """Test that a value in the proxy's cache is returned, w/o calling Redis"""
 
-        self.testproxy.redis_socket.recv.return_value = "$3\r\nbar\r\n"
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$3\r\nbar\r\n")
 
         cached_val = self.testproxy.get('foo')
 
         self.assertEqual(cached_val, 'bar')
-        self.testproxy.redis_socket.sendall.assert_not_called()
-        self.testproxy.redis_socket.recv.assert_not_called()
+        self.redis_socket.sendall.assert_not_called()
+        self.redis_socket.recv_into.assert_not_called()
 
 
     def test_nil_string_returned_from_Redis(self):
         """Test that a nil string from Redis cause proxy to return None"""
 
         # Mocking out a nil return from backing Redis
-        self.testproxy.redis_socket.recv.return_value = "$-1\r\n"
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$-1\r\n")
 
         self.assertIsNone(self.testproxy.get('blarf'))
-        self.testproxy.redis_socket.sendall.assert_called()
-        self.testproxy.redis_socket.recv.assert_called()
+        self.redis_socket.sendall.assert_called()
+        self.redis_socket.recv_into.assert_called()
 
 
     def test_cache_new_data(self):
         """Test that data fetched from Redis is put into the proxy's cache"""
 
-        self.testproxy.redis_socket.recv.return_value = "$5\r\nblarf\r\n"
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$5\r\nblarf\r\n")
 
         ret_val = self.testproxy.get('baz')
         self.assertEqual(ret_val, self.testproxy.cache.get('baz'))
 
+    def test_value_over_threshold_not_cached_without_stream(self):
+        """Test that a value too large to cache is returned whole, but not
+            cached, when there's no client to stream it to
+        """
+
+        self.testproxy.stream_threshold = 4
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$5\r\nblarf\r\n")
+
+        self.assertEqual(self.testproxy.get('baz'), 'blarf')
+        self.assertIsNone(self.testproxy.cache.get('baz'))
+
+    def test_large_value_read_whole(self):
+        """Test that a value longer than one read isn't truncated"""
+
+        value = "v" * 100000
+        self.redis_socket.recv_into.side_effect = fake_recv_into(
+            "$100000\r\n" + value[:4000],
+            value[4000:] + "\r\n",
+        )
+
+        self.assertEqual(self.testproxy.get('big'), value)
+        self.assertEqual(self.testproxy.cache.get('big'), value)
+
+    def test_value_over_threshold_streamed_not_cached(self):
+        """Test that a value over stream_threshold goes to the client uncached"""
+
+        self.testproxy.stream_threshold = 10
+        self.redis_socket.recv_into.side_effect = fake_recv_into(
+            "$20\r\n" + "j" * 20 + "\r\n",
+        )
+        client = mock.MagicMock()
+
+        reply = self.testproxy._handle_command(['GET', 'blob'], False, BulkStream(client))
+
+        self.assertEqual(reply, "")
+        self.assertIsNone(self.testproxy.cache.get('blob'))
+        client.sendall.assert_any_call("$20\r\n")
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_nil_reply_negatively_cached(self, patched_redis, patched_client):
+        """Test that a missing key is remembered apart from the value cache"""
+
+        testproxy = RedisProxy(capacity=5, ttl=7200, negative_ttl=60, negative_capacity=2)
+        patched_redis.return_value.recv_into.side_effect = fake_recv_into("$-1\r\n")
+
+        self.assertIsNone(testproxy.get('blarf'))
+        self.assertIsNone(testproxy.get('blarf'))
+
+        self.assertEqual(patched_redis.return_value.sendall.call_count, 1)
+        self.assertIsNone(testproxy.cache.get('blarf'))
+        stats = testproxy.stats()
+        self.assertEqual(stats['negative_cache']['hits'], 1)
+        self.assertEqual(stats['negative_cache']['misses'], 1)
+        self.assertEqual(stats['cache']['keys'], 0)
+
+    @mock.patch('proxy.monotonic')
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_negative_entry_expires(self, patched_redis, patched_client, clock_mock):
+        """Test that a missing key is looked up again after negative_ttl"""
+
+        clock_mock.return_value = 100
+        testproxy = RedisProxy(capacity=5, ttl=7200, negative_ttl=5)
+        patched_redis.return_value.recv_into.side_effect = fake_recv_into("$-1\r\n", "$3\r\nnew\r\n")
+
+        self.assertIsNone(testproxy.get('blarf'))
+        clock_mock.return_value = 105
+        self.assertEqual(testproxy.get('blarf'), 'new')
+        self.assertEqual(testproxy.cache.get('blarf'), 'new')
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_absent_filter_screens_lookups(self, patched_redis, patched_client):
+        """Test that keys never found absent skip the negative cache"""
+
+        testproxy = RedisProxy(capacity=5, ttl=7200, negative_ttl=60, absent_filter=True)
+        patched_redis.return_value.recv_into.side_effect = fake_recv_into("$-1\r\n", "$3\r\nqux\r\n")
+
+        self.assertIsNone(testproxy.get('blarf'))
+        self.assertIsNone(testproxy.get('blarf'))
+        self.assertEqual(testproxy.get('baz'), 'qux')
+
+        stats = testproxy.stats()['negative_cache']
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['filtered'], 2)
+        self.assertEqual(stats['misses'], 2)
+
+    @mock.patch('proxy.monotonic')
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_stale_hit_refreshed_after_reply(self, patched_redis, patched_client, clock_mock):
+        """Test that a stale value is returned at once, & re-fetched later"""
+
+        clock_mock.return_value = 100
+        testproxy = RedisProxy(capacity=5, ttl=10, grace=60)
+        testproxy.cache.set('foo', 'bar')
+        patched_redis.return_value.recv_into.side_effect = fake_recv_into("$3\r\nqux\r\n")
+
+        clock_mock.return_value = 115
+        self.assertEqual(testproxy.get('foo'), 'bar')
+        patched_redis.return_value.sendall.assert_not_called()
+
+        testproxy._run_refreshes()
+        patched_redis.return_value.sendall.assert_called_once_with("*2\r\n$3\r\nGET\r\n$3\r\nfoo\r\n")
+        self.assertEqual(testproxy.cache.lookup('foo'), ('qux', False))
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_key_ttl_caps_cached_ttl(self, patched_redis, patched_client):
+        """Test that a miss pipelines a PTTL after its GET, & caches the value
+            no longer than Redis keeps it
+        """
+
+        testproxy = RedisProxy(capacity=5, ttl=7200, key_ttl=True)
+        patched_redis.return_value.recv_into.side_effect = fake_recv_into(
+            "$3\r\nqux\r\n:5000\r\n$1\r\n1\r\n:-1\r\n",
+        )
+
+        self.assertEqual(testproxy.get('baz'), 'qux')
+        patched_redis.return_value.sendall.assert_called_with(
+            encode_command("GET", "baz") + encode_command("PTTL", "baz"),
+        )
+        self.assertEqual(testproxy.get('a'), '1')
+        ttls = dict((key, ttl_ms) for key, val, ttl_ms in testproxy.cache.entries())
+        self.assertTrue(4000 < ttls['baz'] <= 5000)
+        self.assertTrue(7199000 < ttls['a'] <= 7200000)
+
+    def test_mget_fetches_only_missing_keys(self):
+        """Test that MGET answers cached keys locally & fetches the rest at once"""
+
+        self.redis_socket.recv_into.side_effect = fake_recv_into("*2\r\n$3\r\nqux\r\n$-1\r\n")
+
+        reply = self.testproxy._handle_command(['MGET', 'foo', 'baz', 'blarf', 'baz'], False)
+
+        self.assertEqual(reply, "*4\r\n$3\r\nbar\r\n$3\r\nqux\r\n$-1\r\n$3\r\nqux\r\n")
+        self.redis_socket.sendall.assert_called_once_with(
+            "*3\r\n$4\r\nMGET\r\n$3\r\nbaz\r\n$5\r\nblarf\r\n",
+        )
+        self.assertEqual(self.testproxy.cache.get('baz'), 'qux')
+
+    def test_get_connection_error_answered(self):
+        """Test that a GET whose Redis connection fails is answered with an
+            error, & the next one goes over a new connection
+        """
+
+        self.redis_socket.recv_into.side_effect = socket.timeout("timed out")
+        new_socket = mock.MagicMock()
+        new_socket.recv_into.side_effect = fake_recv_into("$3\r\nqux\r\n")
+        self.testproxy._open_redis_connection = mock.MagicMock(return_value=new_socket)
+
+        self.assertEqual(self.testproxy._handle_command(['GET', 'baz'], False), "-ERR Redis error: timed out\r\n")
+        self.redis_socket.close.assert_called_once_with()
+        self.assertEqual(self.testproxy._handle_command(['GET', 'baz'], False), "$3\r\nqux\r\n")
+
+    def test_cut_short_stream_raised(self):
+        """Test that a connection failing partway through a streamed value
+            isn't answered with an error the client would read as value
+        """
+
+        self.testproxy.stream_threshold = 4
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$10\r\nabc", socket.error("reset"))
+        self.testproxy._open_redis_connection = mock.MagicMock()
+        stream = BulkStream(mock.MagicMock())
+
+        with self.assertRaises(socket.error):
+            self.testproxy._handle_command(['GET', 'baz'], False, stream)
+        self.redis_socket.close.assert_called_once_with()
+
+    def test_refresh_connection_error_skipped(self):
+        self.redis_socket.recv_into.side_effect = socket.timeout("timed out")
+        self.testproxy._open_redis_connection = mock.MagicMock()
+        self.testproxy.refresh_keys['foo'] = True
+
+        self.testproxy._run_refreshes()
+        self.assertEqual(self.testproxy.cache.get('foo'), 'bar')
+        self.testproxy._open_redis_connection.assert_called_once_with('', 6379, 30)
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_mget_connection_error_answered(self, patched_redis, patched_client):
+        """Test that an MGET split across backends reads the replies of the
+            ones still up, & reconnects the one that failed
+        """
+
+        sockets = {'a': mock.MagicMock(), 'b': mock.MagicMock()}
+        sockets['a'].recv_into.side_effect = fake_recv_into("*1\r\n$3\r\nqux\r\n")
+        sockets['b'].recv_into.side_effect = socket.error("Connection reset by peer")
+        patched_redis.side_effect = lambda host, port, timeout: sockets[host]
+        testproxy = RedisProxy(capacity=5, ttl=7200, backends=[('a', 6379), ('b', 6379)])
+
+        reply = testproxy._handle_command(['MGET', 'zap', 'baz'], False)
+        self.assertEqual(reply, "-ERR Redis error: Connection reset by peer\r\n")
+        self.assertEqual(testproxy.cache.get('baz'), 'qux')
+        sockets['b'].close.assert_called_once_with()
+        sockets['a'].close.assert_not_called()
+
+    def test_warm_fetches_keys_in_batches(self):
+        self.redis_socket.recv_into.side_effect = fake_recv_into(
+            "*2\r\n$1\r\n1\r\n$-1\r\n*1\r\n$1\r\n3\r\n",
+        )
+
+        self.assertEqual(self.testproxy.warm(['a', 'b', 'c'], batch_size=2), 2)
+        self.assertEqual(self.redis_socket.sendall.call_count, 2)
+        self.assertEqual(self.testproxy.cache.get('c'), '3')
+        self.assertEqual(self.testproxy.cache.misses, 0)
+
+    @mock.patch('proxy.save_snapshot')
+    def test_snapshot_saved_on_schedule(self, patched_save):
+        self.testproxy.snapshot_path = 'cache.snap'
+        self.testproxy.snapshot_interval = 60
+        patched_save.return_value = 1
+
+        self.assertEqual(self.testproxy.save_snapshot(), 1)
+        patched_save.assert_called_once_with(self.testproxy.cache, 'cache.snap')
+        self.assertGreater(self.testproxy.next_snapshot, 0)
+
+    def test_hit_and_miss_latency_recorded(self):
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$3\r\nqux\r\n")
+
+        self.testproxy.get('foo')
+        self.testproxy.get('baz')
+
+        self.assertEqual(self.testproxy.metrics.hit_latency.count, 1)
+        self.assertEqual(self.testproxy.metrics.miss_latency.count, 1)
+
+    def test_info_command(self):
+        """Test that INFO/STATS reply with the proxy's metrics as a bulk string"""
+
+        self.testproxy.get('foo')
+        reply = self.testproxy._handle_command(['STATS', 'stats'], False)
+
+        self.assertTrue(reply.startswith("$"))
+        self.assertIn("# Stats\r\n", reply)
+        self.assertIn("keyspace_hits:1\r\n", reply)
+        self.assertNotIn("# Latency", reply)
+        self.assertIn("# Latency", self.testproxy._handle_command(['info'], True))
+
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_keys_routed_across_backends(self, patched_redis, patched_client):
+        """Test that each key goes to the backend it hashes to, & that an
+            MGET is split between backends & merged back in order
+        """
+
+        sockets = {'a': mock.MagicMock(), 'b': mock.MagicMock()}
+        patched_redis.side_effect = lambda host, port, timeout: sockets[host]
+        testproxy = RedisProxy(capacity=5, ttl=7200, backends=[('a', 6379), ('b', 6379)])
+        sockets['a'].recv_into.side_effect = fake_recv_into("*1\r\n$3\r\nqux\r\n")
+        sockets['b'].recv_into.side_effect = fake_recv_into("*1\r\n$-1\r\n", "$3\r\nzzz\r\n")
+
+        self.assertEqual(testproxy.mget(['zap', 'baz']), [None, 'qux'])
+        sockets['a'].sendall.assert_called_once_with("*2\r\n$4\r\nMGET\r\n$3\r\nbaz\r\n")
+        sockets['b'].sendall.assert_called_once_with("*2\r\n$4\r\nMGET\r\n$3\r\nzap\r\n")
+
+        self.assertEqual(testproxy.get('zip'), 'zzz')
+        self.assertEqual(sockets['a'].sendall.call_count, 1)
+
+    def test_write_passed_through(self):
+        """Test that a write is answered with Redis's reply & clears its key
+            from the cache, but only when writes are passed through
+        """
+
+        self.redis_socket.recv_into.side_effect = fake_recv_into("+OK\r\n")
+        reply = self.testproxy._handle_command(['SET', 'foo', 'baz'], False)
+        self.assertEqual(reply, "-ERR Please use Redis 'GET key' command format\r\n")
+        self.assertEqual(self.testproxy.cache.get('foo'), 'bar')
+
+        self.testproxy.pass_writes = True
+        reply = self.testproxy._handle_command(['SET', 'foo', 'baz'], False)
+        self.assertEqual(reply, "+OK\r\n")
+        self.redis_socket.sendall.assert_called_once_with("*3\r\n$3\r\nSET\r\n$3\r\nfoo\r\n$3\r\nbaz\r\n")
+        self.assertIsNone(self.testproxy.cache.get('foo'))
+
+    def test_write_to_closed_connection_answered(self):
+        """Test that a backend closing mid-write gets the client an error,
+            not the proxy stopped, & the key is still invalidated
+        """
+
+        self.testproxy.pass_writes = True
+        self.redis_socket.recv_into.side_effect = fake_recv_into("")
+        reply = self.testproxy._handle_command(['SET', 'foo', 'baz'], False)
+
+        self.assertEqual(reply, "-Redis connection error: Connection closed by Redis\r\n")
+        self.assertIsNone(self.testproxy.cache.get('foo'))
+
+    def test_timed_out_write_reconnects(self):
+        """Test that after a write times out, the next command goes over a
+            new connection, so it can't read the write's late reply
+        """
+
+        self.testproxy.pass_writes = True
+        self.redis_socket.recv_into.side_effect = socket.timeout("timed out")
+        new_socket = mock.MagicMock()
+        new_socket.recv_into.side_effect = fake_recv_into("$3\r\nqux\r\n")
+        self.testproxy._open_redis_connection = mock.MagicMock(return_value=new_socket)
+
+        self.assertEqual(str(self.testproxy.write(['SET', 'foo', 'baz'])), "Redis connection error: timed out")
+        self.redis_socket.close.assert_called_once_with()
+        self.assertNotIn(self.redis_socket, self.testproxy.socket_list)
+        self.assertIn(new_socket, self.testproxy.socket_list)
+
+        self.assertEqual(self.testproxy.get('other'), 'qux')
+        new_socket.sendall.assert_called_once_with(encode_command("GET", "other"))
+        self.assertEqual(self.testproxy.cache.get('other'), 'qux')
+
+    def test_fetch_racing_write_not_cached(self):
+        """Test that a value fetched while a write to its key went through
+            is returned, but not cached
+        """
+
+        recv_into = fake_recv_into("$3\r\nold\r\n")
+
+        def write_lands_meanwhile(buf, nbytes=0):
+            self.testproxy._invalidate(['baz'])
+            return recv_into(buf, nbytes)
+        self.redis_socket.recv_into.side_effect = write_lands_meanwhile
+
+        self.assertEqual(self.testproxy.get('baz'), 'old')
+        self.assertIsNone(self.testproxy.cache.get('baz'))
+        self.assertEqual(self.testproxy.versions.stats()['voided_fetches'], 1)
+
+    def test_announced_keys_invalidated(self):
+        feed = InvalidationFeed('a:6379')
+        feed.conn = mock.MagicMock()
+        feed.conn.sock.recv.return_value = encode_reply(["message", TRACKING_CHANNEL, ["foo"]])
+        self.testproxy.feeds = [feed]
+
+        self.testproxy._on_feed_readable(feed)
+        self.assertIsNone(self.testproxy.cache.get('foo'))
+        self.assertEqual(self.testproxy.stats()['invalidation']['invalidated_keys'], 1)
+
+    def test_lost_invalidation_connection_flushes_cache(self):
+        """Test that the cache is emptied when Redis stops announcing
+            changes, & nothing is cached until it resubscribes
+        """
+
+        feed = InvalidationFeed('a:6379')
+        feed.conn = mock.MagicMock()
+        feed.conn.sock.recv.return_value = ""
+        self.testproxy.feeds = [feed]
+
+        self.testproxy._on_feed_readable(feed)
+        self.assertIsNone(self.testproxy.cache.get('foo'))
+        self.assertIsNone(feed.conn)
+        self.assertEqual(feed.stats()['disconnects'], 1)
+
+        self.redis_socket.recv_into.side_effect = fake_recv_into("$3\r\nqux\r\n")
+        self.assertEqual(self.testproxy.get('baz'), 'qux')
+        self.assertIsNone(self.testproxy.cache.get('baz'))
+
+
+class EventLoopRedisProxyTests(unittest.TestCase):
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def setUp(self, patched_redis, patched_client):
+        """Sets up a test event-loop proxy with mocked sockets & poller"""
+
+        self.testproxy = EventLoopRedisProxy(capacity=5, ttl=7200)
+        self.testproxy.poller = mock.MagicMock()
+        self.backend = self.testproxy.backends.values()[0]
+        self.redis_socket = self.backend.sock
+        self.redis_socket.send.side_effect = lambda data: len(data)
+        self.testproxy.cache.set('foo', 'bar')
+
+    def _client(self):
+        sock = mock.MagicMock()
+        sock.send.side_effect = lambda data: len(data)
+        return ClientConnection(sock)
+
+    def test_cached_val_answered_without_redis(self):
+        """Test that a cache hit is answered immediately, w/o calling Redis"""
+
+        conn = self._client()
+        client_input(self.testproxy, conn, "GET foo\n")
+
+        conn.sock.send.assert_called_with("bar\n\r")
+        self.redis_socket.send.assert_not_called()
+
+    def test_misses_pipelined_to_redis(self):
+        """Test that misses from several clients are all in flight at once"""
+
+        first, second = self._client(), self._client()
+        client_input(self.testproxy, first, "GET baz\n")
+        client_input(self.testproxy, second, "GET blarf\n")
+
+        self.assertEqual(len(self.backend.in_flight), 2)
+        self.assertEqual(self.redis_socket.send.call_count, 2)
+        first.sock.send.assert_not_called()
+
+        redis_input(self.testproxy, self.backend, "$3\r\nqux\r\n$-1\r\n")
+
+        first.sock.send.assert_called_with("qux\n\r")
+        second.sock.send.assert_called_with("Nothing exists for key blarf in Redis\n\r")
+        self.assertEqual(self.testproxy.cache.get('baz'), 'qux')
+
+    def test_concurrent_misses_coalesced(self):
+        """Test that misses for a key already in flight share its GET"""
+
+        first, second = self._client(), self._client()
+        client_input(self.testproxy, first, "GET baz\n")
+        client_input(self.testproxy, second, "*2\r\n$3\r\nGET\r\n$3\r\nbaz\r\n")
+
+        self.assertEqual(self.redis_socket.send.call_count, 1)
+        self.assertEqual(self.testproxy.coalesced, 1)
+
+        redis_input(self.testproxy, self.backend, "$3\r\nqux\r\n")
+        first.sock.send.assert_called_with("qux\n\r")
+        second.sock.send.assert_called_with("$3\r\nqux\r\n")
+        self.assertEqual(self.testproxy.waiters, {})
+
+    @mock.patch('proxy.monotonic')
+    def test_stale_hit_refreshed_in_background(self, clock_mock):
+        """Test that a stale hit is answered, & pipelines a GET no client
+            waits on, which updates the cache
+        """
+
+        clock_mock.return_value = 100
+        self.testproxy.cache.grace_ms = 60000
+        self.testproxy.cache.set('foo', 'bar')
+
+        clock_mock.return_value = 100 + 7200 + 1
+        conn = self._client()
+        client_input(self.testproxy, conn, "GET foo\n")
+        client_input(self.testproxy, conn, "GET foo\n")
+
+        self.assertEqual(conn.sock.send.call_count, 2)
+        conn.sock.send.assert_called_with("bar\n\r")
+        self.assertEqual(self.redis_socket.send.call_count, 1)
+        self.assertEqual(self.testproxy.waiters, {'foo': []})
+
+        redis_input(self.testproxy, self.backend, "$3\r\nqux\r\n")
+        self.assertEqual(self.testproxy.waiters, {})
+        self.assertEqual(self.testproxy.cache.get('foo'), 'qux')
+        self.assertEqual(conn.sock.send.call_count, 2)
+
+    def test_coalesced_misses_share_errors(self):
+        """Test that a Redis error reaches every request waiting on the GET"""
+
+        first, second = self._client(), self._client()
+        client_input(self.testproxy, first, "GET baz\n")
+        client_input(self.testproxy, second, "GET baz\n")
+
+        redis_input(self.testproxy, self.backend, "-ERR oops\r\n")
+        first.sock.send.assert_called_with("Redis error: ERR oops\n\r")
+        second.sock.send.assert_called_with("Redis error: ERR oops\n\r")
+        self.assertIsNone(self.testproxy.cache.get('baz'))
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_absent_key_answered_from_negative_cache(self, patched_redis, patched_client):
+        """Test that a key Redis just reported missing isn't asked for again"""
+
+        testproxy = EventLoopRedisProxy(capacity=5, ttl=7200, negative_ttl=60)
+        testproxy.poller = mock.MagicMock()
+        patched_redis.return_value.send.side_effect = lambda data: len(data)
+        conn = self._client()
+        client_input(testproxy, conn, "GET blarf\n")
+        redis_input(testproxy, testproxy.backends.values()[0], "$-1\r\n")
+
+        client_input(testproxy, conn, "*2\r\n$3\r\nGET\r\n$5\r\nblarf\r\n")
+
+        conn.sock.send.assert_called_with("$-1\r\n")
+        self.assertEqual(patched_redis.return_value.send.call_count, 1)
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_misses_batched_into_mget(self, patched_redis, patched_client):
+        """Test that misses from several clients in one pass share an MGET"""
+
+        testproxy = EventLoopRedisProxy(capacity=5, ttl=7200, batch_size=8)
+        testproxy.poller = mock.MagicMock()
+        patched_redis.return_value.send.side_effect = lambda data: len(data)
+        first, second = self._client(), self._client()
+        client_input(testproxy, first, "GET baz\n")
+        client_input(testproxy, second, "GET blarf\nGET baz\n")
+        patched_redis.return_value.send.assert_not_called()
+
+        backend = testproxy.backends.values()[0]
+        testproxy._send_batch(backend)
+        testproxy._flush_redis(backend)
+        patched_redis.return_value.send.assert_called_once_with(
+            "*3\r\n$4\r\nMGET\r\n$3\r\nbaz\r\n$5\r\nblarf\r\n",
+        )
+
+        redis_input(testproxy, backend, "*2\r\n$3\r\nqux\r\n$-1\r\n")
+        first.sock.send.assert_called_with("qux\n\r")
+        second.sock.send.assert_called_with("Nothing exists for key blarf in Redis\n\rqux\n\r")
+        self.assertEqual(testproxy.waiters, {})
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_mget_split_across_backends(self, patched_redis, patched_client):
+        """Test that a client MGET is pipelined to each backend holding its
+            keys, & answered once all of them have replied
+        """
+
+        sockets = {'a': mock.MagicMock(), 'b': mock.MagicMock()}
+        for sock in sockets.itervalues():
+            sock.send.side_effect = lambda data: len(data)
+        patched_redis.side_effect = lambda host, port, timeout: sockets[host]
+        testproxy = EventLoopRedisProxy(capacity=5, ttl=7200, backends=[('a', 6379), ('b', 6379)])
+        testproxy.poller = mock.MagicMock()
+        conn = self._client()
+        client_input(testproxy, conn, "MGET zap baz\n")
+
+        sockets['a'].send.assert_called_once_with("*2\r\n$3\r\nGET\r\n$3\r\nbaz\r\n")
+        sockets['b'].send.assert_called_once_with("*2\r\n$3\r\nGET\r\n$3\r\nzap\r\n")
+
+        redis_input(testproxy, testproxy.backends['a:6379'], "$3\r\nqux\r\n")
+        conn.sock.send.assert_not_called()
+        redis_input(testproxy, testproxy.backends['b:6379'], "$-1\r\n")
+        conn.sock.send.assert_called_once_with("Nothing exists for key zap in Redis\n\rqux\n\r")
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_replies_from_one_pass_sent_in_one_write(self, patched_redis, patched_client):
+        """Test that a client's replies from every backend that answered in
+            one pass of the loop go out in one write
+        """
+
+        sockets = {'a': mock.MagicMock(), 'b': mock.MagicMock()}
+        for sock in sockets.itervalues():
+            sock.send.side_effect = lambda data: len(data)
+        patched_redis.side_effect = lambda host, port, timeout: sockets[host]
+        testproxy = EventLoopRedisProxy(capacity=5, ttl=7200, backends=[('a', 6379), ('b', 6379)])
+        testproxy.poller = mock.MagicMock()
+        conn = self._client()
+        client_input(testproxy, conn, "GET zap\nGET baz\n")
+
+        testproxy._process_redis_input(testproxy.backends['b:6379'], "$1\r\nz\r\n")
+        testproxy._process_redis_input(testproxy.backends['a:6379'], "$1\r\nb\r\n")
+        conn.sock.send.assert_not_called()
+        testproxy._flush_ready_clients()
+        conn.sock.send.assert_called_once_with("z\n\rb\n\r")
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_key_ttl_waits_for_pttls(self, patched_redis, patched_client):
+        """Test that a fetch is answered once the PTTLs pipelined after it
+            are in, & its keys cached no longer than Redis keeps them
+        """
+
+        testproxy = EventLoopRedisProxy(capacity=5, ttl=7200, batch_size=8, key_ttl=True)
+        testproxy.poller = mock.MagicMock()
+        patched_redis.return_value.send.side_effect = lambda data: len(data)
+        conn = self._client()
+        client_input(testproxy, conn, "MGET baz blarf\n")
+        backend = testproxy.backends.values()[0]
+        testproxy._send_batch(backend)
+        testproxy._flush_redis(backend)
+        patched_redis.return_value.send.assert_called_once_with(
+            encode_command("MGET", "baz", "blarf") + encode_command("PTTL", "baz") + encode_command("PTTL", "blarf"),
+        )
+
+        redis_input(testproxy, backend, "*2\r\n$3\r\nqux\r\n$-1\r\n:5000\r\n")
+        conn.sock.send.assert_not_called()
+        redis_input(testproxy, backend, ":-2\r\n")
+        conn.sock.send.assert_called_with("qux\n\rNothing exists for key blarf in Redis\n\r")
+        key, val, ttl_ms = testproxy.cache.entries()[0]
+        self.assertEqual(key, 'baz')
+        self.assertTrue(4000 < ttl_ms <= 5000)
+        self.assertEqual(backend.inbuf, bytearray())
+
+    @mock.patch('proxy.RedisProxy._open_client_connection')
+    @mock.patch('proxy.RedisProxy._open_redis_connection')
+    def test_mget_reply_read_in_pieces(self, patched_redis, patched_client):
+        """Test that an MGET reply split across reads, behind a reply that
+            came whole, is answered once all of it is in
+        """
+
+        testproxy = EventLoopRedisProxy(capacity=5, ttl=7200, batch_size=8)
+        testproxy.poller = mock.MagicMock()
+        patched_redis.return_value.send.side_effect = lambda data: len(data)
+        backend = testproxy.backends.values()[0]
+        first, second = self._client(), self._client()
+        client_input(testproxy, first, "GET zip\n")
+        testproxy._send_batch(backend)
+        client_input(testproxy, second, "MGET baz blarf\n")
+        testproxy._send_batch(backend)
+
+        redis_input(testproxy, backend, "$1\r\nz\r\n*2\r\n$3\r\nq")
+        first.sock.send.assert_called_once_with("z\n\r")
+        redis_input(testproxy, backend, "ux\r\n$-1")
+        second.sock.send.assert_not_called()
+        redis_input(testproxy, backend, "\r\n")
+        second.sock.send.assert_called_once_with("qux\n\rNothing exists for key blarf in Redis\n\r")
+        self.assertEqual(backend.inbuf, bytearray())
+
+    def test_client_mget_waits_for_missing_keys(self):
+        """Test that a client MGET is answered once each missing key is back"""
+
+        conn = self._client()
+        client_input(self.testproxy, conn, "GET baz\n")
+        client_input(self.testproxy, conn, "*4\r\n$4\r\nMGET\r\n$3\r\nfoo\r\n$3\r\nbaz\r\n$3\r\nqux\r\n")
+        self.assertEqual(self.redis_socket.send.call_count, 2)
+
+        redis_input(self.testproxy, self.backend, "$1\r\na\r\n")
+        conn.sock.send.assert_called_once_with("a\n\r")
+        redis_input(self.testproxy, self.backend, "$1\r\nb\r\n")
+        conn.sock.send.assert_called_with("*3\r\n$3\r\nbar\r\n$1\r\na\r\n$1\r\nb\r\n")
+
+    def test_replies_keep_request_order(self):
+        """Test that a hit queued behind a miss waits for the miss's reply"""
+
+        conn = self._client()
+        client_input(self.testproxy, conn, "GET baz\nGET foo\n")
+        conn.sock.send.assert_not_called()
+
+        redis_input(self.testproxy, self.backend, "$3\r\nq")
+        conn.sock.send.assert_not_called()
+        redis_input(self.testproxy, self.backend, "ux\r\n")
+        conn.sock.send.assert_called_once_with("qux\n\rbar\n\r")
+
+    def test_pipelined_batch_sent_in_one_write(self):
+        """Test that a pipelined batch costs one Redis write & one client write"""
+
+        conn = self._client()
+        client_input(self.testproxy, 
+            conn,
+            "*2\r\n$3\r\nGET\r\n$3\r\nbaz\r\n*2\r\n$3\r\nGET\r\n$3\r\nqux\r\nGET foo\n",
+        )
+        self.assertEqual(self.redis_socket.send.call_count, 1)
+
+        redis_input(self.testproxy, self.backend, "$1\r\na\r\n$-1\r\n")
+        conn.sock.send.assert_called_once_with("$1\r\na\r\n$-1\r\nbar\n\r")
+
+    def test_partial_line_buffered(self):
+        """Test that a command split across reads is handled once complete"""
+
+        conn = self._client()
+        client_input(self.testproxy, conn, "GET f")
+        conn.sock.send.assert_not_called()
+        client_input(self.testproxy, conn, "oo\n")
+        conn.sock.send.assert_called_with("bar\n\r")
+
+    def test_metrics_recorded(self):
+        """Test that commands, bytes & hit/miss latency are counted, a miss
+            once its reply is in
+        """
+
+        conn = self._client()
+        client_input(self.testproxy, conn, "GET foo\nMGET foo baz\n")
+        metrics = self.testproxy.metrics
+        self.assertEqual(metrics.commands, 2)
+        self.assertEqual(metrics.bytes_in, 21)
+        self.assertEqual(metrics.hit_latency.count, 1)
+        self.assertEqual(metrics.miss_latency.count, 0)
+
+        redis_input(self.testproxy, self.backend, "$3\r\nqux\r\n")
+        self.assertEqual(metrics.miss_latency.count, 1)
+        self.assertEqual(metrics.bytes_out, len("bar\n\rbar\n\rqux\n\r"))
+
+    def test_write_answered_in_order(self):
+        """Test that a write is pipelined with the commands around it, & a
+            GET after it reads the value it wrote
+        """
+
+        self.testproxy.pass_writes = True
+        conn = self._client()
+        client_input(self.testproxy, conn, "SET foo new\nGET foo\n")
+        self.assertEqual(self.testproxy.cache.get('foo'), None)
+
+        redis_input(self.testproxy, self.backend, "+OK\r\n$3\r\nnew\r\n")
+        conn.sock.send.assert_called_once_with("OK\n\rnew\n\r")
+        self.assertEqual(self.testproxy.cache.get('foo'), 'new')
+
+    def test_fetch_sent_before_write_not_cached(self):
+        """Test that a GET in flight when a write to its key comes in is
+            answered with what it read, & a GET after the write gets its own
+            fetch, whose value is the one cached
+        """
+
+        self.testproxy.pass_writes = True
+        first, second, third = self._client(), self._client(), self._client()
+        client_input(self.testproxy, first, "GET baz\n")
+        client_input(self.testproxy, second, "SET baz new\n")
+        client_input(self.testproxy, third, "GET baz\n")
+        self.assertEqual(self.redis_socket.send.call_count, 3)
+
+        redis_input(self.testproxy, self.backend, "$3\r\nold\r\n+OK\r\n")
+        first.sock.send.assert_called_once_with("old\n\r")
+        second.sock.send.assert_called_once_with("OK\n\r")
+        self.assertIsNone(self.testproxy.cache.get('baz'))
+
+        redis_input(self.testproxy, self.backend, "$3\r\nnew\r\n")
+        third.sock.send.assert_called_once_with("new\n\r")
+        self.assertEqual(self.testproxy.cache.get('baz'), 'new')
+        self.assertEqual(self.testproxy.waiters, {})
+
+    def test_announced_key_detached(self):
+        """Test that a GET in flight when Redis announces a change to its key
+            isn't shared with later misses, nor cached
+        """
+
+        feed = InvalidationFeed('a:6379')
+        feed.conn = mock.MagicMock()
+        feed.conn.sock.recv.return_value = encode_reply(["message", TRACKING_CHANNEL, ["baz"]])
+        self.testproxy.feeds = [feed]
+        self.testproxy._feed_subscribed(feed)
+        first, second = self._client(), self._client()
+        client_input(self.testproxy, first, "GET baz\n")
+
+        self.testproxy._on_feed_readable(feed)
+        client_input(self.testproxy, second, "GET baz\n")
+        self.assertEqual(self.redis_socket.send.call_count, 2)
+
+        redis_input(self.testproxy, self.backend, "$3\r\nold\r\n$3\r\nnew\r\n")
+        first.sock.send.assert_called_once_with("old\n\r")
+        second.sock.send.assert_called_once_with("new\n\r")
+        self.assertEqual(self.testproxy.cache.get('baz'), 'new')
+
+    def test_info_answered_by_proxy(self):
+        conn = self._client()
+        client_input(self.testproxy, conn, "INFO clients\n")
+
+        conn.sock.send.assert_called_with("# Clients\r\nconnected_clients:0\r\ntotal_connections_received:0\r\n\n\r")
+        self.redis_socket.send.assert_not_called()
+
+
+class EventLoopLatencyTests(unittest.TestCase):
+    """Event-loop proxy serving a real socket, in front of a stand-in Redis"""
+
+    def setUp(self):
+        self.fake_redis = FakeRedis(make_data(100, (10, 10))).start()
+        self.addCleanup(self.fake_redis.stop)
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(5)
+        with mock.patch('proxy.RedisProxy._open_client_connection', return_value=listener):
+            self.testproxy = EventLoopRedisProxy(capacity=100, ttl=7200, backends=[self.fake_redis.server_address])
+        thread = threading.Thread(target=self.testproxy.run)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(thread.join, 5)
+        # Losing Redis ends the loop
+        backend = self.testproxy.backends.values()[0]
+        self.addCleanup(backend.sock.shutdown, socket.SHUT_RDWR)
+
+        sock = socket.create_connection(listener.getsockname())
+        sock.settimeout(5)
+        self.addCleanup(sock.close)
+        greeting = ""
+        while not greeting.endswith("Use QUIT to end connection\n"):
+            greeting += sock.recv(4096)
+        self.client = RedisConnection(sock)
+
+    def test_pipelined_hits_and_misses_not_delayed(self):
+        """Test that a hit answered in one pass & a miss answered in the
+            next aren't held up by Nagle's algorithm waiting on the
+            client's delayed ACK (about 40ms)
+        """
+
+        self.client.sendall(encode_command("GET", "key:1"))
+        self.client.read_reply()
+        rounds = 50
+        start = time.time()
+        for i in xrange(2, rounds + 2):
+            self.client.sendall(encode_command("GET", "key:1") + encode_command("GET", "key:%d" % i))
+            self.assertEqual(self.client.read_reply(), self.fake_redis.data['key:1'])
+            self.assertEqual(self.client.read_reply(), self.fake_redis.data['key:%d' % i])
+
+        self.assertLess((time.time() - start) / rounds, 0.01)
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,87 @@
+"""Runs a proxy in several worker processes accepting on the same port.
+
+Each worker binds its own listening socket with SO_REUSEPORT, and the
+kernel spreads incoming connections across them. Anything the workers
+share (i.e. a shmcache.SharedLRUCache) has to be created before
+fork_workers() is called; everything else, including Redis connections and
+threads, is made by each worker after the fork.
+"""
+
+import errno
+import os
+import signal
+import socket
+import traceback
+
+
+# Missing from the socket module of older Pythons; 15 on Linux
+SO_REUSEPORT = getattr(socket, 'SO_REUSEPORT', 15)
+
+
+def set_reuse_port(sock):
+    sock.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+
+
+def stop_on_sigterm():
+    """Makes SIGTERM raise KeyboardInterrupt, so the process shuts down
+        (e.g. saving its cache) as it does on CTRL-C
+    """
+
+    def interrupt(signum, frame):
+        raise KeyboardInterrupt
+    signal.signal(signal.SIGTERM, interrupt)
+
+
+def fork_workers(num_workers, serve):
+    """Forks num_workers processes, each running serve(worker_id), & waits
+        for them all to exit. CTRL-C reaches the workers directly (they're
+        in the same process group); on SIGTERM, the parent passes it on.
+        :param num_workers (int)
+        :param serve (callable): takes the worker's index, from 0
+        :returns: # of workers that exited with an error before SIGTERM
+    """
+
+    pids = {}
+    for worker_id in xrange(num_workers):
+        pid = os.fork()
+        if pid == 0:
+            status = 0
+            try:
+                serve(worker_id)
+            except (KeyboardInterrupt, SystemExit):
+                pass
+            except Exception:
+                traceback.print_exc()
+                status = 1
+            finally:
+                os._exit(status)
+        pids[pid] = worker_id
+    print "Started %s workers" % num_workers
+
+    stopping = []
+
+    def terminate(signum, frame):
+        stopping.append(signum)
+        for pid in pids:
+            os.kill(pid, signal.SIGTERM)
+    previous_handler = signal.signal(signal.SIGTERM, terminate)
+
+    failed = 0
+    try:
+        while pids:
+            try:
+                pid, status = os.wait()
+            except KeyboardInterrupt:
+                continue
+            except OSError, e:
+                # Interrupted by SIGTERM
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            worker_id = pids.pop(pid)
+            if status and not stopping:
+                print "Worker %s exited with status %s" % (worker_id, status)
+                failed += 1
+    finally:
+        signal.signal(signal.SIGTERM, previous_handler)
+    return failed